@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+"""
+热点路径基准测试
+
+使用合成DICOM检查（见 synthetic_study.py）和 dcm2niix 替身（见 stub_dcm2niix.py），
+对扫描、脱敏、元数据提取、汇总以及完整转换流程计时，结果写成JSON，便于跨版本对比。
+startup.* 项记录各入口脚本 --help / 空目录运行的启动耗时，以及启动期间加载了哪些重量级模块。
+
+用法:
+  python benchmarks/run_benchmarks.py [--series N] [--slices N] [--matrix N] [--scouts N]
+                                      [--repeat N] [--only 关键字]
+                                      [--output 结果.json] [--compare 旧结果.json]
+"""
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import statistics
+import subprocess
+import contextlib
+from pathlib import Path
+from datetime import datetime
+
+BENCH_DIR = Path(__file__).resolve().parent
+REPO_ROOT = BENCH_DIR.parent
+sys.path.insert(0, str(REPO_ROOT / 'src'))
+sys.path.insert(0, str(REPO_ROOT))
+sys.path.insert(0, str(BENCH_DIR))
+
+import synthetic_study  # noqa: E402
+
+# 入口脚本（启动耗时基准）
+ENTRY_POINTS = {
+    'max_layers': REPO_ROOT / 'src' / 'dcm2niix_batch_convert_max_layers.py',
+    '5mm': REPO_ROOT / 'src' / 'dcm2niix_batch_convert_anywhere_5mm.py',
+    'max_layers_safe': REPO_ROOT / 'src' / 'dcm2niix_batch_convert_max_layers_safe.py',
+    'convert_data_folder': REPO_ROOT / 'convert_data_folder.py',
+    'deid': REPO_ROOT / 'src' / 'dicom_deidentify_universal.py',
+    'metadata': REPO_ROOT / 'src' / 'extract_case_metadata_anywhere.py',
+}
+# 启动阶段不应加载的重量级模块
+HEAVY_MODULES = ('pandas', 'numpy', 'tkinter', 'pydicom')
+
+
+def make_stub_converter(work_dir):
+    """生成调用 stub_dcm2niix.py 的可执行启动器，替代 dcm2niix.exe"""
+    stub_script = BENCH_DIR / 'stub_dcm2niix.py'
+    if os.name == 'nt':
+        launcher = Path(work_dir) / 'dcm2niix_stub.bat'
+        launcher.write_text(f'@"{sys.executable}" "{stub_script}" %*\n', encoding='utf-8')
+    else:
+        launcher = Path(work_dir) / 'dcm2niix_stub'
+        launcher.write_text(f'#!/bin/sh\nexec "{sys.executable}" "{stub_script}" "$@"\n', encoding='utf-8')
+        launcher.chmod(0o755)
+    return launcher
+
+
+def time_call(func, repeat, setup=None):
+    """
+    重复执行 func，脚本的打印输出被丢弃
+
+    Returns:
+        tuple: (每次耗时列表（秒）, 最后一次的返回值)
+    """
+    timings = []
+    value = None
+    for _ in range(repeat):
+        arg = setup() if setup else None
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            value = func(arg) if setup else func()
+            timings.append(time.perf_counter() - start)
+    return timings, value
+
+
+class BenchContext:
+    """保存生成的数据集路径和临时工作目录"""
+
+    def __init__(self, root, args):
+        self.root = Path(root)
+        self.args = args
+        self.converter = make_stub_converter(self.root)
+        self._counter = 0
+
+        folder_cases = synthetic_study.generate_dataset(
+            self.root / 'folder_data', 1, args.series, args.slices, args.matrix, args.scouts, 'folder')
+        zip_cases = synthetic_study.generate_dataset(
+            self.root / 'zip_data', 1, args.series, args.slices, args.matrix, args.scouts, 'zip')
+        self.folder_case, self.stats = folder_cases[0]
+        self.zip_case = zip_cases[0][0]
+        self.dicom_files = sorted(str(p) for p in self.folder_case.rglob('*.dcm'))
+
+    def scratch(self, name):
+        """每次调用返回一个新的空目录"""
+        self._counter += 1
+        path = self.root / 'scratch' / f"{name}_{self._counter}"
+        path.mkdir(parents=True)
+        return path
+
+
+def run_script(script, *args):
+    """在子进程中运行入口脚本（输出丢弃）"""
+    subprocess.run([sys.executable, str(script), *args], stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL, cwd=str(REPO_ROOT))
+
+
+def loaded_heavy_modules(script, *args):
+    """以给定参数运行脚本，返回运行结束时已加载的重量级模块"""
+    probe = (
+        "import sys, os, json, runpy, contextlib, io\n"
+        f"script = {str(script)!r}\n"
+        f"sys.argv = [script] + {list(args)!r}\n"
+        "sys.path.insert(0, os.path.dirname(script))\n"
+        "with contextlib.redirect_stdout(io.StringIO()):\n"
+        "    try:\n"
+        "        runpy.run_path(script, run_name='__main__')\n"
+        "    except SystemExit:\n"
+        "        pass\n"
+        f"print(json.dumps(sorted(m for m in {HEAVY_MODULES!r} if m in sys.modules)))\n"
+    )
+    proc = subprocess.run([sys.executable, '-c', probe], capture_output=True, text=True, cwd=str(REPO_ROOT))
+    try:
+        return json.loads(proc.stdout.strip().splitlines()[-1])
+    except (IndexError, ValueError):
+        return None
+
+
+def build_startup_benchmarks(ctx):
+    """
+    入口脚本启动耗时：--help，以及三个转换脚本在空目录上的无操作运行
+
+    Returns:
+        dict: {名称: (函数, setup或None, 数据规模, 探测参数)}
+    """
+    empty_dir = ctx.scratch('empty')
+    benches = {}
+    for name, script in ENTRY_POINTS.items():
+        benches[f'startup.{name}.help'] = (
+            lambda script=script: run_script(script, '--help'), None, None, (script, '--help'))
+    for name in ('max_layers', '5mm', 'max_layers_safe'):
+        script = ENTRY_POINTS[name]
+        benches[f'startup.{name}.noop'] = (
+            lambda script=script: run_script(script, str(empty_dir)), None, None, (script, str(empty_dir)))
+    return benches
+
+
+def build_benchmarks(ctx):
+    """返回 {名称: (函数, setup或None, 数据规模)}"""
+    from dcmnii import core, walk, pixels, compress, nifti, zipindex, workqueue
+    import dcm2niix_batch_convert_max_layers as max_layers
+    import dcm2niix_batch_convert_anywhere_5mm as five_mm
+    import dcm2niix_batch_convert_max_layers_safe as safe
+    import dicom_deidentify_universal as deid
+    import extract_case_metadata_anywhere as metadata
+    import convert_data_folder
+
+    files = len(ctx.dicom_files)
+    nbytes = ctx.stats['bytes']
+    benches = {}
+
+    benches['scan.scan_dicom_series'] = (
+        lambda: core.scan_dicom_series(str(ctx.folder_case)), None, (files, nbytes))
+    # 只遍历+嗅探文件头（不解析DICOM），衡量目录遍历本身的开销
+    benches['walk.walk_files'] = (
+        lambda: walk.walk_files(ctx.folder_case, sniff=True), None, (files, nbytes))
+
+    # 每种选择策略单独计时（扫描结果预先生成）
+    with contextlib.redirect_stdout(io.StringIO()):
+        series_info = core.scan_dicom_series(str(ctx.folder_case))
+    for name in core.STRATEGIES:
+        strategy = core.get_strategy(name)
+        benches[f'select.{name}'] = (
+            lambda strategy=strategy: strategy.select(series_info), None, (files, nbytes))
+    # 读取选中堆栈的像素：内存映射逐层写入 vs 逐个 dcmread 取 pixel_array 再堆叠
+    stack_files = [record.file_path for record in core.get_strategy('max-layers').select(series_info)[0]['files']]
+
+    def pixel_array_stack():
+        import numpy as np
+        import pydicom
+        return np.stack([pydicom.dcmread(fp).pixel_array for fp in stack_files])
+    benches['pixels.pixel_array_stack'] = (pixel_array_stack, None, (len(stack_files), 0))
+    benches['pixels.load_volume'] = (
+        lambda: pixels.load_volume(stack_files), None, (len(stack_files), 0))
+    benches['deid.find_dicom_files'] = (
+        lambda: deid.find_dicom_files(str(ctx.folder_case)), None, (files, nbytes))
+
+    def run_deidentify(out_dir):
+        for fp in ctx.dicom_files:
+            deid.deidentify_dicom(fp, str(out_dir / os.path.basename(fp)), 'ANON_00001')
+    benches['deid.deidentify_dicom'] = (run_deidentify, lambda: ctx.scratch('deid'), (files, nbytes))
+
+    # 压缩包单遍扫描（嗅探 + 内存中解析文件头 + 只写出候选序列），对比上面解压后的目录扫描
+    benches['scan.scan_archive_series'] = (
+        lambda out_dir: core.scan_archive_series(ctx.zip_case, str(out_dir), verbose=False),
+        lambda: ctx.scratch('archive_scan'), (files, nbytes))
+
+    benches['metadata.process_zip_file_fast'] = (
+        lambda: metadata.process_zip_file_fast(ctx.zip_case), None, (files, nbytes))
+
+    # ZIP中央目录：每次重新解析 vs 从 .zip_index 读取（新建 ZipIndex，不含进程内缓存）
+    zip_stat = os.stat(ctx.zip_case)
+    zip_index_dir = ctx.scratch('zip_index')
+    zipindex.ZipIndex(zip_index_dir).get(ctx.zip_case)
+    benches['zip.directory.parse'] = (
+        lambda: zipindex.ZipDirectory.parse(ctx.zip_case, zip_stat), None, (files, 0))
+    benches['zip.directory.cached'] = (
+        lambda: zipindex.ZipIndex(zip_index_dir).get(ctx.zip_case).infolist(), None, (files, 0))
+
+    # 分布式队列：每个任务的领取（改名）+ 写报告分片 + 移到 done/ 的开销（本地磁盘，共享目录上会更高）
+    queue_tasks = 200
+
+    def queue_setup():
+        queue = workqueue.WorkQueue(ctx.scratch('queue'), worker_id='bench').start()
+        queue.acquire_seed()
+        queue.seed({'name': f"case{index:04d}"} for index in range(queue_tasks))
+        return queue
+
+    def drain_queue(queue):
+        for task in queue.tasks():
+            queue.complete(task, {'case_name': task.name, 'success': True})
+        queue.close()
+    benches['queue.claim_complete'] = (drain_queue, queue_setup, (queue_tasks, 0))
+
+    # 汇总阶段需要预先生成的JSON sidecar
+    sidecar_dir = ctx.scratch('sidecars')
+    with contextlib.redirect_stdout(io.StringIO()):
+        core.run_dcm2niix(str(ctx.folder_case), str(sidecar_dir), ctx.converter, ctx.folder_case.name)
+    json_files = sorted(sidecar_dir.glob('*.json'))
+    benches['summary.extract_json_metadata_to_csv_unified'] = (
+        lambda out_dir: core.extract_json_metadata_to_csv_unified(out_dir, json_files),
+        lambda: ctx.scratch('summary'), (len(json_files), 0))
+    # 重复汇总同一批sidecar：第一次解析后从 .sidecar_index.json 读取
+    cached_dir = ctx.scratch('summary_cached')
+    with contextlib.redirect_stdout(io.StringIO()):
+        core.extract_json_metadata_to_csv_unified(cached_dir, json_files)
+    benches['summary.extract_json_metadata_to_csv_unified.cached'] = (
+        lambda: core.extract_json_metadata_to_csv_unified(cached_dir, json_files), None, (len(json_files), 0))
+
+    # NIfTI压缩：单线程gzip（等同 dcm2niix -z y）vs 按块多线程gzip
+    import gzip
+    nii_gz = max(sidecar_dir.glob('*.nii.gz'), key=lambda p: p.stat().st_size)
+    nii_bytes = gzip.decompress(nii_gz.read_bytes())
+
+    def nii_setup():
+        work = ctx.scratch('gzip')
+        (work / 'volume.nii').write_bytes(nii_bytes)
+        return work / 'volume.nii'
+
+    def gzip_single(path):
+        with open(path, 'rb') as src, gzip.open(str(path) + '.gz', 'wb', compresslevel=compress.DEFAULT_LEVEL) as dst:
+            shutil.copyfileobj(src, dst, compress.BLOCK_SIZE)
+    benches['compress.gzip_single'] = (gzip_single, nii_setup, (1, len(nii_bytes)))
+    benches['compress.parallel_gzip'] = (
+        lambda path: compress.parallel_gzip(path), nii_setup, (1, len(nii_bytes)))
+
+    # 下游读取一层：.nii.gz 需整体解压，.nii 直接映射，.nii.zst 只解压所在帧
+    reader_dir = ctx.scratch('nifti_formats')
+    readers = {'gz': nii_gz, 'nii': reader_dir / 'volume.nii'}
+    readers['nii'].write_bytes(nii_bytes)
+    try:
+        import zstandard  # noqa: F401
+        (reader_dir / 'zvolume.nii').write_bytes(nii_bytes)
+        readers['zst'] = compress.seekable_zstd(reader_dir / 'zvolume.nii')
+    except ImportError:
+        pass  # 未安装可选依赖 zstandard 时跳过 zst
+
+    def read_middle_slice(path):
+        with nifti.open_nifti(path) as volume:
+            return volume.slice(volume.slice_count // 2).sum()
+    for fmt, path in readers.items():
+        benches[f'nifti.slice.{fmt}'] = (lambda path=path: read_middle_slice(path), None, (1, 0))
+
+    def pipeline_setup():
+        work = ctx.scratch('pipeline')
+        (work / 'temp').mkdir()
+        (work / 'out').mkdir()
+        return work
+
+    benches['pipeline.max_layers.zip'] = (
+        lambda w: max_layers.process_zip_to_nifti_smart(ctx.zip_case, str(w / 'temp'), w / 'out', ctx.converter),
+        pipeline_setup, (files, nbytes))
+    benches['pipeline.max_layers.folder'] = (
+        lambda w: max_layers.process_dicom_folder_to_nifti_smart(ctx.folder_case, w / 'out', ctx.converter),
+        pipeline_setup, (files, nbytes))
+    benches['pipeline.5mm.zip'] = (
+        lambda w: five_mm.process_zip_to_nifti_smart(ctx.zip_case, str(w / 'temp'), w / 'out', ctx.converter),
+        pipeline_setup, (files, nbytes))
+    benches['pipeline.max_layers_safe.folder'] = (
+        lambda w: safe.safe_convert_folder(ctx.folder_case, w / 'out', ctx.converter, 1),
+        pipeline_setup, (files, nbytes))
+    benches['pipeline.convert_data_folder.zip'] = (
+        lambda w: convert_data_folder.process_zip_file(ctx.zip_case, ctx.converter, w / 'out', [], 1),
+        pipeline_setup, (files, nbytes))
+    return benches
+
+
+def summarize(timings, scale, value):
+    median = statistics.median(timings)
+    result = {
+        'runs': timings,
+        'min': min(timings),
+        'median': median,
+        'mean': statistics.mean(timings),
+    }
+    # 流程函数返回结果字典，记录是否成功，避免把失败的快速返回误当作性能提升
+    if isinstance(value, dict) and 'success' in value:
+        result['success'] = bool(value['success'])
+        if not value['success']:
+            result['error'] = str(value.get('error', ''))[:500]
+    if scale and median > 0:
+        files, nbytes = scale
+        result['files_per_sec'] = files / median
+        result['mb_per_sec'] = nbytes / (1024 * 1024) / median
+    return result
+
+
+def git_revision():
+    try:
+        proc = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT,
+                              capture_output=True, text=True)
+        return proc.stdout.strip() or None
+    except Exception:
+        return None
+
+
+def print_comparison(results, baseline_path):
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f).get('results', {})
+    print(f"\n{'benchmark':<48}{'baseline':>12}{'current':>12}{'ratio':>8}")
+    for name, res in results.items():
+        old = baseline.get(name)
+        if not old:
+            print(f"{name:<48}{'-':>12}{res['median']:>12.4f}{'-':>8}")
+            continue
+        ratio = res['median'] / old['median'] if old['median'] else float('nan')
+        print(f"{name:<48}{old['median']:>12.4f}{res['median']:>12.4f}{ratio:>8.2f}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='DCM-Nii 热点路径基准测试')
+    parser.add_argument('--series', type=int, default=3, help='每个病例的序列数（默认: 3）')
+    parser.add_argument('--slices', type=int, default=64, help='每个序列的层数（默认: 64）')
+    parser.add_argument('--matrix', type=int, default=256, help='矩阵大小（默认: 256）')
+    parser.add_argument('--scouts', type=int, default=1, help='定位像序列数（默认: 1）')
+    parser.add_argument('--repeat', type=int, default=3, help='每项重复次数（默认: 3）')
+    parser.add_argument('--only', default=None, help='只运行名称包含该关键字的基准')
+    parser.add_argument('--output', default=None, help='结果JSON路径（默认: benchmarks/results/bench_<时间>.json）')
+    parser.add_argument('--compare', default=None, help='与之前的结果JSON对比')
+    parser.add_argument('--keep-data', action='store_true', help='保留生成的合成数据（调试用）')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    work_root = tempfile.mkdtemp(prefix='dcmnii_bench_')
+    try:
+        print(f"生成合成数据: {args.series} 序列 x {args.slices} 层, 矩阵 {args.matrix}, 定位像 {args.scouts}")
+        ctx = BenchContext(work_root, args)
+        benches = build_benchmarks(ctx)
+        startup_benches = build_startup_benchmarks(ctx)
+
+        results = {}
+        for name, (func, setup, scale) in benches.items():
+            if args.only and args.only not in name:
+                continue
+            timings, value = time_call(func, args.repeat, setup)
+            results[name] = summarize(timings, scale, value)
+            status = '' if results[name].get('success', True) else f"  ✗ {results[name]['error'][:80]}"
+            print(f"  {name:<48} median {results[name]['median']:.4f}s{status}")
+
+        for name, (func, setup, scale, probe_args) in startup_benches.items():
+            if args.only and args.only not in name:
+                continue
+            timings, value = time_call(func, args.repeat, setup)
+            results[name] = summarize(timings, scale, value)
+            heavy = loaded_heavy_modules(*probe_args)
+            results[name]['heavy_modules'] = heavy
+            print(f"  {name:<48} median {results[name]['median']:.4f}s  heavy: {', '.join(heavy or []) or '-'}")
+    finally:
+        if args.keep_data:
+            print(f"合成数据保留在: {work_root}")
+        else:
+            shutil.rmtree(work_root, ignore_errors=True)
+
+    report = {
+        'timestamp': datetime.now().isoformat(),
+        'git_revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': {
+            'series': args.series,
+            'slices': args.slices,
+            'matrix': args.matrix,
+            'scouts': args.scouts,
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+    if args.output:
+        output_path = Path(args.output)
+    else:
+        output_path = BENCH_DIR / 'results' / f"bench_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n✓ 结果已保存: {output_path}")
+
+    if args.compare:
+        print_comparison(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+dcm2niix 替身（仅供基准测试使用）
+
+接受与 dcm2niix 相同的常用参数（-f -o -z -b -v），按 SeriesInstanceUID 分组，
+为每个序列写出一个 NIfTI-1 文件（像素数据取自DICOM）和一个JSON sidecar。
+这样基准测试可以在没有 dcm2niix.exe 的机器上覆盖完整流程，
+且输出体积、压缩开销与真实转换同一量级。
+
+用法:
+  python benchmarks/stub_dcm2niix.py -f <格式> -o <输出目录> -z y|n [-1..-9] -b y [-v N] <输入目录>
+"""
+import os
+import sys
+import gzip
+import json
+import struct
+import argparse
+from collections import defaultdict
+
+import pydicom
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='dcm2niix stub for benchmarks')
+    parser.add_argument('-f', dest='filename_format', default='%i_%s_%p')
+    parser.add_argument('-o', dest='output_dir', required=True)
+    parser.add_argument('-z', dest='compress', default='y')
+    parser.add_argument('-b', dest='bids', default='y')
+    for level in range(1, 10):
+        parser.add_argument(f'-{level}', dest='level', action='store_const', const=level)
+    parser.add_argument('-v', dest='verbose', default='0')
+    parser.add_argument('input_dir')
+    return parser.parse_args(argv)
+
+
+def nifti1_header(columns, rows, slices, pixel_spacing, thickness):
+    """构造最小的 NIfTI-1 头（348字节 + 4字节扩展标记），数据类型 int16"""
+    header = bytearray(348)
+    struct.pack_into('<i', header, 0, 348)
+    struct.pack_into('<8h', header, 40, 3, columns, rows, slices, 1, 1, 1, 1)
+    struct.pack_into('<h', header, 70, 4)     # datatype: DT_INT16
+    struct.pack_into('<h', header, 72, 16)    # bitpix
+    struct.pack_into('<8f', header, 76, 1.0, pixel_spacing, pixel_spacing, thickness, 1, 1, 1, 1)
+    struct.pack_into('<f', header, 108, 352.0)  # vox_offset
+    struct.pack_into('<f', header, 112, 1.0)    # scl_slope
+    header[344:348] = b'n+1\x00'
+    return bytes(header) + b'\x00\x00\x00\x00'
+
+
+def sanitize(value):
+    return ''.join(c if c.isalnum() or c in '-.' else '_' for c in str(value)) or 'NA'
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    series = defaultdict(list)
+    for root, dirs, files in os.walk(args.input_dir):
+        for fn in files:
+            try:
+                ds = pydicom.dcmread(os.path.join(root, fn))
+            except Exception:
+                continue
+            if 'PixelData' not in ds:
+                continue
+            series[str(getattr(ds, 'SeriesInstanceUID', ''))].append(ds)
+
+    if not series:
+        sys.stderr.write('Error: No valid DICOM images were found\n')
+        return 2
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    used_names = set()
+    for datasets in series.values():
+        datasets.sort(key=lambda d: float(getattr(d, 'ImagePositionPatient', [0, 0, 0])[2]))
+        first = datasets[0]
+        name = (args.filename_format
+                .replace('%i', sanitize(getattr(first, 'PatientID', '')))
+                .replace('%s', sanitize(getattr(first, 'SeriesNumber', '')))
+                .replace('%p', sanitize(getattr(first, 'ProtocolName', ''))))
+        base = name
+        suffix = 1
+        while base in used_names:
+            suffix += 1
+            base = f"{name}_{suffix}"
+        used_names.add(base)
+
+        spacing = float(getattr(first, 'PixelSpacing', [1.0, 1.0])[0])
+        thickness = float(getattr(first, 'SliceThickness', 1.0) or 1.0)
+        header = nifti1_header(first.Columns, first.Rows, len(datasets), spacing, thickness)
+        if args.compress == 'n':
+            nii_path = os.path.join(args.output_dir, base + '.nii')
+            opener = open
+        else:
+            nii_path = os.path.join(args.output_dir, base + '.nii.gz')
+            opener = lambda path, mode: gzip.open(path, mode, compresslevel=args.level or 6)
+        with opener(nii_path, 'wb') as f:
+            f.write(header)
+            for ds in datasets:
+                f.write(ds.PixelData)
+
+        if args.bids == 'y':
+            sidecar = {
+                'Modality': str(getattr(first, 'Modality', '')),
+                'Manufacturer': str(getattr(first, 'Manufacturer', '')),
+                'ManufacturerModelName': str(getattr(first, 'ManufacturerModelName', '')),
+                'InstitutionName': str(getattr(first, 'InstitutionName', '')),
+                'StudyDescription': str(getattr(first, 'StudyDescription', '')),
+                'SeriesDescription': str(getattr(first, 'SeriesDescription', '')),
+                'ProtocolName': str(getattr(first, 'ProtocolName', '')),
+                'SeriesNumber': int(getattr(first, 'SeriesNumber', 0) or 0),
+                'SliceThickness': thickness,
+                'ImageOrientationPatientDICOM': [float(v) for v in getattr(first, 'ImageOrientationPatient', [])],
+                'ConversionSoftware': 'stub_dcm2niix',
+                'ConversionSoftwareVersion': '0.0',
+            }
+            with open(os.path.join(args.output_dir, base + '.json'), 'w', encoding='utf-8') as f:
+                json.dump(sidecar, f, indent=2)
+        print(f"Convert {len(datasets)} DICOM as {nii_path}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+合成DICOM检查生成器（供基准测试使用）
+
+按参数生成一个或多个病例：
+- 可配置序列数、每个序列的层数、矩阵大小、定位像(scout)数量
+- 输出为DICOM文件夹或ZIP压缩包
+
+用法:
+  python benchmarks/synthetic_study.py <输出目录> [--cases N] [--series N] [--slices N]
+                                       [--matrix N] [--scouts N] [--layout folder|zip]
+"""
+import os
+import sys
+import shutil
+import zipfile
+import argparse
+from pathlib import Path
+
+import numpy as np
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, CTImageStorage, generate_uid
+
+# 序列厚度按顺序循环使用，第一个主序列为5mm，保证5mm筛选版也能选中序列
+SERIES_THICKNESSES = [5.0, 1.0, 2.0, 3.0]
+
+
+def build_slice(patient_id, study_uid, series_uid, series_number, description,
+                instance_number, thickness, matrix, pixel_value):
+    """构造一个CT切片数据集"""
+    sop_uid = generate_uid()
+
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = CTImageStorage
+    meta.MediaStorageSOPInstanceUID = sop_uid
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.SOPClassUID = CTImageStorage
+    ds.SOPInstanceUID = sop_uid
+    ds.PatientID = patient_id
+    ds.PatientName = f"SYNTH^{patient_id}"
+    ds.PatientBirthDate = '19700101'
+    ds.PatientSex = 'O'
+    ds.PatientAge = '055Y'
+    ds.StudyDate = '20250101'
+    ds.StudyTime = '120000'
+    ds.StudyInstanceUID = study_uid
+    ds.StudyDescription = 'SYNTHETIC CHEST'
+    ds.SeriesInstanceUID = series_uid
+    ds.SeriesNumber = series_number
+    ds.SeriesDescription = description
+    ds.ProtocolName = description
+    ds.Modality = 'CT'
+    ds.Manufacturer = 'SYNTH'
+    ds.ManufacturerModelName = 'BENCH'
+    ds.InstitutionName = 'BENCHMARK'
+    ds.BodyPartExamined = 'CHEST'
+    ds.InstanceNumber = instance_number
+    ds.AcquisitionNumber = 1
+    ds.SliceThickness = thickness
+    ds.PixelSpacing = [0.7, 0.7]
+    ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    ds.ImagePositionPatient = [0.0, 0.0, float(instance_number * thickness)]
+    ds.SliceLocation = float(instance_number * thickness)
+    ds.Rows = matrix
+    ds.Columns = matrix
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 1
+    ds.RescaleIntercept = -1024
+    ds.RescaleSlope = 1
+    ds.PixelData = np.full((matrix, matrix), pixel_value, dtype=np.int16).tobytes()
+    return ds
+
+
+def write_dataset(ds, path):
+    try:
+        ds.save_as(path, enforce_file_format=True)
+    except TypeError:
+        # 兼容旧版pydicom（无 enforce_file_format 参数）
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+        ds.save_as(path, write_like_original=False)
+
+
+def generate_case_folder(case_dir, patient_id, series=3, slices=64, matrix=256, scouts=1):
+    """
+    在 case_dir 下生成一个病例的DICOM文件
+
+    Returns:
+        dict: 生成统计（文件数、字节数）
+    """
+    os.makedirs(case_dir, exist_ok=True)
+    study_uid = generate_uid()
+    file_count = 0
+    total_bytes = 0
+
+    series_specs = []
+    for s in range(series):
+        thickness = SERIES_THICKNESSES[s % len(SERIES_THICKNESSES)]
+        series_specs.append((100 + s + 1, f"CHEST {thickness:g}mm", slices, thickness, matrix))
+    for s in range(scouts):
+        series_specs.append((s + 1, 'TOPOGRAM', 1, 1.0, matrix))
+
+    for series_number, description, slice_count, thickness, size in series_specs:
+        series_uid = generate_uid()
+        series_dir = os.path.join(case_dir, f"S{series_number:04d}")
+        os.makedirs(series_dir, exist_ok=True)
+        for i in range(1, slice_count + 1):
+            ds = build_slice(patient_id, study_uid, series_uid, series_number, description,
+                             i, thickness, size, pixel_value=i % 1000)
+            path = os.path.join(series_dir, f"IM{i:05d}.dcm")
+            write_dataset(ds, path)
+            file_count += 1
+            total_bytes += os.path.getsize(path)
+
+    return {'files': file_count, 'bytes': total_bytes}
+
+
+def generate_dataset(output_dir, cases=1, series=3, slices=64, matrix=256, scouts=1, layout='folder'):
+    """
+    生成多个病例，layout为 'folder' 时每个病例一个文件夹，为 'zip' 时每个病例一个ZIP
+
+    Returns:
+        list: [(case_path, stats), ...]
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    generated = []
+    for idx in range(1, cases + 1):
+        case_name = f"dicom_{idx:05d}"
+        patient_id = f"P{idx:05d}"
+        case_dir = output_dir / case_name
+        stats = generate_case_folder(str(case_dir), patient_id, series, slices, matrix, scouts)
+        if layout == 'zip':
+            zip_path = output_dir / f"{case_name}.zip"
+            with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_STORED) as zf:
+                for root, dirs, files in os.walk(case_dir):
+                    for fn in files:
+                        fp = os.path.join(root, fn)
+                        zf.write(fp, os.path.relpath(fp, output_dir))
+            shutil.rmtree(case_dir)
+            generated.append((zip_path, stats))
+        else:
+            generated.append((case_dir, stats))
+    return generated
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='生成合成DICOM检查用于基准测试')
+    parser.add_argument('output_dir', help='输出目录')
+    parser.add_argument('--cases', type=int, default=1, help='病例数（默认: 1）')
+    parser.add_argument('--series', type=int, default=3, help='每个病例的序列数（默认: 3）')
+    parser.add_argument('--slices', type=int, default=64, help='每个序列的层数（默认: 64）')
+    parser.add_argument('--matrix', type=int, default=256, help='矩阵大小（默认: 256）')
+    parser.add_argument('--scouts', type=int, default=1, help='定位像序列数（默认: 1）')
+    parser.add_argument('--layout', choices=['folder', 'zip'], default='folder', help='输出形式（默认: folder）')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    generated = generate_dataset(args.output_dir, args.cases, args.series, args.slices,
+                                 args.matrix, args.scouts, args.layout)
+    for path, stats in generated:
+        print(f"{path}: {stats['files']} files, {stats['bytes'] / (1024 * 1024):.1f} MB")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -95,6 +95,8 @@ $PthFile = Get-ChildItem -Path $PythonEmbedDir -Filter "*._pth" | Select-Object
 if ($PthFile) {
     $PthContent = Get-Content $PthFile.FullName
     $PthContent = $PthContent -replace "#import site", "import site"
+    # Embedded Python ignores the script directory; add src so the dcmnii package is importable
+    $PthContent += "..\src"
     $PthContent | Set-Content $PthFile.FullName
     Write-Host "  [OK] Enabled site-packages" -ForegroundColor Green
 }
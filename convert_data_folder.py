@@ -5,123 +5,31 @@
 """
 import os
 import sys
-import zipfile
 import tempfile
 import shutil
-import subprocess
-import pydicom
-import pandas as pd
 from pathlib import Path
-import json
 from datetime import datetime
-from collections import defaultdict
 
+sys.path.insert(0, str(Path(__file__).parent / "src"))
+from dcmnii.stages import StageTimer, print_stage_summary, total_size
+from dcmnii.profiling import CaseProfiler, add_profile_argument, profile_dir
+from dcmnii.compress import add_output_arguments, output_options_from_args
+from dcmnii.progress import add_progress_arguments, progress_from_args, case_io
+from dcmnii.metrics import add_metrics_arguments, metrics_from_args
+from dcmnii.report import ReportWriter
+from dcmnii.zipindex import ZIP_INDEX_DIR_NAME, configure_zip_cache
+from dcmnii.archive import archive_stem, find_archives
+from dcmnii.core import (MaxLayersStrategy, scan_archive_series, create_series_directory,
+                         run_dcm2niix, find_dcm2niix)
 
-def analyze_dicom_series(extract_path):
-    """分析DICOM序列，选择最佳序列（按层数优先）"""
-    series_info = defaultdict(list)
-    
-    print("  扫描DICOM文件...")
-    for root, dirs, files in os.walk(extract_path):
-        for file in files:
-            file_path = os.path.join(root, file)
-            try:
-                ds = pydicom.dcmread(file_path, stop_before_pixels=True)
-                series_uid = getattr(ds, 'SeriesInstanceUID', 'Unknown')
-                series_number = getattr(ds, 'SeriesNumber', 0)
-                series_description = getattr(ds, 'SeriesDescription', 'Unknown')
-                modality = getattr(ds, 'Modality', 'Unknown')
-                rows = getattr(ds, 'Rows', 0)
-                columns = getattr(ds, 'Columns', 0)
-                
-                series_info[series_uid].append({
-                    'file_path': file_path,
-                    'series_number': series_number,
-                    'series_description': str(series_description),
-                    'modality': str(modality),
-                    'rows': rows,
-                    'columns': columns,
-                })
-            except Exception as e:
-                continue
-    
-    if not series_info:
-        return None, "未找到有效的DICOM文件"
-    
-    # 选择最佳序列（按层数、像素面积、模态优先级排序）
-    best_series = None
-    best_key = (-1, -1, -1, -1)
-    
-    for series_uid, files in series_info.items():
-        if not files:
-            continue
-        
-        file_count = len(files)
-        first_file = files[0]
-        pixel_area = max(first_file['rows'], 0) * max(first_file['columns'], 0)
-        modality_priority = 1 if first_file['modality'] == 'CT' else 0
-        series_number = first_file.get('series_number', 0) or 0
-        
-        current_key = (file_count, pixel_area, modality_priority, series_number)
-        
-        if current_key > best_key:
-            best_key = current_key
-            best_series = {
-                'series_uid': series_uid,
-                'files': files,
-                'file_count': file_count,
-                'description': first_file['series_description'],
-                'series_number': first_file['series_number'],
-                'modality': first_file['modality'],
-            }
-    
-    if best_series:
-        msg = f"选择序列: {best_series['description']} ({best_series['file_count']} 层)"
-        return best_series, msg
-    else:
-        return None, "未找到合适的序列"
-
-
-def create_series_directory(series_info, temp_base_dir, case_index):
-    """创建临时目录并复制选定序列的文件"""
-    # 使用简单的索引命名避免中文路径问题
-    series_dir = os.path.join(temp_base_dir, f"case_{case_index}_series")
-    os.makedirs(series_dir, exist_ok=True)
-    
-    for file_info in series_info['files']:
-        src_path = file_info['file_path']
-        dst_path = os.path.join(series_dir, os.path.basename(src_path))
-        shutil.copy2(src_path, dst_path)
-    
-    return series_dir
-
-
-def run_dcm2niix(input_dir, output_dir, dcm2niix_path, case_name):
-    """运行dcm2niix转换"""
-    try:
-        cmd = [
-            str(dcm2niix_path),
-            "-f", f"{case_name}_%i_%s_%p",
-            "-o", str(output_dir),
-            "-z", "y",
-            "-b", "y",
-            "-v", "0",
-            str(input_dir)
-        ]
-        
-        result = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8')
-        
-        if result.returncode == 0:
-            return True, result.stdout
-        else:
-            return False, result.stderr
-            
-    except Exception as e:
-        return False, str(e)
+# 自动选择最佳序列（按层数优先）
+SELECTION_STRATEGY = MaxLayersStrategy()
 
 
 def extract_metadata_from_dicom(dicom_file_path):
     """从DICOM文件提取元数据"""
+    import pydicom
+    
     try:
         ds = pydicom.dcmread(dicom_file_path, stop_before_pixels=True)
         
@@ -147,56 +55,86 @@ def extract_metadata_from_dicom(dicom_file_path):
         return None
 
 
-def process_zip_file(zip_path, dcm2niix_path, output_dir, metadata_list, case_index):
-    """处理单个ZIP文件"""
-    case_name = zip_path.stem
+def process_zip_file(zip_path, dcm2niix_path, output_dir, metadata_list, case_index, stage_records=None,
+                     output_options=None):
+    """
+    处理单个压缩包（ZIP / tar / tar.gz / tar.zst）
+    
+    stage_records: 可选列表，传入时追加该case的分阶段计时记录
+    output_options: NIfTI输出设置（OutputOptions），默认多线程gzip
+    """
+    case_name = archive_stem(zip_path)
     print(f"\n{'='*60}")
     print(f"处理: {case_name}")
     print('='*60)
     
     # 创建临时解压目录
     temp_extract_dir = tempfile.mkdtemp(prefix="dcm2niix_")
+    timer = StageTimer()
+    success = False
+    rationale = None
+    output = None
+    error = None
     
     try:
-        # 解压ZIP
-        print(f"  解压ZIP文件...")
-        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            zip_ref.extractall(temp_extract_dir)
+        # 单遍读取压缩包并扫描DICOM文件（只写出DICOM文件）
+        print(f"  读取压缩包并扫描DICOM文件...")
+        with timer.stage('extract') as st:
+            all_series, scan_stats = scan_archive_series(zip_path, temp_extract_dir, SELECTION_STRATEGY.accept_header,
+                                                         verbose=False)
+            st.add(bytes_read=os.path.getsize(zip_path), bytes_written=scan_stats['bytes_written'],
+                   files=scan_stats['members'])
         
-        # 分析并选择最佳序列
-        series_info, message = analyze_dicom_series(temp_extract_dir)
-        print(f"  {message}")
+        # 选择最佳序列
+        with timer.stage('select'):
+            series_info, message = SELECTION_STRATEGY.select(all_series)
         
         if not series_info:
             print(f"  ✗ 跳过 - 未找到有效DICOM序列")
+            error = 'No valid DICOM series found'
             return False
+        print(f"  选择序列: {series_info['description']} ({series_info['file_count']} 层)")
+        rationale = series_info['rationale']
         
         # 创建序列专用目录（使用索引避免中文路径）
-        series_dir = create_series_directory(series_info, temp_extract_dir, case_index)
+        with timer.stage('stage') as st:
+            # 使用简单的索引命名避免中文路径问题
+            series_dir = create_series_directory(series_info, temp_extract_dir, f"case_{case_index}_series", link=True)
+            staged_bytes = sum(f['file_size'] for f in series_info['files'])
+            st.add(bytes_read=staged_bytes, files=series_info['file_count'])
         
         # 提取元数据
-        first_dicom = series_info['files'][0]['file_path']
-        metadata = extract_metadata_from_dicom(first_dicom)
+        with timer.stage('summarize') as st:
+            first_dicom = series_info['files'][0]['file_path']
+            metadata = extract_metadata_from_dicom(first_dicom)
         
-        if metadata:
-            metadata['CaseName'] = case_name
-            metadata['FileCount'] = series_info['file_count']
-            metadata['SeriesDescription_Selected'] = series_info['description']
-            metadata_list.append(metadata)
+            if metadata:
+                metadata['CaseName'] = case_name
+                metadata['FileCount'] = series_info['file_count']
+                metadata['SeriesDescription_Selected'] = series_info['description']
+                metadata_list.append(metadata)
+            st.add(files=1)
         
         # 运行dcm2niix转换
         print(f"  转换为NIfTI...")
-        success, output = run_dcm2niix(series_dir, output_dir, dcm2niix_path, case_name)
+        with timer.stage('convert') as st:
+            converted, output, produced = run_dcm2niix(series_dir, output_dir, dcm2niix_path, case_name,
+                                                       output_options=output_options, source=zip_path,
+                                                       selection=series_info)
+            st.add(bytes_read=staged_bytes, bytes_written=total_size(produced), files=len(produced))
         
-        if success:
+        if converted:
             print(f"  ✓ 转换成功")
+            success = True
             return True
         else:
             print(f"  ✗ 转换失败: {output}")
+            error = 'dcm2niix conversion failed'
             return False
             
     except Exception as e:
         print(f"  ✗ 处理失败: {str(e)}")
+        error = str(e)
         return False
         
     finally:
@@ -205,24 +143,44 @@ def process_zip_file(zip_path, dcm2niix_path, output_dir, metadata_list, case_in
             shutil.rmtree(temp_extract_dir)
         except Exception as e:
             print(f"  ⚠ 无法删除临时目录: {str(e)}")
+        if stage_records is not None:
+            stage_records.append({
+                'zip_file': case_name,
+                'success': success,
+                'selection_rationale': rationale,
+                'dcm2niix_output': output,  # 写报告时外置为case日志文件
+                'stage_timings': timer.as_dict(),
+                'processing_time': datetime.now().isoformat()
+            })
+            if error:
+                # 与转换脚本的报告一致，failed_cases 分类和 --metrics-file 的 category 标签按它归类
+                stage_records[-1]['error'] = error
+
+
+def parse_args():
+    """解析命令行参数"""
+    import argparse
+    parser = argparse.ArgumentParser(description='批量转换data目录下的DICOM ZIP文件到NIfTI格式')
+    add_profile_argument(parser)
+    add_output_arguments(parser)
+    add_progress_arguments(parser)
+    add_metrics_arguments(parser)
+    return parser.parse_args()
 
 
 def main():
     """主函数"""
+    args = parse_args()
     # 设置路径
     base_dir = Path(__file__).parent
     data_dir = base_dir / "data"
     output_dir = base_dir / "output" / "nifti_files"
     
     # 查找dcm2niix
-    dcm2niix_path = base_dir / "dcm2niix.exe"
-    if not dcm2niix_path.exists():
-        alt_dcm2niix = base_dir / "tools" / "MRIcroGL" / "Resources" / "dcm2niix.exe"
-        if alt_dcm2niix.exists():
-            dcm2niix_path = alt_dcm2niix
-        else:
-            print("✗ 错误: 未找到 dcm2niix.exe")
-            return
+    dcm2niix_path = find_dcm2niix(base_dir)
+    if not dcm2niix_path:
+        print("✗ 错误: 未找到 dcm2niix.exe")
+        return
     
     print(f"使用 dcm2niix: {dcm2niix_path}")
     
@@ -231,40 +189,71 @@ def main():
         print(f"✗ 错误: data目录不存在: {data_dir}")
         return
     
-    # 查找所有ZIP文件
-    zip_files = list(data_dir.glob("*.zip"))
+    # 查找所有压缩包
+    zip_files = find_archives(data_dir)  # ZIP / tar / tar.gz / tar.zst
     
     if not zip_files:
-        print(f"✗ 在 {data_dir} 中未找到ZIP文件")
+        print(f"✗ 在 {data_dir} 中未找到ZIP/tar压缩包")
         return
     
-    print(f"\n📋 找到 {len(zip_files)} 个ZIP文件:")
+    print(f"\n📋 找到 {len(zip_files)} 个压缩包:")
     for zip_file in zip_files:
         print(f"  - {zip_file.name}")
     
     # 创建输出目录
     output_dir.mkdir(parents=True, exist_ok=True)
+    configure_zip_cache(base_dir / "output" / ZIP_INDEX_DIR_NAME)
     
     # 处理每个ZIP文件
     metadata_list = []
+    stage_records = []
     success_count = 0
     
     start_time = datetime.now()
+    run_timestamp = start_time.strftime('%Y%m%d_%H%M%S')
+    profiler = CaseProfiler(args.profile, profile_dir(output_dir, run_timestamp))
+    output_options = output_options_from_args(args)
+    print(f"NIfTI压缩: {output_options.describe()}")
+    # 每个case完成即追加到 .jsonl 计时报告（崩溃不丢失），dcm2niix输出写到单独的case日志文件
+    report = ReportWriter(output_dir / f"conversion_report_{run_timestamp}.jsonl",
+                          log_dir=output_dir / f"conversion_logs_{run_timestamp}")
+    
+    zip_sizes = {zip_file: os.path.getsize(zip_file) for zip_file in zip_files}
+    progress = progress_from_args(args, total=len(zip_files), total_bytes=sum(zip_sizes.values()))
+    metrics = metrics_from_args(args, 'convert_data_folder', total=len(zip_files))
     
     for idx, zip_file in enumerate(zip_files, start=1):
-        if process_zip_file(zip_file, dcm2niix_path, output_dir, metadata_list, idx):
+        with profiler.case(archive_stem(zip_file)) as prof:
+            success = process_zip_file(zip_file, dcm2niix_path, output_dir, metadata_list, idx, stage_records,
+                                       output_options)
+        if prof:
+            stage_records[-1]['profile'] = prof
+        metrics.observe(stage_records[-1])
+        stage_records[-1] = report.write(stage_records[-1])
+        if success:
             success_count += 1
+        progress.case_done(archive_stem(zip_file), success, files=case_io(stage_records[-1])[0], nbytes=zip_sizes[zip_file])
+    progress.close()
+    metrics.close()
     
     end_time = datetime.now()
     duration = end_time - start_time
     
     # 保存元数据CSV
     if metadata_list:
+        import pandas as pd
         csv_path = output_dir / f"conversion_metadata_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
         df = pd.DataFrame(metadata_list)
         df.to_csv(csv_path, index=False, encoding='utf-8-sig')
         print(f"\n✓ 元数据已保存: {csv_path}")
     
+    # 把逐case追加的 .jsonl 压实为分阶段计时报告
+    report_path = report.close()
+    print(f"✓ 计时报告已保存: {report_path}")
+    
+    print_stage_summary([r['stage_timings'] for r in stage_records])
+    profiler.close()
+    
     # 统计信息
     print(f"\n{'='*60}")
     print(f"转换完成")
@@ -4,595 +4,156 @@
 """
 import os
 import sys
-import zipfile
-import tempfile
 import shutil
+import tempfile
 import subprocess
-import pydicom
-import pandas as pd
 from pathlib import Path
-import json
 from datetime import datetime
 from collections import defaultdict
-import tkinter as tk
-from tkinter import filedialog, messagebox
-
+from dcmnii.stages import StageTimer, print_stage_summary, total_size
+from dcmnii.profiling import CaseProfiler, add_profile_argument, profile_dir
+from dcmnii.compress import add_output_arguments, output_options_from_args
+from dcmnii.report import ReportWriter, ERROR_CATEGORIES, error_category, read_failed_cases
+from dcmnii.errors import (NoDicomError, ConverterError, error_from_exception, retry_case, retry_policies,
+                           add_retry_arguments)
+from dcmnii.metrics import add_metrics_arguments, metrics_from_args
+from dcmnii.progress import add_progress_arguments, progress_from_args, case_io
+from dcmnii.zipindex import ZIP_INDEX_DIR_NAME, configure_zip_cache
+from dcmnii.archive import archive_stem, find_archives
+from dcmnii.core import (ThicknessWindowStrategy, ScoredStrategy, scan_archive_series,
+                         create_series_directory, describe_stack, run_dcm2niix, keep_largest_nifti, find_dcm2niix,
+                         find_nifti_files, split_outputs, sidecar_path, extract_json_metadata_to_csv_unified)
 
-# ====== 辅助函数全部补充到此处 ======
-import_types = (os, sys, zipfile, tempfile, shutil, subprocess, pydicom, pd, Path, json, datetime, defaultdict)
+# 只在切片厚度4.5-5.5mm的序列中按评分选择
+SELECTION_STRATEGY = ThicknessWindowStrategy(low=4.5, high=5.5, inner=ScoredStrategy())
 
-def analyze_dicom_series(extract_path):
-    series_info = defaultdict(list)
-    for root, dirs, files in os.walk(extract_path):
-        for file in files:
-            file_path = os.path.join(root, file)
-            try:
-                ds = pydicom.dcmread(file_path, force=True)
-                series_uid = getattr(ds, 'SeriesInstanceUID', 'Unknown')
-                series_number = getattr(ds, 'SeriesNumber', 0)
-                series_description = getattr(ds, 'SeriesDescription', 'Unknown')
-                modality = getattr(ds, 'Modality', 'Unknown')
-                rows = getattr(ds, 'Rows', 0)
-                columns = getattr(ds, 'Columns', 0)
-                slice_thickness = getattr(ds, 'SliceThickness', None)
-                series_info[series_uid].append({
-                    'file_path': file_path,
-                    'series_number': series_number,
-                    'series_description': str(series_description),
-                    'modality': str(modality),
-                    'rows': rows,
-                    'columns': columns,
-                    'slice_thickness': slice_thickness,
-                    'file_size': os.path.getsize(file_path)
-                })
-            except Exception as e:
-                print(f"  ⚠ 跳过文件 {file}: {str(e)}")
-                continue
-    if not series_info:
-        return None, "No valid DICOM files found"
-    best_series = None
-    best_score = -1
-    for series_uid, files in series_info.items():
-        if not files:
-            continue
-        file_count = len(files)
-        first_file = files[0]
-        pixel_area = max(first_file['rows'], 0) * max(first_file['columns'], 0)
-        slice_thickness = first_file.get('slice_thickness', None)
-        
-        # 硬性过滤：只保留切片厚度在4.5-5.5mm范围内的序列
-        if slice_thickness is not None:
-            try:
-                thickness_value = float(slice_thickness)
-                if not (4.5 <= thickness_value <= 5.5):
-                    continue  # 跳过不符合厚度要求的序列
-            except (ValueError, TypeError) as e:
-                print(f"  ⚠ 无法解析切片厚度值 '{slice_thickness}': {str(e)}")
-                continue  # 无法解析厚度值，跳过该序列
-        else:
-            continue  # 没有厚度信息，跳过该序列
-        
-        score = 0
-        score += min(file_count * 2, 100)
-        if first_file['rows'] > 0 and first_file['columns'] > 0:
-            score += min((first_file['rows'] * first_file['columns']) / 1000, 50)
-        desc = first_file['series_description'].lower()
-        if any(keyword in desc for keyword in ['topogram', 'scout', 'localizer', 'overview']):
-            score -= 50
-        elif any(keyword in desc for keyword in ['chest', 'thorax', 'lung', 'helical']):
-            score += 30
-        if first_file['series_number'] > 100:
-            score += 10
-        if first_file['modality'] == 'CT':
-            score += 20
-        
-        if score > best_score:
-            best_score = score
-            best_series = {
-                'series_uid': series_uid,
-                'files': files,
-                'file_count': file_count,
-                'description': first_file['series_description'],
-                'series_number': first_file['series_number'],
-                'score': score,
-                'slice_count': file_count,
-                'pixel_area': pixel_area,
-                'slice_thickness': slice_thickness
-            }
-    
-    if best_series is None:
-        return None, "No series found with slice thickness in 4.5-5.5mm range"
-    return best_series, f"Selected series with score {best_score} and slice thickness {best_series['slice_thickness']}mm"
 
-def create_series_directory(series_info, temp_base_dir, case_name):
-    series_dir = os.path.join(temp_base_dir, f"{case_name}_main_series")
-    os.makedirs(series_dir, exist_ok=True)
-    for file_info in series_info['files']:
-        src_path = file_info['file_path']
-        dst_path = os.path.join(series_dir, os.path.basename(src_path))
-        shutil.copy2(src_path, dst_path)
-    return series_dir
+def process_zip_to_nifti_smart(zip_path, temp_dir, output_base_dir, dcm2niix_path, output_options=None,
+                               policies=None):
+    """转换一个压缩包；失败时按错误类别的重试策略（policies，默认 RETRY_POLICIES）重试"""
+    return retry_case(lambda: convert_zip_once(zip_path, temp_dir, output_base_dir, dcm2niix_path, output_options),
+                      policies)
 
-def keep_largest_nifti(case_output_dir, zip_name):
-    """
-    如果生成了多个NIfTI文件，只保留最大的那个，删除其他的
-    同时删除对应的JSON文件
-    """
-    nii_files = list(Path(case_output_dir).glob(f"{zip_name}_*.nii.gz"))
-    
-    if len(nii_files) <= 1:
-        return nii_files  # 只有1个或0个文件，不需要处理
-    
-    # 找到最大的文件
-    largest_file = max(nii_files, key=lambda f: f.stat().st_size)
-    files_to_delete = [f for f in nii_files if f != largest_file]
-    
-    deleted_count = 0
-    for nii_file in files_to_delete:
-        # 删除对应的JSON文件
-        json_file = nii_file.with_suffix('.json')
-        if json_file.exists():
-            json_file.unlink()
-            deleted_count += 1
-        # 删除NIfTI文件
-        nii_file.unlink()
-        deleted_count += 1
-    
-    if deleted_count > 0:
-        print(f"  🗑️  Removed {len(files_to_delete)} smaller NIfTI file(s), kept largest: {largest_file.name}")
-    
-    return [largest_file]
-
-def run_dcm2niix_smart(input_dir, output_dir, dcm2niix_path, case_name):
-    try:
-        cmd = [
-            str(dcm2niix_path),
-            "-f", f"{case_name}_%i_%s_%p",
-            "-o", str(output_dir),
-            "-z", "y",
-            "-b", "y",  # 生成JSON文件
-            "-v", "0",
-            str(input_dir)
-        ]
-        result = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8')
-        if result.returncode == 0:
-            return True, result.stdout
-        else:
-            return False, result.stderr
-    except Exception as e:
-        return False, str(e)
 
-def process_zip_to_nifti_smart(zip_path, temp_dir, output_base_dir, dcm2niix_path):
-    zip_name = Path(zip_path).stem
+def convert_zip_once(zip_path, temp_dir, output_base_dir, dcm2niix_path, output_options=None):
+    """转换一个压缩包（ZIP / tar / tar.gz / tar.zst，单次尝试），失败时结果带 error_code / error_stage"""
+    zip_name = archive_stem(zip_path)
     print(f"\nProcessing {zip_name}...")
+    timer = StageTimer()
     try:
         case_output_dir = output_base_dir
-        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            extract_path = os.path.join(temp_dir, zip_name)
-            zip_ref.extractall(extract_path)
-            print(f"  Analyzing DICOM series...")
-            best_series, analysis_msg = analyze_dicom_series(extract_path)
-            if not best_series:
-                result = {
-                    'zip_file': zip_name,
-                    'success': False,
-                    'error': analysis_msg,
-                    'processing_time': datetime.now().isoformat()
-                }
-                print(f"  ✗ No suitable series found: {analysis_msg}")
-                return result
-            print(f"  Selected: Series {best_series['series_number']} - {best_series['description']} ({best_series['file_count']} files)")
-            series_dir = create_series_directory(best_series, temp_dir, zip_name)
-            print(f"  Converting main series...")
-            success, output = run_dcm2niix_smart(series_dir, case_output_dir, dcm2niix_path, zip_name)
-            if success:
-                # 后处理：只保留最大的NIfTI文件
-                nii_files = keep_largest_nifti(case_output_dir, zip_name)
-                json_files = list(Path(case_output_dir).glob(f"{zip_name}_*.json"))
-                result = {
-                    'zip_file': zip_name,
-                    'success': True,
-                    'selected_series': {
-                        'series_number': best_series['series_number'],
-                        'description': best_series['description'],
-                        'file_count': best_series['file_count'],
-                        'score': best_series['score'],
-                        'slice_count': best_series['slice_count'],
-                        'pixel_area': best_series['pixel_area']
-                    },
-                    'nii_files': len(nii_files),
-                    'json_files': len(json_files),
-                    'output_dir': str(case_output_dir),
-                    'files_generated': [f.name for f in nii_files + json_files],
-                    'nii_file_paths': [str(f) for f in nii_files],
-                    'json_file_paths': [str(f) for f in json_files],
-                    'dcm2niix_output': output,
-                    'processing_time': datetime.now().isoformat()
-                }
-                print(f"  ✓ Success: Generated {len(nii_files)} NIfTI file(s)")
-                return result
-            else:
-                result = {
-                    'zip_file': zip_name,
-                    'success': False,
-                    'error': output,
-                    'processing_time': datetime.now().isoformat()
-                }
-                print(f"  ✗ Conversion failed: {output}")
-                return result
+        extract_path = os.path.join(temp_dir, zip_name)
+        series_dir = os.path.join(temp_dir, f"{zip_name}_main_series")
+        # 重试时先清掉上一次解压/暂存到一半的文件
+        for leftover in (extract_path, series_dir):
+            shutil.rmtree(leftover, ignore_errors=True)
+        print(f"  Reading archive and analyzing DICOM series...")
+        with timer.stage('extract') as st:
+            # 单遍读取（tar 流不能回头），只把候选序列的文件写到临时目录
+            series_info, scan_stats = scan_archive_series(zip_path, extract_path, SELECTION_STRATEGY.accept_header)
+            st.add(bytes_read=os.path.getsize(zip_path), bytes_written=scan_stats['bytes_written'],
+                   files=scan_stats['members'])
+        if scan_stats['rejected_series']:
+            print(f"  Skipped {scan_stats['rejected_series']} non-candidate series while reading")
+        with timer.stage('select'):
+            best_series, analysis_msg = SELECTION_STRATEGY.select(series_info)
+        if not best_series:
+            # 没有5mm序列时换一次也不会变，no_match_error 的类别不重试
+            raise (SELECTION_STRATEGY.no_match_error if scan_stats['dicom'] else NoDicomError)(analysis_msg)
+        print(f"  Selected: Series {best_series['series_number']} - {best_series['description']} ({best_series['file_count']} files)")
+        print(f"    Stack: {describe_stack(best_series)}")
+        with timer.stage('stage') as st:
+            series_dir = create_series_directory(best_series, temp_dir, f"{zip_name}_main_series", link=True)
+            staged_bytes = sum(f['file_size'] for f in best_series['files'])
+            st.add(bytes_read=staged_bytes, files=best_series['file_count'])
+        print(f"  Converting main series...")
+        with timer.stage('convert') as st:
+            success, output, outputs = run_dcm2niix(series_dir, case_output_dir, dcm2niix_path, zip_name,
+                                                    output_options=output_options, source=zip_path,
+                                                    selection=best_series)
+            produced_nii, json_files = split_outputs(outputs)
+            produced = produced_nii + json_files
+            st.add(bytes_read=staged_bytes, bytes_written=total_size(produced), files=len(produced))
+            if not success:
+                raise ConverterError(output)
+        # 兜底：转换前已只暂存选中的堆栈，dcm2niix仍输出多个NIfTI时才按大小保留一个
+        with timer.stage('postprocess') as st:
+            nii_files = keep_largest_nifti(produced_nii)
+            json_files = [f for f in json_files if f.exists()]
+            pruned = len(produced) - len(nii_files) - len(json_files)
+            st.add(files=pruned)
+        with timer.stage('summarize') as st:
+            st.add(files=len(nii_files) + len(json_files))
+            result = {
+                'zip_file': zip_name,
+                'success': True,
+                'selected_series': {
+                    'series_number': best_series['series_number'],
+                    'description': best_series['description'],
+                    'file_count': best_series['file_count'],
+                    'score': best_series['score'],
+                    'slice_count': best_series['slice_count'],
+                    'pixel_area': best_series['pixel_area'],
+                    'spacing_mm': best_series.get('spacing_mm'),
+                    'coverage_mm': best_series.get('coverage_mm'),
+                    'stack_count': best_series.get('stack_count', 1),
+                    'rationale': best_series['rationale'],
+                },
+                'pruned_outputs': pruned,
+                'nii_files': len(nii_files),
+                'json_files': len(json_files),
+                'output_dir': str(case_output_dir),
+                'files_generated': [f.name for f in nii_files + json_files],
+                'nii_file_paths': [str(f) for f in nii_files],
+                'json_file_paths': [str(f) for f in json_files],
+                'dcm2niix_output': output,
+            }
+        result['stage_timings'] = timer.as_dict()
+        result['processing_time'] = datetime.now().isoformat()
+        print(f"  ✓ Success: Generated {len(nii_files)} NIfTI file(s)")
+        return result
     except Exception as e:
+        error = error_from_exception(e, timer.current)
         result = {
             'zip_file': zip_name,
             'success': False,
-            'error': str(e),
+            **error.fields(),
+            'stage_timings': timer.as_dict(),
             'processing_time': datetime.now().isoformat()
         }
-        print(f"  ✗ Exception: {str(e)}")
+        print(f"  ✗ [{error.code}] {error.message}")
         return result
 
-def extract_json_metadata_to_csv(output_dir):
-    try:
-        print("  Scanning JSON files...")
-        json_files = [f for f in Path(output_dir).glob("*.json") if not f.name.startswith("smart_conversion_report")]
-        if not json_files:
-            print("  Warning: No JSON metadata files found")
-            return None, None
-        print(f"  Found {len(json_files)} JSON files to process...")
-        dicom_metadata_df = None
-        base_dir = Path(output_dir).parent.parent
-        metadata_dir = base_dir / "output"
-        dicom_csv_files = list(metadata_dir.glob("dicom_metadata_*.csv"))
-        if dicom_csv_files:
-            latest_dicom_csv = max(dicom_csv_files, key=lambda f: f.stat().st_mtime)
-            try:
-                dicom_metadata_df = pd.read_csv(latest_dicom_csv)
-                print(f"  Found DICOM metadata: {latest_dicom_csv.name}")
-            except Exception as e:
-                print(f"  Warning: Could not read DICOM metadata: {e}")
-        else:
-            print("  Warning: No DICOM metadata CSV found")
-        all_metadata = []
-        for json_file in json_files:
-            try:
-                parts = json_file.stem.split('_')
-                if len(parts) >= 4:
-                    case_name = parts[0] + '_' + parts[1]
-                    patient_id = parts[2]
-                    series_info = '_'.join(parts[3:])
-                else:
-                    case_name = json_file.stem
-                    patient_id = 'Unknown'
-                    series_info = 'Unknown'
-                with open(json_file, 'r', encoding='utf-8') as f:
-                    json_data = json.load(f)
-                dicom_info = {}
-                if dicom_metadata_df is not None and patient_id != 'Unknown':
-                    matching_rows = dicom_metadata_df[dicom_metadata_df['PatientID'].astype(str) == str(patient_id)]
-                    if not matching_rows.empty:
-                        dicom_row = matching_rows.iloc[0]
-                        dicom_info = {
-                            'PatientName': str(dicom_row.get('PatientName', 'Unknown')),
-                            'PatientBirthDate': str(dicom_row.get('PatientBirthDate', 'Unknown')),
-                            'PatientSex': str(dicom_row.get('PatientSex', 'Unknown')),
-                            'StudyDate': str(dicom_row.get('StudyDate', 'Unknown')),
-                            'StudyTime': str(dicom_row.get('StudyTime', 'Unknown')),
-                            'InstitutionName': str(dicom_row.get('InstitutionName', 'Unknown')),
-                        }
-                        try:
-                            if dicom_info['PatientBirthDate'] != 'Unknown' and dicom_info['StudyDate'] != 'Unknown':
-                                birth_date = dicom_info['PatientBirthDate']
-                                study_date = dicom_info['StudyDate']
-                                if len(birth_date) == 8 and len(study_date) == 8:
-                                    birth_year = int(birth_date[:4])
-                                    study_year = int(study_date[:4])
-                                    age = study_year - birth_year
-                                    dicom_info['PatientAge'] = str(age)
-                                else:
-                                    dicom_info['PatientAge'] = 'Unknown'
-                            else:
-                                dicom_info['PatientAge'] = 'Unknown'
-                        except Exception as e:
-                            print(f"  ⚠ 无法解析PatientAge: {str(e)}")
-                            dicom_info['PatientAge'] = 'Unknown'
-                metadata = {
-                    'FileName': json_file.name,
-                    'CaseName': case_name,
-                    'PatientID': patient_id,
-                    'SeriesInfo': series_info,
-                    'NIfTIFile': json_file.stem + '.nii.gz',
-                    'Modality': json_data.get('Modality', 'Unknown'),
-                    'StudyDate': dicom_info.get('StudyDate', json_data.get('StudyDate', 'Unknown')),
-                    'StudyTime': dicom_info.get('StudyTime', json_data.get('StudyTime', 'Unknown')),
-                    'StudyDescription': json_data.get('StudyDescription', 'Unknown'),
-                    'SeriesNumber': json_data.get('SeriesNumber', 'Unknown'),
-                    'SeriesDescription': json_data.get('SeriesDescription', 'Unknown'),
-                    'ProtocolName': json_data.get('ProtocolName', 'Unknown'),
-                    'PatientName': dicom_info.get('PatientName', json_data.get('PatientName', 'Unknown')),
-                    'PatientBirthDate': dicom_info.get('PatientBirthDate', json_data.get('PatientBirthDate', 'Unknown')),
-                    'PatientSex': dicom_info.get('PatientSex', json_data.get('PatientSex', 'Unknown')),
-                    'PatientAge': dicom_info.get('PatientAge', json_data.get('PatientAge', 'Unknown')),
-                    'SliceThickness': json_data.get('SliceThickness', 'Unknown'),
-                    'SpacingBetweenSlices': json_data.get('SpacingBetweenSlices', 'Unknown'),
-                    'PixelSpacing': str(json_data.get('PixelSpacing', 'Unknown')),
-                    'ImageOrientationPatientDICOM': str(json_data.get('ImageOrientationPatientDICOM', 'Unknown')),
-                    'RepetitionTime': json_data.get('RepetitionTime', 'Unknown'),
-                    'EchoTime': json_data.get('EchoTime', 'Unknown'),
-                    'FlipAngle': json_data.get('FlipAngle', 'Unknown'),
-                    'AcquisitionMatrix': str(json_data.get('AcquisitionMatrix', 'Unknown')),
-                    'Manufacturer': json_data.get('Manufacturer', 'Unknown'),
-                    'ManufacturerModelName': json_data.get('ManufacturerModelName', 'Unknown'),
-                    'MagneticFieldStrength': json_data.get('MagneticFieldStrength', 'Unknown'),
-                    'InstitutionName': json_data.get('InstitutionName', 'Unknown'),
-                    'StationName': json_data.get('StationName', 'Unknown'),
-                    'ConvolutionKernel': json_data.get('ConvolutionKernel', 'Unknown'),
-                    'ReconstructionDiameter': json_data.get('ReconstructionDiameter', 'Unknown'),
-                    'KVP': json_data.get('KVP', 'Unknown'),
-                    'XRayTubeCurrent': json_data.get('XRayTubeCurrent', 'Unknown'),
-                    'ExposureTime': json_data.get('ExposureTime', 'Unknown'),
-                    'dcm2niix_version': json_data.get('dcm2niix_version', 'Unknown'),
-                    'ConversionSoftware': json_data.get('ConversionSoftware', 'dcm2niix'),
-                    'ConversionSoftwareVersion': json_data.get('ConversionSoftwareVersion', 'Unknown'),
-                    'ProcessingTime': datetime.now().isoformat()
-                }
-                all_metadata.append(metadata)
-            except Exception as e:
-                print(f"  Error processing {json_file.name}: {str(e)}")
-                continue
-        if not all_metadata:
-            print("  No valid metadata extracted")
-            return None, None
-        df = pd.DataFrame(all_metadata)
-        csv_path = Path(output_dir) / f"json_metadata_summary_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-        df.to_csv(csv_path, index=False, encoding='utf-8-sig')
-        clinical_fields = ['FileName', 'PatientID', 'StudyDate', 'PatientName', 'PatientBirthDate', 'PatientSex', 'PatientAge']
-        clinical_df = df[clinical_fields].copy()
-        clinical_csv_path = Path(output_dir) / f"clinical_info_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-        clinical_df.to_csv(clinical_csv_path, index=False, encoding='utf-8-sig')
-        print(f"  Successfully extracted metadata from {len(all_metadata)} JSON files")
-        print(f"  Complete CSV saved with {len(df.columns)} columns of information")
-        print(f"  Clinical CSV saved with {len(clinical_fields)} key fields")
-        print(f"\n  Metadata Summary:")
-        if 'Modality' in df.columns:
-            modality_counts = df['Modality'].value_counts()
-            print(f"    - Modalities: {dict(modality_counts)}")
-        if 'ManufacturerModelName' in df.columns:
-            scanner_counts = df['ManufacturerModelName'].value_counts()
-            print(f"    - Scanner models: {len(scanner_counts)} unique models")
-        if 'PatientSex' in df.columns:
-            sex_counts = df['PatientSex'].value_counts()
-            print(f"    - Patient sex distribution: {dict(sex_counts)}")
-        print(f"Complete metadata summary: {csv_path}")
-        print(f"Clinical info summary: {clinical_csv_path}")
-        return csv_path, clinical_csv_path
-    except Exception as e:
-        print(f"  Error during JSON metadata extraction: {str(e)}")
-        return None, None
-
-def extract_json_metadata_to_csv_unified(output_dir, json_files):
-    """统一处理所有JSON文件并生成汇总CSV - 参照原脚本逻辑"""
-    try:
-        print(f"  Processing {len(json_files)} JSON files...")
-        if not json_files:
-            print("  Warning: No JSON metadata files found")
-            return None, None
-        
-        # 尝试读取原始DICOM元数据CSV文件
-        dicom_metadata_df = None
-        
-        # 在多个位置寻找DICOM元数据文件
-        search_dirs = [
-            Path(output_dir),  # 当前output目录
-            Path(output_dir).parent,  # 选择的主目录
-            Path(__file__).parent.parent / "output",  # 项目output目录
-        ]
-        
-        dicom_csv_files = []
-        for search_dir in search_dirs:
-            if search_dir.exists():
-                dicom_csv_files.extend(list(search_dir.glob("dicom_metadata_*.csv")))
-                dicom_csv_files.extend(list(search_dir.glob("case_metadata_*.csv")))
-        
-        if dicom_csv_files:
-            latest_dicom_csv = max(dicom_csv_files, key=lambda f: f.stat().st_mtime)
-            try:
-                dicom_metadata_df = pd.read_csv(latest_dicom_csv)
-                print(f"  ✓ Found DICOM metadata: {latest_dicom_csv.name} ({len(dicom_metadata_df)} records)")
-            except Exception as e:
-                print(f"  ⚠ Warning: Could not read DICOM metadata: {e}")
-        
-        all_metadata = []
-        
-        for json_file in json_files:
-            try:
-                # 从文件名解析案例信息
-                parts = json_file.stem.split('_')
-                
-                if len(parts) >= 4:
-                    case_name = parts[0] + '_' + parts[1]  # dicom_XXXXXXX
-                    patient_id = parts[2]
-                    series_info = '_'.join(parts[3:])
-                else:
-                    case_name = json_file.stem
-                    patient_id = 'Unknown'
-                    series_info = 'Unknown'
-                
-                # 读取JSON内容
-                with open(json_file, 'r', encoding='utf-8') as f:
-                    json_data = json.load(f)
-                
-                # 从原始DICOM元数据中获取患者信息
-                dicom_info = {}
-                if dicom_metadata_df is not None and patient_id != 'Unknown':
-                    # 尝试多种方式查找匹配的患者记录
-                    matching_rows = None
-                    
-                    # 方式1: 直接匹配PatientID
-                    if 'PatientID' in dicom_metadata_df.columns:
-                        matching_rows = dicom_metadata_df[dicom_metadata_df['PatientID'].astype(str) == str(patient_id)]
-                    
-                    # 方式2: 如果没找到，尝试匹配文件名中的部分
-                    if matching_rows is None or matching_rows.empty:
-                        for _, row in dicom_metadata_df.iterrows():
-                            if str(patient_id) in str(row.get('PatientID', '')):
-                                matching_rows = dicom_metadata_df[dicom_metadata_df.index == row.name]
-                                break
-                    
-                    if matching_rows is not None and not matching_rows.empty:
-                        # 使用第一个匹配的记录
-                        dicom_row = matching_rows.iloc[0]
-                        
-                        # 提取可用字段
-                        available_fields = {}
-                        field_mapping = {
-                            'PatientName': ['PatientName', 'Patient Name'],
-                            'PatientBirthDate': ['PatientBirthDate', 'PatientBirtDate', 'Patient Birth Date'],
-                            'PatientSex': ['PatientSex', 'Patient Sex'],
-                            'StudyDate': ['StudyDate', 'Study Date'],
-                            'StudyTime': ['StudyTime', 'Study Time'],
-                            'InstitutionName': ['InstitutionName', 'Institution Name'],
-                            'PatientAge': ['PatientAge', 'Patient Age']
-                        }
-                        
-                        for target_field, possible_names in field_mapping.items():
-                            value = 'Unknown'
-                            for name in possible_names:
-                                if name in dicom_row.index and pd.notna(dicom_row[name]):
-                                    value = str(dicom_row[name])
-                                    break
-                            available_fields[target_field] = value
-                        
-                        dicom_info = available_fields
-                        
-                        # 如果没有现成的年龄，尝试计算
-                        if dicom_info.get('PatientAge') == 'Unknown':
-                            try:
-                                birth_date = dicom_info.get('PatientBirthDate', '')
-                                study_date = dicom_info.get('StudyDate', '')
-                                if len(birth_date) == 8 and len(study_date) == 8:  # YYYYMMDD格式
-                                    birth_year = int(birth_date[:4])
-                                    study_year = int(study_date[:4])
-                                    age = study_year - birth_year
-                                    dicom_info['PatientAge'] = str(age)
-                            except:
-                                pass
-                
-                # 提取关键信息，优先使用原始DICOM数据
-                metadata = {
-                    'FileName': json_file.name,
-                    'CaseName': case_name,
-                    'PatientID': patient_id,
-                    'SeriesInfo': series_info,
-                    'NIfTIFile': json_file.stem + '.nii.gz',
-                    'OutputFolder': str(json_file.parent),
-                    
-                    # DICOM基本信息
-                    'Modality': json_data.get('Modality', 'Unknown'),
-                    'StudyDate': dicom_info.get('StudyDate', json_data.get('StudyDate', 'Unknown')),
-                    'StudyTime': dicom_info.get('StudyTime', json_data.get('StudyTime', 'Unknown')),
-                    'StudyDescription': json_data.get('StudyDescription', 'Unknown'),
-                    'SeriesNumber': json_data.get('SeriesNumber', 'Unknown'),
-                    'SeriesDescription': json_data.get('SeriesDescription', 'Unknown'),
-                    'ProtocolName': json_data.get('ProtocolName', 'Unknown'),
-                    
-                    # 患者信息（优先使用原始DICOM数据）
-                    'PatientName': dicom_info.get('PatientName', json_data.get('PatientName', 'Unknown')),
-                    'PatientBirthDate': dicom_info.get('PatientBirthDate', json_data.get('PatientBirthDate', 'Unknown')),
-                    'PatientSex': dicom_info.get('PatientSex', json_data.get('PatientSex', 'Unknown')),
-                    'PatientAge': dicom_info.get('PatientAge', json_data.get('PatientAge', 'Unknown')),
-                    
-                    # 影像参数
-                    'SliceThickness': json_data.get('SliceThickness', 'Unknown'),
-                    'SpacingBetweenSlices': json_data.get('SpacingBetweenSlices', 'Unknown'),
-                    'PixelSpacing': str(json_data.get('PixelSpacing', 'Unknown')),
-                    'ImageOrientationPatientDICOM': str(json_data.get('ImageOrientationPatientDICOM', 'Unknown')),
-                    
-                    # 采集参数
-                    'RepetitionTime': json_data.get('RepetitionTime', 'Unknown'),
-                    'EchoTime': json_data.get('EchoTime', 'Unknown'),
-                    'FlipAngle': json_data.get('FlipAngle', 'Unknown'),
-                    'AcquisitionMatrix': str(json_data.get('AcquisitionMatrix', 'Unknown')),
-                    
-                    # 设备信息
-                    'Manufacturer': json_data.get('Manufacturer', 'Unknown'),
-                    'ManufacturerModelName': json_data.get('ManufacturerModelName', 'Unknown'),
-                    'MagneticFieldStrength': json_data.get('MagneticFieldStrength', 'Unknown'),
-                    'InstitutionName': dicom_info.get('InstitutionName', json_data.get('InstitutionName', 'Unknown')),
-                    'StationName': json_data.get('StationName', 'Unknown'),
-                    
-                    # 重建参数
-                    'ConvolutionKernel': json_data.get('ConvolutionKernel', 'Unknown'),
-                    'ReconstructionDiameter': json_data.get('ReconstructionDiameter', 'Unknown'),
-                    'KVP': json_data.get('KVP', 'Unknown'),
-                    'XRayTubeCurrent': json_data.get('XRayTubeCurrent', 'Unknown'),
-                    'ExposureTime': json_data.get('ExposureTime', 'Unknown'),
-                    
-                    # dcm2niix相关
-                    'dcm2niix_version': json_data.get('dcm2niix_version', 'Unknown'),
-                    'ConversionSoftware': json_data.get('ConversionSoftware', 'dcm2niix'),
-                    'ConversionSoftwareVersion': json_data.get('ConversionSoftwareVersion', 'Unknown'),
-                    
-                    # 处理信息
-                    'ProcessingTime': datetime.now().isoformat()
-                }
-                
-                all_metadata.append(metadata)
-                
-            except Exception as e:
-                print(f"  Error processing {json_file.name}: {str(e)}")
-                continue
-        
-        if not all_metadata:
-            print("  No valid metadata extracted")
-            return None, None
-        
-        # 转换为DataFrame并保存完整元数据CSV
-        df = pd.DataFrame(all_metadata)
-        csv_path = Path(output_dir) / f"unified_metadata_summary_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-        df.to_csv(csv_path, index=False, encoding='utf-8-sig')
-        
-        # 创建简化的临床信息CSV
-        clinical_fields = ['FileName', 'PatientID', 'StudyDate', 'PatientName', 'PatientBirthDate', 'PatientSex', 'PatientAge', 'OutputFolder']
-        clinical_df = df[clinical_fields].copy()
-        
-        clinical_csv_path = Path(output_dir) / f"unified_clinical_info_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-        clinical_df.to_csv(clinical_csv_path, index=False, encoding='utf-8-sig')
-        
-        print(f"  Successfully extracted metadata from {len(all_metadata)} JSON files")
-        print(f"  Complete CSV saved with {len(df.columns)} columns of information")
-        print(f"  Clinical CSV saved with {len(clinical_fields)} key fields")
-        
-        # 显示一些统计信息
-        print(f"\n  Metadata Summary:")
-        if 'Modality' in df.columns:
-            modality_counts = df['Modality'].value_counts()
-            print(f"    - Modalities: {dict(modality_counts)}")
-        
-        if 'ManufacturerModelName' in df.columns:
-            scanner_counts = df['ManufacturerModelName'].value_counts()
-            print(f"    - Scanner models: {len(scanner_counts)} unique models")
-        
-        if 'PatientSex' in df.columns:
-            sex_counts = df['PatientSex'].value_counts()
-            print(f"    - Patient sex distribution: {dict(sex_counts)}")
-        
-        print(f"Complete metadata summary: {csv_path}")
-        print(f"Clinical info summary: {clinical_csv_path}")
-        return csv_path, clinical_csv_path
-        
-    except Exception as e:
-        print(f"  Error during unified JSON metadata extraction: {str(e)}")
-        return None, None
+def parse_args():
+    """解析命令行参数"""
+    import argparse
+    parser = argparse.ArgumentParser(description='智能DICOM到NIfTI转换（5mm层厚筛选）')
+    parser.add_argument('data_dir', nargs='?', help='包含ZIP/tar病例的主目录（不提供则弹窗选择）')
+    add_profile_argument(parser)
+    add_output_arguments(parser)
+    add_progress_arguments(parser)
+    add_metrics_arguments(parser)
+    add_retry_arguments(parser)
+    return parser.parse_args()
 
 
 def main():
     """主函数，支持命令行参数或弹窗选择目录"""
+    args = parse_args()
     # 设置路径
     base_dir = Path(__file__).parent.parent
     # 目录选择：优先命令行参数，否则弹窗
-    if len(sys.argv) > 1:
-        data_dir = Path(sys.argv[1])
+    if args.data_dir:
+        data_dir = Path(args.data_dir)
         print(f"使用命令行参数目录: {data_dir}")
     else:
+        # tkinter 只在弹窗模式下导入，无图形界面的服务器上命令行模式不受影响
+        try:
+            import tkinter as tk
+            from tkinter import filedialog, messagebox
+        except ImportError:
+            print("错误: 弹窗选择目录需要tkinter库，请在命令行中提供目录参数")
+            return
         root = tk.Tk()
         root.withdraw()
         selected = filedialog.askdirectory(title="请选择包含ZIP病例的主目录")
@@ -603,32 +164,38 @@ def main():
         data_dir = Path(selected)
         print(f"使用弹窗选择目录: {data_dir}")
 
-    dcm2niix_path = base_dir / "dcm2niix.exe"
-    if not dcm2niix_path.exists():
-        alt_dcm2niix = base_dir / "tools" / "MRIcroGL" / "Resources" / "dcm2niix.exe"
-        if alt_dcm2niix.exists():
-            dcm2niix_path = alt_dcm2niix
-        else:
-            print("Error: dcm2niix.exe not found!")
-            return
+    dcm2niix_path = find_dcm2niix(base_dir)
+    if not dcm2niix_path:
+        print("Error: dcm2niix.exe not found!")
+        return
     print(f"Using dcm2niix: {dcm2niix_path}")
-    zip_files = list(data_dir.glob("*.zip"))
+    # ZIP / tar / tar.gz / tar.zst 压缩包
+    zip_files = find_archives(data_dir)
+    if args.retry_failed:
+        # 只重新处理上次失败的case
+        retry_names = set(read_failed_cases(args.retry_failed))
+        zip_files = [zip_file for zip_file in zip_files if archive_stem(zip_file) in retry_names]
+        print(f"Re-queue from {Path(args.retry_failed).name}: {len(zip_files)} of {len(retry_names)} failed cases found")
     if not zip_files:
-        print("No ZIP files found in the data directory")
+        print("No ZIP/tar archives found in the data directory")
         return
-    print(f"Found {len(zip_files)} ZIP files to process")
+    print(f"Found {len(zip_files)} archives to process")
     print("Smart Processing: Will analyze and convert only the main series for each case")
     print("Each output will be saved in the original ZIP directory's output folder.")
     
+    # ZIP中央目录缓存：元数据提取子进程与后面的解压共用（通过环境变量传给子进程）
+    configure_zip_cache(data_dir / "output" / ZIP_INDEX_DIR_NAME)
+    
     # 第一步：提取DICOM元数据
-    print(f"\nStep 1: Extracting DICOM metadata from ZIP files...")
+    print(f"\nStep 1: Extracting DICOM metadata from archives...")
     extract_script_path = base_dir / "src" / "extract_case_metadata_anywhere.py"
     if extract_script_path.exists():
         try:
             import subprocess
-            result = subprocess.run([
-                sys.executable, str(extract_script_path), str(data_dir)
-            ], capture_output=True, text=True, encoding='utf-8')
+            extract_cmd = [sys.executable, str(extract_script_path), str(data_dir)]
+            if args.profile:
+                extract_cmd += ['--profile', args.profile]
+            result = subprocess.run(extract_cmd, capture_output=True, text=True, encoding='utf-8')
             if result.returncode == 0:
                 print("✓ DICOM metadata extraction completed")
                 if result.stdout:
@@ -654,47 +221,77 @@ def main():
     custom_temp_dir = data_dir / "temp_dcm2niix_processing"
     custom_temp_dir.mkdir(parents=True, exist_ok=True)
     
+    # 汇总文件（失败列表、CSV、报告、剖析文件）保存到选择目录的output文件夹
+    summary_output_dir = data_dir / "output"
+    summary_output_dir.mkdir(parents=True, exist_ok=True)
+    
+    # 按case剖析（--profile）
+    run_timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    profiler = CaseProfiler(args.profile, profile_dir(summary_output_dir, run_timestamp))
+    output_options = output_options_from_args(args)
+    policies = retry_policies(args.io_retries)
+    print(f"NIfTI压缩: {output_options.describe()}")
+    
+    # 每个case完成即追加到 .jsonl 报告（崩溃不丢失），dcm2niix输出写到单独的case日志文件
+    report = ReportWriter(summary_output_dir / f"conversion_report_{run_timestamp}.jsonl",
+                          log_dir=summary_output_dir / f"conversion_logs_{run_timestamp}")
+    
     with tempfile.TemporaryDirectory(dir=str(custom_temp_dir)) as temp_dir:
         all_results = []
         all_json_files = []
         skipped_count = 0
+        # 进度/吞吐/ETA（按ZIP文件大小估算剩余时间）
+        zip_sizes = {zip_file: os.path.getsize(zip_file) for zip_file in zip_files}
+        progress = progress_from_args(args, total=len(zip_files), total_bytes=sum(zip_sizes.values()))
+        metrics = metrics_from_args(args, 'anywhere_5mm', total=len(zip_files))
         
         for i, zip_file in enumerate(zip_files, 1):
             print(f"\n[{i}/{len(zip_files)}] Processing {zip_file.name}...")
+            case_name = archive_stem(zip_file)
             
             # 为每个ZIP在其源目录下创建output文件夹
             zip_output_dir = zip_file.parent / "output"
             zip_output_dir.mkdir(parents=True, exist_ok=True)
             
             # 检查是否已经存在输出文件（跳过已成功转换的case）
-            existing_nii = list(zip_output_dir.glob(f"{zip_file.stem}_*.nii.gz"))
+            existing_nii = find_nifti_files(zip_output_dir, case_name)
             if existing_nii:
                 print(f"  ⏩ Skipped - Already converted (found {len(existing_nii)} NIfTI file(s))")
                 skipped_count += 1
                 # 仍然收集已存在的JSON文件用于汇总
-                existing_json = list(zip_output_dir.glob(f"{zip_file.stem}_*.json"))
+                existing_json = [sidecar_path(p) for p in existing_nii if sidecar_path(p).exists()]
                 all_json_files.extend(existing_json)
                 # 添加跳过记录到结果
                 result = {
-                    'zip_file': zip_file.stem,
+                    'zip_file': case_name,
                     'success': True,
                     'skipped': True,
                     'nii_files': len(existing_nii),
                     'json_files': len(existing_json),
                     'processing_time': datetime.now().isoformat()
                 }
-                all_results.append(result)
+                metrics.observe(result)
+                all_results.append(report.write(result))
+                progress.skip(case_name, nbytes=zip_sizes[zip_file])
                 continue
             
             # 转换并收集结果
-            result = process_zip_to_nifti_smart(zip_file, temp_dir, zip_output_dir, dcm2niix_path)
-            all_results.append(result)
+            with profiler.case(case_name) as prof:
+                result = process_zip_to_nifti_smart(zip_file, temp_dir, zip_output_dir, dcm2niix_path, output_options,
+                                                    policies)
+            if prof:
+                result['profile'] = prof
+            metrics.observe(result)
+            all_results.append(report.write(result))
             
             # 收集生成的JSON文件用于汇总
             if result['success']:
-                json_files = list(zip_output_dir.glob(f"{zip_file.stem}_*.json"))
-                all_json_files.extend(json_files)
+                all_json_files.extend(Path(p) for p in result.get('json_file_paths', []))
                 print(f"  ✓ Output saved to: {zip_output_dir}")
+            progress.case_done(case_name, result['success'], files=case_io(result)[0],
+                               nbytes=zip_sizes[zip_file])
+        progress.close()
+        metrics.close()
         
         # 第三步：生成汇总报告和统计
         successful = [r for r in all_results if r['success']]
@@ -712,6 +309,10 @@ def main():
         print(f"Failed: {len(failed)}")
         print(f"Success rate: {len(successful)/len(zip_files)*100:.1f}%")
         
+        # 分阶段耗时汇总（p50/p95，跳过的case没有计时）
+        print_stage_summary([r.get('stage_timings') for r in all_results])
+        profiler.close()
+        
         # 错误分类统计
         if failed:
             print(f"\n{'='*60}")
@@ -721,18 +322,8 @@ def main():
             # 按错误类型分类
             error_types = defaultdict(list)
             for f in failed:
-                error_msg = f.get('error', 'Unknown error')
-                # 简化错误类型
-                if 'No valid DICOM' in error_msg or 'No suitable series' in error_msg:
-                    error_type = 'DICOM文件问题'
-                elif 'slice thickness' in error_msg.lower() or '4.5-5.5' in error_msg:
-                    error_type = '切片厚度不符合要求'
-                elif 'dcm2niix' in error_msg.lower():
-                    error_type = 'dcm2niix转换失败'
-                elif 'extract' in error_msg.lower() or 'zip' in error_msg.lower():
-                    error_type = 'ZIP解压失败'
-                else:
-                    error_type = '其他错误'
+                # 简化错误类型（与 --metrics-file 的 category 标签一致）
+                error_type = ERROR_CATEGORIES[error_category(f)]
                 error_types[error_type].append(f['zip_file'])
             
             print(f"\n按错误类型分类:")
@@ -764,9 +355,6 @@ def main():
             print(f"\n✓ 失败case列表已保存: {failed_list_path.name}")
         
         # 第四步：生成汇总CSV（保存到选择目录的output文件夹）
-        summary_output_dir = data_dir / "output"
-        summary_output_dir.mkdir(parents=True, exist_ok=True)
-        
         if all_json_files:
             print(f"\nStep 3: Generating unified metadata summary...")
             json_summary_path, clinical_summary_path = extract_json_metadata_to_csv_unified(summary_output_dir, all_json_files)
@@ -774,11 +362,9 @@ def main():
                 print(f"✓ Complete metadata: {json_summary_path.name}")
                 print(f"✓ Clinical summary: {clinical_summary_path.name}")
         
-        # 第五步：生成详细报告JSON（保存到选择目录的output文件夹）
-        summary_report = summary_output_dir / f"conversion_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
-        with open(summary_report, 'w', encoding='utf-8') as f:
-            json.dump(all_results, f, ensure_ascii=False, indent=2)
-        print(f"✓ Detailed report: {summary_report.name}")
+        # 第五步：把逐case追加的 .jsonl 报告压实为详细报告JSON（保存到选择目录的output文件夹）
+        summary_report = report.close()
+        print(f"✓ Detailed report: {summary_report.name} (case logs: {report.log_dir.name}/)")
         
         print(f"\n✅ Processing complete!")
         print(f"📁 Individual files: Check each ZIP's directory output folder")
@@ -6,672 +6,572 @@
 """
 import os
 import sys
-import zipfile
-import tempfile
+import time
 import shutil
+import tempfile
 import subprocess
-import pydicom
-import pandas as pd
 from pathlib import Path
-import json
 from datetime import datetime
 from collections import defaultdict
-import tkinter as tk
-from tkinter import filedialog, messagebox
+from dcmnii.stages import StageTimer, print_stage_summary, total_size
+from dcmnii.profiling import CaseProfiler, add_profile_argument, profile_dir
+from dcmnii.walk import walk_files, find_dicom_folders
+from dcmnii.compress import add_output_arguments, output_options_from_args
+from dcmnii.report import ReportWriter, ERROR_CATEGORIES, error_category, read_failed_cases
+from dcmnii.errors import (NoDicomError, ConverterError, error_from_exception, retry_case, retry_policies,
+                           add_retry_arguments)
+from dcmnii.metrics import add_metrics_arguments, metrics_from_args
+from dcmnii.schedule import ORDER_DESCRIPTIONS, add_schedule_arguments, case_seconds, estimate_jobs, order_jobs
+from dcmnii.progress import add_progress_arguments, progress_from_args, case_io, format_bytes
+from dcmnii.zipindex import ZIP_INDEX_DIR_NAME, configure_zip_cache, zip_index
+from dcmnii.archive import archive_stem, find_archives
+from dcmnii.workqueue import add_queue_arguments
+from dcmnii.core import (MaxLayersStrategy, scan_dicom_series, scan_archive_series, create_series_directory,
+                         describe_stack, run_dcm2niix, keep_largest_nifti, find_dcm2niix, split_outputs,
+                         extract_json_metadata_to_csv_unified)
 
+# 层数优先：(层数, 像素面积, CT优先, 序列号)
+SELECTION_STRATEGY = MaxLayersStrategy()
 
-# ====== 辅助函数全部补充到此处 ======
-import_types = (os, sys, zipfile, tempfile, shutil, subprocess, pydicom, pd, Path, json, datetime, defaultdict)
 
-def analyze_dicom_series(extract_path):
-    series_info = defaultdict(list)
-    for root, dirs, files in os.walk(extract_path):
-        for file in files:
-            file_path = os.path.join(root, file)
-            try:
-                ds = pydicom.dcmread(file_path, force=True)
-                series_uid = getattr(ds, 'SeriesInstanceUID', 'Unknown')
-                series_number = getattr(ds, 'SeriesNumber', 0)
-                series_description = getattr(ds, 'SeriesDescription', 'Unknown')
-                modality = getattr(ds, 'Modality', 'Unknown')
-                rows = getattr(ds, 'Rows', 0)
-                columns = getattr(ds, 'Columns', 0)
-                series_info[series_uid].append({
-                    'file_path': file_path,
-                    'series_number': series_number,
-                    'series_description': str(series_description),
-                    'modality': str(modality),
-                    'rows': rows,
-                    'columns': columns,
-                    'file_size': os.path.getsize(file_path)
-                })
-            except Exception as e:
-                print(f"  ⚠ 跳过文件 {file}: {str(e)}")
-                continue
-    if not series_info:
-        return None, "No valid DICOM files found"
-    best_series = None
-    best_key = (-1, -1, -1, -1)  # (slice count, pixel area, modality priority, series number)
-    for series_uid, files in series_info.items():
-        if not files:
-            continue
-        file_count = len(files)
-        first_file = files[0]
-        pixel_area = max(first_file['rows'], 0) * max(first_file['columns'], 0)
-        modality_priority = 1 if first_file['modality'] == 'CT' else 0
-        series_number = first_file.get('series_number', 0) or 0
-        current_key = (file_count, pixel_area, modality_priority, series_number)
-        if current_key > best_key:
-            best_key = current_key
-            best_series = {
-                'series_uid': series_uid,
-                'files': files,
-                'file_count': file_count,
-                'description': first_file['series_description'],
-                'series_number': first_file['series_number'],
-                'slice_count': file_count,
-                'pixel_area': pixel_area,
-            }
-    return best_series, f"Selected series with {best_series['file_count']} slices" if best_series else "No suitable series"
-
-def create_series_directory(series_info, temp_base_dir, case_name):
-    series_dir = os.path.join(temp_base_dir, f"{case_name}_main_series")
-    os.makedirs(series_dir, exist_ok=True)
-    for file_info in series_info['files']:
-        src_path = file_info['file_path']
-        dst_path = os.path.join(series_dir, os.path.basename(src_path))
-        shutil.copy2(src_path, dst_path)
-    return series_dir
-
-def run_dcm2niix_smart(input_dir, output_dir, dcm2niix_path, case_name):
-    try:
-        cmd = [
-            str(dcm2niix_path),
-            "-f", f"{case_name}_%i_%s_%p",
-            "-o", str(output_dir),
-            "-z", "y",
-            "-b", "y",  # 生成JSON文件
-            "-v", "0",
-            str(input_dir)
-        ]
-        result = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8')
-        if result.returncode == 0:
-            return True, result.stdout
-        else:
-            return False, result.stderr
-    except Exception as e:
-        return False, str(e)
+def process_zip_to_nifti_smart(zip_path, temp_dir, output_base_dir, dcm2niix_path, output_options=None,
+                               policies=None):
+    """转换一个压缩包；失败时按错误类别的重试策略（policies，默认 RETRY_POLICIES）重试"""
+    return retry_case(lambda: convert_zip_once(zip_path, temp_dir, output_base_dir, dcm2niix_path, output_options),
+                      policies)
+
 
-def process_zip_to_nifti_smart(zip_path, temp_dir, output_base_dir, dcm2niix_path):
-    zip_name = Path(zip_path).stem
+def convert_zip_once(zip_path, temp_dir, output_base_dir, dcm2niix_path, output_options=None):
+    """转换一个压缩包（ZIP / tar / tar.gz / tar.zst，单次尝试），失败时结果带 error_code / error_stage"""
+    zip_name = archive_stem(zip_path)
     print(f"\nProcessing {zip_name}...")
+    timer = StageTimer()
     try:
         case_output_dir = output_base_dir
-        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            extract_path = os.path.join(temp_dir, zip_name)
-            zip_ref.extractall(extract_path)
-            print(f"  Analyzing DICOM series...")
-            best_series, analysis_msg = analyze_dicom_series(extract_path)
-            if not best_series:
-                result = {
-                    'zip_file': zip_name,
-                    'success': False,
-                    'error': analysis_msg,
-                    'processing_time': datetime.now().isoformat()
-                }
-                print(f"  ✗ No suitable series found: {analysis_msg}")
-                return result
-            print(f"  Selected: Series {best_series['series_number']} - {best_series['description']} ({best_series['file_count']} files)")
-            series_dir = create_series_directory(best_series, temp_dir, zip_name)
-            print(f"  Converting main series...")
-            success, output = run_dcm2niix_smart(series_dir, case_output_dir, dcm2niix_path, zip_name)
-            if success:
-                nii_files = list(Path(case_output_dir).glob(f"{zip_name}_*.nii.gz"))
-                json_files = list(Path(case_output_dir).glob(f"{zip_name}_*.json"))
-                result = {
-                    'zip_file': zip_name,
-                    'success': True,
-                    'selected_series': {
-                        'series_number': best_series['series_number'],
-                        'description': best_series['description'],
-                        'file_count': best_series['file_count'],
-                        'slice_count': best_series['slice_count'],
-                        'pixel_area': best_series['pixel_area']
-                    },
-                    'nii_files': len(nii_files),
-                    'json_files': len(json_files),
-                    'output_dir': str(case_output_dir),
-                    'files_generated': [f.name for f in nii_files + json_files],
-                    'nii_file_paths': [str(f) for f in nii_files],
-                    'json_file_paths': [str(f) for f in json_files],
-                    'dcm2niix_output': output,
-                    'processing_time': datetime.now().isoformat()
-                }
-                print(f"  Success: Generated {len(nii_files)} NIfTI files")
-                return result
-            else:
-                result = {
-                    'zip_file': zip_name,
-                    'success': False,
-                    'error': output,
-                    'processing_time': datetime.now().isoformat()
-                }
-                print(f"  ✗ Conversion failed: {output}")
-                return result
+        extract_path = os.path.join(temp_dir, zip_name)
+        series_dir = os.path.join(temp_dir, f"{zip_name}_main_series")
+        # 重试时先清掉上一次解压/暂存到一半的文件
+        for leftover in (extract_path, series_dir):
+            shutil.rmtree(leftover, ignore_errors=True)
+        print(f"  Reading archive and analyzing DICOM series...")
+        with timer.stage('extract') as st:
+            # 单遍读取（tar 流不能回头），只把候选序列的文件写到临时目录
+            series_info, scan_stats = scan_archive_series(zip_path, extract_path, SELECTION_STRATEGY.accept_header)
+            st.add(bytes_read=os.path.getsize(zip_path), bytes_written=scan_stats['bytes_written'],
+                   files=scan_stats['members'])
+        if scan_stats['rejected_series']:
+            print(f"  Skipped {scan_stats['rejected_series']} non-candidate series while reading")
+        with timer.stage('select'):
+            best_series, analysis_msg = SELECTION_STRATEGY.select(series_info)
+        if not best_series:
+            raise (SELECTION_STRATEGY.no_match_error if scan_stats['dicom'] else NoDicomError)(analysis_msg)
+        print(f"  Selected: Series {best_series['series_number']} - {best_series['description']} ({best_series['file_count']} files)")
+        print(f"    Stack: {describe_stack(best_series)}")
+        with timer.stage('stage') as st:
+            series_dir = create_series_directory(best_series, temp_dir, f"{zip_name}_main_series", link=True)
+            staged_bytes = sum(f['file_size'] for f in best_series['files'])
+            st.add(bytes_read=staged_bytes, files=best_series['file_count'])
+        print(f"  Converting main series...")
+        with timer.stage('convert') as st:
+            success, output, outputs = run_dcm2niix(series_dir, case_output_dir, dcm2niix_path, zip_name,
+                                                    output_options=output_options, source=zip_path,
+                                                    selection=best_series)
+            nii_files, json_files = split_outputs(outputs)
+            st.add(bytes_read=staged_bytes, bytes_written=total_size(nii_files + json_files),
+                   files=len(nii_files) + len(json_files))
+            if not success:
+                raise ConverterError(output)
+        with timer.stage('summarize') as st:
+            st.add(files=len(nii_files) + len(json_files))
+            result = {
+                'zip_file': zip_name,
+                'success': True,
+                'selected_series': {
+                    'series_number': best_series['series_number'],
+                    'description': best_series['description'],
+                    'file_count': best_series['file_count'],
+                    'slice_count': best_series['slice_count'],
+                    'pixel_area': best_series['pixel_area'],
+                    'spacing_mm': best_series.get('spacing_mm'),
+                    'coverage_mm': best_series.get('coverage_mm'),
+                    'stack_count': best_series.get('stack_count', 1),
+                    'rationale': best_series['rationale'],
+                },
+                'nii_files': len(nii_files),
+                'json_files': len(json_files),
+                'output_dir': str(case_output_dir),
+                'files_generated': [f.name for f in nii_files + json_files],
+                'nii_file_paths': [str(f) for f in nii_files],
+                'json_file_paths': [str(f) for f in json_files],
+                'dcm2niix_output': output,
+            }
+        result['stage_timings'] = timer.as_dict()
+        result['processing_time'] = datetime.now().isoformat()
+        print(f"  Success: Generated {len(nii_files)} NIfTI files")
+        return result
     except Exception as e:
+        error = error_from_exception(e, timer.current)
         result = {
             'zip_file': zip_name,
             'success': False,
-            'error': str(e),
+            **error.fields(),
+            'stage_timings': timer.as_dict(),
             'processing_time': datetime.now().isoformat()
         }
-        print(f"  ✗ Exception: {str(e)}")
+        print(f"  ✗ [{error.code}] {error.message}")
         return result
 
 
-def process_dicom_folder_to_nifti_smart(dicom_folder_path, output_base_dir, dcm2niix_path):
+def process_dicom_folder_to_nifti_smart(dicom_folder_path, output_base_dir, dcm2niix_path, temp_dir=None, output_options=None,
+                                        policies=None):
+    """转换一个DICOM文件夹；失败时按错误类别的重试策略（policies，默认 RETRY_POLICIES）重试"""
+    return retry_case(lambda: convert_folder_once(dicom_folder_path, output_base_dir, dcm2niix_path, temp_dir,
+                                                  output_options), policies)
+
+
+def convert_folder_once(dicom_folder_path, output_base_dir, dcm2niix_path, temp_dir=None, output_options=None):
     """
-    处理DICOM文件夹到NIfTI的智能转换
+    处理DICOM文件夹到NIfTI的智能转换（单次尝试），失败时结果带 error_code / error_stage
+    
+    转换前选好堆栈，只把该堆栈的文件（硬链接）暂存到 temp_dir 下交给dcm2niix，
+    不再转换整个文件夹后按文件大小删除多余输出。temp_dir 为None时使用系统临时目录。
     """
     folder_name = Path(dicom_folder_path).name
     print(f"\nProcessing DICOM folder: {folder_name}...")
+    timer = StageTimer()
     
     try:
         # 创建输出目录
         case_output_dir = Path(output_base_dir) / folder_name
         case_output_dir.mkdir(parents=True, exist_ok=True)
         
-        # 检查文件夹中是否有DICOM文件
-        dicom_files = []
-        for ext in ['*.dcm', '*.dicom', '*.DCM', '*.DICOM']:
-            dicom_files.extend(list(Path(dicom_folder_path).rglob(ext)))
+        with timer.stage('scan') as st:
+            # 并行遍历文件夹并嗅探文件头（不依赖扩展名），结果直接交给序列扫描，不再重复遍历
+            dicom_files = walk_files(dicom_folder_path, sniff=True)
         
-        # 如果没有标准扩展名的DICOM文件，尝试检查所有文件
-        if not dicom_files:
-            print(f"  No DICOM files with standard extensions found, checking all files...")
-            all_files = [f for f in Path(dicom_folder_path).rglob('*') if f.is_file()]
-            for file_path in all_files[:10]:  # 只检查前10个文件避免太慢
-                try:
-                    pydicom.dcmread(str(file_path), force=True)
-                    dicom_files = all_files  # 如果发现DICOM文件，使用所有文件
-                    break
-                except:
-                    continue
+            if not dicom_files:
+                raise NoDicomError('No valid DICOM files found in folder')
         
-        if not dicom_files:
-            return {
-                'dicom_folder': folder_name,
-                'success': False,
-                'error': 'No valid DICOM files found in folder',
-                'processing_time': datetime.now().isoformat()
-            }
+            print(f"  Found {len(dicom_files)} DICOM files")
         
-        print(f"  Found {len(dicom_files)} DICOM files")
+            # 分析DICOM序列
+            print(f"  Analyzing DICOM series...")
+            series_info = scan_dicom_series(str(dicom_folder_path), files=dicom_files)
+            for files in series_info.values():
+                st.add(bytes_read=sum(f['file_size'] for f in files), files=len(files))
         
-        # 分析DICOM序列
-        print(f"  Analyzing DICOM series...")
-        best_series, analysis_msg = analyze_dicom_series(str(dicom_folder_path))
+        with timer.stage('select'):
+            best_series, analysis_msg = SELECTION_STRATEGY.select(series_info)
         
         if not best_series:
-            return {
-                'dicom_folder': folder_name,
-                'success': False,
-                'error': f'No valid DICOM series found: {analysis_msg}',
-                'processing_time': datetime.now().isoformat()
-            }
-            return {
-                'dicom_folder': folder_name,
-                'success': False,
-                'error': 'No suitable series found after analysis',
-                'processing_time': datetime.now().isoformat()
-            }
+            error_cls = SELECTION_STRATEGY.no_match_error if series_info else NoDicomError
+            raise error_cls(f'No valid DICOM series found: {analysis_msg}')
         
         print(f"  Selected series: {best_series['series_uid'][:16]}... "
               f"({len(best_series['files'])} files, "
               f"Modality: {best_series['modality']}, "
-              f"Description: {best_series['series_description']})")
+              f"Description: {best_series['description']})")
+        print(f"    Stack: {describe_stack(best_series)}")
         
-        # 直接使用原始DICOM文件夹进行转换
-        print(f"  Running dcm2niix conversion...")
-        success, output = run_dcm2niix_smart(str(dicom_folder_path), str(case_output_dir), dcm2niix_path, folder_name)
+        # 只暂存选中的堆栈，dcm2niix不再为要丢弃的堆栈做gzip压缩
+        staging_root = temp_dir or tempfile.mkdtemp(prefix='dcm2niix_')
+        with timer.stage('stage') as st:
+            series_dir = create_series_directory(best_series, staging_root, f"{folder_name}_main_series", link=True)
+            staged_bytes = sum(f['file_size'] for f in best_series['files'])
+            st.add(bytes_read=staged_bytes, files=best_series['file_count'])
         
-        if success:
-            # 保留最大的NIfTI文件
-            nii_files = keep_largest_nifti(str(case_output_dir), folder_name)
-            json_files = list(Path(case_output_dir).glob(f"{folder_name}_*.json"))
+        print(f"  Running dcm2niix conversion...")
+        try:
+            with timer.stage('convert') as st:
+                success, output, outputs = run_dcm2niix(series_dir, str(case_output_dir), dcm2niix_path, folder_name,
+                                                        output_options=output_options, source=dicom_folder_path,
+                                                        selection=best_series)
+                produced_nii, json_files = split_outputs(outputs)
+                produced = produced_nii + json_files
+                st.add(bytes_read=staged_bytes, bytes_written=total_size(produced), files=len(produced))
+                if not success:
+                    raise ConverterError(f'dcm2niix failed: {output}')
+        finally:
+            shutil.rmtree(series_dir if temp_dir else staging_root, ignore_errors=True)
+        
+        # 兜底：dcm2niix仍输出多个NIfTI时才按大小保留一个
+        with timer.stage('postprocess') as st:
+            nii_files = keep_largest_nifti(produced_nii)
+            json_files = [f for f in json_files if f.exists()]
+            pruned = len(produced) - len(nii_files) - len(json_files)
+            st.add(files=pruned)
+            if not (nii_files and json_files):
+                raise ConverterError('dcm2niix succeeded but no output files found')
             
-            if nii_files and json_files:
-                print(f"  ✓ Conversion successful")
-                print(f"    NIfTI: {[f.name for f in nii_files]}")
-                print(f"    JSON: {[f.name for f in json_files]}")
-                return {
-                    'dicom_folder': folder_name,
-                    'success': True,
-                    'nifti_files': [str(f) for f in nii_files],
-                    'json_files': [str(f) for f in json_files],
-                    'series_info': f"{best_series['modality']}: {best_series['series_description']}",
-                    'file_count': len(best_series['files']),
-                    'processing_time': datetime.now().isoformat()
-                }
-            else:
-                return {
-                    'dicom_folder': folder_name,
-                    'success': False,
-                    'error': 'dcm2niix succeeded but no output files found',
-                    'processing_time': datetime.now().isoformat()
-                }
-        else:
-            return {
+        print(f"  ✓ Conversion successful")
+        print(f"    NIfTI: {[f.name for f in nii_files]}")
+        print(f"    JSON: {[f.name for f in json_files]}")
+        with timer.stage('summarize') as st:
+            st.add(files=len(nii_files) + len(json_files))
+            result = {
                 'dicom_folder': folder_name,
-                'success': False,
-                'error': f'dcm2niix failed: {output}',
-                'processing_time': datetime.now().isoformat()
+                'success': True,
+                'nifti_files': [str(f) for f in nii_files],
+                'json_files': [str(f) for f in json_files],
+                'series_info': f"{best_series['modality']}: {best_series['description']}",
+                'file_count': len(best_series['files']),
+                'slice_count': best_series['slice_count'],
+                'spacing_mm': best_series.get('spacing_mm'),
+                'coverage_mm': best_series.get('coverage_mm'),
+                'selection_rationale': best_series['rationale'],
+                'pruned_outputs': pruned,
             }
+        result['stage_timings'] = timer.as_dict()
+        result['processing_time'] = datetime.now().isoformat()
+        return result
             
     except Exception as e:
+        error = error_from_exception(e, timer.current)
         return {
             'dicom_folder': folder_name,
             'success': False,
-            'error': str(e),
+            **error.fields(),
+            'stage_timings': timer.as_dict(),
             'processing_time': datetime.now().isoformat()
         }
 
 
-def keep_largest_nifti(case_output_dir, case_name):
+def _warm_worker():
+    """常驻进程池的初始化：预先导入pydicom，Ctrl+C 交给主进程统一处理"""
+    import signal
+    import pydicom  # noqa: F401
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def convert_zip_in_own_temp(zip_path, temp_root, output_dir, dcm2niix_path, output_options=None, policies=None):
+    """在独立的临时目录中转换一个压缩包，转换结束即清理（常驻模式下临时文件不会累积）"""
+    with tempfile.TemporaryDirectory(dir=temp_root) as temp_dir:
+        return process_zip_to_nifti_smart(zip_path, temp_dir, Path(output_dir), dcm2niix_path, output_options,
+                                          policies)
+
+
+def convert_job(kind, path, temp_root, dcm2niix_path, output_options=None, policies=None):
+    """并行批处理的worker任务：转换一个压缩包或DICOM文件夹，输出到其所在目录的output文件夹"""
+    output_dir = Path(path).parent / "output"
+    output_dir.mkdir(parents=True, exist_ok=True)
+    if kind == 'archive':
+        return convert_zip_in_own_temp(path, temp_root, output_dir, dcm2niix_path, output_options, policies)
+    return process_dicom_folder_to_nifti_smart(Path(path), output_dir, dcm2niix_path, temp_root, output_options,
+                                               policies)
+
+
+def watch_inbox(inbox_dir, dcm2niix_path, args):
     """
-    如果生成了多个NIfTI文件，只保留最大的那个，删除其他的
-    同时删除对应的JSON文件
+    常驻监视模式（--watch）：收件箱中的新ZIP写入完成后立即转换
+    
+    进程和进程池只启动一次，pydicom等模块在各worker中预先导入，
+    每个case不再重复付出Python启动和导入的开销。Ctrl+C 或 SIGTERM 后等待进行中的转换完成再退出，
+    被中断的case不记入状态文件，下次启动时重新处理。
     """
-    nii_files = list(Path(case_output_dir).glob(f"{case_name}_*.nii.gz"))
+    import signal
+    import threading
+    from concurrent.futures import ProcessPoolExecutor
+    from dcmnii.watch import InboxWatcher
+    
+    # 常驻运行时输出通常被重定向到日志文件，按行刷新以便实时查看
+    if hasattr(sys.stdout, 'reconfigure'):
+        sys.stdout.reconfigure(line_buffering=True)
+    
+    output_dir = inbox_dir / "output"
+    output_dir.mkdir(parents=True, exist_ok=True)
+    configure_zip_cache(output_dir / ZIP_INDEX_DIR_NAME)
+    temp_root = inbox_dir / "temp_dcm2niix_processing"
+    temp_root.mkdir(parents=True, exist_ok=True)
+    
+    workers = args.workers or 2
+    output_options = output_options_from_args(args)
+    policies = retry_policies(args.io_retries)
+    if not args.gzip_threads:
+        # 多个worker同时压缩时，自动线程数按worker平分CPU
+        output_options.threads = max(1, output_options.threads // workers)
     
-    if len(nii_files) <= 1:
-        return nii_files  # 只有1个或0个文件，不需要处理
+    watcher = InboxWatcher(inbox_dir, state_path=output_dir / ".watch_state.json",
+                           settle_seconds=args.settle, poll_interval=args.poll_interval,
+                           idle_exit=args.idle_exit)
+    run_timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    # 每个case完成只追加一行到 .jsonl（不再每次重写整个报告），内存中只保留汇总需要的计时
+    report = ReportWriter(output_dir / f"watch_report_{run_timestamp}.jsonl",
+                          log_dir=output_dir / f"watch_logs_{run_timestamp}")
+    latencies = []
+    stage_timings = []
+    converted = 0
+    # 监视模式没有总数，只输出吞吐
+    progress = progress_from_args(args)
+    metrics = metrics_from_args(args, 'max_layers_watch')
+    all_json_files = []
+    lock = threading.Lock()
+    in_flight = {}
     
-    # 找到最大的文件
-    largest_file = max(nii_files, key=lambda f: f.stat().st_size)
-    files_to_delete = [f for f in nii_files if f != largest_file]
+    print(f"\n👀 监视收件箱: {inbox_dir}")
+    print(f"   检测方式: {watcher.backend}, 稳定等待: {args.settle}s, worker数: {workers}")
+    print(f"   NIfTI压缩: {output_options.describe()}")
+    print(f"   已处理记录: {len(watcher.done)} 个ZIP（{watcher.state_path.name}）")
+    print("   按 Ctrl+C 停止")
+    if args.profile:
+        print("⚠ --watch 模式下忽略 --profile")
     
-    deleted_count = 0
-    for nii_file in files_to_delete:
-        # 删除对应的JSON文件
-        json_file = nii_file.with_suffix('.json')
-        if json_file.exists():
-            json_file.unlink()
-            deleted_count += 1
-        # 删除NIfTI文件
-        nii_file.unlink()
-        deleted_count += 1
+    def on_done(future, zip_path, detected_at):
+        try:
+            result = future.result()
+        except Exception as e:
+            result = {'zip_file': archive_stem(zip_path), 'success': False, **error_from_exception(e).fields(),
+                      'processing_time': datetime.now().isoformat()}
+        result['watch'] = {
+            'detected_at': datetime.fromtimestamp(detected_at).isoformat(),
+            'latency_seconds': round(time.time() - detected_at, 3),
+        }
+        nonlocal converted
+        with lock:
+            in_flight.pop(future, None)
+            metrics.observe(result)
+            report.write(result)
+            latencies.append(result['watch']['latency_seconds'])
+            stage_timings.append(result.get('stage_timings'))
+            if result['success']:
+                converted += 1
+                all_json_files.extend(Path(p) for p in result.get('json_file_paths', []))
+                print(f"  ✓ {zip_path.name} 完成，耗时 {result['watch']['latency_seconds']:.1f}s")
+            else:
+                print(f"  ✗ {zip_path.name} 失败: {result.get('error')}")
+            files, nbytes = case_io(result)
+            progress.case_done(archive_stem(zip_path), result['success'], files=files, nbytes=nbytes)
+            if watcher.stopped and not result['success']:
+                watcher.release(zip_path)
+            else:
+                watcher.mark_done(zip_path)
     
-    if deleted_count > 0:
-        print(f"  Removed {deleted_count//2} smaller NIfTI files, kept: {largest_file.name}")
+    def on_term(signum, frame):
+        raise KeyboardInterrupt
     
-    return [largest_file]
+    previous_term = signal.signal(signal.SIGTERM, on_term)
+    pool = ProcessPoolExecutor(max_workers=workers, initializer=_warm_worker)
+    try:
+        for zip_path in watcher.ready():
+            detected_at = time.time()
+            print(f"\n📦 新ZIP就绪: {zip_path.name}")
+            future = pool.submit(convert_zip_in_own_temp, str(zip_path), str(temp_root),
+                                 str(output_dir), str(dcm2niix_path), output_options, policies)
+            with lock:
+                in_flight[future] = zip_path
+            future.add_done_callback(lambda f, z=zip_path, t=detected_at: on_done(f, z, t))
+    except KeyboardInterrupt:
+        print(f"\n收到停止信号，等待 {len(in_flight)} 个进行中的转换完成...")
+    finally:
+        watcher.stop()
+        pool.shutdown(wait=True)
+        watcher.close()
+        signal.signal(signal.SIGTERM, previous_term)
+    
+    print(f"\n{'='*60}")
+    print(f"WATCH SUMMARY")
+    print(f"{'='*60}")
+    progress.close()
+    metrics.close()
+    print(f"Cases converted: {converted}/{report.count}")
+    report_path = report.close()
+    if latencies:
+        latencies.sort()
+        print(f"Latency (detected -> done): median {latencies[len(latencies) // 2]:.1f}s, max {latencies[-1]:.1f}s")
+        print_stage_summary(stage_timings)
+        print(f"✓ Watch report: {report_path.name}")
+    if all_json_files:
+        json_summary_path, clinical_summary_path = extract_json_metadata_to_csv_unified(output_dir, all_json_files)
+        if json_summary_path and clinical_summary_path:
+            print(f"✓ Complete metadata: {json_summary_path.name}")
+            print(f"✓ Clinical summary: {clinical_summary_path.name}")
 
 
-def extract_json_metadata_to_csv(output_dir):
+def queue_batch(data_dir, dcm2niix_path, args, base_dir):
+    """
+    分布式批处理（--queue）：挂载同一共享目录的多台机器各自运行同一命令，从共享队列领取case
+    
+    第一个启动的worker负责查找输入、提取元数据并按调度顺序生成任务，其他worker等待后一起领取；
+    每个case的结果写入本worker的报告分片，最后完成的worker合并各分片，生成与单机运行相同的汇总文件。
+    """
+    from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+    from dcmnii.workqueue import queue_from_args
+    
+    summary_output_dir = data_dir / "output"
+    summary_output_dir.mkdir(parents=True, exist_ok=True)
+    configure_zip_cache(summary_output_dir / ZIP_INDEX_DIR_NAME)
+    queue = queue_from_args(args, summary_output_dir).start()
+    print(f"\n🔗 分布式队列: {queue.root}")
+    print(f"   worker: {queue.worker_id}, 租约超时: {queue.lease_timeout:.0f}s, 心跳: {queue.heartbeat:.0f}s")
+    
+    if queue.acquire_seed():
+        zip_files, dicom_folders = discover_inputs(data_dir, args)
+        print(f"\n📋 检测到: {len(zip_files)} 个压缩包, {len(dicom_folders)} 个DICOM文件夹")
+        if zip_files:
+            run_metadata_extraction(data_dir, base_dir, args, zip_files)
+        jobs = order_jobs(estimate_jobs(zip_files, dicom_folders), args.order)
+        tasks = [{'name': job.name, 'kind': job.kind, 'path': str(job.path), 'cost_bytes': job.cost_bytes,
+                  'label': {'zip_file' if job.kind == 'archive' else 'dicom_folder': job.name}} for job in jobs]
+        if queue.seed(tasks, data_dir=str(data_dir), order=args.order):
+            print(f"✓ 已生成 {len(tasks)} 个任务（{ORDER_DESCRIPTIONS[args.order]}，"
+                  f"预估总量 {format_bytes(sum(job.cost_bytes for job in jobs))}）")
+    batch = queue.batch()
+    
+    workers = max(1, args.workers or 1)
+    output_options = output_options_from_args(args)
+    policies = retry_policies(args.io_retries)
+    if workers > 1 and not args.gzip_threads:
+        output_options.threads = max(1, output_options.threads // workers)
+    pending, running = queue.remaining()
+    print(f"\n批次: {batch['total']} 个case（任务由 {batch['seeded_by']} 生成），"
+          f"待领取 {pending}, 处理中 {running}; 本机worker数: {workers}")
+    print(f"NIfTI压缩: {output_options.describe()}")
+    if workers > 1 and args.profile:
+        print("⚠ 并行模式（--workers > 1）下忽略 --profile")
+    
+    custom_temp_dir = data_dir / "temp_dcm2niix_processing"
+    custom_temp_dir.mkdir(parents=True, exist_ok=True)
+    run_timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    profiler = CaseProfiler(args.profile if workers == 1 else None,
+                            profile_dir(summary_output_dir, f"{run_timestamp}_{queue.worker_id}"))
+    # 每个worker只处理整批的一部分，进度只输出本机的吞吐，指标不带计划总数
+    progress = progress_from_args(args)
+    metrics = metrics_from_args(args, 'max_layers')
+    own_results = []
+    
+    def collect(task, result):
+        metrics.observe(result)
+        own_results.append(queue.complete(task, result))
+        status = '✓' if result['success'] else '✗'
+        print(f"  {status} [{queue.completed}] {task.name} (~{format_bytes(task.data['cost_bytes'])}, "
+              f"{case_seconds(result):.1f}s)")
+        progress.case_done(task.name, result['success'], files=case_io(result)[0], nbytes=task.data['cost_bytes'])
+    
+    def failure(task, exc):
+        return {**task.data['label'], 'success': False, **error_from_exception(exc).fields(),
+                'processing_time': datetime.now().isoformat()}
+    
     try:
-        print("  Scanning JSON files...")
-        json_files = [f for f in Path(output_dir).glob("*.json") if not f.name.startswith("smart_conversion_report")]
-        if not json_files:
-            print("  Warning: No JSON metadata files found")
-            return None, None
-        print(f"  Found {len(json_files)} JSON files to process...")
-        dicom_metadata_df = None
-        base_dir = Path(output_dir).parent.parent
-        metadata_dir = base_dir / "output"
-        dicom_csv_files = list(metadata_dir.glob("dicom_metadata_*.csv"))
-        if dicom_csv_files:
-            latest_dicom_csv = max(dicom_csv_files, key=lambda f: f.stat().st_mtime)
-            try:
-                dicom_metadata_df = pd.read_csv(latest_dicom_csv)
-                print(f"  Found DICOM metadata: {latest_dicom_csv.name}")
-            except Exception as e:
-                print(f"  Warning: Could not read DICOM metadata: {e}")
-        else:
-            print("  Warning: No DICOM metadata CSV found")
-        all_metadata = []
-        for json_file in json_files:
-            try:
-                parts = json_file.stem.split('_')
-                if len(parts) >= 4:
-                    case_name = parts[0] + '_' + parts[1]
-                    patient_id = parts[2]
-                    series_info = '_'.join(parts[3:])
-                else:
-                    case_name = json_file.stem
-                    patient_id = 'Unknown'
-                    series_info = 'Unknown'
-                with open(json_file, 'r', encoding='utf-8') as f:
-                    json_data = json.load(f)
-                dicom_info = {}
-                if dicom_metadata_df is not None and patient_id != 'Unknown':
-                    matching_rows = dicom_metadata_df[dicom_metadata_df['PatientID'].astype(str) == str(patient_id)]
-                    if not matching_rows.empty:
-                        dicom_row = matching_rows.iloc[0]
-                        dicom_info = {
-                            'PatientName': str(dicom_row.get('PatientName', 'Unknown')),
-                            'PatientBirthDate': str(dicom_row.get('PatientBirthDate', 'Unknown')),
-                            'PatientSex': str(dicom_row.get('PatientSex', 'Unknown')),
-                            'StudyDate': str(dicom_row.get('StudyDate', 'Unknown')),
-                            'StudyTime': str(dicom_row.get('StudyTime', 'Unknown')),
-                            'InstitutionName': str(dicom_row.get('InstitutionName', 'Unknown')),
-                        }
+        with tempfile.TemporaryDirectory(dir=str(custom_temp_dir)) as temp_dir:
+            if workers == 1:
+                for task in queue.tasks():
+                    print(f"\n📥 领取: {task.name} (第 {task.attempt} 次)")
+                    with profiler.case(task.name) as prof:
                         try:
-                            if dicom_info['PatientBirthDate'] != 'Unknown' and dicom_info['StudyDate'] != 'Unknown':
-                                birth_date = dicom_info['PatientBirthDate']
-                                study_date = dicom_info['StudyDate']
-                                if len(birth_date) == 8 and len(study_date) == 8:
-                                    birth_year = int(birth_date[:4])
-                                    study_year = int(study_date[:4])
-                                    age = study_year - birth_year
-                                    dicom_info['PatientAge'] = str(age)
-                                else:
-                                    dicom_info['PatientAge'] = 'Unknown'
-                            else:
-                                dicom_info['PatientAge'] = 'Unknown'
+                            result = convert_job(task.data['kind'], task.data['path'], temp_dir, dcm2niix_path,
+                                                 output_options, policies)
                         except Exception as e:
-                            print(f"  ⚠ 无法解析PatientAge: {str(e)}")
-                            dicom_info['PatientAge'] = 'Unknown'
-                metadata = {
-                    'FileName': json_file.name,
-                    'CaseName': case_name,
-                    'PatientID': patient_id,
-                    'SeriesInfo': series_info,
-                    'NIfTIFile': json_file.stem + '.nii.gz',
-                    'Modality': json_data.get('Modality', 'Unknown'),
-                    'StudyDate': dicom_info.get('StudyDate', json_data.get('StudyDate', 'Unknown')),
-                    'StudyTime': dicom_info.get('StudyTime', json_data.get('StudyTime', 'Unknown')),
-                    'StudyDescription': json_data.get('StudyDescription', 'Unknown'),
-                    'SeriesNumber': json_data.get('SeriesNumber', 'Unknown'),
-                    'SeriesDescription': json_data.get('SeriesDescription', 'Unknown'),
-                    'ProtocolName': json_data.get('ProtocolName', 'Unknown'),
-                    'PatientName': dicom_info.get('PatientName', json_data.get('PatientName', 'Unknown')),
-                    'PatientBirthDate': dicom_info.get('PatientBirthDate', json_data.get('PatientBirthDate', 'Unknown')),
-                    'PatientSex': dicom_info.get('PatientSex', json_data.get('PatientSex', 'Unknown')),
-                    'PatientAge': dicom_info.get('PatientAge', json_data.get('PatientAge', 'Unknown')),
-                    'SliceThickness': json_data.get('SliceThickness', 'Unknown'),
-                    'SpacingBetweenSlices': json_data.get('SpacingBetweenSlices', 'Unknown'),
-                    'PixelSpacing': str(json_data.get('PixelSpacing', 'Unknown')),
-                    'ImageOrientationPatientDICOM': str(json_data.get('ImageOrientationPatientDICOM', 'Unknown')),
-                    'RepetitionTime': json_data.get('RepetitionTime', 'Unknown'),
-                    'EchoTime': json_data.get('EchoTime', 'Unknown'),
-                    'FlipAngle': json_data.get('FlipAngle', 'Unknown'),
-                    'AcquisitionMatrix': str(json_data.get('AcquisitionMatrix', 'Unknown')),
-                    'Manufacturer': json_data.get('Manufacturer', 'Unknown'),
-                    'ManufacturerModelName': json_data.get('ManufacturerModelName', 'Unknown'),
-                    'MagneticFieldStrength': json_data.get('MagneticFieldStrength', 'Unknown'),
-                    'InstitutionName': json_data.get('InstitutionName', 'Unknown'),
-                    'StationName': json_data.get('StationName', 'Unknown'),
-                    'ConvolutionKernel': json_data.get('ConvolutionKernel', 'Unknown'),
-                    'ReconstructionDiameter': json_data.get('ReconstructionDiameter', 'Unknown'),
-                    'KVP': json_data.get('KVP', 'Unknown'),
-                    'XRayTubeCurrent': json_data.get('XRayTubeCurrent', 'Unknown'),
-                    'ExposureTime': json_data.get('ExposureTime', 'Unknown'),
-                    'dcm2niix_version': json_data.get('dcm2niix_version', 'Unknown'),
-                    'ConversionSoftware': json_data.get('ConversionSoftware', 'dcm2niix'),
-                    'ConversionSoftwareVersion': json_data.get('ConversionSoftwareVersion', 'Unknown'),
-                    'ProcessingTime': datetime.now().isoformat()
-                }
-                all_metadata.append(metadata)
-            except Exception as e:
-                print(f"  Error processing {json_file.name}: {str(e)}")
-                continue
-        if not all_metadata:
-            print("  No valid metadata extracted")
-            return None, None
-        df = pd.DataFrame(all_metadata)
-        csv_path = Path(output_dir) / f"json_metadata_summary_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-        df.to_csv(csv_path, index=False, encoding='utf-8-sig')
-        clinical_fields = ['FileName', 'PatientID', 'StudyDate', 'PatientName', 'PatientBirthDate', 'PatientSex', 'PatientAge']
-        clinical_df = df[clinical_fields].copy()
-        clinical_csv_path = Path(output_dir) / f"clinical_info_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-        clinical_df.to_csv(clinical_csv_path, index=False, encoding='utf-8-sig')
-        print(f"  Successfully extracted metadata from {len(all_metadata)} JSON files")
-        print(f"  Complete CSV saved with {len(df.columns)} columns of information")
-        print(f"  Clinical CSV saved with {len(clinical_fields)} key fields")
-        print(f"\n  Metadata Summary:")
-        if 'Modality' in df.columns:
-            modality_counts = df['Modality'].value_counts()
-            print(f"    - Modalities: {dict(modality_counts)}")
-        if 'ManufacturerModelName' in df.columns:
-            scanner_counts = df['ManufacturerModelName'].value_counts()
-            print(f"    - Scanner models: {len(scanner_counts)} unique models")
-        if 'PatientSex' in df.columns:
-            sex_counts = df['PatientSex'].value_counts()
-            print(f"    - Patient sex distribution: {dict(sex_counts)}")
-        print(f"Complete metadata summary: {csv_path}")
-        print(f"Clinical info summary: {clinical_csv_path}")
-        return csv_path, clinical_csv_path
-    except Exception as e:
-        print(f"  Error during JSON metadata extraction: {str(e)}")
-        return None, None
-
-def extract_json_metadata_to_csv_unified(output_dir, json_files):
-    """统一处理所有JSON文件并生成汇总CSV - 参照原脚本逻辑"""
-    try:
-        print(f"  Processing {len(json_files)} JSON files...")
-        if not json_files:
-            print("  Warning: No JSON metadata files found")
-            return None, None
-        
-        # 尝试读取原始DICOM元数据CSV文件
-        dicom_metadata_df = None
-        
-        # 在多个位置寻找DICOM元数据文件
-        search_dirs = [
-            Path(output_dir),  # 当前output目录
-            Path(output_dir).parent,  # 选择的主目录
-            Path(__file__).parent.parent / "output",  # 项目output目录
-        ]
-        
-        dicom_csv_files = []
-        for search_dir in search_dirs:
-            if search_dir.exists():
-                dicom_csv_files.extend(list(search_dir.glob("dicom_metadata_*.csv")))
-                dicom_csv_files.extend(list(search_dir.glob("case_metadata_*.csv")))
-        
-        if dicom_csv_files:
-            latest_dicom_csv = max(dicom_csv_files, key=lambda f: f.stat().st_mtime)
-            try:
-                dicom_metadata_df = pd.read_csv(latest_dicom_csv)
-                print(f"  ✓ Found DICOM metadata: {latest_dicom_csv.name} ({len(dicom_metadata_df)} records)")
-            except Exception as e:
-                print(f"  ⚠ Warning: Could not read DICOM metadata: {e}")
-        
-        all_metadata = []
-        
-        for json_file in json_files:
-            try:
-                # 从文件名解析案例信息
-                parts = json_file.stem.split('_')
-                
-                if len(parts) >= 4:
-                    case_name = parts[0] + '_' + parts[1]  # dicom_XXXXXXX
-                    patient_id = parts[2]
-                    series_info = '_'.join(parts[3:])
-                else:
-                    case_name = json_file.stem
-                    patient_id = 'Unknown'
-                    series_info = 'Unknown'
-                
-                # 读取JSON内容
-                with open(json_file, 'r', encoding='utf-8') as f:
-                    json_data = json.load(f)
-                
-                # 从原始DICOM元数据中获取患者信息
-                dicom_info = {}
-                if dicom_metadata_df is not None and patient_id != 'Unknown':
-                    # 尝试多种方式查找匹配的患者记录
-                    matching_rows = None
-                    
-                    # 方式1: 直接匹配PatientID
-                    if 'PatientID' in dicom_metadata_df.columns:
-                        matching_rows = dicom_metadata_df[dicom_metadata_df['PatientID'].astype(str) == str(patient_id)]
-                    
-                    # 方式2: 如果没找到，尝试匹配文件名中的部分
-                    if matching_rows is None or matching_rows.empty:
-                        for _, row in dicom_metadata_df.iterrows():
-                            if str(patient_id) in str(row.get('PatientID', '')):
-                                matching_rows = dicom_metadata_df[dicom_metadata_df.index == row.name]
+                            result = failure(task, e)
+                    if prof:
+                        result['profile'] = prof
+                    collect(task, result)
+            else:
+                # 本机最多同时领取 workers 个任务，有worker空闲才领取下一个（不替其他机器囤积任务）
+                with ProcessPoolExecutor(max_workers=workers, initializer=_warm_worker) as pool:
+                    in_flight = {}
+                    while True:
+                        while len(in_flight) < workers:
+                            task = queue.next_task()
+                            if task is None:
                                 break
-                    
-                    if matching_rows is not None and not matching_rows.empty:
-                        # 使用第一个匹配的记录
-                        dicom_row = matching_rows.iloc[0]
-                        
-                        # 提取可用字段
-                        available_fields = {}
-                        field_mapping = {
-                            'PatientName': ['PatientName', 'Patient Name'],
-                            'PatientBirthDate': ['PatientBirthDate', 'PatientBirtDate', 'Patient Birth Date'],
-                            'PatientSex': ['PatientSex', 'Patient Sex'],
-                            'StudyDate': ['StudyDate', 'Study Date'],
-                            'StudyTime': ['StudyTime', 'Study Time'],
-                            'InstitutionName': ['InstitutionName', 'Institution Name'],
-                            'PatientAge': ['PatientAge', 'Patient Age']
-                        }
-                        
-                        for target_field, possible_names in field_mapping.items():
-                            value = 'Unknown'
-                            for name in possible_names:
-                                if name in dicom_row.index and pd.notna(dicom_row[name]):
-                                    value = str(dicom_row[name])
-                                    break
-                            available_fields[target_field] = value
-                        
-                        dicom_info = available_fields
-                        
-                        # 如果没有现成的年龄，尝试计算
-                        if dicom_info.get('PatientAge') == 'Unknown':
+                            print(f"\n📥 领取: {task.name} (第 {task.attempt} 次)")
+                            future = pool.submit(convert_job, task.data['kind'], task.data['path'], temp_dir,
+                                                 str(dcm2niix_path), output_options, policies)
+                            in_flight[future] = task
+                        if not in_flight:
+                            if queue.drained():
+                                break
+                            queue.wait()
+                            continue
+                        done, _ = wait(in_flight, timeout=queue.heartbeat, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            task = in_flight.pop(future)
                             try:
-                                birth_date = dicom_info.get('PatientBirthDate', '')
-                                study_date = dicom_info.get('StudyDate', '')
-                                if len(birth_date) == 8 and len(study_date) == 8:  # YYYYMMDD格式
-                                    birth_year = int(birth_date[:4])
-                                    study_year = int(study_date[:4])
-                                    age = study_year - birth_year
-                                    dicom_info['PatientAge'] = str(age)
+                                result = future.result()
                             except Exception as e:
-                                print(f"  ⚠ 无法计算患者年龄: {str(e)}")
-                                pass
-                
-                # 提取关键信息，优先使用原始DICOM数据
-                metadata = {
-                    'FileName': json_file.name,
-                    'CaseName': case_name,
-                    'PatientID': patient_id,
-                    'SeriesInfo': series_info,
-                    'NIfTIFile': json_file.stem + '.nii.gz',
-                    'OutputFolder': str(json_file.parent),
-                    
-                    # DICOM基本信息
-                    'Modality': json_data.get('Modality', 'Unknown'),
-                    'StudyDate': dicom_info.get('StudyDate', json_data.get('StudyDate', 'Unknown')),
-                    'StudyTime': dicom_info.get('StudyTime', json_data.get('StudyTime', 'Unknown')),
-                    'StudyDescription': json_data.get('StudyDescription', 'Unknown'),
-                    'SeriesNumber': json_data.get('SeriesNumber', 'Unknown'),
-                    'SeriesDescription': json_data.get('SeriesDescription', 'Unknown'),
-                    'ProtocolName': json_data.get('ProtocolName', 'Unknown'),
-                    
-                    # 患者信息（优先使用原始DICOM数据）
-                    'PatientName': dicom_info.get('PatientName', json_data.get('PatientName', 'Unknown')),
-                    'PatientBirthDate': dicom_info.get('PatientBirthDate', json_data.get('PatientBirthDate', 'Unknown')),
-                    'PatientSex': dicom_info.get('PatientSex', json_data.get('PatientSex', 'Unknown')),
-                    'PatientAge': dicom_info.get('PatientAge', json_data.get('PatientAge', 'Unknown')),
-                    
-                    # 影像参数
-                    'SliceThickness': json_data.get('SliceThickness', 'Unknown'),
-                    'SpacingBetweenSlices': json_data.get('SpacingBetweenSlices', 'Unknown'),
-                    'PixelSpacing': str(json_data.get('PixelSpacing', 'Unknown')),
-                    'ImageOrientationPatientDICOM': str(json_data.get('ImageOrientationPatientDICOM', 'Unknown')),
-                    
-                    # 采集参数
-                    'RepetitionTime': json_data.get('RepetitionTime', 'Unknown'),
-                    'EchoTime': json_data.get('EchoTime', 'Unknown'),
-                    'FlipAngle': json_data.get('FlipAngle', 'Unknown'),
-                    'AcquisitionMatrix': str(json_data.get('AcquisitionMatrix', 'Unknown')),
-                    
-                    # 设备信息
-                    'Manufacturer': json_data.get('Manufacturer', 'Unknown'),
-                    'ManufacturerModelName': json_data.get('ManufacturerModelName', 'Unknown'),
-                    'MagneticFieldStrength': json_data.get('MagneticFieldStrength', 'Unknown'),
-                    'InstitutionName': dicom_info.get('InstitutionName', json_data.get('InstitutionName', 'Unknown')),
-                    'StationName': json_data.get('StationName', 'Unknown'),
-                    
-                    # 重建参数
-                    'ConvolutionKernel': json_data.get('ConvolutionKernel', 'Unknown'),
-                    'ReconstructionDiameter': json_data.get('ReconstructionDiameter', 'Unknown'),
-                    'KVP': json_data.get('KVP', 'Unknown'),
-                    'XRayTubeCurrent': json_data.get('XRayTubeCurrent', 'Unknown'),
-                    'ExposureTime': json_data.get('ExposureTime', 'Unknown'),
-                    
-                    # dcm2niix相关
-                    'dcm2niix_version': json_data.get('dcm2niix_version', 'Unknown'),
-                    'ConversionSoftware': json_data.get('ConversionSoftware', 'dcm2niix'),
-                    'ConversionSoftwareVersion': json_data.get('ConversionSoftwareVersion', 'Unknown'),
-                    
-                    # 处理信息
-                    'ProcessingTime': datetime.now().isoformat()
-                }
-                
-                all_metadata.append(metadata)
-                
-            except Exception as e:
-                print(f"  Error processing {json_file.name}: {str(e)}")
-                continue
-        
-        if not all_metadata:
-            print("  No valid metadata extracted")
-            return None, None
-        
-        # 转换为DataFrame并保存完整元数据CSV
-        df = pd.DataFrame(all_metadata)
-        csv_path = Path(output_dir) / f"unified_metadata_summary_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-        df.to_csv(csv_path, index=False, encoding='utf-8-sig')
-        
-        # 创建简化的临床信息CSV
-        clinical_fields = ['FileName', 'PatientID', 'StudyDate', 'PatientName', 'PatientBirthDate', 'PatientSex', 'PatientAge', 'OutputFolder']
-        clinical_df = df[clinical_fields].copy()
-        
-        clinical_csv_path = Path(output_dir) / f"unified_clinical_info_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-        clinical_df.to_csv(clinical_csv_path, index=False, encoding='utf-8-sig')
-        
-        print(f"  Successfully extracted metadata from {len(all_metadata)} JSON files")
-        print(f"  Complete CSV saved with {len(df.columns)} columns of information")
-        print(f"  Clinical CSV saved with {len(clinical_fields)} key fields")
-        
-        # 显示一些统计信息
-        print(f"\n  Metadata Summary:")
-        if 'Modality' in df.columns:
-            modality_counts = df['Modality'].value_counts()
-            print(f"    - Modalities: {dict(modality_counts)}")
-        
-        if 'ManufacturerModelName' in df.columns:
-            scanner_counts = df['ManufacturerModelName'].value_counts()
-            print(f"    - Scanner models: {len(scanner_counts)} unique models")
-        
-        if 'PatientSex' in df.columns:
-            sex_counts = df['PatientSex'].value_counts()
-            print(f"    - Patient sex distribution: {dict(sex_counts)}")
-        
-        print(f"Complete metadata summary: {csv_path}")
-        print(f"Clinical info summary: {clinical_csv_path}")
-        return csv_path, clinical_csv_path
-        
-    except Exception as e:
-        print(f"  Error during unified JSON metadata extraction: {str(e)}")
-        return None, None
+                                result = failure(task, e)
+                            collect(task, result)
+    finally:
+        queue.close()
+        progress.close()
+        metrics.close()
+        profiler.close()
+    
+    succeeded = sum(1 for r in own_results if r['success'])
+    print(f"\n本worker完成 {len(own_results)} 个case（成功 {succeeded}），回收过期租约 {queue.reclaimed} 个")
+    print(f"报告分片: {queue.shard_path}")
+    
+    records = queue.finalize()
+    if records is None:
+        print("其他worker仍在处理或已生成汇总，本worker退出")
+        return
+    
+    # 本worker最后完成：合并各worker的报告分片，生成整批的汇总
+    print(f"\n所有任务已完成，合并 {len(queue.workers())} 个worker的报告分片...")
+    report = ReportWriter(summary_output_dir / f"conversion_report_{run_timestamp}.jsonl",
+                          log_dir=summary_output_dir / f"conversion_logs_{run_timestamp}")
+    for record in records:
+        report.write(record)
+    print_conversion_summary(records, sum(1 for r in records if 'zip_file' in r),
+                             sum(1 for r in records if 'dicom_folder' in r))
+    report_failures(records, summary_output_dir)
+    # 压缩包结果记录 json_file_paths，文件夹结果的 json_files 即为路径列表
+    all_json_files = [Path(p) for r in records if r['success']
+                      for p in (r.get('json_file_paths') or r.get('json_files') or []) if isinstance(p, str)]
+    if all_json_files:
+        print(f"\nStep 3: Generating unified metadata summary...")
+        json_summary_path, clinical_summary_path = extract_json_metadata_to_csv_unified(summary_output_dir, all_json_files)
+        if json_summary_path and clinical_summary_path:
+            print(f"✓ Complete metadata: {json_summary_path.name}")
+            print(f"✓ Clinical summary: {clinical_summary_path.name}")
+    summary_report = report.close()
+    print(f"✓ Detailed report: {summary_report.name}")
+    print(f"\n✅ Processing complete!")
+    print(f"📄 Summary files saved to: {summary_output_dir}")
+
+
+def parse_args():
+    """解析命令行参数"""
+    import argparse
+    parser = argparse.ArgumentParser(description='智能DICOM到NIfTI转换（层数优先）')
+    parser.add_argument('data_dir', nargs='?', help='包含ZIP病例或DICOM文件夹的主目录（不提供则弹窗选择）')
+    add_profile_argument(parser)
+    add_output_arguments(parser)
+    add_progress_arguments(parser)
+    add_metrics_arguments(parser)
+    add_retry_arguments(parser)
+    schedule = add_schedule_arguments(parser)
+    schedule.add_argument('--workers', type=int, default=None,
+                          help='并行转换的worker进程数（默认: 批处理1，--watch 模式2）')
+    watch = parser.add_argument_group('常驻监视模式')
+    watch.add_argument('--watch', action='store_true',
+                       help='常驻运行，监视 data_dir（收件箱）中新到达的ZIP并立即转换')
+    watch.add_argument('--settle', type=float, default=5.0,
+                       help='ZIP大小和修改时间保持不变多少秒后才开始转换（默认5）')
+    watch.add_argument('--poll-interval', type=float, default=2.0,
+                       help='无inotify时的目录轮询间隔秒数（默认2）')
+    watch.add_argument('--idle-exit', type=float, default=0,
+                       help='收件箱空闲超过该秒数后退出（默认0，一直运行）')
+    add_queue_arguments(parser)
+    return parser.parse_args()
 
 
 def main():
     """主函数，支持命令行参数或弹窗选择目录"""
+    args = parse_args()
     # 设置路径
     base_dir = Path(__file__).parent.parent
     # 目录选择：优先命令行参数，否则弹窗
-    if len(sys.argv) > 1:
-        data_dir = Path(sys.argv[1])
+    if args.data_dir:
+        data_dir = Path(args.data_dir)
         print(f"使用命令行参数目录: {data_dir}")
     else:
+        # tkinter 只在弹窗模式下导入，无图形界面的服务器上命令行模式不受影响
+        try:
+            import tkinter as tk
+            from tkinter import filedialog, messagebox
+        except ImportError:
+            print("错误: 弹窗选择目录需要tkinter库，请在命令行中提供目录参数")
+            return
         root = tk.Tk()
         root.withdraw()
         selected = filedialog.askdirectory(title="请选择包含ZIP病例或DICOM文件夹的主目录")
@@ -682,61 +582,34 @@ def main():
         data_dir = Path(selected)
         print(f"使用弹窗选择目录: {data_dir}")
 
-    dcm2niix_path = base_dir / "dcm2niix.exe"
-    if not dcm2niix_path.exists():
-        alt_dcm2niix = base_dir / "tools" / "MRIcroGL" / "Resources" / "dcm2niix.exe"
-        if alt_dcm2niix.exists():
-            dcm2niix_path = alt_dcm2niix
-        else:
-            print("Error: dcm2niix.exe not found!")
-            return
+    dcm2niix_path = find_dcm2niix(base_dir)
+    if not dcm2niix_path:
+        print("Error: dcm2niix.exe not found!")
+        return
     print(f"Using dcm2niix: {dcm2niix_path}")
     
-    # 检测输入类型：ZIP文件和DICOM文件夹
-    zip_files = list(data_dir.glob("*.zip"))
+    if args.watch:
+        watch_inbox(data_dir, dcm2niix_path, args)
+        return
+    if args.queue is not None:
+        queue_batch(data_dir, dcm2niix_path, args, base_dir)
+        return
     
-    # 查找可能的DICOM文件夹（排除已知的输出目录）
-    dicom_folders = []
-    exclude_dirs = {'output', 'temp_dcm2niix_processing', '.git', '__pycache__'}
-    for item in data_dir.iterdir():
-        if item.is_dir() and item.name not in exclude_dirs:
-            # 检查文件夹中是否有DICOM文件
-            has_dicom = False
-            try:
-                # 检查标准DICOM扩展名
-                for ext in ['*.dcm', '*.dicom', '*.DCM', '*.DICOM']:
-                    if list(item.rglob(ext)):
-                        has_dicom = True
-                        break
-                
-                # 如果没有标准扩展名，检查前几个文件是否为DICOM
-                if not has_dicom:
-                    all_files = [f for f in item.rglob('*') if f.is_file()][:5]
-                    for file_path in all_files:
-                        try:
-                            pydicom.dcmread(str(file_path), force=True)
-                            has_dicom = True
-                            break
-                        except:
-                            continue
-            except:
-                continue
-            
-            if has_dicom:
-                dicom_folders.append(item)
+    # 检测输入类型：ZIP文件和DICOM文件夹
+    zip_files, dicom_folders = discover_inputs(data_dir, args)
     
     # 显示检测结果
     total_items = len(zip_files) + len(dicom_folders)
     if total_items == 0:
         print("❌ No ZIP files or DICOM folders found in the directory")
         print("请确保目录中包含：")
-        print("  - ZIP压缩包（包含DICOM文件）")
+        print("  - ZIP / tar / tar.gz / tar.zst 压缩包（包含DICOM文件）")
         print("  - DICOM文件夹（直接包含DICOM文件）")
         return
     
     print(f"\n📋 检测到的输入文件/文件夹:")
     if zip_files:
-        print(f"  📦 ZIP文件: {len(zip_files)} 个")
+        print(f"  📦 压缩包: {len(zip_files)} 个")
         for zip_file in zip_files[:3]:  # 最多显示3个
             print(f"    - {zip_file.name}")
         if len(zip_files) > 3:
@@ -751,18 +624,166 @@ def main():
     
     print(f"\n总计: {total_items} 个待处理项目")
     print("智能处理模式: 自动分析并转换每个case的主要序列")
+    workers = max(1, args.workers or 1)
+    output_options = output_options_from_args(args)
+    policies = retry_policies(args.io_retries)
+    if workers > 1 and not args.gzip_threads:
+        # 多个worker同时压缩时，自动线程数按worker平分CPU
+        output_options.threads = max(1, output_options.threads // workers)
+    print(f"NIfTI压缩: {output_options.describe()}")
     print("输出保存: 每个项目的output文件夹中")
     
+    # ZIP中央目录缓存：元数据提取子进程、调度估算、各worker解压共用（通过环境变量传给子进程）
+    configure_zip_cache(data_dir / "output" / ZIP_INDEX_DIR_NAME)
+    
     # 第一步：提取DICOM元数据（仅对ZIP文件）
+    run_metadata_extraction(data_dir, base_dir, args, zip_files)
+    
+    # 第二步：批量转换所有ZIP文件
+    # 临时目录设置在用户选择的主目录下，避免跨盘符问题
+    custom_temp_dir = data_dir / "temp_dcm2niix_processing"
+    custom_temp_dir.mkdir(parents=True, exist_ok=True)
+    
+    # 按case剖析（--profile），剖析文件与转换报告一起保存在output文件夹
+    run_timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    profiler = CaseProfiler(args.profile, profile_dir(data_dir / "output", run_timestamp))
+    
+    # 每个case完成即追加到 .jsonl 报告（崩溃不丢失），dcm2niix输出写到单独的case日志文件
+    summary_output_dir = data_dir / "output"
+    summary_output_dir.mkdir(parents=True, exist_ok=True)
+    report = ReportWriter(summary_output_dir / f"conversion_report_{run_timestamp}.jsonl",
+                          log_dir=summary_output_dir / f"conversion_logs_{run_timestamp}")
+    
+    # 按预估开销（ZIP解压后大小 / 文件夹大小）排列处理顺序
+    jobs = order_jobs(estimate_jobs(zip_files, dicom_folders), args.order)
+    total_bytes = sum(job.cost_bytes for job in jobs)
+    print(f"\n调度: {ORDER_DESCRIPTIONS[args.order]}, worker数: {workers}, 预估总量: {format_bytes(total_bytes)}")
+    index = zip_index()
+    if index.loads or index.parses:
+        print(f"ZIP中央目录: {index.loads} 个来自缓存, {index.parses} 个重新解析（{index.cache_dir}）")
+    if workers > 1 and args.profile:
+        print("⚠ 并行模式（--workers > 1）下忽略 --profile")
+    
+    with tempfile.TemporaryDirectory(dir=str(custom_temp_dir)) as temp_dir:
+        all_results = []
+        all_json_files = []
+        # 进度/吞吐/ETA：按估算的总字节数计算剩余时间
+        progress = progress_from_args(args, total=total_items, total_bytes=total_bytes)
+        metrics = metrics_from_args(args, 'max_layers', total=total_items)
+        
+        def collect(job, result):
+            """写入报告，收集生成的JSON文件用于汇总，并更新进度和指标"""
+            metrics.observe(result)
+            all_results.append(report.write(result))
+            if result['success']:
+                output_dir = job.path.parent / "output"
+                # 只收集本case报告的sidecar（压缩包结果为 json_file_paths，文件夹结果为 json_files）
+                json_paths = result.get('json_file_paths') or result.get('json_files') or []
+                all_json_files.extend(Path(p) for p in json_paths if isinstance(p, str))
+                print(f"  ✓ Output saved to: {output_dir}")
+            progress.case_done(job.name, result['success'], files=case_io(result)[0], nbytes=job.cost_bytes)
+        
+        if workers == 1:
+            for current_item, job in enumerate(jobs, start=1):
+                # 为每个ZIP / DICOM文件夹在其所在目录下创建output文件夹
+                job_output_dir = job.path.parent / "output"
+                job_output_dir.mkdir(parents=True, exist_ok=True)
+            
+                # 转换并收集结果
+                with profiler.case(job.name) as prof:
+                    if job.kind == 'archive':
+                        print(f"\n[{current_item}/{total_items}] Processing archive: {job.path.name} "
+                              f"(~{format_bytes(job.cost_bytes)})...")
+                        result = process_zip_to_nifti_smart(job.path, temp_dir, job_output_dir, dcm2niix_path,
+                                                            output_options, policies)
+                    else:
+                        print(f"\n[{current_item}/{total_items}] Processing DICOM folder: {job.path.name}/ "
+                              f"(~{format_bytes(job.cost_bytes)})...")
+                        result = process_dicom_folder_to_nifti_smart(job.path, job_output_dir, dcm2niix_path,
+                                                                     temp_dir, output_options, policies)
+                if prof:
+                    result['profile'] = prof
+                collect(job, result)
+        else:
+            # 按调度顺序一次性提交：进程池按提交顺序取任务，哪个worker空闲就接下一个（LPT时大case先开始）
+            from concurrent.futures import ProcessPoolExecutor, as_completed
+            with ProcessPoolExecutor(max_workers=workers, initializer=_warm_worker) as pool:
+                futures = {pool.submit(convert_job, job.kind, str(job.path), temp_dir, str(dcm2niix_path),
+                                       output_options, policies): job for job in jobs}
+                for current_item, future in enumerate(as_completed(futures), start=1):
+                    job = futures[future]
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        result = {'zip_file' if job.kind == 'archive' else 'dicom_folder': job.name, 'success': False,
+                                  **error_from_exception(e).fields(), 'processing_time': datetime.now().isoformat()}
+                    label = 'Archive' if job.kind == 'archive' else 'DICOM folder'
+                    status = '✓' if result['success'] else '✗'
+                    print(f"\n[{current_item}/{total_items}] {status} {label}: {job.path.name} "
+                          f"(~{format_bytes(job.cost_bytes)}, {case_seconds(result):.1f}s)")
+                    collect(job, result)
+        
+        progress.close()
+        metrics.close()
+        
+        # 第三步：生成汇总报告和统计
+        print_conversion_summary(all_results, len(zip_files), len(dicom_folders))
+        profiler.close()
+        report_failures(all_results, summary_output_dir)
+        
+        # 第四步：生成汇总CSV（保存到选择目录的output文件夹）
+        if all_json_files:
+            print(f"\nStep 3: Generating unified metadata summary...")
+            json_summary_path, clinical_summary_path = extract_json_metadata_to_csv_unified(summary_output_dir, all_json_files)
+            if json_summary_path and clinical_summary_path:
+                print(f"✓ Complete metadata: {json_summary_path.name}")
+                print(f"✓ Clinical summary: {clinical_summary_path.name}")
+        
+        # 第五步：把逐case追加的 .jsonl 报告压实为详细报告JSON（保存到选择目录的output文件夹）
+        summary_report = report.close()
+        print(f"✓ Detailed report: {summary_report.name} (case logs: {report.log_dir.name}/)")
+        
+        print(f"\n✅ Processing complete!")
+        print(f"📁 Individual outputs:")
+        if zip_files:
+            print(f"   - ZIP files: Check each ZIP's directory output folder")
+        if dicom_folders:
+            print(f"   - DICOM folders: Check each folder's parent directory output folder")
+        print(f"📄 Summary files saved to: {summary_output_dir}")
+
+
+def discover_inputs(data_dir, args):
+    """查找 data_dir 下的压缩包和DICOM文件夹（--retry-failed 时只保留上次失败的case）"""
+    zip_files = find_archives(data_dir)  # ZIP / tar / tar.gz / tar.zst
+    
+    # 查找可能的DICOM文件夹（排除已知的输出目录）：每个文件夹找到第一个DICOM文件即停止，
+    # 文件夹之间并行检查；结果缓存在output目录，未变化的文件夹下次运行不再检查
+    exclude_dirs = {'output', 'temp_dcm2niix_processing', '.git', '__pycache__'}
+    dicom_folders = find_dicom_folders(data_dir, exclude=exclude_dirs,
+                                       cache_path=data_dir / "output" / ".folder_discovery.json")
+    
+    if args.retry_failed:
+        # 只重新处理上次失败的case（failed_cases_*.txt 中ZIP记录为去掉扩展名的文件名，文件夹为目录名）
+        retry_names = set(read_failed_cases(args.retry_failed))
+        zip_files = [zip_file for zip_file in zip_files if archive_stem(zip_file) in retry_names]
+        dicom_folders = [folder for folder in dicom_folders if folder.name in retry_names]
+        print(f"重新处理 {Path(args.retry_failed).name} 中的失败case: "
+              f"找到 {len(zip_files) + len(dicom_folders)}/{len(retry_names)} 个")
+    return zip_files, dicom_folders
+
+
+def run_metadata_extraction(data_dir, base_dir, args, zip_files):
+    """第一步：在子进程中运行 extract_case_metadata_anywhere.py 提取DICOM元数据（仅对压缩包）"""
     if zip_files:
-        print(f"\nStep 1: Extracting DICOM metadata from ZIP files...")
+        print(f"\nStep 1: Extracting DICOM metadata from archives...")
         extract_script_path = base_dir / "src" / "extract_case_metadata_anywhere.py"
         if extract_script_path.exists():
             try:
                 import subprocess
-                result = subprocess.run([
-                    sys.executable, str(extract_script_path), str(data_dir)
-                ], capture_output=True, text=True, encoding='utf-8')
+                extract_cmd = [sys.executable, str(extract_script_path), str(data_dir)]
+                if args.profile:
+                    extract_cmd += ['--profile', args.profile]
+                result = subprocess.run(extract_cmd, capture_output=True, text=True, encoding='utf-8')
                 if result.returncode == 0:
                     print("✓ DICOM metadata extraction completed")
                     if result.stdout:
@@ -776,161 +797,87 @@ def main():
         else:
             print("⚠ extract_case_metadata_anywhere.py not found, skipping metadata extraction")
     else:
-        print(f"\nStep 1: No ZIP files found, skipping metadata extraction")
-        
+        print(f"\nStep 1: No archives found, skipping metadata extraction")
+    
     # 检查是否生成了元数据文件
     metadata_files = list(data_dir.glob("*metadata*.csv"))
     if metadata_files:
         print(f"✓ Found metadata files: {[f.name for f in metadata_files]}")
     else:
         print("⚠ No metadata CSV files found after extraction")
+
+
+def print_conversion_summary(all_results, zip_count, folder_count):
+    """打印成功/失败统计和分阶段耗时汇总（p50/p95）"""
+    total_items = len(all_results)
+    successful = [r for r in all_results if r['success']]
+    failed = [r for r in all_results if not r['success']]
     
-    # 第二步：批量转换所有ZIP文件
-    # 临时目录设置在用户选择的主目录下，避免跨盘符问题
-    custom_temp_dir = data_dir / "temp_dcm2niix_processing"
-    custom_temp_dir.mkdir(parents=True, exist_ok=True)
+    print(f"\n{'='*60}")
+    print(f"CONVERSION SUMMARY")
+    print(f"{'='*60}")
+    print(f"Total items processed: {total_items}")
+    print(f"  - ZIP files: {zip_count}")
+    print(f"  - DICOM folders: {folder_count}")
+    print(f"Successfully converted: {len(successful)}")
+    print(f"Failed: {len(failed)}")
+    if total_items:
+        print(f"Success rate: {len(successful)/total_items*100:.1f}%")
     
-    with tempfile.TemporaryDirectory(dir=str(custom_temp_dir)) as temp_dir:
-        all_results = []
-        all_json_files = []
-        
-        # 处理所有项目的计数器
-        current_item = 0
-        
-        # 第2.1步：处理ZIP文件
-        for zip_file in zip_files:
-            current_item += 1
-            print(f"\n[{current_item}/{total_items}] Processing ZIP: {zip_file.name}...")
-            
-            # 为每个ZIP在其源目录下创建output文件夹
-            zip_output_dir = zip_file.parent / "output"
-            zip_output_dir.mkdir(parents=True, exist_ok=True)
-            
-            # 转换并收集结果
-            result = process_zip_to_nifti_smart(zip_file, temp_dir, zip_output_dir, dcm2niix_path)
-            all_results.append(result)
-            
-            # 收集生成的JSON文件用于汇总
-            if result['success']:
-                json_files = list(zip_output_dir.glob(f"{zip_file.stem}_*.json"))
-                all_json_files.extend(json_files)
-                print(f"  ✓ Output saved to: {zip_output_dir}")
-        
-        # 第2.2步：处理DICOM文件夹
-        for dicom_folder in dicom_folders:
-            current_item += 1
-            print(f"\n[{current_item}/{total_items}] Processing DICOM folder: {dicom_folder.name}/...")
-            
-            # 为每个DICOM文件夹在其父目录下创建output文件夹
-            folder_output_dir = dicom_folder.parent / "output"
-            folder_output_dir.mkdir(parents=True, exist_ok=True)
-            
-            # 转换并收集结果
-            result = process_dicom_folder_to_nifti_smart(dicom_folder, folder_output_dir, dcm2niix_path)
-            all_results.append(result)
-            
-            # 收集生成的JSON文件用于汇总
-            if result['success']:
-                json_files = list(folder_output_dir.glob(f"{dicom_folder.name}_*.json"))
-                all_json_files.extend(json_files)
-                print(f"  ✓ Output saved to: {folder_output_dir}")
-        
-        # 第三步：生成汇总报告和统计
-        successful = [r for r in all_results if r['success']]
-        failed = [r for r in all_results if not r['success']]
-        
+    print_stage_summary([r.get('stage_timings') for r in all_results])
+
+
+def report_failures(all_results, summary_output_dir):
+    """按错误类别打印失败的case，并保存 failed_cases_*.txt（--retry-failed 读取）"""
+    failed = [r for r in all_results if not r['success']]
+    # 错误分类统计
+    if failed:
         print(f"\n{'='*60}")
-        print(f"CONVERSION SUMMARY")
+        print(f"ERROR SUMMARY")
         print(f"{'='*60}")
-        print(f"Total items processed: {total_items}")
-        print(f"  - ZIP files: {len(zip_files)}")
-        print(f"  - DICOM folders: {len(dicom_folders)}")
-        print(f"Successfully converted: {len(successful)}")
-        print(f"Failed: {len(failed)}")
-        print(f"Success rate: {len(successful)/total_items*100:.1f}%")
         
-        # 错误分类统计
-        if failed:
-            print(f"\n{'='*60}")
-            print(f"ERROR SUMMARY")
-            print(f"{'='*60}")
-            
-            # 按错误类型分类
-            error_types = defaultdict(list)
-            for f in failed:
-                error_msg = f.get('error', 'Unknown error')
-                # 获取文件/文件夹名称
-                case_name = f.get('zip_file') or f.get('dicom_folder', 'Unknown')
-                
-                # 简化错误类型
-                if 'No valid DICOM' in error_msg or 'No suitable series' in error_msg:
-                    error_type = 'DICOM文件问题'
-                elif 'dcm2niix' in error_msg.lower():
-                    error_type = 'dcm2niix转换失败'
-                elif 'extract' in error_msg.lower() or 'zip' in error_msg.lower():
-                    error_type = 'ZIP解压失败'
-                else:
-                    error_type = '其他错误'
-                error_types[error_type].append(case_name)
+        # 按错误类型分类
+        error_types = defaultdict(list)
+        for f in failed:
+            # 获取文件/文件夹名称
+            case_name = f.get('zip_file') or f.get('dicom_folder', 'Unknown')
             
-            print(f"\n按错误类型分类:")
+            # 简化错误类型（与 --metrics-file 的 category 标签一致）
+            error_type = ERROR_CATEGORIES[error_category(f)]
+            error_types[error_type].append(case_name)
+        
+        print(f"\n按错误类型分类:")
+        for error_type, cases in sorted(error_types.items(), key=lambda x: len(x[1]), reverse=True):
+            print(f"\n  {error_type} ({len(cases)} cases):")
+            for case in cases[:10]:  # 最多显示10个
+                print(f"    - {case}")
+            if len(cases) > 10:
+                print(f"    ... 还有 {len(cases)-10} 个case")
+        
+        print(f"\n详细错误信息:")
+        for f in failed:
+            case_name = f.get('zip_file') or f.get('dicom_folder', 'Unknown')
+            case_type = '📦ZIP' if 'zip_file' in f else '📁文件夹'
+            print(f"  ✗ {case_type}: {case_name}")
+            print(f"    错误: {f['error']}")
+        
+        # 保存失败case列表到文件
+        failed_list_path = summary_output_dir / f"failed_cases_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
+        with open(failed_list_path, 'w', encoding='utf-8') as f:
+            f.write("# 转换失败的case列表\n")
+            f.write(f"# 生成时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+            f.write(f"# 总失败数: {len(failed)} (ZIP文件: {len([r for r in failed if 'zip_file' in r])}, DICOM文件夹: {len([r for r in failed if 'dicom_folder' in r])})\n\n")
             for error_type, cases in sorted(error_types.items(), key=lambda x: len(x[1]), reverse=True):
-                print(f"\n  {error_type} ({len(cases)} cases):")
-                for case in cases[:10]:  # 最多显示10个
-                    print(f"    - {case}")
-                if len(cases) > 10:
-                    print(f"    ... 还有 {len(cases)-10} 个case")
-            
-            print(f"\n详细错误信息:")
-            for f in failed:
-                case_name = f.get('zip_file') or f.get('dicom_folder', 'Unknown')
-                case_type = '📦ZIP' if 'zip_file' in f else '📁文件夹'
-                print(f"  ✗ {case_type}: {case_name}")
-                print(f"    错误: {f['error']}")
-            
-            # 保存失败case列表到文件
-            summary_output_dir = data_dir / "output"
-            summary_output_dir.mkdir(parents=True, exist_ok=True)
-            failed_list_path = summary_output_dir / f"failed_cases_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
-            with open(failed_list_path, 'w', encoding='utf-8') as f:
-                f.write("# 转换失败的case列表\n")
-                f.write(f"# 生成时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-                f.write(f"# 总失败数: {len(failed)} (ZIP文件: {len([r for r in failed if 'zip_file' in r])}, DICOM文件夹: {len([r for r in failed if 'dicom_folder' in r])})\n\n")
-                for error_type, cases in sorted(error_types.items(), key=lambda x: len(x[1]), reverse=True):
-                    f.write(f"\n## {error_type} ({len(cases)} cases)\n")
-                    for case in cases:
-                        f.write(f"{case}\n")
-                f.write(f"\n## 详细错误信息\n")
-                for fail in failed:
-                    case_name = fail.get('zip_file') or fail.get('dicom_folder', 'Unknown')
-                    case_type = 'ZIP' if 'zip_file' in fail else 'DICOM文件夹'
-                    f.write(f"\n[{case_type}] {case_name}: {fail['error']}\n")
-            print(f"\n✓ 失败case列表已保存: {failed_list_path.name}")
-        
-        # 第四步：生成汇总CSV（保存到选择目录的output文件夹）
-        summary_output_dir = data_dir / "output"
-        summary_output_dir.mkdir(parents=True, exist_ok=True)
-        
-        if all_json_files:
-            print(f"\nStep 3: Generating unified metadata summary...")
-            json_summary_path, clinical_summary_path = extract_json_metadata_to_csv_unified(summary_output_dir, all_json_files)
-            if json_summary_path and clinical_summary_path:
-                print(f"✓ Complete metadata: {json_summary_path.name}")
-                print(f"✓ Clinical summary: {clinical_summary_path.name}")
-        
-        # 第五步：生成详细报告JSON（保存到选择目录的output文件夹）
-        summary_report = summary_output_dir / f"conversion_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
-        with open(summary_report, 'w', encoding='utf-8') as f:
-            json.dump(all_results, f, ensure_ascii=False, indent=2)
-        print(f"✓ Detailed report: {summary_report.name}")
-        
-        print(f"\n✅ Processing complete!")
-        print(f"📁 Individual outputs:")
-        if zip_files:
-            print(f"   - ZIP files: Check each ZIP's directory output folder")
-        if dicom_folders:
-            print(f"   - DICOM folders: Check each folder's parent directory output folder")
-        print(f"📄 Summary files saved to: {summary_output_dir}")
+                f.write(f"\n## {error_type} ({len(cases)} cases)\n")
+                for case in cases:
+                    f.write(f"{case}\n")
+            f.write(f"\n## 详细错误信息\n")
+            for fail in failed:
+                case_name = fail.get('zip_file') or fail.get('dicom_folder', 'Unknown')
+                case_type = 'ZIP' if 'zip_file' in fail else 'DICOM文件夹'
+                f.write(f"\n[{case_type}] {case_name}: {fail['error']}\n")
+        print(f"\n✓ 失败case列表已保存: {failed_list_path.name}")
+
 
 if __name__ == "__main__":
     main()
@@ -4,111 +4,67 @@ Safe wrapper for dcm2niix conversion that avoids passing non-ASCII paths to dcm2
 - Scans a DICOM folder, selects best series (by slice count -> pixel area -> CT preference)
 - Copies selected series files to an ASCII-only temporary directory
 - Runs dcm2niix on that temporary directory and captures stdout/stderr to a log
-- Moves resulting .nii.gz/.json files to an output folder
+- Moves resulting NIfTI (.nii.gz by default, see --nifti-format)/.json files to an output folder
 
 Usage:
-  python dcm2niix_batch_convert_max_layers_safe.py <data_dir>
+  python dcm2niix_batch_convert_max_layers_safe.py <data_dir> [--profile cpu|mem]
 
 If no arg provided, uses repository `data` folder.
 """
 import os
-import sys
+import argparse
 import shutil
 import tempfile
-import subprocess
 from pathlib import Path
-from collections import defaultdict
-import pydicom
 from datetime import datetime
+from dcmnii.stages import StageTimer, print_stage_summary, total_size
+from dcmnii.profiling import CaseProfiler, add_profile_argument, profile_dir
+from dcmnii.compress import add_output_arguments, output_options_from_args
+from dcmnii.progress import add_progress_arguments, progress_from_args, case_io
+from dcmnii.metrics import add_metrics_arguments, metrics_from_args
+from dcmnii.errors import ConversionError, NoDicomError, NoSeriesError, ConverterError
+from dcmnii.core import (MaxLayersStrategy, scan_dicom_series, create_series_directory,
+                         describe_stack, run_dcm2niix_capture, find_dcm2niix, split_outputs)
 
-
-def analyze_dicom_series(folder_path):
-    series_info = defaultdict(list)
-    for root, dirs, files in os.walk(folder_path):
-        for fn in files:
-            fp = os.path.join(root, fn)
-            try:
-                ds = pydicom.dcmread(fp, force=True)
-                uid = getattr(ds, 'SeriesInstanceUID', 'UNKNOWN')
-                rows = getattr(ds, 'Rows', 0) or 0
-                cols = getattr(ds, 'Columns', 0) or 0
-                modality = str(getattr(ds, 'Modality', ''))
-                series_number = getattr(ds, 'SeriesNumber', 0) or 0
-                desc = str(getattr(ds, 'SeriesDescription', ''))
-                series_info[uid].append({
-                    'file_path': fp,
-                    'rows': rows,
-                    'cols': cols,
-                    'modality': modality,
-                    'series_number': series_number,
-                    'series_description': desc,
-                })
-            except Exception:
-                continue
-    if not series_info:
-        return None
-    best = None
-    best_key = (-1, -1, -1, -1)
-    for uid, files in series_info.items():
-        if not files:
-            continue
-        file_count = len(files)
-        first = files[0]
-        pixel_area = first['rows'] * first['cols']
-        modality_priority = 1 if first['modality'].upper() == 'CT' else 0
-        series_number = first.get('series_number', 0) or 0
-        key = (file_count, pixel_area, modality_priority, series_number)
-        if key > best_key:
-            best_key = key
-            best = {
-                'uid': uid,
-                'files': files,
-                'file_count': file_count,
-                'description': first['series_description'],
-                'modality': first['modality'],
-                'series_number': first['series_number']
-            }
-    return best
+SELECTION_STRATEGY = MaxLayersStrategy()
 
 
 def copy_series_to_ascii_temp(series, case_index):
     # create ascii-only temp dir
     base_temp = tempfile.mkdtemp(prefix='dcm2niix_')
-    series_dir = os.path.join(base_temp, f'case_{case_index}_series')
-    os.makedirs(series_dir, exist_ok=True)
-    for f in series['files']:
-        src = f['file_path']
-        dst = os.path.join(series_dir, os.path.basename(src))
-        shutil.copy2(src, dst)
+    series_dir = create_series_directory(series, base_temp, f'case_{case_index}_series')
     return base_temp, series_dir
 
 
-def find_dcm2niix(repo_root: Path):
-    candidate = repo_root / 'dcm2niix.exe'
-    if candidate.exists():
-        return str(candidate)
-    alt = repo_root / 'tools' / 'MRIcroGL' / 'Resources' / 'dcm2niix.exe'
-    if alt.exists():
-        return str(alt)
-    return None
-
-
-def run_dcm2niix_and_capture(dcm2niix_path, input_dir, out_dir, case_name):
-    cmd = [dcm2niix_path, '-f', f"{case_name}_%i_%s_%p", '-o', str(out_dir), '-z', 'y', '-b', 'y', '-v', '2', str(input_dir)]
-    proc = subprocess.run(cmd, capture_output=True, text=True)
-    return proc.returncode, proc.stdout, proc.stderr
-
-
-def safe_convert_folder(dicom_folder: Path, output_base: Path, dcm2niix_path: str, case_index: int):
+def safe_convert_folder(dicom_folder: Path, output_base: Path, dcm2niix_path: str, case_index: int,
+                        output_options=None):
     folder_name = dicom_folder.name
     print(f"\n[{case_index}] Processing folder: {folder_name}")
-    best = analyze_dicom_series(str(dicom_folder))
+    timer = StageTimer()
+    try:
+        with timer.stage('scan') as st:
+            series_info = scan_dicom_series(str(dicom_folder), verbose=False)
+            for files in series_info.values():
+                st.add(bytes_read=sum(f['file_size'] for f in files), files=len(files))
+    except ConversionError as e:
+        # read errors (e.g. a flaky share) fail the case instead of silently shrinking the series
+        print(f"  ✗ [{e.code}] {e.message}")
+        return {'success': False, **e.fields(), 'stage_timings': timer.as_dict()}
+    with timer.stage('select'):
+        best, _ = SELECTION_STRATEGY.select(series_info)
     if not best:
         print("  No DICOM series found")
-        return {'success': False, 'error': 'No DICOM series found'}
+        # same error codes as the other converters, so exported failure categories line up
+        error_cls = NoSeriesError if series_info else NoDicomError
+        return {'success': False, **error_cls('No DICOM series found', stage='select').fields(),
+                'stage_timings': timer.as_dict()}
     print(f"  Selected series: {best['series_number']} desc='{best['description']}' files={best['file_count']}")
+    print(f"    Stack: {describe_stack(best)}")
 
-    base_temp, series_dir = copy_series_to_ascii_temp(best, case_index)
+    with timer.stage('stage') as st:
+        base_temp, series_dir = copy_series_to_ascii_temp(best, case_index)
+        staged_bytes = sum(f['file_size'] for f in best['files'])
+        st.add(bytes_read=staged_bytes, bytes_written=staged_bytes, files=best['file_count'])
     print(f"  Copied series to ascii temp: {series_dir}")
 
     # ensure output dir exists (use ASCII-safe folder name to avoid dcm2niix unicode issues)
@@ -117,40 +73,58 @@ def safe_convert_folder(dicom_folder: Path, output_base: Path, dcm2niix_path: st
     case_output = output_base / safe_folder_name
     case_output.mkdir(parents=True, exist_ok=True)
 
-    rc, out, err = run_dcm2niix_and_capture(dcm2niix_path, series_dir, case_output, folder_name)
-
-    # save log
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    log_path = case_output / f"dcm2niix_{timestamp}.log"
-    with open(log_path, 'w', encoding='utf-8') as lf:
-        lf.write('--- STDOUT ---\n')
-        lf.write(out or '')
-        lf.write('\n--- STDERR ---\n')
-        lf.write(err or '')
-
-    # gather outputs
-    nii_files = list(case_output.glob(f"{folder_name}_*.nii.gz"))
-    json_files = list(case_output.glob(f"{folder_name}_*.json"))
-
-    # cleanup temp
-    try:
-        shutil.rmtree(base_temp)
-    except Exception:
-        pass
+    with timer.stage('convert') as st:
+        rc, out, err, outputs = run_dcm2niix_capture(series_dir, case_output, dcm2niix_path, folder_name, verbose=2,
+                                                    output_options=output_options, source=dicom_folder, selection=best)
+        # gather outputs (only the files this run produced)
+        nii_files, json_files = split_outputs(outputs)
+        st.add(bytes_read=staged_bytes, bytes_written=total_size(nii_files + json_files),
+               files=len(nii_files) + len(json_files))
+
+    with timer.stage('postprocess') as st:
+        # save log
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        log_path = case_output / f"dcm2niix_{timestamp}.log"
+        with open(log_path, 'w', encoding='utf-8') as lf:
+            lf.write('--- STDOUT ---\n')
+            lf.write(out or '')
+            lf.write('\n--- STDERR ---\n')
+            lf.write(err or '')
+
+        # cleanup temp
+        try:
+            shutil.rmtree(base_temp)
+        except Exception:
+            pass
+        st.add(bytes_written=os.path.getsize(log_path), files=1)
 
     if rc == 0 and nii_files:
         print(f"  ✓ Conversion OK - {len(nii_files)} nii files, log: {log_path}")
-        return {'success': True, 'nii_files': [str(p) for p in nii_files], 'json_files': [str(p) for p in json_files], 'log': str(log_path)}
+        return {'success': True, 'nii_files': [str(p) for p in nii_files], 'json_files': [str(p) for p in json_files],
+                'log': str(log_path), 'selection_rationale': best['rationale'], 'stage_timings': timer.as_dict()}
     else:
         print(f"  ✗ Conversion failed (rc={rc}) - see log: {log_path}")
-        return {'success': False, 'error': err or out, 'log': str(log_path)}
+        message = (err or out) if rc != 0 else 'dcm2niix succeeded but no output files found'
+        return {'success': False, **ConverterError(message, stage='convert').fields(), 'log': str(log_path),
+                'selection_rationale': best['rationale'], 'stage_timings': timer.as_dict()}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Safe dcm2niix conversion (ASCII-only temp paths)')
+    parser.add_argument('data_dir', nargs='?', help='folder containing DICOM case folders (default: repo data/)')
+    add_profile_argument(parser)
+    add_output_arguments(parser)
+    add_progress_arguments(parser)
+    add_metrics_arguments(parser)
+    return parser.parse_args()
 
 
 def main():
+    args = parse_args()
     repo_root = Path(__file__).parent.parent
     # input
-    if len(sys.argv) > 1:
-        data_dir = Path(sys.argv[1])
+    if args.data_dir:
+        data_dir = Path(args.data_dir)
     else:
         data_dir = repo_root / 'data'
     if not data_dir.exists():
@@ -178,15 +152,33 @@ def main():
     output_base = repo_root / 'output' / 'nifti_files_safe'
     output_base.mkdir(parents=True, exist_ok=True)
 
+    # per-case profiling (--profile), written next to the converted cases
+    profiler = CaseProfiler(args.profile, profile_dir(output_base, datetime.now().strftime('%Y%m%d_%H%M%S')))
+
+    output_options = output_options_from_args(args)
+    print(f"NIfTI compression: {output_options.describe()}")
+
     results = []
+    progress = progress_from_args(args, total=len(candidates))
+    metrics = metrics_from_args(args, 'max_layers_safe', total=len(candidates))
     for idx, folder in enumerate(sorted(candidates), start=1):
-        res = safe_convert_folder(folder, output_base, dcm2niix, idx)
+        with profiler.case(folder.name) as prof:
+            res = safe_convert_folder(folder, output_base, dcm2niix, idx, output_options)
+        if prof:
+            res['profile'] = prof
         results.append({'folder': str(folder), **res})
+        metrics.observe(res)
+        files, nbytes = case_io(res)
+        progress.case_done(folder.name, res['success'], files=files, nbytes=nbytes)
+    progress.close()
+    metrics.close()
 
     # summary
     print('\nSummary:')
     for r in results:
-        print(r)
+        print({k: v for k, v in r.items() if k not in ('stage_timings', 'profile')})
+    print_stage_summary([r.get('stage_timings') for r in results])
+    profiler.close()
 
 
 if __name__ == '__main__':
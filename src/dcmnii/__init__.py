@@ -0,0 +1,6 @@
+"""
+DCM-Nii 共享模块
+
+src/ 下的各个脚本直接以 `python src/<脚本>.py` 运行，src 目录会自动加入 sys.path，
+因此脚本可以通过 `from dcmnii.xxx import ...` 使用这里的公共代码。
+"""
@@ -0,0 +1,206 @@
+"""
+统一的压缩包读取（ZIP / tar / tar.gz / tar.zst）
+
+PACS 导出除了ZIP还有 .tar、.tar.gz 和 .tar.zst，原来只能先转成ZIP再交给各脚本。
+这里按文件名识别格式（archive_kind），各脚本用 find_archives() 代替 glob("*.zip")，
+case名用 archive_stem() 去掉完整的扩展名（case.tar.zst → case）。
+
+读取成员统一用 iter_members()，按包内顺序逐个产出 (名称, 解压后大小, 只读流)：
+- ZIP: 中央目录来自 dcmnii.zipindex 缓存，按 infolist 顺序读取；
+- tar 系列: tarfile 流模式（'r|'），只能顺序读一遍，gzip/zstd 边读边解压，不需要临时的解压文件；
+  上一个成员的流在取下一个成员后失效，需要的数据必须在当前迭代中读完。
+tar.zst 需要可选依赖 zstandard（pip install zstandard），没有安装时打开会抛出 ValueError。
+
+转换脚本在此基础上单遍扫描（core.scan_archive_series）：嗅探文件头、解析DICOM头，只把候选序列写到临时目录。
+"""
+import os
+import shutil
+import tarfile
+import zipfile
+from contextlib import contextmanager
+from pathlib import Path
+from dcmnii.zipindex import zip_directory, is_zip
+
+# (扩展名, 格式)，按扩展名长度从长到短匹配
+ARCHIVE_SUFFIXES = (
+    ('.tar.zst', 'tar.zst'),
+    ('.tar.gz', 'tar.gz'),
+    ('.tzst', 'tar.zst'),
+    ('.tgz', 'tar.gz'),
+    ('.tar', 'tar'),
+    ('.zip', 'zip'),
+)
+ARCHIVE_KINDS = ('zip', 'tar', 'tar.gz', 'tar.zst')
+# 各格式文件开头的魔数（tar 的 "ustar" 在第257字节处）
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+TAR_BLOCK = 512
+# 读取压缩包的缓冲区（tar 流模式每次只读 10KB，网络共享上需要更大的缓冲）
+IO_BUFFER = 1024 * 1024
+
+
+def archive_kind(path):
+    """按文件名判断压缩包格式（'zip' / 'tar' / 'tar.gz' / 'tar.zst'），不是支持的格式时返回None"""
+    name = Path(path).name.lower()
+    for suffix, kind in ARCHIVE_SUFFIXES:
+        if name.endswith(suffix) and len(name) > len(suffix):
+            return kind
+    return None
+
+
+def archive_stem(path):
+    """去掉压缩包扩展名后的文件名（case名），例如 case01.tar.zst → case01"""
+    name = Path(path).name
+    for suffix, _ in ARCHIVE_SUFFIXES:
+        if name.lower().endswith(suffix) and len(name) > len(suffix):
+            return name[:-len(suffix)]
+    return Path(path).stem
+
+
+def _read_head(path, size):
+    with open(path, 'rb') as f:
+        return f.read(size)
+
+
+def is_archive(path):
+    """文件名是支持的格式，且文件开头与该格式一致（ZIP 顺带缓存中央目录）"""
+    kind = archive_kind(path)
+    if kind is None or not os.path.isfile(path):
+        return False
+    if kind == 'zip':
+        return is_zip(path)
+    try:
+        if kind == 'tar':
+            return tarfile.is_tarfile(path)
+        head = _read_head(path, len(ZSTD_MAGIC))
+    except OSError:
+        return False
+    return head.startswith(GZIP_MAGIC if kind == 'tar.gz' else ZSTD_MAGIC)
+
+
+def archive_complete(path):
+    """
+    压缩包是否已经完整写入（监视收件箱时判断拷贝是否结束）
+
+    ZIP 检查末尾的中央目录；未压缩的 tar 检查长度为512的整数倍且以两个全零块结尾；
+    tar.gz / tar.zst 无法不解压就确认完整，只检查文件头，依靠大小/修改时间稳定判断。
+    """
+    kind = archive_kind(path)
+    if kind != 'tar':
+        return is_archive(path)
+    try:
+        size = os.path.getsize(path)
+        if size < 2 * TAR_BLOCK or size % TAR_BLOCK:
+            return False
+        with open(path, 'rb') as f:
+            f.seek(-2 * TAR_BLOCK, os.SEEK_END)
+            tail = f.read()
+    except OSError:
+        return False
+    return not tail.strip(b'\0') and tarfile.is_tarfile(path)
+
+
+def find_archives(directory):
+    """目录（不递归）下所有支持的压缩包，按文件名排序"""
+    directory = Path(directory)
+    return sorted((p for p in directory.iterdir() if p.is_file() and archive_kind(p)), key=lambda p: p.name)
+
+
+def archive_cost(path):
+    """
+    预估解压后的字节数（调度排序用）
+
+    ZIP 读取中央目录中的成员大小；tar 系列要读完整个流才知道，这里取文件大小
+    （压缩过的 tar 会被低估，只影响排序）。无法读取时返回文件大小。
+    """
+    try:
+        if archive_kind(path) == 'zip':
+            return zip_directory(path).total_size()
+    except (OSError, zipfile.BadZipFile):
+        pass
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError("Reading .tar.zst archives requires the optional 'zstandard' package") from None
+    return zstandard
+
+
+@contextmanager
+def open_tar_stream(path):
+    """以流模式打开 tar / tar.gz / tar.zst（只能顺序读取一遍）"""
+    kind = archive_kind(path)
+    with open(path, 'rb', buffering=IO_BUFFER) as raw:
+        if kind == 'tar.zst':
+            # 多线程 zstd 压缩的文件由多个帧组成，需要跨帧读取
+            reader = _zstandard().ZstdDecompressor().stream_reader(raw, read_across_frames=True)
+            with reader, tarfile.open(fileobj=reader, mode='r|') as tar:
+                yield tar
+        else:
+            with tarfile.open(fileobj=raw, mode='r|gz' if kind == 'tar.gz' else 'r|') as tar:
+                yield tar
+
+
+def iter_members(path):
+    """
+    按包内顺序产出每个文件成员的 (名称, 解压后大小, 只读流)，跳过目录、链接等非普通文件
+
+    流只在当前迭代内有效（tar 是顺序流）；调用方提前 break 时关闭压缩包。
+    """
+    kind = archive_kind(path)
+    if kind is None:
+        raise ValueError(f"Unsupported archive format: {path}")
+    if kind == 'zip':
+        with zip_directory(path).open() as zf:
+            for info in zf.infolist():
+                if info.is_dir():
+                    continue
+                with zf.open(info) as stream:
+                    yield info.filename, info.file_size, stream
+        return
+    with open_tar_stream(path) as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            stream = tar.extractfile(member)
+            yield member.name, member.size, stream
+
+
+def member_path(dest, name):
+    """成员解压到 dest 下的路径；绝对路径或含 .. 的成员名（可能写到 dest 之外）返回None"""
+    parts = [part for part in name.replace('\\', '/').split('/') if part not in ('', '.')]
+    if not parts or '..' in parts or os.path.isabs(name) or ':' in parts[0]:
+        return None
+    return os.path.join(dest, *parts)
+
+
+def extract_archive(path, dest):
+    """
+    解压整个压缩包到 dest
+
+    Returns:
+        tuple: (文件数, 解压后总字节数)
+    """
+    if archive_kind(path) == 'zip':
+        directory = zip_directory(path)
+        with directory.open() as zf:
+            zf.extractall(dest)
+        return len(directory.members()), directory.total_size()
+    count = 0
+    total = 0
+    for name, size, stream in iter_members(path):
+        target = member_path(dest, name)
+        if target is None:
+            continue
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, 'wb') as out:
+            shutil.copyfileobj(stream, out, IO_BUFFER)
+        count += 1
+        total += size
+    return count, total
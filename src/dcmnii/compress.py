@@ -0,0 +1,248 @@
+"""
+NIfTI输出格式与压缩（多线程gzip / 未压缩 / 可寻址zstd）
+
+dcm2niix 的 -z y 在单线程里完成gzip压缩，512x512x2000 这样的大体数据压缩是转换中最大的单项开销。
+启用多线程时改为让 dcm2niix 输出未压缩的 .nii（-z n），再由 parallel_gzip() 按块并行压缩：
+- 输入按 BLOCK_SIZE 切块，每块在线程池中用 zlib 独立压缩成一个完整的gzip成员（zlib压缩时释放GIL）；
+- 各成员按顺序拼接写出。多成员gzip是标准格式（RFC 1952），gzip/nibabel/dcm2niix 等都能直接读取，
+  输出仍是普通的 .nii.gz；
+- 同时在途的块数有上限，内存占用与文件大小无关。
+线程数为1时保持原来的做法（dcm2niix 自己压缩），只把压缩级别传给 dcm2niix。
+
+下游会立即解压的场景可以用 --nifti-format 换掉gzip：
+- nii: 直接保留 dcm2niix 的未压缩 .nii（可 memmap）；
+- zst: 压缩为 .nii.zst（zstd 可寻址格式，需要可选依赖 zstandard），帧按整数层切分，
+       末尾附带帧索引，dcmnii.nifti.open_nifti() 读一层只解压一个帧。
+"""
+import os
+import zlib
+import struct
+from pathlib import Path
+from dcmnii.nifti import (FORMAT_SUFFIXES, NIFTI1_HEADER_SIZE, ZSTD_SKIPPABLE_MAGIC, ZSTD_SEEKABLE_MAGIC,
+                          SEEK_TABLE_FOOTER, SEEK_TABLE_ENTRY, parse_header)
+
+DEFAULT_LEVEL = 6
+DEFAULT_ZSTD_LEVEL = 3
+# 每个gzip成员的原始数据大小：块越大压缩率越接近单流，块越小并行粒度越细
+BLOCK_SIZE = 1 << 20
+
+
+def _gzip_block(data, level):
+    """把一块数据压缩为一个完整的gzip成员（wbits=31 表示带gzip头和CRC尾）"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def parallel_gzip(src_path, dst_path=None, threads=None, level=DEFAULT_LEVEL, block_size=BLOCK_SIZE,
+                  remove_source=True):
+    """
+    多线程压缩一个文件为多成员gzip（pigz 风格）
+
+    Args:
+        src_path: 输入文件（例如 dcm2niix 输出的 .nii）
+        dst_path: 输出路径，默认为 src_path + '.gz'
+        threads: 压缩线程数，默认为CPU核数
+        level: 压缩级别 1-9
+        remove_source: 压缩成功后删除输入文件
+
+    Returns:
+        Path: 输出文件路径
+    """
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+
+    src_path = Path(src_path)
+    dst_path = Path(dst_path) if dst_path else src_path.with_name(src_path.name + '.gz')
+    threads = max(1, threads or os.cpu_count() or 1)
+    tmp_path = dst_path.with_name(dst_path.name + '.part')
+
+    try:
+        with open(src_path, 'rb') as src, open(tmp_path, 'wb') as dst, \
+                ThreadPoolExecutor(max_workers=threads) as pool:
+            in_flight = deque()
+            while True:
+                data = src.read(block_size)
+                if not data:
+                    break
+                in_flight.append(pool.submit(_gzip_block, data, level))
+                # 限制在途块数，按提交顺序写出
+                while len(in_flight) >= threads * 2:
+                    dst.write(in_flight.popleft().result())
+            while in_flight:
+                dst.write(in_flight.popleft().result())
+            if dst.tell() == 0:
+                dst.write(_gzip_block(b'', level))  # 空文件也输出一个合法的gzip成员
+        os.replace(tmp_path, dst_path)
+    except BaseException:
+        if tmp_path.exists():
+            tmp_path.unlink()
+        raise
+    if remove_source:
+        src_path.unlink()
+    return dst_path
+
+
+def _zstd_frames(src, block_size):
+    """按层对齐切分 .nii：头部单独一帧，之后每帧包含整数层（约 block_size 字节）"""
+    header = src.read(NIFTI1_HEADER_SIZE)
+    info = parse_header(header)
+    yield header + src.read(max(info['vox_offset'] - len(header), 0))
+    frame_bytes = max(1, block_size // info['slice_bytes']) * info['slice_bytes']
+    while True:
+        data = src.read(frame_bytes)
+        if not data:
+            break
+        yield data
+
+
+def seekable_zstd(src_path, dst_path=None, threads=None, level=DEFAULT_ZSTD_LEVEL, block_size=BLOCK_SIZE,
+                  remove_source=True):
+    """
+    把 .nii 压缩为 zstd 可寻址格式的 .nii.zst（多线程，每帧独立压缩）
+
+    文件由若干个标准 zstd 帧拼接，末尾是一个跳过帧形式的帧索引（zstd seekable format），
+    普通 zstd 工具可以整体解压，open_nifti() 可以按层读取。
+
+    Returns:
+        Path: 输出文件路径
+    """
+    import threading
+    import zstandard
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+
+    src_path = Path(src_path)
+    if dst_path is None:
+        dst_path = src_path.with_name(src_path.name + '.zst') if src_path.name.endswith('.nii') \
+            else src_path.with_suffix('.nii.zst')
+    dst_path = Path(dst_path)
+    threads = max(1, threads or os.cpu_count() or 1)
+    tmp_path = dst_path.with_name(dst_path.name + '.part')
+    local = threading.local()
+
+    def compress_frame(data):
+        # ZstdCompressor 不能跨线程共享，每个线程一个
+        compressor = getattr(local, 'compressor', None)
+        if compressor is None:
+            compressor = local.compressor = zstandard.ZstdCompressor(level=level, write_content_size=True)
+        return compressor.compress(data), len(data)
+
+    entries = []
+    try:
+        with open(src_path, 'rb') as src, open(tmp_path, 'wb') as dst, \
+                ThreadPoolExecutor(max_workers=threads) as pool:
+            in_flight = deque()
+
+            def write_next():
+                frame, size = in_flight.popleft().result()
+                dst.write(frame)
+                entries.append((len(frame), size))
+
+            for data in _zstd_frames(src, block_size):
+                in_flight.append(pool.submit(compress_frame, data))
+                while len(in_flight) >= threads * 2:
+                    write_next()
+            while in_flight:
+                write_next()
+            # 帧索引：跳过帧头 + 每帧 (压缩大小, 解压大小) + 尾部 (帧数, 描述符, 魔数)
+            table = b''.join(SEEK_TABLE_ENTRY.pack(csize, dsize) for csize, dsize in entries)
+            table += SEEK_TABLE_FOOTER.pack(len(entries), 0, ZSTD_SEEKABLE_MAGIC)
+            dst.write(struct.pack('<II', ZSTD_SKIPPABLE_MAGIC, len(table)) + table)
+        os.replace(tmp_path, dst_path)
+    except BaseException:
+        if tmp_path.exists():
+            tmp_path.unlink()
+        raise
+    if remove_source:
+        src_path.unlink()
+    return dst_path
+
+
+class OutputOptions:
+    """
+    NIfTI输出设置，传给 run_dcm2niix / run_dcm2niix_capture
+
+    format: 'gz'（默认，.nii.gz）、'nii'（未压缩）或 'zst'（可寻址zstd，.nii.zst）
+    threads: 压缩线程数（0或None为CPU核数；gz 格式下1为由 dcm2niix 单线程压缩）
+    level: gzip压缩级别 1-9
+    zstd_level: zstd压缩级别（默认3）
+    """
+
+    def __init__(self, threads=None, level=DEFAULT_LEVEL, format='gz', zstd_level=DEFAULT_ZSTD_LEVEL):
+        if format not in FORMAT_SUFFIXES:
+            raise ValueError(f"Unknown NIfTI format: {format} (available: {', '.join(FORMAT_SUFFIXES)})")
+        if not 1 <= int(level) <= 9:
+            raise ValueError(f"gzip level must be 1-9, got {level}")
+        if format == 'zst':
+            try:
+                import zstandard  # noqa: F401
+            except ImportError:
+                raise ValueError("NIfTI format 'zst' requires the optional 'zstandard' package") from None
+        self.format = format
+        self.threads = threads or os.cpu_count() or 1
+        self.level = int(level)
+        self.zstd_level = int(zstd_level)
+
+    @property
+    def suffix(self):
+        return FORMAT_SUFFIXES[self.format]
+
+    @property
+    def post_process(self):
+        """dcm2niix 输出 .nii 后是否还需要由这里压缩"""
+        return self.format == 'zst' or (self.format == 'gz' and self.threads > 1)
+
+    def dcm2niix_args(self):
+        """dcm2niix 的压缩相关参数"""
+        if self.format == 'gz' and not self.post_process:
+            return ["-z", "y", f"-{self.level}"]
+        return ["-z", "n"]
+
+    def finalize(self, output_dir):
+        """
+        压缩 output_dir 中 dcm2niix 输出的 .nii 文件，返回生成的压缩文件列表
+
+        output_dir 是本次转换专用的暂存目录（见 run_dcm2niix_capture），其中的 .nii 都属于本次转换。
+        """
+        if not self.post_process:
+            return []
+        compressed = []
+        for nii_file in sorted(Path(output_dir).glob("*.nii")):
+            if self.format == 'zst':
+                compressed.append(seekable_zstd(nii_file, threads=self.threads, level=self.zstd_level))
+            else:
+                compressed.append(parallel_gzip(nii_file, threads=self.threads, level=self.level))
+        return compressed
+
+    def describe(self):
+        if self.format == 'nii':
+            return "uncompressed .nii"
+        if self.format == 'zst':
+            return f"seekable zstd level {self.zstd_level}, {self.threads} threads"
+        if self.post_process:
+            return f"gzip level {self.level}, {self.threads} threads"
+        return f"gzip level {self.level} (dcm2niix)"
+
+
+def add_output_arguments(parser):
+    """为入口脚本的 argparse 添加输出格式/压缩选项"""
+    group = parser.add_argument_group('NIfTI输出')
+    group.add_argument('--nifti-format', choices=tuple(FORMAT_SUFFIXES), default='gz',
+                       help='输出格式: gz=.nii.gz（默认）, nii=未压缩（可memmap）, '
+                            'zst=.nii.zst 可寻址zstd（需要 pip install zstandard）')
+    group.add_argument('--gzip-threads', type=int, default=0,
+                       help='压缩线程数（默认0=CPU核数；gz 格式下1=由dcm2niix单线程压缩）')
+    group.add_argument('--gzip-level', type=int, default=DEFAULT_LEVEL, choices=range(1, 10), metavar='1-9',
+                       help=f'gzip压缩级别（默认{DEFAULT_LEVEL}）')
+    group.add_argument('--zstd-level', type=int, default=DEFAULT_ZSTD_LEVEL,
+                       help=f'zstd压缩级别（默认{DEFAULT_ZSTD_LEVEL}）')
+    return group
+
+
+def output_options_from_args(args):
+    """根据命令行参数构造 OutputOptions；选项不可用（例如缺少 zstandard）时退出并提示"""
+    try:
+        return OutputOptions(threads=args.gzip_threads, level=args.gzip_level, format=args.nifti_format,
+                             zstd_level=args.zstd_level)
+    except ValueError as e:
+        raise SystemExit(f"错误: {e}")
@@ -0,0 +1,1377 @@
+"""
+DICOM扫描 / 序列选择 / dcm2niix转换的公共引擎
+
+各转换脚本（max_layers、anywhere_5mm、max_layers_safe、convert_data_folder.py）只负责命令行和批处理流程，
+扫描、选序列、暂存、调用dcm2niix、后处理和JSON汇总都在这里实现一次。
+
+序列选择通过策略对象完成（见 SelectionStrategy）：
+- MaxLayersStrategy:       按 (层数, 像素面积, CT优先, 序列号) 选择
+- ScoredStrategy:          按层数/矩阵/描述关键字/模态打分选择
+- ThicknessWindowStrategy: 先按层厚窗口过滤（默认4.5-5.5mm），再交给内部策略选择
+新的选择规则只需继承 SelectionStrategy 并用 register_strategy() 注册。
+
+同一个 SeriesInstanceUID 下可能有多个堆栈（多回波、多期相、重复扫描、不同方位），
+选择前先按 ImagePositionPatient / ImageOrientationPatient / EchoNumbers 分组，同一位置有多个文件时
+再按 AcquisitionNumber 和时间相关标签（期相、触发时间、b值、ContentTime）拆分成子堆栈（见 split_stacks），
+策略比较的是堆栈，层数按不同的空间位置计算。
+
+压缩包（ZIP / tar / tar.gz / tar.zst）由 scan_archive_series 单遍读取，扫描的同时只把候选序列写到临时目录。
+"""
+import os
+import json
+import shutil
+import tempfile
+import subprocess
+from pathlib import Path
+from datetime import datetime
+from collections import defaultdict
+from dcmnii.walk import walk_files, sniff_dicom_head, SNIFF_BYTES
+from dcmnii.archive import iter_members, member_path, extract_archive
+from dcmnii.compress import OutputOptions
+from dcmnii.nifti import FORMAT_SUFFIXES, nifti_format
+from dcmnii.errors import NoSeriesError, NoThicknessMatchError, error_from_exception
+
+# pydicom / pandas 在用到的函数里才导入：脚本的 --help 和无事可做的增量运行不需要它们
+
+# 仓库根目录（src/dcmnii/core.py 向上两级）
+REPO_ROOT = Path(__file__).resolve().parent.parent.parent
+
+SCOUT_KEYWORDS = ('topogram', 'scout', 'localizer', 'overview')
+PREFERRED_KEYWORDS = ('chest', 'thorax', 'lung', 'helical')
+# 压缩包单遍扫描时，不超过该大小的成员在内存中解析文件头，确认是候选序列后才写盘
+SPOOL_IN_MEMORY = 16 * 1024 * 1024
+
+
+# ====== 扫描 ======
+
+# 序列级属性：同一序列的所有文件共享一份（取该序列扫描到的第一个文件）
+SERIES_FIELDS = ('series_number', 'series_description', 'modality', 'rows', 'columns', 'slice_thickness',
+                 'patient_id')
+
+
+class SeriesHeader:
+    """一个序列的序列级属性，每个序列只保存一份；相同的方位元组也在这里复用"""
+
+    __slots__ = SERIES_FIELDS + ('_orientations',)
+
+    def __init__(self, ds):
+        self.series_number = getattr(ds, 'SeriesNumber', 0) or 0
+        self.series_description = str(getattr(ds, 'SeriesDescription', 'Unknown'))
+        self.modality = str(getattr(ds, 'Modality', 'Unknown'))
+        self.rows = getattr(ds, 'Rows', 0) or 0
+        self.columns = getattr(ds, 'Columns', 0) or 0
+        self.slice_thickness = getattr(ds, 'SliceThickness', None)
+        self.patient_id = str(getattr(ds, 'PatientID', '') or '')
+        self._orientations = {}
+
+    def shared_orientation(self, orientation):
+        """同一序列中方位通常完全相同，返回共享的元组，避免每个文件各存一份"""
+        if orientation is None:
+            return None
+        return self._orientations.setdefault(orientation, orientation)
+
+
+class DicomFileRecord:
+    """
+    扫描得到的单个文件记录
+
+    只保存逐文件的数据（目录和文件名、大小、几何信息），序列级属性通过共享的 SeriesHeader 读取；
+    目录字符串同一目录下的文件共用一个对象。仍可以按原来的字典方式访问：
+    record['file_path']、record['series_description']、record.get('slice_thickness')。
+    """
+
+    __slots__ = ('directory', 'name', 'file_size', 'image_position', 'image_orientation',
+                 'acquisition_number', 'echo_number', 'instance_number', 'temporal', 'header')
+
+    def __init__(self, directory, name, file_size, header, image_position=None, image_orientation=None,
+                 acquisition_number=0, echo_number=0, instance_number=0, temporal=None):
+        self.directory = directory
+        self.name = name
+        self.file_size = file_size
+        self.header = header
+        self.image_position = image_position
+        self.image_orientation = header.shared_orientation(image_orientation)
+        self.acquisition_number = acquisition_number
+        self.echo_number = echo_number
+        self.instance_number = instance_number
+        self.temporal = temporal
+
+    @property
+    def file_path(self):
+        return os.path.join(self.directory, self.name)
+
+    def __getitem__(self, key):
+        if key in SERIES_FIELDS:
+            return getattr(self.header, key)
+        if key == 'file_path' or (key in self.__slots__ and key != 'header'):
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return key in SERIES_FIELDS or key == 'file_path' or (key in self.__slots__ and key != 'header')
+
+    def as_dict(self):
+        """转换为普通字典（写报告或调试时使用）"""
+        keys = ('file_path',) + SERIES_FIELDS + ('file_size', 'image_position', 'image_orientation',
+                                                 'acquisition_number', 'echo_number', 'instance_number', 'temporal')
+        return {key: self[key] for key in keys}
+
+    def __repr__(self):
+        return f"DicomFileRecord({self.file_path!r})"
+
+
+def scan_dicom_series(root_dir, verbose=True, files=None):
+    """
+    扫描目录下所有DICOM文件（只读文件头），按SeriesInstanceUID分组
+
+    目录由 walk.walk_files() 并行遍历，先嗅探文件头，非DICOM文件不交给pydicom解析。
+    files 可传入已经遍历好的 [(目录, 文件名, 字节数)]（例如发现阶段的结果），避免重复遍历。
+    无法解析的文件跳过；读取文件本身出错（带 errno 的 OSError，例如网络共享超时、文件被锁定）不跳过，
+    与压缩包路径一样按 error_from_exception 抛出（临时错误为 io 类别，由 retry_case 重试），
+    避免序列悄悄少了文件或变成“没有DICOM序列”。
+
+    Returns:
+        dict: {series_uid: [DicomFileRecord, ...]}，记录可按字典方式访问 file_path, series_number,
+              series_description, modality, rows, columns, slice_thickness, patient_id, file_size，
+              以及几何信息 image_position, image_orientation（缺失时为None）, acquisition_number, echo_number,
+              instance_number 和 temporal（TEMPORAL_TAGS 各标签的数值元组，缺失的为None；全部缺失时为None）。
+              序列级属性每个序列只存一份，内存占用≈序列数 + 每个文件一个小的定长记录
+    """
+    import pydicom
+
+    series_info = defaultdict(list)
+    headers = {}
+    if files is None:
+        files = walk_files(root_dir, sniff=True)
+    for directory, file, file_size in files:
+        file_path = os.path.join(directory, file)
+        try:
+            ds = pydicom.dcmread(file_path, stop_before_pixels=True, force=True)
+            series_uid = _series_uid(ds)
+            if series_uid is None:
+                continue
+            header = headers.get(series_uid)
+            if header is None:
+                header = headers[series_uid] = SeriesHeader(ds)
+            series_info[series_uid].append(_file_record(ds, directory, file, file_size, header))
+        except Exception as e:
+            if isinstance(e, OSError) and (e.errno is not None or getattr(e, 'winerror', None) is not None):
+                # 读文件出错，不是文件内容的问题（没有 errno 的 OSError 才是解析错误）
+                raise error_from_exception(e, 'scan') from e
+            if verbose:
+                print(f"  ⚠ 跳过文件 {file}: {str(e)}")
+            continue
+    return series_info
+
+
+def _series_uid(ds):
+    """数据集的 SeriesInstanceUID；force=True 时非DICOM文件也可能“读取成功”，没有任何UID的返回None"""
+    if 'SOPInstanceUID' not in ds and 'SeriesInstanceUID' not in ds:
+        return None
+    return str(getattr(ds, 'SeriesInstanceUID', 'Unknown'))
+
+
+def _file_record(ds, directory, name, file_size, header):
+    return DicomFileRecord(
+        directory, name, file_size, header,
+        image_position=_float_tuple(getattr(ds, 'ImagePositionPatient', None), 3),
+        image_orientation=_float_tuple(getattr(ds, 'ImageOrientationPatient', None), 6),
+        acquisition_number=_int_or_zero(getattr(ds, 'AcquisitionNumber', None)),
+        echo_number=_int_or_zero(getattr(ds, 'EchoNumbers', None)),
+        instance_number=_int_or_zero(getattr(ds, 'InstanceNumber', None)),
+        temporal=_temporal_values(ds),
+    )
+
+
+def scan_archive_series(archive_path, spool_dir, accept_header=None, verbose=True):
+    """
+    单遍读取压缩包（ZIP / tar / tar.gz / tar.zst）并扫描DICOM序列，只把候选序列的文件写到 spool_dir
+
+    tar 流只能顺序读一遍，不能像解压后的目录那样先扫描再挑文件，因此每个成员读出后立即：
+    嗅探文件头（非DICOM成员不落盘）→ 在内存中解析DICOM头 → 按序列头判断是否候选
+    （accept_header(SeriesHeader)，例如层厚窗口之外的序列）→ 只写出候选序列的文件。
+    超过 SPOOL_IN_MEMORY 的成员（如增强型多帧）边读边写到磁盘，解析后不是候选再删除。
+    ZIP 也走同一流程，不再把整个包解压出来再遍历。
+
+    Returns:
+        tuple: (series_info, stats)
+            series_info 与 scan_dicom_series() 相同（记录的 file_path 指向 spool_dir 中的文件）；
+            stats: members（文件成员数）, dicom（DICOM文件数）, spooled（写出的文件数）,
+                   rejected_series（被 accept_header 排除的序列数）, bytes_read（解压后读取的字节数）,
+                   bytes_written（写出的字节数）
+    """
+    import io
+    import pydicom
+
+    series_info = defaultdict(list)
+    headers = {}
+    accepted = {}
+    directories = {}
+    stats = dict.fromkeys(('members', 'dicom', 'spooled', 'rejected_series', 'bytes_read', 'bytes_written'), 0)
+    for name, size, stream in iter_members(archive_path):
+        stats['members'] += 1
+        target = member_path(spool_dir, name)
+        if target is None:
+            if verbose:
+                print(f"  ⚠ 跳过路径不安全的成员 {name}")
+            continue
+        head = stream.read(SNIFF_BYTES)
+        stats['bytes_read'] += len(head)
+        if not sniff_dicom_head(head):
+            continue
+        data = None
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if size <= SPOOL_IN_MEMORY:
+            data = head + stream.read()
+            source = io.BytesIO(data)
+        else:
+            with open(target, 'wb') as out:
+                out.write(head)
+                shutil.copyfileobj(stream, out, SPOOL_IN_MEMORY)
+            source = target
+        stats['bytes_read'] += size - len(head)
+        try:
+            ds = pydicom.dcmread(source, stop_before_pixels=True, force=True)
+            series_uid = _series_uid(ds)
+        except Exception as e:
+            if verbose:
+                print(f"  ⚠ 跳过文件 {os.path.basename(target)}: {str(e)}")
+            series_uid = None
+        if series_uid is not None:
+            stats['dicom'] += 1
+            header = headers.get(series_uid)
+            if header is None:
+                header = headers[series_uid] = SeriesHeader(ds)
+                accepted[series_uid] = accept_header is None or accept_header(header)
+                stats['rejected_series'] += not accepted[series_uid]
+            if not accepted[series_uid]:
+                series_uid = None
+        if series_uid is None:
+            if data is None:
+                os.remove(target)
+            continue
+        if data is not None:
+            with open(target, 'wb') as out:
+                out.write(data)
+        stats['spooled'] += 1
+        stats['bytes_written'] += size
+        directory = os.path.dirname(target)
+        directory = directories.setdefault(directory, directory)
+        series_info[series_uid].append(_file_record(ds, directory, os.path.basename(target), size, header))
+    return series_info, stats
+
+
+def _float_tuple(value, length):
+    """把多值DICOM元素转换为定长浮点元组，缺失或格式不对时返回None"""
+    try:
+        values = tuple(float(v) for v in value)
+    except (TypeError, ValueError):
+        return None
+    return values if len(values) == length else None
+
+
+def _int_or_zero(value):
+    """AcquisitionNumber / EchoNumbers / InstanceNumber 转换为整数（缺失或无法解析为0；多值取第一个）"""
+    if value is None or value == '':
+        return 0
+    try:
+        if not isinstance(value, (str, bytes)) and hasattr(value, '__len__'):
+            value = value[0]
+        return int(float(value))
+    except (TypeError, ValueError, IndexError):
+        return 0
+
+
+def _float_or_none(value):
+    """数值型DICOM元素转换为浮点数（缺失或无法解析为None；多值取第一个）"""
+    if value is None or value == '':
+        return None
+    try:
+        if not isinstance(value, (str, bytes)) and hasattr(value, '__len__'):
+            value = value[0]
+        return float(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def _time_seconds(value):
+    """DICOM TM（HHMMSS.FFFFFF，可省略后面的部分）转换为当天的秒数，无法解析为None"""
+    text = str(value or '').strip()
+    digits, _, fraction = text.partition('.')
+    if not digits.isdigit() or len(digits) % 2 or len(digits) > 6:
+        return None
+    digits = digits.ljust(6, '0')
+    seconds = int(digits[:2]) * 3600 + int(digits[2:4]) * 60 + int(digits[4:6])
+    return seconds + (float(f"0.{fraction}") if fraction.isdigit() else 0.0)
+
+
+def _temporal_values(ds):
+    """TEMPORAL_TAGS 各标签的数值（缺失为None），全部缺失时返回None"""
+    values = (
+        _float_or_none(getattr(ds, 'TemporalPositionIdentifier', None)),
+        _float_or_none(getattr(ds, 'TriggerTime', None)),
+        _float_or_none(getattr(ds, 'DiffusionBValue', None)),
+        _time_seconds(getattr(ds, 'ContentTime', None)),
+    )
+    return values if any(v is not None for v in values) else None
+
+
+# ====== 堆栈几何 ======
+
+# 同一位置的容差（mm）和方位比较精度（小数位）
+POSITION_TOLERANCE = 0.01
+ORIENTATION_DECIMALS = 3
+# 扫描时记录的时间相关标签（DicomFileRecord.temporal 的顺序），同一位置的重复文件按此顺序尝试区分
+TEMPORAL_TAGS = ('TemporalPositionIdentifier', 'TriggerTime', 'DiffusionBValue', 'ContentTime')
+
+
+def series_geometry(files):
+    """
+    把一个序列的几何信息整理为 NumPy 结构化数组（每个文件一行）
+
+    字段: index（在 files 中的下标）, position（沿层法向的坐标, mm）, orientation（6个方向余弦）,
+          acquisition, echo, instance（InstanceNumber）, temporal（TEMPORAL_TAGS 各标签的数值，缺失为NaN）,
+          valid（是否有完整的 IPP/IOP）
+    """
+    import numpy as np
+
+    dtype = np.dtype([('index', 'i4'), ('position', 'f8'), ('orientation', 'f8', (6,)),
+                      ('acquisition', 'i4'), ('echo', 'i4'), ('instance', 'i4'),
+                      ('temporal', 'f8', (len(TEMPORAL_TAGS),)), ('valid', '?')])
+    geometry = np.zeros(len(files), dtype=dtype)
+    geometry['index'] = np.arange(len(files))
+    geometry['temporal'] = np.nan
+    ipp = np.zeros((len(files), 3))
+    for i, f in enumerate(files):
+        iop = f.get('image_orientation')
+        pos = f.get('image_position')
+        if iop is not None and pos is not None:
+            geometry['orientation'][i] = iop
+            ipp[i] = pos
+            geometry['valid'][i] = True
+        geometry['acquisition'][i] = f.get('acquisition_number', 0)
+        geometry['echo'][i] = f.get('echo_number', 0)
+        geometry['instance'][i] = f.get('instance_number', 0)
+        temporal = f.get('temporal')
+        if temporal is not None:
+            geometry['temporal'][i] = [np.nan if v is None else v for v in temporal]
+    # 层法向 = 行方向 × 列方向，层位置 = IPP 在法向上的投影
+    normal = np.cross(geometry['orientation'][:, :3], geometry['orientation'][:, 3:])
+    geometry['position'] = np.einsum('ij,ij->i', ipp, normal)
+    geometry['orientation'] = np.round(geometry['orientation'], ORIENTATION_DECIMALS)
+    return geometry
+
+
+def _position_ids(geometry, rows):
+    """每一行所在层位置的编号（容差 POSITION_TOLERANCE 内视为同一位置）"""
+    import numpy as np
+
+    keys = np.round(geometry['position'][rows] / POSITION_TOLERANCE).astype(np.int64)
+    return np.unique(keys, return_inverse=True)[1].ravel()
+
+
+def _stack_summary(files, geometry, rows, has_geometry, split_by=(), ambiguous=0):
+    """根据一组几何行构造堆栈字典（文件按层位置排序）"""
+    import numpy as np
+
+    summary = {
+        'acquisition_number': int(geometry['acquisition'][rows[0]]),
+        'echo_number': int(geometry['echo'][rows[0]]),
+        'has_geometry': has_geometry,
+        'split_by': [list(item) for item in split_by],
+        'ambiguous_duplicates': ambiguous,
+        'spacing_mm': None,
+        'coverage_mm': None,
+        'gaps': 0,
+    }
+    slice_rows = rows
+    if has_geometry:
+        rows = rows[np.argsort(geometry['position'][rows], kind='stable')]
+        if ambiguous:
+            # 无法区分的重复文件全部保留（一起交给dcm2niix），层数和间距按每个位置的第一个文件计算
+            _, first = np.unique(_position_ids(geometry, rows), return_index=True)
+            slice_rows = rows[first]
+        else:
+            slice_rows = rows
+        positions = geometry['position'][slice_rows]
+        if len(positions) > 1:
+            steps = np.diff(positions)
+            spacing = float(np.median(steps))
+            summary['spacing_mm'] = round(spacing, 4)
+            summary['coverage_mm'] = round(float(positions[-1] - positions[0]), 4)
+            summary['gaps'] = int(np.count_nonzero(steps > spacing * 1.5)) if spacing > 0 else 0
+        else:
+            summary['coverage_mm'] = 0.0
+    summary['files'] = [files[i] for i in geometry['index'][rows]]
+    summary['slice_files'] = ([files[i] for i in geometry['index'][slice_rows]] if ambiguous
+                              else summary['files'])
+    summary['slice_count'] = len(summary['slice_files'])
+    return summary
+
+
+def _split_duplicates(geometry, rows, keys):
+    """
+    把同一位置有多个文件的一组行拆成各自位置不重复的部分
+
+    依次尝试 keys 中的 (名称, 列)：该列在组内没有缺失，且不同取值的个数在 2 和不同位置数之间（每层一个
+    采集号/时间的逐层扫描不拆），就按取值拆分，各部分再用剩余的键继续拆。所有键都不能区分时，若每个位置的
+    文件数相同，按 InstanceNumber 排序后把每个位置的第 k 个文件归为第 k 个堆栈；否则整组保留并标记。
+
+    Returns:
+        list: [(行, 拆分依据 ((名称, 取值), ...), 无法区分的重复文件数)]
+    """
+    import numpy as np
+
+    position_ids = _position_ids(geometry, rows)
+    unique_positions = int(position_ids.max()) + 1
+    if unique_positions == len(rows):
+        return [(rows, (), 0)]
+    for n, (name, column) in enumerate(keys):
+        values = column[rows]
+        if np.isnan(values).any():
+            continue
+        distinct = np.unique(values)
+        if 1 < len(distinct) < unique_positions:
+            parts = []
+            for value in distinct:
+                for part, split_by, ambiguous in _split_duplicates(geometry, rows[values == value], keys[n + 1:]):
+                    parts.append((part, ((name, float(value)),) + split_by, ambiguous))
+            return parts
+    counts = np.bincount(position_ids)
+    if counts.min() == counts.max():
+        per_position = int(counts[0])
+        ordered = rows[np.lexsort((rows, geometry['instance'][rows], position_ids))]
+        return [(ordered[k::per_position], (('InstanceNumber order', k + 1),), 0) for k in range(per_position)]
+    return [(rows, (), len(rows) - unique_positions)]
+
+
+def split_stacks(files):
+    """
+    把一个序列拆分为几何上一致的子堆栈
+
+    先按 (是否有几何信息, 方位, 回波号) 分组；组内层位置有重复时依次用 AcquisitionNumber 和
+    TEMPORAL_TAGS（期相编号、触发时间、b值、ContentTime）区分（多期相/多b值/重复扫描），
+    都不能区分时按 InstanceNumber 把每个位置的重复文件依次分到各个堆栈（要求每个位置的文件数相同，
+    拆分依据记为 InstanceNumber order），仍无法区分的组不拆也不丢文件，记为 ambiguous_duplicates。
+    没有 IPP/IOP 的文件单独成组，层数按文件数计。
+
+    Returns:
+        list: 堆栈字典，包含 files（要转换的全部文件，按层位置排序）, slice_files（每个位置一个文件，
+              策略据此比较）, slice_count（不同位置数）, spacing_mm, coverage_mm, gaps（间距大于1.5倍中位数的次数）,
+              acquisition_number, echo_number, has_geometry, split_by（拆分依据 [[名称, 取值], ...]）,
+              ambiguous_duplicates（无法区分而保留的重复文件数）；按 (层数, 覆盖范围) 从大到小排序
+    """
+    import numpy as np
+
+    if not files:
+        return []
+    geometry = series_geometry(files)
+    keys = [('AcquisitionNumber', geometry['acquisition'].astype('f8'))]
+    keys += [(name, geometry['temporal'][:, i]) for i, name in enumerate(TEMPORAL_TAGS)]
+    stacks = []
+    group_keys = np.column_stack([geometry['valid'], geometry['echo'], geometry['orientation']])
+    _, group_ids = np.unique(group_keys, axis=0, return_inverse=True)
+    for group_id in np.unique(group_ids):
+        rows = np.flatnonzero(group_ids.ravel() == group_id)
+        if not geometry['valid'][rows[0]]:
+            stacks.append(_stack_summary(files, geometry, rows, has_geometry=False))
+            continue
+        for part, split_by, ambiguous in _split_duplicates(geometry, rows, keys):
+            stacks.append(_stack_summary(files, geometry, part, has_geometry=True, split_by=split_by,
+                                         ambiguous=ambiguous))
+    stacks.sort(key=lambda st: (st['slice_count'], st['coverage_mm'] or 0.0), reverse=True)
+    return stacks
+
+
+# ====== 序列选择策略 ======
+
+def build_selection(series_uid, files, stack=None, **extra):
+    """构造统一的选中序列字典（所有策略和脚本共用同一组键）；stack 为 split_stacks() 的堆栈时附带几何信息"""
+    first_file = files[0]
+    selection = {
+        'series_uid': series_uid,
+        'files': files,
+        'file_count': len(files),
+        'slice_count': stack['slice_count'] if stack else len(files),
+        'description': first_file['series_description'],
+        'series_number': first_file['series_number'],
+        'modality': first_file['modality'],
+        'pixel_area': max(first_file['rows'], 0) * max(first_file['columns'], 0),
+        'slice_thickness': first_file.get('slice_thickness'),
+        'patient_id': first_file.get('patient_id'),
+    }
+    if stack:
+        selection.update({key: stack[key] for key in ('spacing_mm', 'coverage_mm', 'gaps', 'acquisition_number',
+                                                        'echo_number', 'has_geometry', 'split_by',
+                                                        'ambiguous_duplicates')})
+    selection.update(extra)
+    return selection
+
+
+def _jsonable_key(key):
+    """排序键转换为可写入JSON报告的形式"""
+    if isinstance(key, tuple):
+        return [_jsonable_key(k) for k in key]
+    if isinstance(key, (int, float, str)) or key is None:
+        return key
+    return str(key)
+
+
+def describe_stack(selection):
+    """选中堆栈的一行说明（层数/间距/覆盖范围，序列含多个堆栈时注明采集号、回波号和拆分依据）"""
+    text = f"{selection['slice_count']} slices"
+    if selection.get('spacing_mm') is not None:
+        text += f", spacing {selection['spacing_mm']:g}mm, coverage {selection['coverage_mm']:g}mm"
+    if selection.get('stack_count', 1) > 1:
+        text += (f", stack acquisition {selection['acquisition_number']} / echo {selection['echo_number']}"
+                 f" of {selection['stack_count']} ({selection['series_file_count']} files in series)")
+        if selection.get('split_by'):
+            text += ", split by " + ", ".join(f"{name}={value:g}" for name, value in selection['split_by'])
+    if selection.get('ambiguous_duplicates'):
+        text += f", {selection['ambiguous_duplicates']} ambiguous duplicate positions kept"
+    return text
+
+
+class SelectionStrategy:
+    """
+    序列选择策略基类
+
+    子类实现 key()（越大越好），可选实现 accept() 过滤序列、extra() 往结果里附加字段。
+    accept_header() 只看序列级属性（SeriesHeader），压缩包单遍扫描时用来提前排除不可能选中的序列，
+    这些序列的文件不会写到临时目录（见 scan_archive_series）。
+    accept()/key() 收到的是 split_stacks() 拆出的一个堆栈每个位置一个文件的列表（slice_files），
+    因此 len(files) 就是真实层数；选中后转换的是该堆栈的全部文件。
+    select() 返回 (选中序列字典或None, 说明信息)，与原脚本的 analyze_dicom_series 一致；
+    选中结果还带有 series_file_count（整个序列的文件数）和 stack_count。
+    没有选中时调用方抛出 no_match_error（带错误代码，决定是否重试）。
+    """
+
+    name = 'base'
+    no_match_error = NoSeriesError
+    # key 必须严格大于该值才会被选中（None 表示不设下限）
+    initial_key = None
+
+    def accept(self, files):
+        return True
+
+    def accept_header(self, header):
+        return True
+
+    def key(self, files):
+        raise NotImplementedError
+
+    def extra(self, key):
+        return {}
+
+    def no_match_message(self):
+        return "No suitable series"
+
+    def selected_message(self, best):
+        return f"Selected series with {best['file_count']} slices"
+
+    def select(self, series_info):
+        if not series_info:
+            return None, "No valid DICOM files found"
+        best_series = None
+        best_key = self.initial_key
+        candidates = []
+        rejected = 0
+        for series_uid, series_files in series_info.items():
+            if not series_files:
+                continue
+            stacks = split_stacks(series_files)
+            for stack in stacks:
+                files = stack['slice_files']
+                if not self.accept(files):
+                    rejected += 1
+                    continue
+                current_key = self.key(files)
+                candidates.append((current_key, series_uid, stack))
+                if best_key is None or current_key > best_key:
+                    best_key = current_key
+                    best_series = build_selection(series_uid, stack['files'], stack=stack,
+                                                  series_file_count=len(series_files),
+                                                  stack_count=len(stacks), **self.extra(current_key))
+        if best_series is None:
+            return None, self.no_match_message()
+        best_series['rationale'] = self.rationale(best_series, best_key, candidates, rejected)
+        return best_series, self.selected_message(best_series)
+
+    def rationale(self, best, best_key, candidates, rejected):
+        """
+        记录选择依据（写入转换报告）：策略、选中堆栈的排序键、候选/被过滤的堆栈数、堆栈的拆分依据和
+        无法区分的重复文件数，以及排名第二的堆栈，便于事后核对为什么转换的是这个堆栈
+        """
+        runner_up = None
+        others = [c for c in candidates if c[2]['files'] is not best['files']]
+        if others:
+            key, series_uid, stack = max(others, key=lambda c: c[0])
+            first_file = stack['files'][0]
+            runner_up = {
+                'series_uid': series_uid,
+                'series_number': first_file['series_number'],
+                'description': first_file['series_description'],
+                'slice_count': stack['slice_count'],
+                'acquisition_number': stack['acquisition_number'],
+                'echo_number': stack['echo_number'],
+                'key': _jsonable_key(key),
+            }
+        return {
+            'strategy': self.name,
+            'key': _jsonable_key(best_key),
+            'candidate_stacks': len(candidates),
+            'rejected_stacks': rejected,
+            'stack': describe_stack(best),
+            'split_by': best.get('split_by', []),
+            'ambiguous_duplicates': best.get('ambiguous_duplicates', 0),
+            'runner_up': runner_up,
+        }
+
+
+class MaxLayersStrategy(SelectionStrategy):
+    """层数优先：(层数, 像素面积, CT优先, 序列号)"""
+
+    name = 'max-layers'
+
+    def key(self, files):
+        first_file = files[0]
+        pixel_area = max(first_file['rows'], 0) * max(first_file['columns'], 0)
+        modality_priority = 1 if first_file['modality'].upper() == 'CT' else 0
+        return (len(files), pixel_area, modality_priority, first_file['series_number'] or 0)
+
+
+class ScoredStrategy(SelectionStrategy):
+    """按层数、矩阵大小、描述关键字（定位像扣分、胸部加分）、序列号和模态打分"""
+
+    name = 'scored'
+    initial_key = -1
+
+    def key(self, files):
+        first_file = files[0]
+        score = 0
+        score += min(len(files) * 2, 100)
+        if first_file['rows'] > 0 and first_file['columns'] > 0:
+            score += min((first_file['rows'] * first_file['columns']) / 1000, 50)
+        desc = first_file['series_description'].lower()
+        if any(keyword in desc for keyword in SCOUT_KEYWORDS):
+            score -= 50
+        elif any(keyword in desc for keyword in PREFERRED_KEYWORDS):
+            score += 30
+        if first_file['series_number'] > 100:
+            score += 10
+        if first_file['modality'] == 'CT':
+            score += 20
+        return score
+
+    def extra(self, key):
+        return {'score': key}
+
+    def selected_message(self, best):
+        return f"Selected series with score {best['score']}"
+
+
+class ThicknessWindowStrategy(SelectionStrategy):
+    """只保留层厚在 [low, high] 内的序列，再交给内部策略（默认 ScoredStrategy）选择"""
+
+    name = 'thickness-window'
+    no_match_error = NoThicknessMatchError
+
+    def __init__(self, low=4.5, high=5.5, inner=None):
+        self.low = low
+        self.high = high
+        self.inner = inner or ScoredStrategy()
+        self.initial_key = self.inner.initial_key
+
+    def accept_header(self, header):
+        try:
+            thickness_value = float(header.slice_thickness)
+        except (ValueError, TypeError):
+            return False  # 没有或无法解析厚度信息，accept() 同样会跳过
+        return self.low <= thickness_value <= self.high and self.inner.accept_header(header)
+
+    def accept(self, files):
+        slice_thickness = files[0].get('slice_thickness')
+        if slice_thickness is None:
+            return False  # 没有厚度信息，跳过该序列
+        try:
+            thickness_value = float(slice_thickness)
+        except (ValueError, TypeError) as e:
+            print(f"  ⚠ 无法解析切片厚度值 '{slice_thickness}': {str(e)}")
+            return False
+        return self.low <= thickness_value <= self.high and self.inner.accept(files)
+
+    def key(self, files):
+        return self.inner.key(files)
+
+    def extra(self, key):
+        return self.inner.extra(key)
+
+    def no_match_message(self):
+        return f"No series found with slice thickness in {self.low:g}-{self.high:g}mm range"
+
+    def selected_message(self, best):
+        return f"{self.inner.selected_message(best)} and slice thickness {best['slice_thickness']}mm"
+
+
+STRATEGIES = {
+    MaxLayersStrategy.name: MaxLayersStrategy,
+    ScoredStrategy.name: ScoredStrategy,
+    ThicknessWindowStrategy.name: ThicknessWindowStrategy,
+}
+
+
+def register_strategy(cls):
+    """注册自定义选择策略（按 cls.name），可作为类装饰器使用"""
+    STRATEGIES[cls.name] = cls
+    return cls
+
+
+def get_strategy(name, **kwargs):
+    """按名称创建选择策略"""
+    if name not in STRATEGIES:
+        raise ValueError(f"Unknown selection strategy: {name} (available: {', '.join(STRATEGIES)})")
+    return STRATEGIES[name](**kwargs)
+
+
+def analyze_dicom_series(root_dir, strategy, verbose=True):
+    """扫描并选择最佳序列，返回 (选中序列字典或None, 说明信息)"""
+    return strategy.select(scan_dicom_series(root_dir, verbose))
+
+
+# ====== 解压 / 暂存 / 转换 ======
+
+def extract_zip(zip_path, extract_path):
+    """
+    解压整个压缩包（ZIP / tar / tar.gz / tar.zst，见 dcmnii.archive.extract_archive）
+
+    转换脚本改用 scan_archive_series 单遍读取，只写出候选序列；需要完整解压时使用本函数。
+
+    Returns:
+        tuple: (文件数, 解压后总字节数)
+    """
+    return extract_archive(zip_path, extract_path)
+
+
+def create_series_directory(series, temp_base_dir, dir_name, link=False):
+    """
+    把选中堆栈的文件放到 temp_base_dir/dir_name，返回该目录
+
+    dcm2niix 只看到这个目录，因此只会输出选中的那一个堆栈。
+    link=True 时优先创建硬链接（同一文件系统上不复制数据），失败时回退为复制。
+    不同子目录下的同名文件加序号区分，避免互相覆盖。
+    """
+    series_dir = os.path.join(temp_base_dir, dir_name)
+    os.makedirs(series_dir, exist_ok=True)
+    used = set()
+    for index, file_info in enumerate(series['files']):
+        src_path = file_info['file_path']
+        name = os.path.basename(src_path)
+        if name in used:
+            name = f"{index:05d}_{name}"
+        used.add(name)
+        dst_path = os.path.join(series_dir, name)
+        if link:
+            try:
+                os.link(src_path, dst_path)
+                continue
+            except OSError:
+                pass
+        shutil.copy2(src_path, dst_path)
+    return series_dir
+
+
+def find_dcm2niix(base_dir):
+    """在 base_dir 或 tools/MRIcroGL/Resources 下查找 dcm2niix.exe，找不到返回None"""
+    base_dir = Path(base_dir)
+    for candidate in (base_dir / "dcm2niix.exe",
+                      base_dir / "tools" / "MRIcroGL" / "Resources" / "dcm2niix.exe"):
+        if candidate.exists():
+            return candidate
+    return None
+
+
+def run_dcm2niix_capture(input_dir, output_dir, dcm2niix_path, case_name, verbose=0, output_options=None,
+                         source=None, selection=None):
+    """
+    运行dcm2niix（gzip压缩输出 + JSON sidecar）
+
+    dcm2niix 先写到 output_dir 下本次转换专用的暂存目录（.dcm2niix_*），压缩和改名都在暂存目录里完成，
+    最后才移动到 output_dir。多个worker同时向同一个 output_dir 转换时，各自只处理自己的文件，
+    不会因为 case 名互为前缀（A 与 A_x）而压缩、删除或登记别的 case 的输出。
+    output_options 为 OutputOptions（默认 .nii.gz，按CPU核数多线程压缩）：需要后处理时 dcm2niix 输出 .nii，
+    成功后再压缩为 .nii.gz（parallel_gzip）或 .nii.zst（seekable_zstd）；nii 格式直接保留 .nii。
+    成功后为本次生成的每个NIfTI写一个 <输出名>.manifest（见 write_output_manifests），
+    source 为原始ZIP/目录，selection 为选中的序列字典（记录 SeriesInstanceUID 和 PatientID）。
+
+    Returns:
+        tuple: (返回码, stdout, stderr, 本次输出到 output_dir 的文件路径列表)；无法启动dcm2niix时返回码为 -1，
+               失败时输出列表为空（暂存目录连同不完整的输出一起删除）
+    """
+    output = output_options or OutputOptions()
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    staging_dir = Path(tempfile.mkdtemp(prefix=OUTPUT_STAGING_PREFIX, dir=output_dir))
+    try:
+        cmd = [
+            str(dcm2niix_path),
+            "-f", f"{case_name}_%i_%s_%p",
+            "-o", str(staging_dir),
+            *output.dcm2niix_args(),
+            "-b", "y",  # 生成JSON文件
+            "-v", str(verbose),
+            str(input_dir)
+        ]
+        try:
+            result = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8', errors='replace')
+        except OSError as e:
+            return -1, '', str(e), []
+        stdout = result.stdout
+        if result.returncode != 0:
+            return result.returncode, stdout, result.stderr, []
+        try:
+            compressed = output.finalize(staging_dir)
+        except OSError as e:
+            return -1, stdout, f"Compression failed: {e}", []
+        if compressed:
+            stdout += f"Compressed {len(compressed)} file(s) ({output.describe()})\n"
+        try:
+            outputs = _publish_outputs(staging_dir, output_dir)
+        except OSError as e:
+            return -1, stdout, f"Could not move outputs to {output_dir}: {e}", []
+        try:
+            write_output_manifests(split_outputs(outputs)[0], case_name, source or input_dir, selection)
+        except OSError as e:
+            stdout += f"Warning: could not write output manifest: {e}\n"
+        return result.returncode, stdout, result.stderr, outputs
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+
+def _publish_outputs(staging_dir, output_dir):
+    """把暂存目录中的输出移动到 output_dir（同一文件系统上是改名；同名的旧输出被覆盖），返回新路径"""
+    outputs = []
+    for path in sorted(Path(staging_dir).iterdir()):
+        if path.is_file():
+            target = output_dir / path.name
+            os.replace(path, target)
+            outputs.append(target)
+    return outputs
+
+
+def run_dcm2niix(input_dir, output_dir, dcm2niix_path, case_name, output_options=None, source=None,
+                 selection=None):
+    """运行dcm2niix，返回 (是否成功, stdout或错误信息, 本次输出的文件路径列表)"""
+    returncode, stdout, stderr, outputs = run_dcm2niix_capture(input_dir, output_dir, dcm2niix_path, case_name,
+                                                               output_options=output_options, source=source,
+                                                               selection=selection)
+    if returncode == 0:
+        return True, stdout, outputs
+    return False, stderr or stdout, outputs
+
+
+def split_outputs(outputs):
+    """把 run_dcm2niix 返回的输出文件分为 (NIfTI列表, JSON sidecar列表)"""
+    nii_files = [p for p in outputs if nifti_format(p)]
+    json_files = [p for p in outputs if p.suffix == '.json']
+    return nii_files, json_files
+
+
+def sidecar_path(nii_file):
+    """NIfTI文件对应的JSON sidecar路径（x.nii.gz / x.nii.zst / x.nii -> x.json）"""
+    name = nii_file.name
+    for suffix in FORMAT_SUFFIXES.values():
+        if name.endswith(suffix):
+            return nii_file.with_name(name[:-len(suffix)] + '.json')
+    return nii_file.with_suffix('.json')
+
+
+def find_nifti_files(output_dir, case_name):
+    """
+    目录中已有的 case NIfTI 输出（任意 --nifti-format：.nii.gz / .nii.zst / .nii），用于跳过已转换的 case
+
+    文件名前缀相同的其他 case（A 与 A_x）按输出清单里的 case_id 排除；没有清单的旧输出仍按文件名匹配。
+    转换本身不用它查找输出，run_dcm2niix 直接返回本次生成的文件。
+    """
+    nifti_files = []
+    for p in Path(output_dir).glob(f"{case_name}_*.nii*"):
+        if not nifti_format(p):
+            continue
+        manifest = read_output_manifest(p)
+        if manifest is None or manifest['case_id'] == case_name:
+            nifti_files.append(p)
+    return sorted(nifti_files)
+
+
+# ====== 输出清单 ======
+
+# 每个输出旁边的清单文件：x.nii.gz / x.json -> x.manifest
+# 故意不用 .json 扩展名，各脚本按 "<case>_*.json" 收集sidecar时不会把清单当成sidecar
+MANIFEST_SUFFIX = '.manifest'
+MANIFEST_VERSION = 1
+# dcm2niix 的暂存目录（在输出目录下，见 run_dcm2niix_capture）
+OUTPUT_STAGING_PREFIX = '.dcm2niix_'
+
+
+def manifest_path(output_file):
+    """NIfTI 或 JSON sidecar 对应的清单路径"""
+    output_file = Path(output_file)
+    return sidecar_path(output_file).with_suffix(MANIFEST_SUFFIX)
+
+
+def write_output_manifests(nifti_files, case_name, source=None, selection=None):
+    """
+    为每个NIfTI输出写一个清单（JSON格式，x.manifest）：case、来源、SeriesInstanceUID、输出文件
+
+    汇总阶段按清单里的 case_id / patient_id 精确关联原始DICOM元数据，
+    不必再从 "<case>_<PatientID>_<序列号>_<协议>" 文件名里拆分（ZIP名本身含下划线时拆分会出错）。
+
+    Returns:
+        list: 写出的清单路径
+    """
+    selection = selection or {}
+    written = []
+    for nii_file in nifti_files:
+        nii_file = Path(nii_file)
+        json_file = sidecar_path(nii_file)
+        manifest = {
+            'manifest_version': MANIFEST_VERSION,
+            'case_id': case_name,
+            'source': str(source) if source else None,
+            'patient_id': selection.get('patient_id') or None,
+            'series_uid': selection.get('series_uid'),
+            'series_number': selection.get('series_number'),
+            'series_description': selection.get('description'),
+            'nifti_file': nii_file.name,
+            'nifti_format': nifti_format(nii_file),
+            'sidecar_file': json_file.name if json_file.exists() else None,
+            'created': datetime.now().isoformat(),
+        }
+        path = manifest_path(nii_file)
+        tmp_path = path.with_name(path.name + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2, default=str)
+        os.replace(tmp_path, path)
+        written.append(path)
+    return written
+
+
+def read_output_manifest(output_file):
+    """读取输出（NIfTI或sidecar）旁边的清单，没有清单或无法解析时返回None"""
+    try:
+        with open(manifest_path(output_file), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return manifest if isinstance(manifest, dict) and manifest.get('case_id') else None
+
+
+def nifti_for_sidecar(json_file):
+    """JSON sidecar 对应的 NIfTI 文件，返回 (文件名, 格式)；找不到时按默认 .nii.gz 命名"""
+    for fmt, suffix in FORMAT_SUFFIXES.items():
+        candidate = json_file.with_name(json_file.stem + suffix)
+        if candidate.exists():
+            return candidate.name, fmt
+    return json_file.stem + FORMAT_SUFFIXES['gz'], 'gz'
+
+
+def keep_largest_nifti(nii_files):
+    """
+    兜底清理：如果本次转换生成了多个NIfTI文件（run_dcm2niix 返回的输出），只保留最大的那个，删除其他的
+    同时删除对应的JSON文件和输出清单
+
+    正常情况下转换前已经只暂存了选中的堆栈（见 split_stacks / create_series_directory），
+    dcm2niix 只输出一个文件；只有 dcm2niix 仍按我们没有识别的维度拆分时才会走到这里。
+    只处理传入的文件，不按文件名在输出目录里查找（同一目录下可能有其他 case 正在写入）。
+    """
+    nii_files = [Path(p) for p in nii_files]
+
+    if len(nii_files) <= 1:
+        return nii_files  # 只有1个或0个文件，不需要处理
+
+    # 找到最大的文件
+    largest_file = max(nii_files, key=lambda f: f.stat().st_size)
+    files_to_delete = [f for f in nii_files if f != largest_file]
+
+    for nii_file in files_to_delete:
+        # 删除对应的JSON文件
+        json_file = sidecar_path(nii_file)
+        if json_file.exists():
+            json_file.unlink()
+        manifest_file = manifest_path(nii_file)
+        if manifest_file.exists():
+            manifest_file.unlink()
+        # 删除NIfTI文件
+        nii_file.unlink()
+
+    print(f"  🗑️  Removed {len(files_to_delete)} smaller NIfTI file(s), kept largest: {largest_file.name}")
+    return [largest_file]
+
+
+# ====== JSON sidecar 汇总 ======
+
+def find_case_metadata_csv(search_dirs):
+    """在多个目录中查找最新的 dicom_metadata_*.csv / case_metadata_*.csv"""
+    dicom_csv_files = []
+    for search_dir in search_dirs:
+        if search_dir.exists():
+            dicom_csv_files.extend(list(search_dir.glob("dicom_metadata_*.csv")))
+            dicom_csv_files.extend(list(search_dir.glob("case_metadata_*.csv")))
+    if not dicom_csv_files:
+        return None
+    return max(dicom_csv_files, key=lambda f: f.stat().st_mtime)
+
+
+# sidecar 解析结果缓存（按路径 + 大小 + 修改时间），字段变化时提升版本号使旧缓存失效
+SIDECAR_INDEX_NAME = '.sidecar_index.json'
+SIDECAR_INDEX_VERSION = 2
+
+# 优先使用原始DICOM元数据CSV中的值覆盖的列
+DICOM_OVERRIDE_FIELDS = ('StudyDate', 'StudyTime', 'PatientName', 'PatientBirthDate', 'PatientSex',
+                         'PatientAge', 'InstitutionName')
+DICOM_FIELD_MAPPING = {
+    'PatientName': ['PatientName', 'Patient Name'],
+    'PatientBirthDate': ['PatientBirthDate', 'PatientBirtDate', 'Patient Birth Date'],
+    'PatientSex': ['PatientSex', 'Patient Sex'],
+    'StudyDate': ['StudyDate', 'Study Date'],
+    'StudyTime': ['StudyTime', 'Study Time'],
+    'InstitutionName': ['InstitutionName', 'Institution Name'],
+    'PatientAge': ['PatientAge', 'Patient Age']
+}
+
+
+def sidecar_row(json_file):
+    """
+    把一个 dcm2niix JSON sidecar 解析为汇总表的一行（只依赖sidecar和它的输出清单，可以缓存）
+
+    case / PatientID / SeriesInstanceUID 优先取自输出清单（IdentitySource = 'manifest'）；
+    没有清单的旧输出才从文件名 "<case>_<PatientID>_<序列号>_<协议>" 拆分（IdentitySource = 'filename'）。
+    DICOM_OVERRIDE_FIELDS 中的列先填入sidecar的值，汇总时再用原始DICOM元数据覆盖。
+    """
+    json_file = Path(json_file)
+    manifest = read_output_manifest(json_file)
+    series_uid = 'Unknown'
+    if manifest:
+        case_name = manifest['case_id']
+        patient_id = manifest.get('patient_id') or 'Unknown'
+        series_uid = manifest.get('series_uid') or 'Unknown'
+        # 文件名去掉 "<case>_" 和 dcm2niix 写入的PatientID，剩下 "<序列号>_<协议>"
+        rest = json_file.stem[len(case_name) + 1:] if json_file.stem.startswith(case_name + '_') \
+            else json_file.stem
+        if patient_id != 'Unknown' and rest[len(patient_id):len(patient_id) + 1] == '_':
+            series_info = rest[len(patient_id) + 1:]
+        else:
+            series_info = rest.split('_', 1)[-1]
+    else:
+        # 从文件名解析案例信息
+        parts = json_file.stem.split('_')
+
+        if len(parts) >= 4:
+            case_name = parts[0] + '_' + parts[1]  # dicom_XXXXXXX
+            patient_id = parts[2]
+            series_info = '_'.join(parts[3:])
+        else:
+            case_name = json_file.stem
+            patient_id = 'Unknown'
+            series_info = 'Unknown'
+
+    # 读取JSON内容
+    with open(json_file, 'r', encoding='utf-8') as f:
+        json_data = json.load(f)
+
+    # 实际的NIfTI文件和格式（下游按 NIfTIFormat 选择读取方式）
+    nifti_name, nifti_fmt = nifti_for_sidecar(json_file)
+
+    return {
+        'FileName': json_file.name,
+        'CaseName': case_name,
+        'PatientID': patient_id,
+        'SeriesInfo': series_info,
+        'SeriesInstanceUID': series_uid,
+        'IdentitySource': 'manifest' if manifest else 'filename',
+        'NIfTIFile': nifti_name,
+        'NIfTIFormat': nifti_fmt,
+        'OutputFolder': str(json_file.parent),
+
+        # DICOM基本信息
+        'Modality': json_data.get('Modality', 'Unknown'),
+        'StudyDate': json_data.get('StudyDate', 'Unknown'),
+        'StudyTime': json_data.get('StudyTime', 'Unknown'),
+        'StudyDescription': json_data.get('StudyDescription', 'Unknown'),
+        'SeriesNumber': json_data.get('SeriesNumber', 'Unknown'),
+        'SeriesDescription': json_data.get('SeriesDescription', 'Unknown'),
+        'ProtocolName': json_data.get('ProtocolName', 'Unknown'),
+
+        # 患者信息（汇总时优先使用原始DICOM数据）
+        'PatientName': json_data.get('PatientName', 'Unknown'),
+        'PatientBirthDate': json_data.get('PatientBirthDate', 'Unknown'),
+        'PatientSex': json_data.get('PatientSex', 'Unknown'),
+        'PatientAge': json_data.get('PatientAge', 'Unknown'),
+
+        # 影像参数
+        'SliceThickness': json_data.get('SliceThickness', 'Unknown'),
+        'SpacingBetweenSlices': json_data.get('SpacingBetweenSlices', 'Unknown'),
+        'PixelSpacing': str(json_data.get('PixelSpacing', 'Unknown')),
+        'ImageOrientationPatientDICOM': str(json_data.get('ImageOrientationPatientDICOM', 'Unknown')),
+
+        # 采集参数
+        'RepetitionTime': json_data.get('RepetitionTime', 'Unknown'),
+        'EchoTime': json_data.get('EchoTime', 'Unknown'),
+        'FlipAngle': json_data.get('FlipAngle', 'Unknown'),
+        'AcquisitionMatrix': str(json_data.get('AcquisitionMatrix', 'Unknown')),
+
+        # 设备信息
+        'Manufacturer': json_data.get('Manufacturer', 'Unknown'),
+        'ManufacturerModelName': json_data.get('ManufacturerModelName', 'Unknown'),
+        'MagneticFieldStrength': json_data.get('MagneticFieldStrength', 'Unknown'),
+        'InstitutionName': json_data.get('InstitutionName', 'Unknown'),
+        'StationName': json_data.get('StationName', 'Unknown'),
+
+        # 重建参数
+        'ConvolutionKernel': json_data.get('ConvolutionKernel', 'Unknown'),
+        'ReconstructionDiameter': json_data.get('ReconstructionDiameter', 'Unknown'),
+        'KVP': json_data.get('KVP', 'Unknown'),
+        'XRayTubeCurrent': json_data.get('XRayTubeCurrent', 'Unknown'),
+        'ExposureTime': json_data.get('ExposureTime', 'Unknown'),
+
+        # dcm2niix相关
+        'dcm2niix_version': json_data.get('dcm2niix_version', 'Unknown'),
+        'ConversionSoftware': json_data.get('ConversionSoftware', 'dcm2niix'),
+        'ConversionSoftwareVersion': json_data.get('ConversionSoftwareVersion', 'Unknown'),
+    }
+
+
+class SidecarIndex:
+    """
+    sidecar 解析结果缓存（保存在汇总目录的 .sidecar_index.json）
+
+    以文件路径为键，记录 sidecar 和输出清单的 (大小, mtime_ns) 以及解析出的行；都未变化时直接复用，
+    重复汇总（例如5mm脚本重新收集已转换case的sidecar）只解析新增或改动过的文件。
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.hits = 0
+        self.misses = 0
+        self.entries = {}
+        self._dirty = False
+        if self.path.exists():
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                if data.get('version') == SIDECAR_INDEX_VERSION:
+                    self.entries = data.get('entries', {})
+            except (OSError, ValueError, AttributeError):
+                self.entries = {}
+
+    def row(self, json_file):
+        """返回sidecar的行（命中缓存时不打开文件）"""
+        key = os.path.abspath(json_file)
+        st = os.stat(key)
+        signature = [st.st_size, st.st_mtime_ns]
+        try:
+            manifest_st = os.stat(manifest_path(key))
+            signature += [manifest_st.st_size, manifest_st.st_mtime_ns]
+        except OSError:
+            pass
+        cached = self.entries.get(key)
+        if cached and cached.get('signature') == signature:
+            self.hits += 1
+            row = dict(cached['row'])
+            # NIfTI 可能在sidecar之后被重新压缩/替换，只重新确认文件名和格式
+            if not os.path.exists(os.path.join(os.path.dirname(key), row['NIfTIFile'])):
+                row['NIfTIFile'], row['NIfTIFormat'] = nifti_for_sidecar(Path(key))
+            return row
+        row = sidecar_row(json_file)
+        self.entries[key] = {'signature': signature, 'row': row}
+        self.misses += 1
+        self._dirty = True
+        return dict(row)
+
+    def save(self):
+        """写回缓存（去掉已不存在的文件）；没有新解析的文件时不重写"""
+        stale = [key for key in self.entries if not os.path.exists(key)]
+        for key in stale:
+            del self.entries[key]
+        if not (self._dirty or stale):
+            return
+        try:
+            tmp_path = self.path.with_name(self.path.name + '.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'version': SIDECAR_INDEX_VERSION, 'entries': self.entries}, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"  ⚠ Could not save sidecar index: {e}")
+
+
+def _dicom_info_from_record(record):
+    """从原始DICOM元数据CSV的一行提取患者/检查信息（缺失为 'Unknown'，必要时由日期计算年龄）"""
+    import pandas as pd
+
+    dicom_info = {}
+    for target_field, possible_names in DICOM_FIELD_MAPPING.items():
+        value = 'Unknown'
+        for name in possible_names:
+            if name in record and pd.notna(record[name]):
+                value = str(record[name])
+                break
+        dicom_info[target_field] = value
+
+    # 如果没有现成的年龄，尝试计算
+    if dicom_info.get('PatientAge') == 'Unknown':
+        try:
+            birth_date = dicom_info.get('PatientBirthDate', '')
+            study_date = dicom_info.get('StudyDate', '')
+            if len(birth_date) == 8 and len(study_date) == 8:  # YYYYMMDD格式
+                birth_year = int(birth_date[:4])
+                study_year = int(study_date[:4])
+                age = study_year - birth_year
+                dicom_info['PatientAge'] = str(age)
+        except Exception as e:
+            print(f"  ⚠ 无法计算患者年龄: {str(e)}")
+    return dicom_info
+
+
+class DicomMetadataLookup:
+    """
+    查找原始DICOM元数据（一次建立哈希表，代替每个sidecar都过滤/遍历整个DataFrame）
+
+    匹配顺序：case名精确匹配 ZipFileName 列（extract_case_metadata_anywhere 按ZIP/目录名记录）、
+    PatientID 精确匹配，都取第一条；exact=False 时（没有输出清单的旧输出）最后取第一条 PatientID 包含该值的记录。
+    """
+
+    def __init__(self, dicom_metadata_df):
+        self.records = dicom_metadata_df.to_dict('records') if dicom_metadata_df is not None else []
+        self.ids = [str(record.get('PatientID', '')) for record in self.records]
+        self.by_patient = {}
+        self.by_case = {}
+        for index, record in enumerate(self.records):
+            self.by_patient.setdefault(self.ids[index], index)
+            if 'ZipFileName' in record:
+                self.by_case.setdefault(str(record['ZipFileName']), index)
+        self._patient_index = {}
+        self._info = {}
+
+    def _find_patient(self, patient_id, exact):
+        """PatientID 对应的记录下标（按 (PatientID, exact) 缓存，子串匹配每个ID只扫描一次）"""
+        key = (patient_id, exact)
+        if key not in self._patient_index:
+            index = self.by_patient.get(patient_id)
+            if index is None and not exact:
+                index = next((i for i, value in enumerate(self.ids) if patient_id in value), None)
+            self._patient_index[key] = index
+        return self._patient_index[key]
+
+    def find(self, case_id, patient_id, exact=False):
+        """返回 dicom_info 字典，找不到返回空字典"""
+        if not self.records:
+            return {}
+        index = self.by_case.get(str(case_id))
+        if index is None and patient_id != 'Unknown':
+            index = self._find_patient(str(patient_id), exact)
+        if index is None:
+            return {}
+        if index not in self._info:
+            self._info[index] = _dicom_info_from_record(self.records[index])
+        return self._info[index]
+
+
+def extract_json_metadata_to_csv_unified(output_dir, json_files):
+    """统一处理所有JSON文件并生成汇总CSV - 参照原脚本逻辑"""
+    import pandas as pd
+
+    try:
+        print(f"  Processing {len(json_files)} JSON files...")
+        if not json_files:
+            print("  Warning: No JSON metadata files found")
+            return None, None
+
+        # 尝试读取原始DICOM元数据CSV文件
+        dicom_metadata_df = None
+
+        # 在多个位置寻找DICOM元数据文件
+        search_dirs = [
+            Path(output_dir),  # 当前output目录
+            Path(output_dir).parent,  # 选择的主目录
+            REPO_ROOT / "output",  # 项目output目录
+        ]
+
+        latest_dicom_csv = find_case_metadata_csv(search_dirs)
+        if latest_dicom_csv:
+            try:
+                dicom_metadata_df = pd.read_csv(latest_dicom_csv)
+                print(f"  ✓ Found DICOM metadata: {latest_dicom_csv.name} ({len(dicom_metadata_df)} records)")
+            except Exception as e:
+                print(f"  ⚠ Warning: Could not read DICOM metadata: {e}")
+        dicom_lookup = DicomMetadataLookup(dicom_metadata_df)
+
+        index = SidecarIndex(Path(output_dir) / SIDECAR_INDEX_NAME)
+        processing_time = datetime.now().isoformat()
+        all_metadata = []
+
+        for json_file in json_files:
+            try:
+                metadata = index.row(json_file)
+                # 从原始DICOM元数据中获取患者信息（优先于sidecar中的值）
+                dicom_info = dicom_lookup.find(metadata['CaseName'], metadata['PatientID'],
+                                               exact=metadata['IdentitySource'] == 'manifest')
+                for field in DICOM_OVERRIDE_FIELDS:
+                    if field in dicom_info:
+                        metadata[field] = dicom_info[field]
+                # 处理信息
+                metadata['ProcessingTime'] = processing_time
+                all_metadata.append(metadata)
+
+            except Exception as e:
+                print(f"  Error processing {Path(json_file).name}: {str(e)}")
+                continue
+
+        index.save()
+        print(f"  Sidecar index: {index.hits} cached, {index.misses} parsed")
+
+        if not all_metadata:
+            print("  No valid metadata extracted")
+            return None, None
+
+        # 转换为DataFrame并保存完整元数据CSV
+        df = pd.DataFrame(all_metadata)
+        csv_path = Path(output_dir) / f"unified_metadata_summary_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+        df.to_csv(csv_path, index=False, encoding='utf-8-sig')
+
+        # 创建简化的临床信息CSV
+        clinical_fields = ['FileName', 'PatientID', 'StudyDate', 'PatientName', 'PatientBirthDate', 'PatientSex', 'PatientAge', 'OutputFolder']
+        clinical_df = df[clinical_fields].copy()
+
+        clinical_csv_path = Path(output_dir) / f"unified_clinical_info_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+        clinical_df.to_csv(clinical_csv_path, index=False, encoding='utf-8-sig')
+
+        print(f"  Successfully extracted metadata from {len(all_metadata)} JSON files")
+        print(f"  Complete CSV saved with {len(df.columns)} columns of information")
+        print(f"  Clinical CSV saved with {len(clinical_fields)} key fields")
+
+        # 显示一些统计信息
+        print(f"\n  Metadata Summary:")
+        if 'Modality' in df.columns:
+            modality_counts = df['Modality'].value_counts()
+            print(f"    - Modalities: {dict(modality_counts)}")
+
+        if 'ManufacturerModelName' in df.columns:
+            scanner_counts = df['ManufacturerModelName'].value_counts()
+            print(f"    - Scanner models: {len(scanner_counts)} unique models")
+
+        if 'PatientSex' in df.columns:
+            sex_counts = df['PatientSex'].value_counts()
+            print(f"    - Patient sex distribution: {dict(sex_counts)}")
+
+        print(f"Complete metadata summary: {csv_path}")
+        print(f"Clinical info summary: {clinical_csv_path}")
+        return csv_path, clinical_csv_path
+
+    except Exception as e:
+        print(f"  Error during unified JSON metadata extraction: {str(e)}")
+        return None, None
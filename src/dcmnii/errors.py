@@ -0,0 +1,168 @@
+"""
+带错误代码的转换异常与按类别的重试策略
+
+原来各脚本在批次结束后才按错误信息的子串把失败归类（failed_cases_*.txt），
+转换过程中所有失败都一样处理，文件被锁定、网络共享抖动这类临时错误也不会重试。
+
+现在转换函数在失败处抛出 ConversionError 的子类，code 与 dcmnii.report.ERROR_CATEGORIES 的键一致，
+结果记录带 error_code / error_stage 字段；retry_case() 按 code 查 RETRY_POLICIES 决定是否重试：
+- io:               文件被锁定、网络共享超时等临时I/O错误，指数退避重试（默认再试3次：2s、4s、8s）
+- 其余（没有DICOM、没有5mm序列、ZIP损坏、dcm2niix失败……）: 换一次也不会变，不重试
+
+--retry-failed FILE 读取上次的 failed_cases_*.txt，只重新处理其中列出的case，已成功的case不再重复处理。
+"""
+import errno
+import time
+import zipfile
+
+# 视为临时错误的 errno（文件被占用、I/O超时、网络连接中断等）
+TRANSIENT_ERRNOS = {getattr(errno, name) for name in (
+    'EAGAIN', 'EBUSY', 'EIO', 'ETIMEDOUT', 'ESTALE', 'ECONNRESET', 'ECONNABORTED',
+    'ENETDOWN', 'ENETUNREACH', 'EHOSTUNREACH', 'ETXTBSY') if hasattr(errno, name)}
+# Windows 错误码：32 共享冲突（文件被其他进程打开）、33 锁定冲突、53/59/64/67 网络路径/共享错误、121 信号灯超时
+TRANSIENT_WINERRORS = {32, 33, 53, 59, 64, 67, 121}
+
+
+class ConversionError(Exception):
+    """转换失败（code 为错误类别，对应 ERROR_CATEGORIES 和重试策略；stage 为出错的处理阶段）"""
+
+    code = 'other'
+
+    def __init__(self, message, stage=None):
+        super().__init__(message)
+        self.message = str(message)
+        self.stage = stage
+
+    def fields(self):
+        """写入结果记录的错误字段"""
+        return {'error': self.message, 'error_code': self.code, 'error_stage': self.stage}
+
+
+class NoDicomError(ConversionError):
+    """输入中没有可读的DICOM文件"""
+    code = 'dicom'
+
+
+class NoSeriesError(ConversionError):
+    """有DICOM文件，但选择策略没有选中任何序列"""
+    code = 'dicom'
+
+
+class NoThicknessMatchError(NoSeriesError):
+    """没有层厚在要求范围内（例如4.5-5.5mm）的序列"""
+    code = 'slice_thickness'
+
+
+class ExtractError(ConversionError):
+    """ZIP损坏或无法解压"""
+    code = 'extract'
+
+
+class ConverterError(ConversionError):
+    """dcm2niix 运行失败或没有生成输出"""
+    code = 'dcm2niix'
+
+
+class TransientIOError(ConversionError):
+    """临时I/O错误（文件被锁定、网络共享超时等），稍后重试可能成功"""
+    code = 'io'
+
+
+# 各阶段中非 ConversionError 的异常默认归入的类别
+STAGE_ERRORS = {
+    'extract': ExtractError,
+    'convert': ConverterError,
+}
+
+
+def is_transient(exc):
+    """OSError 是否属于可以重试的临时错误"""
+    if not isinstance(exc, OSError):
+        return False
+    if getattr(exc, 'winerror', None) in TRANSIENT_WINERRORS:
+        return True
+    return isinstance(exc, (TimeoutError, ConnectionError)) or exc.errno in TRANSIENT_ERRNOS
+
+
+def error_from_exception(exc, stage=None):
+    """把处理过程中抛出的任意异常转换为带错误代码的 ConversionError"""
+    if isinstance(exc, ConversionError):
+        if exc.stage is None:
+            exc.stage = stage
+        return exc
+    if is_transient(exc):
+        return TransientIOError(str(exc), stage)
+    if isinstance(exc, zipfile.BadZipFile):
+        return ExtractError(f"Bad ZIP file: {exc}", stage)
+    return STAGE_ERRORS.get(stage, ConversionError)(str(exc), stage)
+
+
+class RetryPolicy:
+    """最多尝试 attempts 次，第 n 次失败后等待 min(delay * factor**(n-1), max_delay) 秒"""
+
+    __slots__ = ('attempts', 'delay', 'factor', 'max_delay')
+
+    def __init__(self, attempts=1, delay=0.0, factor=2.0, max_delay=60.0):
+        self.attempts = max(1, attempts)
+        self.delay = delay
+        self.factor = factor
+        self.max_delay = max_delay
+
+    def backoff(self, attempt):
+        return min(self.delay * self.factor ** (attempt - 1), self.max_delay)
+
+
+NO_RETRY = RetryPolicy()
+# 只有临时I/O错误值得重试；没有的类别按 NO_RETRY 处理
+RETRY_POLICIES = {
+    'io': RetryPolicy(attempts=4, delay=2.0),
+}
+
+
+def retry_policies(io_retries=None):
+    """按命令行参数调整后的重试策略表（io_retries=0 关闭重试）"""
+    policies = dict(RETRY_POLICIES)
+    if io_retries is not None:
+        base = policies['io']
+        policies['io'] = RetryPolicy(attempts=io_retries + 1, delay=base.delay, factor=base.factor,
+                                     max_delay=base.max_delay)
+    return policies
+
+
+def retry_case(attempt, policies=None, sleep=time.sleep):
+    """
+    运行 attempt()（返回带 success / error_code 的结果字典），失败时按错误类别的策略重试
+
+    重试过的结果带 attempts（总尝试次数）和 retried_errors（之前各次的错误信息）。
+    """
+    policies = RETRY_POLICIES if policies is None else policies
+    errors = []
+    number = 1
+    while True:
+        result = attempt()
+        if result.get('success'):
+            break
+        policy = policies.get(result.get('error_code'), NO_RETRY)
+        if number >= policy.attempts:
+            break
+        delay = policy.backoff(number)
+        print(f"  ↻ {result.get('error_code')} 错误，{delay:.0f}s 后重试（第 {number + 1}/{policy.attempts} 次）: "
+              f"{result.get('error')}")
+        errors.append(result.get('error'))
+        sleep(delay)
+        number += 1
+    if errors:
+        result['attempts'] = number
+        result['retried_errors'] = errors
+    return result
+
+
+def add_retry_arguments(parser):
+    """为入口脚本的 argparse 添加重试/重新排队选项"""
+    group = parser.add_argument_group('失败处理')
+    group.add_argument('--io-retries', type=int, default=None, metavar='N',
+                       help=f"临时I/O错误（文件被锁定、网络共享超时）的重试次数"
+                            f"（默认{RETRY_POLICIES['io'].attempts - 1}，指数退避；0=不重试）")
+    group.add_argument('--retry-failed', metavar='FILE', default=None,
+                       help='只重新处理该 failed_cases_*.txt 中列出的case（跳过上次已成功的case）')
+    return group
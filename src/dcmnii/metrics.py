@@ -0,0 +1,200 @@
+"""
+Prometheus 指标导出（textfile collector）
+
+转换脚本在调度系统下长时间运行时，除了翻日志看不到进度和失败情况。
+--metrics-file 把批次指标按 Prometheus 文本格式写到本地文件，每个case完成后原子替换（先写临时文件再 os.replace），
+node_exporter 的 textfile collector（--collector.textfile.directory）直接读取，不需要网络端口或额外依赖：
+
+    dcmnii_cases_total{script, status}              已处理case数（status: success / failed / skipped）
+    dcmnii_failures_total{script, category}         失败case数，category 与 failed_cases_*.txt 的分类一致
+                                                    （dicom / slice_thickness / dcm2niix / extract / io / other）
+    dcmnii_files_total{script}                      处理的DICOM文件数
+    dcmnii_bytes_read_total / dcmnii_bytes_written_total{script}   各阶段读写字节数之和
+    dcmnii_stage_duration_seconds{script, stage}    各阶段耗时直方图（extract / scan / select / stage / convert / ...）
+    dcmnii_case_duration_seconds{script}            每个case各阶段耗时之和的直方图
+    dcmnii_cases_planned{script}                    本批次case总数（监视模式没有）
+    dcmnii_run_start_time_seconds / dcmnii_last_update_time_seconds{script}   运行开始/最近更新的Unix时间
+    dcmnii_run_finished{script}                     批次结束后为1
+
+计数器在每次运行开始时从0计数，Prometheus 会把进程重启识别为计数器重置。
+"""
+import os
+import time
+from pathlib import Path
+from dcmnii.report import ERROR_CATEGORIES, error_category
+from dcmnii.stages import STAGES
+
+# 阶段/case耗时直方图的桶上限（秒）
+DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0)
+CASE_STATUSES = ('success', 'failed', 'skipped')
+
+
+def _escape(value):
+    """标签值转义（反斜杠、双引号、换行）"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels):
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + '}'
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value) if value != int(value) else str(int(value))
+    return str(value)
+
+
+class Histogram:
+    """累计桶直方图（Prometheus histogram：_bucket{le} / _sum / _count）"""
+
+    __slots__ = ('buckets', 'counts', 'total', 'count')
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.total += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def lines(self, name, **labels):
+        for bound, count in zip(self.buckets, self.counts):
+            yield f"{name}_bucket{_labels(**labels, le=repr(float(bound)))} {count}"
+        yield f"{name}_bucket{_labels(**labels, le='+Inf')} {self.count}"
+        yield f"{name}_sum{_labels(**labels)} {round(self.total, 6)}"
+        yield f"{name}_count{_labels(**labels)} {self.count}"
+
+
+class BatchMetrics:
+    """
+    一次批处理/监视运行的指标
+
+    用法:
+        metrics = BatchMetrics('max_layers', path='/var/lib/node_exporter/textfile/dcmnii.prom', total=len(cases))
+        for case in cases:
+            result = process(case)
+            metrics.observe(result)      # 按结果记录的 success / skipped / error / stage_timings 计数，并写出文件
+        metrics.close()                  # dcmnii_run_finished 置1
+
+    path 为None时只计数不写文件。
+    """
+
+    def __init__(self, script, path=None, total=None):
+        self.script = script
+        self.path = Path(path) if path else None
+        self.total = total
+        self.cases = dict.fromkeys(CASE_STATUSES, 0)
+        self.failures = dict.fromkeys(ERROR_CATEGORIES, 0)
+        self.files = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.stages = {}
+        self.case_duration = Histogram()
+        self.started = time.time()
+        self.updated = self.started
+        self.finished = False
+        if self.path:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.write()
+
+    def observe(self, result):
+        """记录一个case的结果并更新指标文件"""
+        if result.get('skipped'):
+            self.cases['skipped'] += 1
+        elif result.get('success'):
+            self.cases['success'] += 1
+        else:
+            self.cases['failed'] += 1
+            self.failures[error_category(result)] += 1
+        timings = result.get('stage_timings') or {}
+        if timings:
+            self.files += max(stage.get('files', 0) for stage in timings.values())
+            self.case_duration.observe(sum(stage.get('seconds', 0) for stage in timings.values()))
+        for name, stage in timings.items():
+            self.bytes_read += stage.get('bytes_read', 0)
+            self.bytes_written += stage.get('bytes_written', 0)
+            self.stages.setdefault(name, Histogram()).observe(stage.get('seconds', 0))
+        self.updated = time.time()
+        self.write()
+
+    def close(self):
+        self.finished = True
+        self.updated = time.time()
+        self.write()
+
+    def render(self):
+        """Prometheus 文本格式（exposition format 0.0.4）"""
+        script = self.script
+        lines = [
+            '# HELP dcmnii_cases_total Cases processed, by outcome.',
+            '# TYPE dcmnii_cases_total counter',
+        ]
+        lines += [f"dcmnii_cases_total{_labels(script=script, status=status)} {count}"
+                  for status, count in self.cases.items()]
+        lines += [
+            '# HELP dcmnii_failures_total Failed cases, by error category.',
+            '# TYPE dcmnii_failures_total counter',
+        ]
+        lines += [f"dcmnii_failures_total{_labels(script=script, category=category)} {count}"
+                  for category, count in self.failures.items()]
+        for name, value, help_text in (
+                ('dcmnii_files_total', self.files, 'DICOM files processed.'),
+                ('dcmnii_bytes_read_total', self.bytes_read, 'Bytes read across all stages.'),
+                ('dcmnii_bytes_written_total', self.bytes_written, 'Bytes written across all stages.')):
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter',
+                      f"{name}{_labels(script=script)} {value}"]
+        lines += [
+            '# HELP dcmnii_stage_duration_seconds Per-case time spent in each processing stage.',
+            '# TYPE dcmnii_stage_duration_seconds histogram',
+        ]
+        ordered = [s for s in STAGES if s in self.stages] + [s for s in self.stages if s not in STAGES]
+        for stage in ordered:
+            lines += self.stages[stage].lines('dcmnii_stage_duration_seconds', script=script, stage=stage)
+        lines += [
+            '# HELP dcmnii_case_duration_seconds Total processing time per case.',
+            '# TYPE dcmnii_case_duration_seconds histogram',
+        ]
+        lines += self.case_duration.lines('dcmnii_case_duration_seconds', script=script)
+        gauges = [
+            ('dcmnii_run_start_time_seconds', round(self.started, 3), 'Unix time the run started.'),
+            ('dcmnii_last_update_time_seconds', round(self.updated, 3), 'Unix time of the last update.'),
+            ('dcmnii_run_finished', int(self.finished), '1 once the run has finished.'),
+        ]
+        if self.total is not None:
+            gauges.insert(0, ('dcmnii_cases_planned', self.total, 'Cases found for this run.'))
+        for name, value, help_text in gauges:
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} gauge',
+                      f"{name}{_labels(script=script)} {_number(value)}"]
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        """原子写出指标文件（collector 不会读到写了一半的文件）"""
+        if self.path is None:
+            return
+        tmp_path = self.path.with_name(f".{self.path.name}.{os.getpid()}.tmp")
+        try:
+            with open(tmp_path, 'w', encoding='utf-8', newline='\n') as f:
+                f.write(self.render())
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            # 指标只用于监控，写不出来（例如Windows上文件正被读取）时不影响转换，下一个case再写
+            print(f"⚠ 无法写入指标文件 {self.path}: {e}")
+
+
+def add_metrics_arguments(parser):
+    """为入口脚本的 argparse 添加指标导出选项"""
+    group = parser.add_argument_group('指标导出')
+    group.add_argument('--metrics-file', metavar='FILE.prom', default=None,
+                       help='把 Prometheus 格式的批次指标写到该文件（每个case完成后更新），'
+                            '放在 node_exporter textfile collector 的目录中即可采集')
+    return group
+
+
+def metrics_from_args(args, script, total=None):
+    """根据命令行参数构造 BatchMetrics（未指定 --metrics-file 时只计数不写文件）"""
+    return BatchMetrics(script, path=args.metrics_file, total=total)
@@ -0,0 +1,234 @@
+"""
+NIfTI输出读取（按层读取，不必解压整个文件）
+
+转换脚本可以输出三种格式（--nifti-format，见 compress.py）：
+- gz:  标准 .nii.gz，只能整体解压（兼容所有工具）
+- nii: 未压缩 .nii，用 numpy.memmap 直接映射，取任意一层都是零拷贝
+- zst: .nii.zst，zstd 可寻址格式（seekable format）：每个帧只包含整数层，
+       文件末尾的跳过帧里记录每帧的压缩/解压大小，读一层只需解压它所在的帧
+
+open_nifti() 根据扩展名返回统一的 NiftiVolume，训练数据加载等下游可以按汇总表中的
+NIfTIFormat 列选择 nii / zst 走快速路径。只支持 NIfTI-1 单文件格式（dcm2niix 默认输出）。
+"""
+import os
+import struct
+from pathlib import Path
+
+# NIfTI-1 datatype -> numpy dtype 字符
+NIFTI_DTYPES = {
+    2: 'u1', 4: 'i2', 8: 'i4', 16: 'f4', 64: 'f8',
+    256: 'i1', 512: 'u2', 768: 'u4', 1024: 'i8', 1280: 'u8',
+}
+NIFTI1_HEADER_SIZE = 348
+
+# 输出格式 -> 扩展名
+FORMAT_SUFFIXES = {'gz': '.nii.gz', 'nii': '.nii', 'zst': '.nii.zst'}
+
+# zstd 可寻址格式（zstd contrib/seekable_format）的常量
+ZSTD_SKIPPABLE_MAGIC = 0x184D2A5E
+ZSTD_SEEKABLE_MAGIC = 0x8F92EAB1
+SEEK_TABLE_FOOTER = struct.Struct('<IBI')   # 帧数, 描述符, 魔数
+SEEK_TABLE_ENTRY = struct.Struct('<II')     # 压缩大小, 解压大小（不带校验和）
+
+
+def nifti_format(path):
+    """根据扩展名返回输出格式（'gz' / 'zst' / 'nii'），不是NIfTI文件返回None"""
+    name = Path(path).name
+    for fmt, suffix in FORMAT_SUFFIXES.items():
+        if name.endswith(suffix):
+            return fmt
+    return None
+
+
+def parse_header(data):
+    """
+    解析 NIfTI-1 头
+
+    Returns:
+        dict: {'shape': (x, y, z, ...), 'dtype': numpy dtype, 'vox_offset': int, 'slice_bytes': int}
+    """
+    import numpy as np
+
+    if len(data) < NIFTI1_HEADER_SIZE:
+        raise ValueError("Truncated NIfTI header")
+    for order in ('<', '>'):
+        if struct.unpack_from(order + 'i', data, 0)[0] == NIFTI1_HEADER_SIZE:
+            break
+    else:
+        raise ValueError("Not a NIfTI-1 file (sizeof_hdr != 348)")
+    dim = struct.unpack_from(order + '8h', data, 40)
+    datatype = struct.unpack_from(order + 'h', data, 70)[0]
+    vox_offset = int(struct.unpack_from(order + 'f', data, 108)[0])
+    if datatype not in NIFTI_DTYPES:
+        raise ValueError(f"Unsupported NIfTI datatype: {datatype}")
+    ndim = max(1, min(dim[0], 7))
+    shape = tuple(max(1, d) for d in dim[1:1 + ndim])
+    dtype = np.dtype(order + NIFTI_DTYPES[datatype])
+    slice_bytes = shape[0] * (shape[1] if ndim > 1 else 1) * dtype.itemsize
+    return {'shape': shape, 'dtype': dtype, 'vox_offset': vox_offset, 'slice_bytes': slice_bytes}
+
+
+def read_seek_table(f):
+    """读取 .nii.zst 末尾的可寻址索引，返回 [(压缩偏移, 压缩大小, 解压偏移, 解压大小)]"""
+    f.seek(0, os.SEEK_END)
+    end = f.tell()
+    if end < SEEK_TABLE_FOOTER.size:
+        raise ValueError("File too small for a zstd seek table")
+    f.seek(end - SEEK_TABLE_FOOTER.size)
+    frames, descriptor, magic = SEEK_TABLE_FOOTER.unpack(f.read(SEEK_TABLE_FOOTER.size))
+    if magic != ZSTD_SEEKABLE_MAGIC:
+        raise ValueError("Missing zstd seek table (not a seekable .nii.zst)")
+    entry_size = SEEK_TABLE_ENTRY.size + (4 if descriptor & 0x80 else 0)
+    table_size = frames * entry_size + SEEK_TABLE_FOOTER.size
+    f.seek(end - table_size)
+    table = f.read(frames * entry_size)
+    entries = []
+    compressed_offset = decompressed_offset = 0
+    for i in range(frames):
+        csize, dsize = SEEK_TABLE_ENTRY.unpack_from(table, i * entry_size)
+        entries.append((compressed_offset, csize, decompressed_offset, dsize))
+        compressed_offset += csize
+        decompressed_offset += dsize
+    return entries
+
+
+class NiftiVolume:
+    """
+    按层读取 NIfTI 输出
+
+    用法:
+        with open_nifti(path) as vol:
+            vol.shape, vol.dtype, vol.format
+            axial = vol.slice(10)        # 第10层（第三维），形状 (x, y)
+            data = vol.volume()          # 整个体数据，形状同 vol.shape
+
+    返回文件中存储的原始数值（未应用 scl_slope / scl_inter）。
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.format = nifti_format(self.path)
+        if self.format is None:
+            raise ValueError(f"Not a NIfTI file: {self.path}")
+        self._memmap = None
+        self._data = None
+        self._file = None
+        self._frames = None
+        self._frame_cache = (None, None)
+        if self.format == 'nii':
+            with open(self.path, 'rb') as f:
+                self.header = parse_header(f.read(NIFTI1_HEADER_SIZE))
+        elif self.format == 'zst':
+            import zstandard
+
+            self._file = open(self.path, 'rb')
+            self._frames = read_seek_table(self._file)
+            self._decompressor = zstandard.ZstdDecompressor()
+            self.header = parse_header(self._read_range(0, NIFTI1_HEADER_SIZE))
+        else:
+            import gzip
+
+            with gzip.open(self.path, 'rb') as f:
+                self._data = f.read()
+            self.header = parse_header(self._data)
+        self.shape = self.header['shape']
+        self.dtype = self.header['dtype']
+
+    @property
+    def slice_count(self):
+        """层数（第三维之后的维度展开后的总层数）"""
+        count = 1
+        for d in self.shape[2:]:
+            count *= d
+        return count
+
+    def _frame(self, index):
+        """解压一个 zstd 帧（缓存最近一个，连续读相邻层时不重复解压）"""
+        if self._frame_cache[0] == index:
+            return self._frame_cache[1]
+        coffset, csize, _, dsize = self._frames[index]
+        self._file.seek(coffset)
+        data = self._decompressor.decompress(self._file.read(csize), max_output_size=dsize)
+        self._frame_cache = (index, data)
+        return data
+
+    def _read_range(self, start, length):
+        """从 .nii.zst 中读取解压后的 [start, start+length) 字节，只解压覆盖该范围的帧"""
+        import bisect
+
+        starts = [entry[2] for entry in self._frames]
+        index = max(bisect.bisect_right(starts, start) - 1, 0)
+        chunks = []
+        remaining = length
+        position = start
+        while remaining > 0 and index < len(self._frames):
+            frame_start = self._frames[index][2]
+            data = self._frame(index)
+            piece = data[position - frame_start:position - frame_start + remaining]
+            chunks.append(piece)
+            remaining -= len(piece)
+            position += len(piece)
+            index += 1
+        if remaining > 0:
+            raise ValueError(f"Read past end of {self.path.name}")
+        return b''.join(chunks)
+
+    def _mapped(self):
+        import numpy as np
+
+        if self._memmap is None:
+            self._memmap = np.memmap(self.path, dtype=self.dtype, mode='r', offset=self.header['vox_offset'],
+                                     shape=self.shape, order='F')
+        return self._memmap
+
+    def slice(self, index):
+        """读取第 index 层（按第三维及之后维度展开计数），返回形状 (x, y) 的数组"""
+        import numpy as np
+
+        if not 0 <= index < self.slice_count:
+            raise IndexError(f"Slice {index} out of range (0-{self.slice_count - 1})")
+        if self.format == 'nii':
+            flat = self._mapped().reshape(self.shape[0], self.shape[1] if len(self.shape) > 1 else 1, -1,
+                                          order='F')
+            return flat[:, :, index]
+        size = self.header['slice_bytes']
+        start = self.header['vox_offset'] + index * size
+        if self.format == 'zst':
+            raw = self._read_range(start, size)
+        else:
+            raw = self._data[start:start + size]
+        nx = self.shape[0]
+        return np.frombuffer(raw, dtype=self.dtype).reshape((nx, -1), order='F')
+
+    def volume(self):
+        """读取整个体数据（nii 格式返回只读 memmap，不占用内存）"""
+        import numpy as np
+
+        if self.format == 'nii':
+            return self._mapped()
+        nbytes = self.slice_count * self.header['slice_bytes']
+        start = self.header['vox_offset']
+        if self.format == 'zst':
+            raw = self._read_range(start, nbytes)
+        else:
+            raw = self._data[start:start + nbytes]
+        return np.frombuffer(raw, dtype=self.dtype).reshape(self.shape, order='F')
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+        self._memmap = None
+        self._data = None
+        self._frame_cache = (None, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_nifti(path):
+    """打开 .nii / .nii.zst / .nii.gz 输出，返回 NiftiVolume"""
+    return NiftiVolume(path)
@@ -0,0 +1,170 @@
+"""
+内存映射的像素读取
+
+需要像素数据的场景（拼体数据、质控统计）如果对每个文件 dcmread 后取 pixel_array，
+每层会先读入一份 PixelData 字节、再解码出一份数组，峰值内存约为体数据的两倍以上。
+
+对未压缩的传输语法（隐式/显式VR小端、显式VR大端），这里只解析文件头找到 Pixel Data 的偏移，
+然后用 numpy.memmap 直接映射文件得到零拷贝视图，逐层写入预先分配好的体数据数组
+（或磁盘上的 .npy memmap），峰值常驻内存约等于一个体数据（写到磁盘时更少）。
+压缩的传输语法（JPEG等）无法映射，回退为 pydicom 解码后写入同一个输出数组。
+"""
+import os
+
+PIXEL_DATA_TAG = 0x7FE00010
+
+# 可以直接映射的传输语法 -> 字节序
+UNCOMPRESSED_SYNTAXES = {
+    '1.2.840.10008.1.2': '<',      # Implicit VR Little Endian
+    '1.2.840.10008.1.2.1': '<',    # Explicit VR Little Endian
+    '1.2.840.10008.1.2.2': '>',    # Explicit VR Big Endian（已废弃，但仍可能遇到）
+}
+
+
+def _read_header(path):
+    """只解析到 Pixel Data 之前的元素（Pixel Data 的值延迟读取，只记录偏移）"""
+    import pydicom
+
+    return pydicom.dcmread(path, defer_size=256, force=True)
+
+
+def _pixel_element(ds):
+    try:
+        return ds.get_item(PIXEL_DATA_TAG, keep_deferred=True)
+    except TypeError:
+        # pydicom 2.x 的 get_item 没有 keep_deferred 参数，本身就返回未转换的原始元素
+        return ds.get_item(PIXEL_DATA_TAG)
+
+
+def _byte_order(ds):
+    """未压缩时返回 '<' 或 '>'，压缩或无法判断时返回None"""
+    file_meta = getattr(ds, 'file_meta', None)
+    syntax = str(getattr(file_meta, 'TransferSyntaxUID', '') or '') if file_meta is not None else ''
+    if syntax:
+        return UNCOMPRESSED_SYNTAXES.get(syntax)
+    # 没有文件元信息的裸数据集：按读取时识别出的编码
+    encoding = getattr(ds, 'original_encoding', None)
+    little_endian = encoding[1] if encoding else getattr(ds, 'is_little_endian', True)
+    return '<' if little_endian else '>'
+
+
+def frame_layout(ds):
+    """
+    根据图像像素模块计算 (dtype, 每个文件的数组形状)；不支持直接映射的格式返回 (None, None)
+
+    支持 BitsAllocated 8/16/32、单通道或交错存储（PlanarConfiguration=0）的多通道、多帧。
+    """
+    import numpy as np
+
+    bits = int(getattr(ds, 'BitsAllocated', 0) or 0)
+    if bits not in (8, 16, 32):
+        return None, None
+    samples = int(getattr(ds, 'SamplesPerPixel', 1) or 1)
+    if samples > 1 and int(getattr(ds, 'PlanarConfiguration', 0) or 0) != 0:
+        return None, None
+    order = _byte_order(ds)
+    if order is None:
+        return None, None
+    kind = 'i' if int(getattr(ds, 'PixelRepresentation', 0) or 0) == 1 else 'u'
+    dtype = np.dtype(f"{order}{kind}{bits // 8}")
+    frames = int(getattr(ds, 'NumberOfFrames', 1) or 1)
+    shape = (frames, int(ds.Rows), int(ds.Columns))
+    if samples > 1:
+        shape += (samples,)
+    return dtype, shape
+
+
+def pixel_view(path):
+    """
+    返回文件像素数据的只读零拷贝视图（numpy.memmap，形状为 (帧数, 行, 列[, 通道])）
+
+    压缩传输语法或不支持的像素格式返回None，由调用方回退为 pydicom 解码。
+    """
+    import numpy as np
+
+    ds = _read_header(path)
+    element = _pixel_element(ds)
+    if element is None:
+        return None
+    dtype, shape = frame_layout(ds)
+    offset = getattr(element, 'value_tell', None)
+    if dtype is None or offset is None:
+        return None
+    expected = int(np.prod(shape)) * dtype.itemsize
+    # 封装（压缩）像素数据长度为未定义长度，或长度对不上时不映射
+    if element.length in (None, 0xFFFFFFFF) or element.length < expected:
+        return None
+    if offset + expected > os.path.getsize(path):
+        return None
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape)
+
+
+def load_volume(paths, out=None, out_path=None):
+    """
+    把一组文件（通常是选中堆栈按层位置排好序的文件）的像素写入一个体数据数组
+
+    Args:
+        paths: 文件路径列表（或 scan_dicom_series 的文件记录，例如选中序列的 selection['files']），顺序即层顺序
+        out: 预先分配好的数组（形状需与结果一致），不提供时自动分配
+        out_path: 提供时在磁盘上创建 .npy memmap 作为输出（适合超过内存的大序列）
+
+    Returns:
+        tuple: (体数据数组, 统计信息 {'slices', 'mapped', 'decoded'})；
+               数组形状为 (总帧数, 行, 列[, 通道])，保持文件中存储的原始数值（未做 Rescale）
+    """
+    import numpy as np
+
+    paths = [getattr(p, 'file_path', p) for p in paths]
+    if not paths:
+        raise ValueError("load_volume() needs at least one file")
+    first = pixel_view(paths[0])
+    if first is not None:
+        frame_shape, dtype = first.shape[1:], first.dtype.newbyteorder('=')
+        frames_per_file = first.shape[0]
+        del first
+    else:
+        # 第一个文件无法映射（压缩），解码一次确定形状
+        sample = _decode(paths[0])
+        frame_shape, dtype, frames_per_file = sample.shape[1:], sample.dtype, sample.shape[0]
+        del sample
+    shape = (frames_per_file * len(paths),) + tuple(frame_shape)
+    if out is None:
+        if out_path is not None:
+            out = np.lib.format.open_memmap(str(out_path), mode='w+', dtype=dtype, shape=shape)
+        else:
+            out = np.empty(shape, dtype=dtype)
+    elif out.shape != shape:
+        raise ValueError(f"Output shape {out.shape} does not match volume shape {shape}")
+
+    stats = {'slices': len(paths), 'mapped': 0, 'decoded': 0}
+    position = 0
+    for path in paths:
+        view = pixel_view(path)
+        if view is not None and view.shape[1:] == tuple(frame_shape):
+            block = view
+            stats['mapped'] += 1
+        else:
+            block = _decode(path)
+            stats['decoded'] += 1
+        if block.shape[1:] != tuple(frame_shape):
+            raise ValueError(f"Slice shape {block.shape[1:]} differs from {tuple(frame_shape)}: {path}")
+        out[position:position + block.shape[0]] = block
+        position += block.shape[0]
+        del view, block
+    if position != shape[0]:
+        raise ValueError(f"Expected {shape[0]} frames, got {position}")
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out, stats
+
+
+def _decode(path):
+    """回退路径：用 pydicom 解码（压缩传输语法），统一为 (帧数, 行, 列[, 通道])"""
+    import pydicom
+
+    ds = pydicom.dcmread(path, force=True)
+    array = ds.pixel_array
+    frames = int(getattr(ds, 'NumberOfFrames', 1) or 1)
+    if frames == 1:
+        array = array[None, ...]
+    return array
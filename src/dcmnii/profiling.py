@@ -0,0 +1,165 @@
+"""
+按case的性能剖析（cProfile / tracemalloc）
+
+各入口脚本的 --profile cpu|mem 选项使用这里的 CaseProfiler：
+- cpu: 每个case单独用 cProfile 采样，写出 <case>.prof（可用 pstats / snakeviz 查看）
+       和按累计耗时排序的前若干个函数摘要 <case>_cpu.txt
+- mem: 每个case前后各取一次 tracemalloc 快照，写出按代码行统计的分配增量
+       和case期间的峰值内存 <case>_mem.txt
+批次结束后写出 profile_index.json，列出每个case的耗时/峰值和对应文件，方便找出异常case。
+未指定 --profile 时 case() 直接执行，不产生额外开销。
+"""
+import io
+import re
+import json
+import time
+import pstats
+import cProfile
+import tracemalloc
+from pathlib import Path
+from contextlib import contextmanager
+
+PROFILE_MODES = ('cpu', 'mem')
+
+
+def add_profile_argument(parser):
+    """为入口脚本的 argparse 添加 --profile 选项"""
+    parser.add_argument('--profile', choices=PROFILE_MODES, default=None,
+                        help='按case剖析: cpu 写出 cProfile 的 .prof 文件, mem 写出 tracemalloc 分配报告')
+
+
+def profile_dir(report_dir, timestamp):
+    """剖析文件目录，与转换报告放在同一个output目录下"""
+    return Path(report_dir) / f"profiles_{timestamp}"
+
+
+def safe_name(case_name):
+    """把case名称转换为可用作文件名的形式"""
+    return re.sub(r'[\\/:*?"<>|\s]+', '_', str(case_name)).strip('_') or 'case'
+
+
+class CaseProfiler:
+    """
+    对每个case单独做 CPU 或内存剖析
+
+    用法:
+        profiler = CaseProfiler(args.profile, profile_dir(output_dir, timestamp))
+        with profiler.case(case_name) as prof:
+            result = process_case(...)
+        if prof:
+            result['profile'] = prof
+        profiler.close()
+    """
+
+    def __init__(self, mode, output_dir, top=30, frames=1):
+        if mode is not None and mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profile mode: {mode}")
+        self.mode = mode
+        self.output_dir = Path(output_dir)
+        self.top = top
+        self.frames = frames
+        self.records = []
+        self._seen = {}
+        self._started_tracemalloc = False
+
+    @property
+    def enabled(self):
+        return self.mode is not None
+
+    @contextmanager
+    def case(self, case_name):
+        """剖析一个case，yield 的字典在退出时填入耗时、峰值内存和输出文件"""
+        record = {}
+        if not self.enabled:
+            yield record
+            return
+
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        stem = safe_name(case_name)
+        # 同名case（例如ZIP和文件夹同名）加序号区分
+        self._seen[stem] = self._seen.get(stem, 0) + 1
+        if self._seen[stem] > 1:
+            stem = f"{stem}_{self._seen[stem]}"
+        record.update({'case': str(case_name), 'stem': stem, 'mode': self.mode})
+
+        start = time.perf_counter()
+        if self.mode == 'cpu':
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                yield record
+            finally:
+                profiler.disable()
+                record['seconds'] = round(time.perf_counter() - start, 4)
+                self._write_cpu(profiler, record)
+                self.records.append(record)
+        else:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self.frames)
+                self._started_tracemalloc = True
+            tracemalloc.reset_peak()
+            baseline, _ = tracemalloc.get_traced_memory()
+            before = tracemalloc.take_snapshot()
+            try:
+                yield record
+            finally:
+                after = tracemalloc.take_snapshot()
+                current, peak = tracemalloc.get_traced_memory()
+                record['seconds'] = round(time.perf_counter() - start, 4)
+                record['peak_bytes'] = peak - baseline
+                record['retained_bytes'] = current - baseline
+                self._write_mem(before, after, record)
+                self.records.append(record)
+
+    def _write_cpu(self, profiler, record):
+        prof_path = self.output_dir / f"{record['stem']}.prof"
+        profiler.dump_stats(str(prof_path))
+        text = io.StringIO()
+        pstats.Stats(profiler, stream=text).sort_stats('cumulative').print_stats(self.top)
+        txt_path = self.output_dir / f"{record['stem']}_cpu.txt"
+        txt_path.write_text(f"# case: {record['case']}\n# wall: {record['seconds']:.3f}s\n"
+                            + text.getvalue(), encoding='utf-8')
+        record['files'] = [prof_path.name, txt_path.name]
+
+    def _write_mem(self, before, after, record):
+        # 排除 tracemalloc 自身和本模块的分配
+        ignore = (tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__))
+        diffs = after.filter_traces(ignore).compare_to(before.filter_traces(ignore), 'lineno')
+        mb = 1024 * 1024
+        lines = [
+            f"# case: {record['case']}",
+            f"# wall: {record['seconds']:.3f}s",
+            f"# peak during case: {record['peak_bytes'] / mb:.1f} MB",
+            f"# retained after case: {record['retained_bytes'] / mb:.1f} MB",
+            '',
+            f"Top {self.top} allocation sites (size delta, count delta):",
+        ]
+        for stat in diffs[:self.top]:
+            lines.append(str(stat))
+        txt_path = self.output_dir / f"{record['stem']}_mem.txt"
+        txt_path.write_text('\n'.join(lines) + '\n', encoding='utf-8')
+        record['files'] = [txt_path.name]
+
+    def close(self):
+        """停止剖析并写出索引文件，返回索引路径（未启用时返回None）"""
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+        if not self.enabled or not self.records:
+            return None
+        index_path = self.output_dir / 'profile_index.json'
+        with open(index_path, 'w', encoding='utf-8') as f:
+            json.dump(self.records, f, ensure_ascii=False, indent=2)
+
+        key = 'peak_bytes' if self.mode == 'mem' else 'seconds'
+        worst = sorted(self.records, key=lambda r: r.get(key, 0), reverse=True)[:5]
+        print(f"\n{'='*60}")
+        print(f"PROFILE ({self.mode})")
+        print(f"{'='*60}")
+        for r in worst:
+            if self.mode == 'mem':
+                print(f"  {r['case']}: peak {r['peak_bytes'] / (1024 * 1024):.1f} MB, {r['seconds']:.2f}s")
+            else:
+                print(f"  {r['case']}: {r['seconds']:.2f}s")
+        print(f"✓ 剖析文件已保存: {self.output_dir}")
+        return index_path
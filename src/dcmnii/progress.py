@@ -0,0 +1,261 @@
+"""
+进度 / 吞吐 / 预计剩余时间
+
+各入口脚本原来只打印 "[i/N] ..." 或每100个文件一个 \r 计数，看不出速度是否在下降。
+Progress 记录已完成的case数、文件数和字节数，按滑动窗口（默认最近60秒，至少包含上一次更新）计算
+文件/秒、MB/秒、case/分钟，并估算剩余时间：
+- 知道总字节数（例如调度阶段按ZIP解压后大小估算的总量）时按 剩余字节 / MB每秒 估算；
+- 否则按 剩余case数 / case每秒 估算。
+
+输出方式（--progress）：
+- text: 每个case完成后在终端打印一行进度（默认）
+- json: 每个事件在 stdout 输出一行JSON（以 {"event": ...} 开头），供调度系统解析、展示和按吞吐告警
+- off:  不输出
+--progress-jsonl 另外把所有事件追加到一个 .jsonl 文件（与 --progress 无关）。
+"""
+import sys
+import json
+import time
+from collections import deque
+from datetime import datetime
+
+PROGRESS_MODES = ('text', 'json', 'off')
+# 滑动窗口长度（秒）
+DEFAULT_WINDOW = 60.0
+# tick() 两次输出之间的最短间隔（秒）
+TICK_INTERVAL = 2.0
+MB = 1024 * 1024
+
+
+def format_bytes(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return f"{seconds}s"
+    minutes, seconds = divmod(seconds, 60)
+    if minutes < 60:
+        return f"{minutes}m{seconds:02d}s"
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m"
+
+
+def case_io(result):
+    """从结果记录的分阶段计时中取该case处理的 (文件数, 字节数)：各阶段中的最大值"""
+    timings = result.get('stage_timings') or {}
+    files = max((stage.get('files', 0) for stage in timings.values()), default=0)
+    nbytes = max((stage.get('bytes_read', 0) for stage in timings.values()), default=0)
+    return files, nbytes
+
+
+class Progress:
+    """
+    进度跟踪
+
+    用法:
+        progress = Progress(total=len(cases), total_bytes=估算总字节数, mode='text')
+        for case in cases:
+            result = process(case)
+            progress.case_done(case.name, result['success'], files=..., nbytes=...)
+        progress.close()
+
+    扫描等长时间的单步操作可以调用 tick(files=1, nbytes=...)，只累计计数，按 TICK_INTERVAL 节流输出。
+    total 为None（例如监视模式）时不计算剩余量和ETA。
+    """
+
+    def __init__(self, total=None, total_bytes=None, label='case', mode='text', jsonl_path=None,
+                 window=DEFAULT_WINDOW, stream=None):
+        if mode not in PROGRESS_MODES:
+            raise ValueError(f"Unknown progress mode: {mode} (available: {', '.join(PROGRESS_MODES)})")
+        self.total = total
+        self.total_bytes = total_bytes
+        self.label = label
+        self.mode = mode
+        self.window = window
+        self.stream = stream or sys.stdout
+        self.done = 0
+        self.failed = 0
+        self.files = 0
+        self.bytes = 0
+        self.done_bytes = 0
+        self._start = time.monotonic()
+        self._last_tick = self._start
+        # (时间, 完成case数, 文件数, 字节数)
+        self._samples = deque([(self._start, 0, 0, 0)])
+        self._jsonl = open(jsonl_path, 'a', encoding='utf-8') if jsonl_path else None
+        self._emit('start')
+
+    # ---- 计数 ----
+
+    def case_done(self, name=None, success=True, files=0, nbytes=0):
+        """一个case处理完成（nbytes 计入已完成数据量，用于按字节估算ETA）"""
+        self.done += 1
+        if not success:
+            self.failed += 1
+        self.files += files
+        self.bytes += nbytes
+        self.done_bytes += nbytes
+        self._sample()
+        self._emit('case_done', name=name, success=success)
+
+    def skip(self, name=None, nbytes=0):
+        """跳过一个case（例如已转换过）：从总数和总字节数中扣除，不影响速率"""
+        if self.total is not None:
+            self.total = max(self.total - 1, 0)
+        if self.total_bytes:
+            self.total_bytes = max(self.total_bytes - nbytes, 0)
+        self._emit('case_skipped', name=name)
+
+    def tick(self, files=0, nbytes=0):
+        """case内部的进度（例如逐个扫描文件），节流输出"""
+        self.files += files
+        self.bytes += nbytes
+        now = time.monotonic()
+        if now - self._last_tick >= TICK_INTERVAL:
+            self._last_tick = now
+            self._sample(now)
+            self._emit('tick')
+
+    def close(self):
+        """输出结束事件并关闭 .jsonl 文件"""
+        if self._jsonl is None and self.mode == 'off':
+            return
+        self._emit('finish')
+        if self._jsonl:
+            self._jsonl.close()
+            self._jsonl = None
+        self.mode = 'off'
+
+    # ---- 速率 ----
+
+    def _sample(self, now=None):
+        now = now or time.monotonic()
+        self._samples.append((now, self.done, self.files, self.bytes))
+        # 只保留窗口内的样本，但至少保留两个（case很慢时窗口内可能只有最新一次更新）
+        while len(self._samples) > 2 and now - self._samples[1][0] >= self.window:
+            self._samples.popleft()
+
+    def rates(self):
+        """滑动窗口内的 (case/秒, 文件/秒, 字节/秒)"""
+        t0, cases0, files0, bytes0 = self._samples[0]
+        t1, cases1, files1, bytes1 = self._samples[-1]
+        span = t1 - t0
+        if span <= 0:
+            return 0.0, 0.0, 0.0
+        return (cases1 - cases0) / span, (files1 - files0) / span, (bytes1 - bytes0) / span
+
+    @property
+    def remaining(self):
+        return None if self.total is None else max(self.total - self.done, 0)
+
+    def eta_seconds(self):
+        """预计剩余秒数，无法估计时为None"""
+        if self.total is None:
+            return None
+        if not self.remaining:
+            return 0.0
+        case_rate, _, byte_rate = self.rates()
+        if self.total_bytes and byte_rate > 0:
+            return max(self.total_bytes - self.done_bytes, 0) / byte_rate
+        if case_rate > 0:
+            return self.remaining / case_rate
+        return None
+
+    def snapshot(self, event='progress', **extra):
+        """当前进度的字典（json 模式和 .jsonl 输出的内容）"""
+        elapsed = time.monotonic() - self._start
+        case_rate, file_rate, byte_rate = self.rates()
+        eta = self.eta_seconds()
+        data = {
+            'event': event,
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'label': self.label,
+            'done': self.done,
+            'failed': self.failed,
+            'total': self.total,
+            'remaining': self.remaining,
+            'files': self.files,
+            'bytes': self.bytes,
+            'elapsed_seconds': round(elapsed, 2),
+            'files_per_second': round(file_rate, 2),
+            'mb_per_second': round(byte_rate / MB, 3),
+            'cases_per_minute': round(case_rate * 60, 2),
+            'avg_mb_per_second': round(self.bytes / MB / elapsed, 3) if elapsed > 0 else 0.0,
+            'eta_seconds': round(eta, 1) if eta is not None else None,
+        }
+        if self.total_bytes:
+            data['remaining_bytes'] = max(self.total_bytes - self.done_bytes, 0)
+        data.update(extra)
+        return data
+
+    # ---- 输出 ----
+
+    def render(self, data):
+        """把快照格式化为一行终端文本"""
+        if data['total']:
+            head = f"进度 {data['done']}/{data['total']} ({data['done'] * 100 // data['total']}%)"
+        else:
+            head = f"已完成 {data['done']} 个{self.label}"
+        parts = [head, f"{data['files_per_second']:.1f} 文件/s", f"{data['mb_per_second']:.1f} MB/s"]
+        if data['failed']:
+            parts.append(f"失败 {data['failed']}")
+        if data['remaining']:
+            remaining = f"剩余 {data['remaining']}"
+            if 'remaining_bytes' in data:
+                remaining += f" ({format_bytes(data['remaining_bytes'])})"
+            parts.append(remaining)
+            if data['eta_seconds'] is not None:
+                parts.append(f"ETA {format_duration(data['eta_seconds'])}")
+        return '  ⏱ ' + ' | '.join(parts)
+
+    def _emit(self, event, **extra):
+        if self.mode == 'off' and self._jsonl is None:
+            return
+        data = self.snapshot(event, **extra)
+        if self._jsonl:
+            self._jsonl.write(json.dumps(data, ensure_ascii=False) + '\n')
+            self._jsonl.flush()
+        if self.mode == 'json':
+            self.stream.write(json.dumps(data, ensure_ascii=False) + '\n')
+            self.stream.flush()
+        elif self.mode == 'text' and event in ('case_done', 'tick', 'finish'):
+            if event == 'tick':
+                line = f"  扫描中: {data['files']} 个文件, {data['files_per_second']:.1f} 文件/s"
+                end = '\r' if self.stream.isatty() else '\n'
+                self.stream.write(line + end)
+            elif event == 'finish':
+                # 只用 tick() 计数（例如扫描阶段）时没有完成的case，不显示case数
+                head = f"共 {data['done']} 个{self.label}, " if data['done'] else ''
+                self.stream.write(f"  ⏱ {head}{data['files']} 个文件, "
+                                  f"{format_bytes(data['bytes'])}, 用时 {format_duration(data['elapsed_seconds'])}"
+                                  f"（平均 {data['avg_mb_per_second']:.1f} MB/s）\n")
+            else:
+                self.stream.write(self.render(data) + '\n')
+            self.stream.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def add_progress_arguments(parser):
+    """为入口脚本的 argparse 添加进度输出选项"""
+    group = parser.add_argument_group('进度')
+    group.add_argument('--progress', choices=PROGRESS_MODES, default='text',
+                       help='进度输出: text=终端文本（默认）, json=每个事件在stdout输出一行JSON, off=不输出')
+    group.add_argument('--progress-jsonl', metavar='FILE', default=None,
+                       help='另外把进度事件追加写入该 .jsonl 文件')
+    return group
+
+
+def progress_from_args(args, total=None, total_bytes=None, label='case'):
+    """根据命令行参数构造 Progress"""
+    return Progress(total=total, total_bytes=total_bytes, label=label, mode=args.progress,
+                    jsonl_path=args.progress_jsonl)
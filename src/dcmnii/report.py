@@ -0,0 +1,209 @@
+"""
+流式转换报告（JSON Lines）
+
+原来各脚本把每个case的结果（包括完整的 dcm2niix 输出）都留在 all_results 里，
+批次结束才 json.dump 一次：内存随批次线性增长，中途崩溃则整份报告丢失。
+
+ReportWriter 在每个case完成时追加一行JSON到 <报告>.jsonl 并 flush，按时间/条数间隔 fsync；
+dcm2niix 的输出和过长的错误信息写到单独的 case 日志文件，报告里只记录路径。
+close() 时把 .jsonl 逐行压实成与原来格式相同的 <报告>.json（流式写出，不整体载入内存），然后删除 .jsonl。
+进程中途退出时 .jsonl 仍保留已完成的case，可以用 read_jsonl() 读取（忽略最后一行不完整的记录）。
+"""
+import os
+import json
+import time
+from pathlib import Path
+from dcmnii.profiling import safe_name
+
+# 直接写入日志文件、报告里只保留路径的字段
+LOG_FIELDS = ('dcm2niix_output',)
+# 超过该长度的错误信息写入日志文件，报告里只保留开头
+MAX_INLINE_ERROR = 500
+
+
+# 失败case的错误类别: 代码 -> failed_cases_*.txt 中的标题（代码用作 metrics 的 category 标签）
+ERROR_CATEGORIES = {
+    'dicom': 'DICOM文件问题',
+    'slice_thickness': '切片厚度不符合要求',
+    'dcm2niix': 'dcm2niix转换失败',
+    'extract': '压缩包解压失败',
+    'io': '文件访问错误（锁定/网络共享，已重试）',
+    'other': '其他错误',
+}
+
+
+def classify_error(error_msg):
+    """按错误信息归类（没有 error_code 的旧记录），返回 ERROR_CATEGORIES 中的代码"""
+    error_msg = error_msg or 'Unknown error'
+    lower = error_msg.lower()
+    if 'No valid DICOM' in error_msg or 'No suitable series' in error_msg:
+        return 'dicom'
+    if 'slice thickness' in lower or '4.5-5.5' in error_msg:
+        return 'slice_thickness'
+    if 'dcm2niix' in lower:
+        return 'dcm2niix'
+    if 'extract' in lower or 'zip' in lower:
+        return 'extract'
+    return 'other'
+
+
+def error_category(record):
+    """失败记录的错误类别：优先用转换时记录的 error_code（dcmnii.errors），否则按错误信息归类"""
+    code = record.get('error_code')
+    return code if code in ERROR_CATEGORIES else classify_error(record.get('error'))
+
+
+def read_failed_cases(path):
+    """
+    读取 failed_cases_*.txt 中列出的case名称（"## 详细错误信息" 之前各分类下的行）
+
+    也接受每行一个case名称的普通文本文件。
+    """
+    names = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('## 详细错误信息'):
+                break
+            if line and not line.startswith('#'):
+                names.append(line)
+    return names
+
+
+def case_name_of(record, default='case'):
+    """结果记录对应的case名称（各脚本的结果字典用不同的键）"""
+    for key in ('zip_file', 'dicom_folder', 'case_name', 'folder'):
+        if record.get(key):
+            return Path(str(record[key])).name
+    return default
+
+
+class ReportWriter:
+    """
+    逐case追加的 JSON Lines 报告
+
+    用法:
+        report = ReportWriter(output_dir / f"conversion_report_{ts}.jsonl", log_dir=output_dir / f"logs_{ts}")
+        for case in cases:
+            result = process(case)
+            result = report.write(result)      # 返回日志外置后的精简记录，可以留作汇总统计
+        report.close()                          # 生成 conversion_report_{ts}.json
+    """
+
+    def __init__(self, path, log_dir=None, fsync_interval=5.0, fsync_every=20, compact=True):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.log_dir = Path(log_dir) if log_dir else self.path.with_name(self.path.stem + '_logs')
+        self.fsync_interval = fsync_interval
+        self.fsync_every = fsync_every
+        self.compact = compact
+        self.count = 0
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self._log_names = set()
+        self._file = open(self.path, 'a', encoding='utf-8')
+
+    @property
+    def json_path(self):
+        """压实后的聚合报告路径（x.jsonl -> x.json）"""
+        return self.path.with_suffix('.json')
+
+    def _log_path(self, record):
+        name = safe_name(case_name_of(record, f"case_{self.count + 1}"))
+        candidate = name
+        index = 1
+        while candidate in self._log_names:
+            index += 1
+            candidate = f"{name}_{index}"
+        self._log_names.add(candidate)
+        self.log_dir.mkdir(parents=True, exist_ok=True)
+        return self.log_dir / f"{candidate}.log"
+
+    def externalize(self, record):
+        """把转换器输出和过长的错误信息写到case日志文件，返回只含路径引用的新记录"""
+        record = dict(record)
+        sections = []
+        for field in LOG_FIELDS:
+            value = record.pop(field, None)
+            if value:
+                sections.append((field, str(value)))
+        error = record.get('error')
+        if isinstance(error, str) and len(error) > MAX_INLINE_ERROR:
+            sections.append(('error', error))
+            record['error'] = error[:MAX_INLINE_ERROR].rstrip() + ' ...'
+        if sections:
+            log_path = self._log_path(record)
+            with open(log_path, 'w', encoding='utf-8') as f:
+                for field, text in sections:
+                    f.write(f"--- {field} ---\n{text}\n")
+            record['log_file'] = str(log_path)
+        return record
+
+    def write(self, record):
+        """追加一条case记录；返回外置日志后的记录"""
+        record = self.externalize(record)
+        self._file.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+        self._file.flush()
+        self.count += 1
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_every or time.monotonic() - self._last_sync >= self.fsync_interval:
+            self.sync()
+        return record
+
+    def sync(self):
+        if self._unsynced:
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        """fsync 并关闭；compact=True 时生成聚合JSON并删除 .jsonl，返回聚合JSON路径（否则返回 .jsonl 路径）"""
+        if self._file is None:
+            return self.json_path if self.compact else self.path
+        self.sync()
+        self._file.close()
+        self._file = None
+        if not self.compact:
+            return self.path
+        json_path = compact_jsonl(self.path, self.json_path)
+        self.path.unlink()
+        return json_path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_jsonl(path):
+    """逐条读取 .jsonl 报告（崩溃时可能留下的不完整末行会被跳过）"""
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+
+def compact_jsonl(jsonl_path, json_path=None):
+    """
+    把 .jsonl 报告压实为一个JSON数组文件（格式与 json.dump(records, indent=2) 相同）
+
+    逐条读写，内存占用与报告大小无关。
+    """
+    jsonl_path = Path(jsonl_path)
+    json_path = Path(json_path) if json_path else jsonl_path.with_suffix('.json')
+    tmp_path = json_path.with_name(json_path.name + '.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as out:
+        first = True
+        for record in read_jsonl(jsonl_path):
+            body = json.dumps(record, ensure_ascii=False, indent=2, default=str)
+            out.write(('[\n' if first else ',\n') + '\n'.join('  ' + line for line in body.split('\n')))
+            first = False
+        out.write('[]' if first else '\n]')
+    os.replace(tmp_path, json_path)
+    return json_path
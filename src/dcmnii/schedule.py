@@ -0,0 +1,87 @@
+"""
+批处理调度：按预估开销排列case
+
+case 从几十MB到数GB不等，按 glob 顺序处理时，排在最后的大case会让其他worker长时间空等。
+开始转换前先为每个case估算开销（字节数）：
+- ZIP: 中央目录里各成员解压后大小之和（只读ZIP末尾的目录，不解压；无法读取时取文件大小）
+- tar / tar.gz / tar.zst: 文件大小（见 dcmnii.archive.archive_cost）
+- DICOM文件夹: 遍历得到的文件大小之和
+case_metadata_*.csv 的 DicomFileCount 只统计每个case检查过的前50个文件，不能代表层数，这里不使用。
+
+排序策略（--order）：
+- lpt:   开销大的先处理（longest processing time first），多worker时整批完成得最早（默认）
+- sjf:   开销小的先处理（shortest job first），尽快拿到第一批结果
+- input: 保持发现顺序
+剩余数据量和预计耗时由 dcmnii.progress.Progress 按估算的总字节数计算，显示在进度输出中。
+"""
+from pathlib import Path
+from dcmnii.walk import walk_files
+from dcmnii.archive import archive_cost, archive_stem
+
+ORDER_POLICIES = ('lpt', 'sjf', 'input')
+DEFAULT_ORDER = 'lpt'
+ORDER_DESCRIPTIONS = {
+    'lpt': '大case优先（LPT）',
+    'sjf': '小case优先（SJF）',
+    'input': '发现顺序',
+}
+
+
+class CaseJob:
+    """一个待转换的case（压缩包或DICOM文件夹）及其预估开销"""
+
+    __slots__ = ('path', 'kind', 'cost_bytes', 'index')
+
+    def __init__(self, path, kind, cost_bytes, index=0):
+        self.path = Path(path)
+        self.kind = kind
+        self.cost_bytes = cost_bytes
+        self.index = index
+
+    @property
+    def name(self):
+        """case名称（压缩包去掉扩展名，文件夹取目录名）"""
+        return archive_stem(self.path) if self.kind == 'archive' else self.path.name
+
+    def __repr__(self):
+        return f"CaseJob({self.kind}, {self.path.name!r}, {self.cost_bytes})"
+
+
+def folder_cost(folder):
+    """文件夹下所有文件的总字节数"""
+    return sum(size for _, _, size in walk_files(folder, sniff=False))
+
+
+def estimate_jobs(zip_files=(), dicom_folders=()):
+    """为压缩包和DICOM文件夹估算开销，返回按发现顺序编号的 CaseJob 列表"""
+    jobs = [CaseJob(path, 'archive', archive_cost(path)) for path in zip_files]
+    jobs += [CaseJob(path, 'folder', folder_cost(path)) for path in dicom_folders]
+    for index, job in enumerate(jobs):
+        job.index = index
+    return jobs
+
+
+def order_jobs(jobs, policy=DEFAULT_ORDER):
+    """按策略排序（开销相同时保持发现顺序）"""
+    if policy not in ORDER_POLICIES:
+        raise ValueError(f"Unknown order policy: {policy} (available: {', '.join(ORDER_POLICIES)})")
+    if policy == 'lpt':
+        return sorted(jobs, key=lambda job: (-job.cost_bytes, job.index))
+    if policy == 'sjf':
+        return sorted(jobs, key=lambda job: (job.cost_bytes, job.index))
+    return sorted(jobs, key=lambda job: job.index)
+
+
+def case_seconds(result):
+    """结果记录中各阶段耗时之和（worker实际处理该case的时间）"""
+    timings = result.get('stage_timings') or {}
+    return sum(stage.get('seconds', 0) for stage in timings.values())
+
+
+def add_schedule_arguments(parser):
+    """为入口脚本的 argparse 添加调度选项，返回参数组（脚本可以继续添加 --workers 等）"""
+    group = parser.add_argument_group('调度')
+    group.add_argument('--order', choices=ORDER_POLICIES, default=DEFAULT_ORDER,
+                       help='处理顺序: lpt=按预估大小从大到小（默认，并行时整批最早完成）, '
+                            'sjf=从小到大（尽快得到第一批结果）, input=发现顺序')
+    return group
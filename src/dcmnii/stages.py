@@ -0,0 +1,138 @@
+"""
+分阶段计时与吞吐统计
+
+每个case的处理被拆分为固定的几个阶段（解压、扫描、选择、暂存、转换、后处理、汇总），
+每个阶段记录耗时、读写字节数和涉及的文件数，写入转换报告；
+批次结束时按阶段打印 p50/p95 汇总表，用于判断慢在磁盘、CPU还是转换器。
+"""
+import os
+import math
+import time
+from contextlib import contextmanager
+
+# 报告和汇总表中的阶段顺序
+STAGES = ('extract', 'scan', 'select', 'stage', 'convert', 'postprocess', 'summarize')
+
+
+class StageStats:
+    """单个阶段的累计统计"""
+
+    __slots__ = ('seconds', 'bytes_read', 'bytes_written', 'files')
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.files = 0
+
+    def add(self, bytes_read=0, bytes_written=0, files=0):
+        self.bytes_read += bytes_read
+        self.bytes_written += bytes_written
+        self.files += files
+
+    def as_dict(self):
+        return {
+            'seconds': round(self.seconds, 4),
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'files': self.files,
+        }
+
+
+class StageTimer:
+    """
+    记录一个case各阶段的耗时和I/O量
+
+    用法:
+        timer = StageTimer()
+        with timer.stage('extract') as st:
+            ...
+            st.add(bytes_read=..., bytes_written=..., files=...)
+        result['stage_timings'] = timer.as_dict()
+    """
+
+    def __init__(self):
+        self._stages = {}
+        # 最近进入的阶段（出错时记录在哪个阶段失败）
+        self.current = None
+
+    @contextmanager
+    def stage(self, name):
+        stats = self._stages.setdefault(name, StageStats())
+        self.current = name
+        start = time.perf_counter()
+        try:
+            yield stats
+        finally:
+            stats.seconds += time.perf_counter() - start
+
+    def as_dict(self):
+        ordered = [s for s in STAGES if s in self._stages]
+        ordered += [s for s in self._stages if s not in STAGES]
+        return {name: self._stages[name].as_dict() for name in ordered}
+
+
+def percentile(values, pct):
+    """最近秩法百分位数（values 非空）"""
+    ordered = sorted(values)
+    rank = max(math.ceil(pct / 100.0 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+def aggregate_stage_timings(timings_list):
+    """
+    汇总多个case的 stage_timings
+
+    Returns:
+        dict: {stage: {'cases', 'p50', 'p95', 'total_seconds', 'bytes_read', 'bytes_written', 'files'}}
+    """
+    per_stage = {}
+    for timings in timings_list:
+        for name, stats in (timings or {}).items():
+            per_stage.setdefault(name, []).append(stats)
+
+    summary = {}
+    ordered = [s for s in STAGES if s in per_stage] + [s for s in per_stage if s not in STAGES]
+    for name in ordered:
+        records = per_stage[name]
+        seconds = [r['seconds'] for r in records]
+        summary[name] = {
+            'cases': len(records),
+            'p50': percentile(seconds, 50),
+            'p95': percentile(seconds, 95),
+            'total_seconds': sum(seconds),
+            'bytes_read': sum(r['bytes_read'] for r in records),
+            'bytes_written': sum(r['bytes_written'] for r in records),
+            'files': sum(r['files'] for r in records),
+        }
+    return summary
+
+
+def print_stage_summary(timings_list):
+    """打印按阶段汇总的 p50/p95 耗时与吞吐表"""
+    summary = aggregate_stage_timings(timings_list)
+    if not summary:
+        return summary
+    mb = 1024 * 1024
+    print(f"\n{'='*60}")
+    print(f"STAGE TIMINGS")
+    print(f"{'='*60}")
+    print(f"{'stage':<12}{'cases':>6}{'p50(s)':>9}{'p95(s)':>9}{'total(s)':>10}"
+          f"{'read MB':>10}{'write MB':>10}{'files':>8}{'MB/s':>8}")
+    for name, s in summary.items():
+        moved = max(s['bytes_read'], s['bytes_written']) / mb
+        rate = moved / s['total_seconds'] if s['total_seconds'] > 0 else 0.0
+        print(f"{name:<12}{s['cases']:>6}{s['p50']:>9.3f}{s['p95']:>9.3f}{s['total_seconds']:>10.1f}"
+              f"{s['bytes_read'] / mb:>10.1f}{s['bytes_written'] / mb:>10.1f}{s['files']:>8}{rate:>8.1f}")
+    return summary
+
+
+def total_size(paths):
+    """统计一组文件的总字节数（不存在的文件忽略）"""
+    total = 0
+    for p in paths:
+        try:
+            total += os.path.getsize(p)
+        except OSError:
+            continue
+    return total
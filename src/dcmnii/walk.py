@@ -0,0 +1,201 @@
+"""
+并行目录遍历与DICOM文件嗅探
+
+在 NFS/SMB 共享上每次列目录、stat 都是一次网络往返，单线程的 os.walk / rglob 会被延迟卡住。
+这里用线程池并行 os.scandir 各个目录，文件按块并行 stat 和嗅探：
+- sniff_dicom() 只读前132字节：第128-131字节为 "DICM" 即为标准DICOM文件；
+  allow_raw=True 时还接受没有前导码的裸数据集（以 0002/0008 组标签开头的隐式/显式VR小端编码），
+  与 pydicom.dcmread(force=True) 能读取的文件范围基本一致；
+- 文本、图片、.DS_Store 等非DICOM文件在调用 pydicom 之前就被排除。
+
+iter_files() 按完成顺序流式产出结果，调用方提前 break 时会取消剩余任务（用于“找到一个就够了”的检测）；
+walk_files() 收集全部结果并排序，保证扫描顺序稳定（序列选择在并列时取先遇到的序列）。
+"""
+import os
+import struct
+
+# 并行度：I/O 等待为主（网络往返），与CPU核数无关
+DEFAULT_WORKERS = 16
+# 每个嗅探任务处理的文件数（单个目录下文件很多时也能并行）
+CHUNK_SIZE = 32
+
+DICOM_PREAMBLE = 128
+DICOM_MAGIC = b'DICM'
+# 裸数据集的第一个标签通常属于文件元信息组或标识组
+RAW_FIRST_GROUPS = (0x0002, 0x0008)
+# 嗅探需要读取的字节数（前导码 + "DICM"）
+SNIFF_BYTES = DICOM_PREAMBLE + len(DICOM_MAGIC)
+
+
+def _looks_like_raw_dataset(head):
+    """没有前导码时，判断开头是否像一个小端编码的DICOM数据元素"""
+    if len(head) < 8:
+        return False
+    group, _ = struct.unpack('<HH', head[:4])
+    if group not in RAW_FIRST_GROUPS:
+        return False
+    vr = head[4:6]
+    if vr.isalpha() and vr.isupper():
+        return True  # 显式VR
+    length = struct.unpack('<I', head[4:8])[0]
+    # 隐式VR：开头的元素都很短（或为未定义长度）
+    return length < 0x10000 or length == 0xFFFFFFFF
+
+
+def sniff_dicom_head(head, allow_raw=True):
+    """按已读出的文件开头（至少 SNIFF_BYTES 字节，文件更短时为整个文件）判断是否为DICOM"""
+    if len(head) >= SNIFF_BYTES and head[DICOM_PREAMBLE:SNIFF_BYTES] == DICOM_MAGIC:
+        return True
+    return allow_raw and _looks_like_raw_dataset(head[:SNIFF_BYTES])
+
+
+def sniff_dicom(path, allow_raw=True):
+    """只读文件头判断是否为DICOM文件（不调用pydicom）"""
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(SNIFF_BYTES)
+    except OSError:
+        return False
+    return sniff_dicom_head(head, allow_raw)
+
+
+def _list_dir(directory, skip_dirs):
+    """列出一个目录：返回 (目录, [文件名], [子目录路径])，无权限等错误按空目录处理（与 os.walk 一致）"""
+    names = []
+    subdirs = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.name not in skip_dirs:
+                            subdirs.append(entry.path)
+                    elif entry.is_file():
+                        names.append(entry.name)
+                except OSError:
+                    continue
+    except OSError:
+        pass
+    return directory, names, subdirs
+
+
+def _check_files(directory, names, sniff, allow_raw):
+    """对一批文件取大小并（可选）嗅探，返回通过的 (目录, 文件名, 大小)"""
+    found = []
+    for name in names:
+        path = os.path.join(directory, name)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            continue
+        if sniff and not sniff_dicom(path, allow_raw):
+            continue
+        found.append((directory, name, size))
+    return found
+
+
+def iter_files(root, sniff=True, allow_raw=True, workers=None, skip_dirs=()):
+    """
+    并行遍历 root 下的所有文件，按完成顺序产出 (目录, 文件名, 字节数)
+
+    同一目录下的文件共用同一个目录字符串对象。sniff=True 时只产出嗅探为DICOM的文件。
+    skip_dirs 为要跳过的子目录名（例如 output、临时目录）。
+    """
+    # concurrent.futures 会连带导入 logging，只在真正遍历时导入（保持 --help 启动快）
+    from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+    skip_dirs = frozenset(skip_dirs)
+    pool = ThreadPoolExecutor(max_workers=workers or DEFAULT_WORKERS)
+    pending = {pool.submit(_list_dir, str(root), skip_dirs)}
+    try:
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                if isinstance(result, list):
+                    yield from result
+                    continue
+                directory, names, subdirs = result
+                for subdir in subdirs:
+                    pending.add(pool.submit(_list_dir, subdir, skip_dirs))
+                for start in range(0, len(names), CHUNK_SIZE):
+                    pending.add(pool.submit(_check_files, directory, names[start:start + CHUNK_SIZE],
+                                            sniff, allow_raw))
+    finally:
+        # 调用方提前结束时不再等待排队中的任务
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def walk_files(root, sniff=True, allow_raw=True, workers=None, skip_dirs=()):
+    """遍历并排序：返回按 (目录, 文件名) 排序的 [(目录, 文件名, 字节数)]"""
+    return sorted(iter_files(root, sniff, allow_raw, workers, skip_dirs), key=lambda item: (item[0], item[1]))
+
+
+def walk_paths(root, sniff=True, allow_raw=True, workers=None, skip_dirs=()):
+    """同 walk_files，只返回完整路径列表"""
+    return [os.path.join(d, n) for d, n, _ in walk_files(root, sniff, allow_raw, workers, skip_dirs)]
+
+
+def contains_dicom(root, allow_raw=True, workers=None, skip_dirs=()):
+    """目录下是否至少有一个DICOM文件（找到第一个即停止）"""
+    for _ in iter_files(root, sniff=True, allow_raw=allow_raw, workers=workers, skip_dirs=skip_dirs):
+        return True
+    return False
+
+
+def find_dicom_folders(parent, exclude=(), cache_path=None, workers=8):
+    """
+    找出 parent 下直接包含（或在其子目录中包含）DICOM文件的一级子文件夹
+
+    每个文件夹找到第一个DICOM文件就停止，多个文件夹并行检查，不再为判断“是否为空”而列出全部文件。
+    cache_path 指定时把结果（文件夹修改时间 + 第一个找到的DICOM文件）写入JSON缓存：
+    下次运行时修改时间未变、且记录的文件仍存在的文件夹直接视为DICOM文件夹，不再检查；
+    没有DICOM的文件夹每次都重新检查（避免漏掉之后才拷入子目录的数据）。
+
+    Returns:
+        list: 按名称排序的 Path 列表
+    """
+    import json
+    from pathlib import Path
+    from concurrent.futures import ThreadPoolExecutor
+
+    parent = Path(parent)
+    exclude = set(exclude)
+    candidates = sorted((p for p in parent.iterdir() if p.is_dir() and p.name not in exclude),
+                        key=lambda p: p.name)
+
+    cache = {}
+    if cache_path and Path(cache_path).exists():
+        try:
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            cache = {}
+
+    def first_dicom(folder):
+        try:
+            mtime_ns = folder.stat().st_mtime_ns
+        except OSError:
+            return folder, None, None
+        cached = cache.get(folder.name)
+        if cached and cached.get('mtime_ns') == mtime_ns and os.path.isfile(cached.get('first_file', '')):
+            return folder, mtime_ns, cached['first_file']
+        # 每个文件夹内部用少量线程，文件夹之间再并行
+        for directory, name, _ in iter_files(folder, sniff=True, workers=4):
+            return folder, mtime_ns, os.path.join(directory, name)
+        return folder, mtime_ns, None
+
+    found = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for folder, mtime_ns, first_file in pool.map(first_dicom, candidates):
+            if first_file:
+                found[folder.name] = {'mtime_ns': mtime_ns, 'first_file': first_file}
+
+    if cache_path and (found or Path(cache_path).exists()):
+        try:
+            Path(cache_path).parent.mkdir(parents=True, exist_ok=True)
+            with open(cache_path, 'w', encoding='utf-8') as f:
+                json.dump(found, f, ensure_ascii=False, indent=2)
+        except OSError:
+            pass
+    return [parent / name for name in sorted(found)]
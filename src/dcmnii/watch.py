@@ -0,0 +1,223 @@
+"""
+收件箱监视（--watch 常驻模式）
+
+InboxWatcher 监视一个收件箱目录，新的压缩包（ZIP / tar / tar.gz / tar.zst）写入完成
+（大小和修改时间在 settle 秒内不再变化，且结构完整，见 dcmnii.archive.archive_complete）
+后才交给调用方处理，避免转换还在拷贝中的半个压缩包。
+
+- Linux 上通过 ctypes 调用 inotify，文件一落盘立即唤醒；
+- 其他平台（Windows等）或 inotify 不可用时退回定时轮询（poll_interval 秒扫描一次目录）。
+两种方式的就绪判定相同，inotify 只是把“发现新文件”的延迟从一个轮询周期降到几乎为零。
+
+已处理的文件按 (名称, 大小, 修改时间) 记录在状态文件中，常驻进程重启后不会重复转换，
+同名ZIP被覆盖（大小或时间变化）时会重新处理。
+"""
+import os
+import sys
+import json
+import time
+import select
+import struct
+from pathlib import Path
+from dcmnii.archive import archive_kind, archive_complete
+
+# inotify 事件掩码（linux/inotify.h）
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+class _Inotify:
+    """最小的 inotify 封装：只监视一个目录，wait() 返回期间有变化的文件名集合"""
+
+    def __init__(self, directory):
+        import ctypes
+        import ctypes.util
+
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        if libc.inotify_add_watch(self.fd, os.fsencode(str(directory)), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f'inotify_add_watch failed: {directory}')
+
+    def wait(self, timeout):
+        """最多等待 timeout 秒，返回发生变化的文件名（超时返回空集合）"""
+        readable, _, _ = select.select([self.fd], [], [], max(timeout, 0))
+        names = set()
+        if not readable:
+            return names
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return names
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(data):
+            _, _, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if name:
+                names.add(os.fsdecode(name))
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class InboxWatcher:
+    """
+    监视收件箱目录，产出已写入完成的ZIP文件
+
+    用法:
+        watcher = InboxWatcher(inbox, state_path=output_dir / '.watch_state.json')
+        for zip_path in watcher.ready():      # 阻塞等待，直到 stop() 或空闲超时
+            ...提交转换...
+            watcher.mark_done(zip_path)       # 转换结束后记录，转换中的文件不会被重复产出
+    """
+
+    def __init__(self, inbox, state_path=None, settle_seconds=5.0, poll_interval=2.0,
+                 idle_exit=0, use_inotify=True):
+        self.inbox = Path(inbox)
+        self.state_path = Path(state_path) if state_path else None
+        self.settle_seconds = settle_seconds
+        self.poll_interval = poll_interval
+        self.idle_exit = idle_exit
+        self._pending = {}   # 名称 -> (大小, mtime_ns, 最近一次观察到变化的时间)
+        self._claimed = set()  # 已产出、正在转换的文件名
+        self._warned = set()
+        self._stopped = False
+        self.done = self._load_state()
+        self.backend = 'polling'
+        self._inotify = None
+        if use_inotify and sys.platform.startswith('linux'):
+            try:
+                self._inotify = _Inotify(self.inbox)
+                self.backend = 'inotify'
+            except (OSError, AttributeError) as e:
+                print(f"⚠ inotify 不可用，改用轮询: {e}")
+
+    def _load_state(self):
+        if self.state_path and self.state_path.exists():
+            try:
+                with open(self.state_path, 'r', encoding='utf-8') as f:
+                    return {name: tuple(sig) for name, sig in json.load(f).items()}
+            except (OSError, ValueError):
+                print(f"⚠ 无法读取监视状态文件，将重新处理收件箱: {self.state_path}")
+        return {}
+
+    def _save_state(self):
+        if not self.state_path:
+            return
+        self.state_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.state_path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({name: list(sig) for name, sig in self.done.items()}, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.state_path)
+
+    @staticmethod
+    def signature(path):
+        st = os.stat(path)
+        return (st.st_size, st.st_mtime_ns)
+
+    def mark_done(self, zip_path):
+        """记录一个ZIP已处理（无论转换成功与否），同样的文件不会再次产出"""
+        name = Path(zip_path).name
+        try:
+            self.done[name] = self.signature(zip_path)
+        except OSError:
+            self.done.pop(name, None)
+        self._claimed.discard(name)
+        self._save_state()
+
+    def release(self, zip_path):
+        """放弃一个已产出的ZIP（例如转换被中断），下次启动或下次扫描时重新处理"""
+        self._claimed.discard(Path(zip_path).name)
+
+    def stop(self):
+        self._stopped = True
+
+    @property
+    def stopped(self):
+        return self._stopped
+
+    def close(self):
+        if self._inotify:
+            self._inotify.close()
+            self._inotify = None
+
+    def _observe(self, now):
+        """扫描收件箱，更新待定文件的大小/时间，返回已稳定的ZIP路径列表（now 为 time.time()，与 mtime 可比）"""
+        ready = []
+        seen = set()
+        with os.scandir(self.inbox) as entries:
+            for entry in entries:
+                if not entry.is_file() or not archive_kind(entry.name):
+                    continue
+                seen.add(entry.name)
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                sig = (st.st_size, st.st_mtime_ns)
+                if entry.name in self._claimed or self.done.get(entry.name) == sig:
+                    continue
+                previous = self._pending.get(entry.name)
+                if previous is None or previous[:2] != sig:
+                    self._pending[entry.name] = (sig[0], sig[1], now)
+                    continue
+                # 大小和修改时间在 settle 秒内都没有变化，再确认压缩包结构完整
+                if now - previous[2] < self.settle_seconds or now - st.st_mtime_ns / 1e9 < self.settle_seconds:
+                    continue
+                # ZIP 顺带缓存中央目录，worker读取时不再重新解析
+                if not archive_complete(entry.path):
+                    if entry.name not in self._warned:
+                        print(f"⚠ {entry.name} 大小已稳定但压缩包不完整，继续等待")
+                        self._warned.add(entry.name)
+                    continue
+                del self._pending[entry.name]
+                self._warned.discard(entry.name)
+                self._claimed.add(entry.name)
+                ready.append(Path(entry.path))
+        # 已被移走/删除的文件不再等待
+        for name in list(self._pending):
+            if name not in seen:
+                del self._pending[name]
+        return sorted(ready, key=lambda p: p.name)
+
+    def _wait(self):
+        """等待下一次检查：有待定文件时按较短间隔复查，否则等目录事件或轮询周期"""
+        timeout = self.poll_interval
+        if self._pending:
+            timeout = min(timeout, max(self.settle_seconds / 2.0, 0.1))
+        if self._inotify:
+            # 没有待定文件时 inotify 可以睡得更久（有空闲退出时除外），仍保留周期性全量扫描兜底
+            if not self._pending and not self.idle_exit:
+                timeout = max(timeout, 30.0)
+            self._inotify.wait(timeout)
+        else:
+            time.sleep(timeout)
+
+    def ready(self):
+        """生成器：依次产出写入完成、尚未处理过的ZIP；idle_exit>0 时空闲超过该秒数后结束"""
+        last_activity = time.monotonic()
+        while not self._stopped:
+            batch = self._observe(time.time())
+            for i, zip_path in enumerate(batch):
+                if self._stopped:
+                    for skipped in batch[i:]:
+                        self.release(skipped)
+                    return
+                yield zip_path
+            if batch or self._pending:
+                last_activity = time.monotonic()
+            elif self.idle_exit and time.monotonic() - last_activity >= self.idle_exit:
+                return
+            self._wait()
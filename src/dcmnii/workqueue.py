@@ -0,0 +1,477 @@
+"""
+共享目录上的分布式工作队列（无协调进程）
+
+集群中的几台机器挂载同一个共享目录时，每台机器各自运行同一个脚本并加上 --queue，
+就能共同处理一批case，不需要消息中间件或常驻的调度服务。所有协调都通过共享目录中的文件完成：
+
+    <队列目录>/
+        pending/            待领取的任务（000000.json ...，按调度顺序编号）和批次信息 .batch.json
+        claimed/            已领取的任务 <编号>@<worker>.json，文件的修改时间就是租约的心跳
+        done/               已完成的任务（记录最终由哪个worker完成）
+        workers/            各worker的状态文件（主机、进程号、当前任务、已完成数）
+        reports/            各worker的报告分片 <worker>.jsonl（dcmnii.report.ReportWriter）
+        seed.lock / merge.lock
+
+- 生成任务：第一个抢到 seed.lock（O_EXCL 创建）的worker扫描输入、写出全部任务，
+  先写到临时目录再整体改名为 pending/（原子操作，pending/ 出现即表示任务已完整生成），其他worker等待；
+- 领取：把 pending/<编号>.json 改名为 claimed/<编号>@<自己>.json，改名是原子的，同一任务只有一个worker成功；
+- 心跳：后台线程每 heartbeat 秒刷新自己持有的租约文件的修改时间；
+- 回收：待领取的任务取完后，修改时间超过 lease_timeout 的租约（worker崩溃、机器断电）被其他worker
+  同样用改名接手；同一任务被回收超过 max_attempts 次时不再重试，记为失败；
+- 完成：结果先追加到自己的报告分片，再把租约改名到 done/；
+- 合并：所有任务完成后，抢到 merge.lock 的worker合并各分片（同一任务有多条记录时以 done/ 中记录的worker为准），
+  生成与单机运行相同的汇总文件。
+
+过期判断使用共享存储上的时间（刚写过的心跳文件的修改时间），不依赖各节点时钟一致。
+队列目录对应一个批次：合并后再次运行不会重复合并（merge.lock 已存在，直接退出），需要重新合并时删除 merge.lock
+后再运行任意一个worker；处理新批次时删除该目录或使用新的目录。
+"""
+import os
+import json
+import time
+import shutil
+import socket
+import threading
+from datetime import datetime
+from pathlib import Path
+from dcmnii.profiling import safe_name
+from dcmnii.report import ReportWriter, read_jsonl
+
+QUEUE_DIR_NAME = '.queue'
+BATCH_FILE = '.batch.json'
+SEED_LOCK = 'seed.lock'
+MERGE_LOCK = 'merge.lock'
+# 租约文件名中任务编号与worker名称的分隔符
+OWNER_SEP = '@'
+DEFAULT_LEASE_TIMEOUT = 600.0
+DEFAULT_HEARTBEAT = 30.0
+DEFAULT_MAX_ATTEMPTS = 3
+
+
+def default_worker_id():
+    """默认的worker名称：主机名-进程号"""
+    host = socket.gethostname().split('.')[0] or 'host'
+    return safe_name(f"{host}-{os.getpid()}").replace(OWNER_SEP, '_')
+
+
+def _write_json(path, data):
+    """先写临时文件再改名（读取方不会看到写了一半的JSON；临时文件以 . 开头，列目录时被忽略）"""
+    path = Path(path)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, default=str)
+    os.replace(tmp_path, path)
+
+
+def _read_json(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _entries(directory):
+    """目录中的任务文件（忽略 . 开头的批次信息和临时文件），按名称排序"""
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    return [Path(directory) / name for name in sorted(names) if name.endswith('.json') and not name.startswith('.')]
+
+
+class QueueTask:
+    """领取到的一个任务（data 为生成任务时写入的字典，attempt 为第几次领取）"""
+
+    __slots__ = ('key', 'data')
+
+    def __init__(self, key, data):
+        self.key = key
+        self.data = data
+
+    @property
+    def name(self):
+        return self.data.get('name', self.key)
+
+    @property
+    def attempt(self):
+        return self.data.get('attempt', 1)
+
+    def __repr__(self):
+        return f"QueueTask({self.key}, {self.name!r}, attempt={self.attempt})"
+
+
+class WorkQueue:
+    """
+    一个worker对共享队列的视图
+
+    用法:
+        queue = WorkQueue(data_dir / 'output' / '.queue')
+        queue.start()                                   # 创建目录、打开报告分片、启动心跳线程
+        if queue.acquire_seed():                        # 由本worker生成任务
+            queue.seed([{'name': job.name, 'path': str(job.path)} for job in jobs])
+        for task in queue.tasks():                      # 没有可领取的任务时等待其他worker，全部完成后结束
+            result = process(task.data)
+            queue.complete(task, result)                # 写入报告分片并把任务移到 done/
+        queue.close()
+        records = queue.finalize()                      # 最后完成的worker得到合并后的全部记录，其他worker得到None
+    """
+
+    def __init__(self, root, worker_id=None, lease_timeout=DEFAULT_LEASE_TIMEOUT, heartbeat=DEFAULT_HEARTBEAT,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS):
+        if heartbeat <= 0 or heartbeat >= lease_timeout:
+            raise ValueError(f"Heartbeat interval ({heartbeat}s) must be positive and shorter than "
+                             f"the lease timeout ({lease_timeout}s)")
+        self.root = Path(root)
+        self.worker_id = (safe_name(worker_id).replace(OWNER_SEP, '_') if worker_id else default_worker_id())
+        self.lease_timeout = lease_timeout
+        self.heartbeat = heartbeat
+        self.max_attempts = max_attempts
+        self.pending_dir = self.root / 'pending'
+        self.claimed_dir = self.root / 'claimed'
+        self.done_dir = self.root / 'done'
+        self.workers_dir = self.root / 'workers'
+        self.reports_dir = self.root / 'reports'
+        self.report = None
+        self.claimed = 0
+        self.completed = 0
+        self.reclaimed = 0
+        self.lost = 0
+        self._held = {}
+        self._seed_lock_held = False
+        self._candidates = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._started = datetime.now().isoformat()
+
+    @property
+    def worker_file(self):
+        return self.workers_dir / f"{self.worker_id}.json"
+
+    @property
+    def shard_path(self):
+        return self.reports_dir / f"{self.worker_id}.jsonl"
+
+    def start(self):
+        """创建队列目录、打开本worker的报告分片并启动心跳线程"""
+        for directory in (self.claimed_dir, self.done_dir, self.workers_dir, self.reports_dir):
+            directory.mkdir(parents=True, exist_ok=True)
+        # 分片保留为 .jsonl（不压实），合并时逐行读取
+        self.report = ReportWriter(self.shard_path, log_dir=self.reports_dir / f"{self.worker_id}_logs",
+                                   compact=False)
+        self._beat()
+        self._thread = threading.Thread(target=self._heartbeat_loop, name='queue-heartbeat', daemon=True)
+        self._thread.start()
+        return self
+
+    def _beat(self, finished=False):
+        """写出worker状态文件，并刷新持有的租约（以及生成任务期间的 seed.lock）的修改时间"""
+        with self._lock:
+            held = list(self._held.values())
+            if self._seed_lock_held:
+                held.append(self.root / SEED_LOCK)
+            _write_json(self.worker_file, {
+                'worker': self.worker_id,
+                'host': socket.gethostname(),
+                'pid': os.getpid(),
+                'started': self._started,
+                'updated': datetime.now().isoformat(),
+                'current': [path.name for path in held],
+                'completed': self.completed,
+                'reclaimed': self.reclaimed,
+                'finished': finished,
+            })
+        for path in held:
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                # 租约已被回收，complete() 时会发现
+                pass
+
+    def _heartbeat_loop(self):
+        while not self._stop.wait(self.heartbeat):
+            try:
+                self._beat()
+            except OSError as e:
+                print(f"⚠ 队列心跳写入失败（{self.heartbeat:.0f}s 后重试）: {e}")
+
+    def _share_now(self):
+        """共享存储上的当前时间：刚写出的心跳文件的修改时间（不依赖本机时钟与其他节点一致）"""
+        self._beat()
+        return os.stat(self.worker_file).st_mtime
+
+    def _stale(self, path, now):
+        """文件超过租约时长没有刷新时返回已过去的秒数，否则返回None"""
+        try:
+            age = now - os.stat(path).st_mtime
+        except FileNotFoundError:
+            return None
+        return age if age >= self.lease_timeout else None
+
+    # 生成任务
+
+    def seeded(self):
+        return (self.pending_dir / BATCH_FILE).exists()
+
+    def batch(self):
+        """生成任务时写入的批次信息（total、seeded_by 以及 seed() 的关键字参数）"""
+        return _read_json(self.pending_dir / BATCH_FILE)
+
+    def acquire_seed(self):
+        """
+        决定由哪个worker生成任务列表
+
+        返回True时调用方负责扫描输入并调用 seed()；任务已经生成时返回False。
+        其他worker正在生成时等待；它超过租约时长没有心跳（崩溃）时接手生成。
+        """
+        lock = self.root / SEED_LOCK
+        waiting = False
+        while not self.seeded():
+            try:
+                fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                pass
+            else:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    f.write(self.worker_id)
+                with self._lock:
+                    self._seed_lock_held = True
+                return True
+            if self._stale(lock, self._share_now()) is not None:
+                print(f"⚠ 生成任务的worker已超过 {self.lease_timeout:.0f}s 没有心跳，由本worker接手")
+                try:
+                    os.rename(lock, self.root / f".{SEED_LOCK}.{self.worker_id}.stale")
+                    os.remove(self.root / f".{SEED_LOCK}.{self.worker_id}.stale")
+                except FileNotFoundError:
+                    pass
+                continue
+            if not waiting:
+                print(f"等待其他worker生成任务列表（{self.root}）...")
+                waiting = True
+            time.sleep(min(self.heartbeat, 2.0))
+        return False
+
+    def seed(self, tasks, **meta):
+        """
+        写出全部任务（tasks 为带 'name' 的字典，按处理顺序排列）；meta 写入批次信息
+
+        返回False表示另一个worker已经先生成了任务（本次写出的任务被丢弃）。
+        """
+        staging = self.root / f".seed-{self.worker_id}"
+        shutil.rmtree(staging, ignore_errors=True)
+        staging.mkdir(parents=True)
+        count = 0
+        for index, task in enumerate(tasks):
+            _write_json(staging / f"{index:06d}.json", {**task, 'attempt': 0})
+            count += 1
+        _write_json(staging / BATCH_FILE, {'total': count, 'seeded_by': self.worker_id,
+                                           'seeded_at': datetime.now().isoformat(), **meta})
+        try:
+            # pending/ 始终包含 .batch.json，不会是空目录，后来者的改名一定失败
+            os.rename(staging, self.pending_dir)
+            seeded = True
+        except OSError:
+            shutil.rmtree(staging, ignore_errors=True)
+            seeded = False
+        finally:
+            with self._lock:
+                held, self._seed_lock_held = self._seed_lock_held, False
+            if held:
+                try:
+                    os.remove(self.root / SEED_LOCK)
+                except FileNotFoundError:
+                    pass
+        return seeded
+
+    # 领取与完成
+
+    def _take(self, source, key):
+        """把任务文件原子地改名为自己的租约；已被其他worker拿走时返回None"""
+        target = self.claimed_dir / f"{key}{OWNER_SEP}{self.worker_id}.json"
+        try:
+            # 改名保留原来的修改时间，先刷新，否则刚领取的任务会被其他worker当作过期
+            os.utime(source)
+            os.rename(source, target)
+        except FileNotFoundError:
+            return None
+        data = _read_json(target)
+        data['attempt'] = data.get('attempt', 0) + 1
+        data['worker'] = self.worker_id
+        _write_json(target, data)
+        with self._lock:
+            self._held[key] = target
+        self.claimed += 1
+        return QueueTask(key, data)
+
+    def _next_pending(self):
+        # 按上次列出的顺序逐个尝试，取完才重新列目录（任务很多时不必每次都列一遍共享目录）
+        for attempt in range(2):
+            while self._candidates:
+                path = self._candidates.pop(0)
+                task = self._take(path, path.stem)
+                if task is not None:
+                    return task
+            if attempt == 0:
+                self._candidates = _entries(self.pending_dir)
+        return None
+
+    def _reclaim(self):
+        """接手一个过期的租约（持有它的worker超过 lease_timeout 没有心跳）"""
+        now = self._share_now()
+        for path in _entries(self.claimed_dir):
+            key, _, owner = path.stem.rpartition(OWNER_SEP)
+            with self._lock:
+                held = key in self._held
+            # 只跳过本进程正在处理的租约；用固定 --worker-id 重启后，上次崩溃留下的同名租约照常回收
+            if held:
+                continue
+            age = self._stale(path, now)
+            if age is None:
+                continue
+            task = self._take(path, key)
+            if task is not None:
+                self.reclaimed += 1
+                print(f"  ↺ 回收过期租约: {task.name}（worker {owner} 已 {age:.0f}s 没有心跳）")
+                return task
+        return None
+
+    def next_task(self):
+        """领取下一个任务（先取待领取的，再回收过期租约），暂时没有可领取的任务时返回None，不等待"""
+        while True:
+            task = self._next_pending() or self._reclaim()
+            if task is None or task.attempt <= self.max_attempts:
+                return task
+            # 反复让worker失联的case（例如耗尽内存）不再重试
+            label = task.data.get('label') or {'case_name': task.name}
+            self.complete(task, {**label, 'success': False, 'error_code': 'other',
+                                 'error': f"Abandoned after {task.attempt - 1} lost leases (worker crashed or hung)",
+                                 'processing_time': datetime.now().isoformat()})
+            print(f"  ✗ {task.name}: 已 {task.attempt - 1} 次失去租约，不再重试")
+
+    def remaining(self):
+        """(待领取数, 处理中数)"""
+        return len(_entries(self.pending_dir)), len(_entries(self.claimed_dir))
+
+    def drained(self):
+        """所有任务都已完成（没有待领取的，也没有处理中的）"""
+        return self.seeded() and self.remaining() == (0, 0)
+
+    def wait(self):
+        """没有可领取的任务时等待一个心跳周期（其他worker完成或租约过期）"""
+        time.sleep(self.heartbeat)
+
+    def tasks(self):
+        """逐个领取任务；暂时没有时等待其他worker（期间回收过期租约），全部完成后结束"""
+        waiting = False
+        while True:
+            task = self.next_task()
+            if task is not None:
+                waiting = False
+                yield task
+                continue
+            if self.drained():
+                return
+            if not waiting:
+                print(f"没有待领取的任务，等待其他worker完成 {self.remaining()[1]} 个处理中的case"
+                      f"（超过 {self.lease_timeout:.0f}s 没有心跳的将被回收）...")
+                waiting = True
+            self.wait()
+
+    def complete(self, task, record):
+        """
+        把结果写入本worker的报告分片，并把任务移到 done/；返回写入分片的记录（日志已外置）
+
+        租约已被其他worker回收时记录仍会写入分片（合并时以 done/ 中记录的worker为准），返回记录带 lease_lost。
+        """
+        record = dict(record)
+        record['queue'] = {'task': task.key, 'worker': self.worker_id, 'attempt': task.attempt}
+        with self._lock:
+            lease = self._held.pop(task.key, None)
+        try:
+            if lease is None:
+                raise FileNotFoundError(task.key)
+            os.rename(lease, self.done_dir / f"{task.key}.json")
+        except FileNotFoundError:
+            record['queue']['lease_lost'] = True
+            self.lost += 1
+            print(f"  ⚠ {task.name}: 租约已被其他worker回收，结果仍写入报告分片")
+        record = self.report.write(record)
+        self.completed += 1
+        return record
+
+    def close(self):
+        """停止心跳，关闭报告分片；未完成的任务留在 claimed/ 中，由其他worker在租约过期后回收"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.report is not None:
+            self.report.close()
+        try:
+            self._beat(finished=True)
+        except OSError:
+            pass
+
+    # 合并
+
+    def finalize(self):
+        """所有任务完成后由一个worker（抢到 merge.lock）合并报告分片，返回合并后的记录；其他worker返回None"""
+        if not self.drained():
+            return None
+        try:
+            fd = os.open(self.root / MERGE_LOCK, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return None
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(self.worker_id)
+        return self.merge()
+
+    def merge(self):
+        """按任务顺序合并各worker的报告分片（同一任务有多条记录时，取 done/ 中记录的完成者的那条）"""
+        owners = {}
+        for path in _entries(self.done_dir):
+            try:
+                owners[path.stem] = _read_json(path).get('worker')
+            except (OSError, ValueError):
+                continue
+        merged = {}
+        for shard in sorted(self.reports_dir.glob('*.jsonl')):
+            for record in read_jsonl(shard):
+                key = (record.get('queue') or {}).get('task')
+                if key is None:
+                    continue
+                current = merged.get(key)
+                if current is None or current['queue'].get('worker') != owners.get(key):
+                    merged[key] = record
+        return [merged[key] for key in sorted(merged)]
+
+    def workers(self):
+        """各worker的状态文件内容"""
+        statuses = []
+        for path in _entries(self.workers_dir):
+            try:
+                statuses.append(_read_json(path))
+            except (OSError, ValueError):
+                continue
+        return statuses
+
+
+def add_queue_arguments(parser):
+    """为入口脚本的 argparse 添加分布式队列选项"""
+    group = parser.add_argument_group('分布式队列（多台机器共同处理同一批数据）')
+    group.add_argument('--queue', nargs='?', const='', default=None, metavar='DIR',
+                       help=f'从共享目录中的工作队列领取case，各机器对同一数据目录运行相同命令即可'
+                            f'（默认队列目录: 输出目录下的 {QUEUE_DIR_NAME}/；一个队列目录对应一个批次）')
+    group.add_argument('--worker-id', default=None,
+                       help='worker名称，用于租约和报告分片（默认: 主机名-进程号）')
+    group.add_argument('--lease-timeout', type=float, default=DEFAULT_LEASE_TIMEOUT, metavar='SECONDS',
+                       help=f'租约超过该秒数没有心跳时由其他worker回收（默认{DEFAULT_LEASE_TIMEOUT:.0f}）')
+    group.add_argument('--heartbeat', type=float, default=DEFAULT_HEARTBEAT, metavar='SECONDS',
+                       help=f'刷新租约的间隔秒数（默认{DEFAULT_HEARTBEAT:.0f}，须小于 --lease-timeout）')
+    return group
+
+
+def queue_from_args(args, default_dir):
+    """根据命令行参数构造 WorkQueue（未指定 --queue 时返回None）；default_dir 为输出目录"""
+    if args.queue is None:
+        return None
+    root = Path(args.queue) if args.queue else Path(default_dir) / QUEUE_DIR_NAME
+    return WorkQueue(root, worker_id=args.worker_id, lease_timeout=args.lease_timeout, heartbeat=args.heartbeat)
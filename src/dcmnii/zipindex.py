@@ -0,0 +1,301 @@
+"""
+ZIP中央目录缓存
+
+同一个ZIP在一次运行中会被打开好几次：调度估算大小、is_zipfile 判断、解压、脱敏工具的完整性校验和补全解压，
+每次 zipfile.ZipFile 都要重新读取并解析整个中央目录。十万个成员的 ZIP64 包仅解析目录就要几秒（网络共享上更慢）。
+
+ZipIndex 按 (路径, 大小, mtime_ns) 缓存解析结果：
+- 进程内：最近用过的 MAX_CACHED 个ZIP保留在内存中，各函数共用；
+- 持久化：设置缓存目录后（configure_zip_cache，各脚本使用 output/.zip_index/），目录按列写成JSON，
+  下次运行或其他进程（并行worker、元数据提取子进程）直接读取，ZIP大小或修改时间变化后自动失效。
+  缓存目录同时写入环境变量 DCMNII_ZIP_INDEX_DIR，子进程无需额外传参。
+
+名称、大小等查询直接使用按列保存的数据；需要读取成员时 ZipDirectory.open() 返回一个不再解析中央目录的
+zipfile.ZipFile（ZipInfo 在第一次 open 时才构造），解压仍由 zipfile 流式完成，ZIP64 成员照常支持。
+
+注意：不解析目录的 ZipFile 依赖 zipfile 的内部实现——覆盖私有方法 ZipFile._RealGetContents，
+并在其中填写 filelist / NameToInfo / _comment（ZIP注释）/ start_dir（中央目录偏移）。已核对的
+Python 版本范围见 _ZIPFILE_TESTED；版本不在范围内、或这些私有属性不存在时，open() 退回普通的
+zipfile.ZipFile（重新解析中央目录，只是慢一些），结果不受影响。
+"""
+import os
+import sys
+import json
+import hashlib
+import zipfile
+from collections import OrderedDict
+from pathlib import Path
+
+ZIP_INDEX_DIR_NAME = '.zip_index'
+ZIP_INDEX_VERSION = 2
+ZIP_INDEX_ENV = 'DCMNII_ZIP_INDEX_DIR'
+# 进程内最多保留的ZIP目录数（十万成员的目录在内存中约占几十MB）
+MAX_CACHED = 16
+# 按列保存的 ZipInfo 字段（date_time 另存为DOS时间）
+COLUMNS = ('header_offset', 'compress_type', 'compress_size', 'file_size', 'CRC', 'flag_bits', 'external_attr')
+
+
+def _dos_time(date_time):
+    year, month, day, hour, minute, second = date_time
+    return (max(year - 1980, 0) << 25 | month << 21 | day << 16 | hour << 11 | minute << 5 | second // 2)
+
+
+def _date_time(dos_time):
+    return ((dos_time >> 25) + 1980, dos_time >> 21 & 0xF, dos_time >> 16 & 0x1F,
+            dos_time >> 11 & 0x1F, dos_time >> 5 & 0x3F, (dos_time & 0x1F) * 2)
+
+
+# _CachedZipFile 覆盖的 zipfile 内部实现已核对过的 Python 版本（含两端）
+_ZIPFILE_TESTED = ((3, 8), (3, 14))
+
+
+def _cached_open_supported():
+    """当前 zipfile 是否提供 _CachedZipFile 依赖的私有接口"""
+    low, high = _ZIPFILE_TESTED
+    if not low <= sys.version_info[:2] <= high:
+        return False
+    return (callable(getattr(zipfile.ZipFile, '_RealGetContents', None))
+            and isinstance(getattr(zipfile.ZipFile, 'comment', None), property))
+
+
+CACHED_OPEN_SUPPORTED = _cached_open_supported()
+
+
+class _CachedZipFile(zipfile.ZipFile):
+    """用已缓存的 ZipInfo 列表代替解析中央目录的 ZipFile（只读）"""
+
+    def __init__(self, path, infos, comment, start_dir):
+        self._cached_infos = infos
+        self._cached_comment = comment
+        self._cached_start_dir = start_dir
+        super().__init__(path, 'r')
+
+    def _RealGetContents(self):
+        # 与 zipfile 原实现填写相同的属性：ZIP注释、中央目录起始位置、成员列表
+        self._comment = self._cached_comment
+        self.start_dir = self._cached_start_dir
+        for info in self._cached_infos:
+            self.filelist.append(info)
+            self.NameToInfo[info.filename] = info
+
+
+class ZipDirectory:
+    """
+    一个ZIP中央目录的快照（按列保存）
+
+    names / file_sizes 等列表与ZIP中的成员顺序一致（包括目录项）。
+    """
+
+    def __init__(self, path, size, mtime_ns, names, columns, comment=b'', start_dir=0):
+        self.path = Path(path)
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.names = names
+        self.columns = columns
+        self.comment = comment
+        self.start_dir = start_dir
+        self._infos = None
+
+    @classmethod
+    def parse(cls, path, st):
+        """读取并解析ZIP的中央目录（唯一一处真正打开ZIP解析目录的地方）"""
+        with zipfile.ZipFile(path, 'r') as zf:
+            infos = zf.infolist()
+            comment = zf.comment
+            start_dir = getattr(zf, 'start_dir', 0)
+        columns = {name: [getattr(info, name) for info in infos] for name in COLUMNS}
+        columns['date_time'] = [_dos_time(info.date_time) for info in infos]
+        directory = cls(path, st.st_size, st.st_mtime_ns, [info.orig_filename for info in infos], columns,
+                        comment, start_dir)
+        directory._infos = infos
+        return directory
+
+    @classmethod
+    def from_dict(cls, path, data):
+        return cls(path, data['size'], data['mtime_ns'], data['names'], data['columns'],
+                   bytes.fromhex(data['comment']), data['start_dir'])
+
+    def to_dict(self):
+        return {
+            'version': ZIP_INDEX_VERSION,
+            'path': str(self.path),
+            'size': self.size,
+            'mtime_ns': self.mtime_ns,
+            'names': self.names,
+            'columns': self.columns,
+            # ZIP注释是任意字节，按十六进制保存
+            'comment': self.comment.hex(),
+            'start_dir': self.start_dir,
+        }
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def file_sizes(self):
+        return self.columns['file_size']
+
+    def is_dir(self, index):
+        return self.names[index].endswith('/')
+
+    def members(self):
+        """所有文件成员（不含目录项）的 (名称, 解压后大小)"""
+        return [(name, size) for name, size in zip(self.names, self.file_sizes) if not name.endswith('/')]
+
+    def namelist(self):
+        return list(self.names)
+
+    def total_size(self):
+        """文件成员解压后的总字节数"""
+        return sum(size for name, size in zip(self.names, self.file_sizes) if not name.endswith('/'))
+
+    def infolist(self):
+        """按缓存数据构造的 ZipInfo 列表（只构造一次）"""
+        if self._infos is None:
+            columns = self.columns
+            infos = []
+            for index, name in enumerate(self.names):
+                dos_time = columns['date_time'][index]
+                info = zipfile.ZipInfo(name, _date_time(dos_time))
+                # 加密且带数据描述符的成员用它校验密码
+                info._raw_time = dos_time & 0xFFFF
+                for column in COLUMNS:
+                    setattr(info, column, columns[column][index])
+                infos.append(info)
+            self._infos = infos
+        return self._infos
+
+    def open(self):
+        """返回读取该ZIP的 zipfile.ZipFile（不重新解析中央目录），用法与 zipfile.ZipFile 相同"""
+        if CACHED_OPEN_SUPPORTED:
+            try:
+                return _CachedZipFile(self.path, self.infolist(), self.comment, self.start_dir)
+            except AttributeError:
+                # zipfile 内部实现与预期不符（私有属性缺失），改用普通方式打开
+                pass
+        return zipfile.ZipFile(self.path, 'r')
+
+
+class ZipIndex:
+    """
+    ZIP中央目录缓存（进程内LRU + 可选的持久化目录）
+
+    用法:
+        index = ZipIndex(cache_dir=output_dir / '.zip_index')
+        directory = index.get(zip_path)          # 不是ZIP时抛出 zipfile.BadZipFile
+        with directory.open() as zf:
+            zf.extractall(dest)
+    """
+
+    def __init__(self, cache_dir=None, max_cached=MAX_CACHED):
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.max_cached = max_cached
+        self._memory = OrderedDict()
+        # 已确认不是ZIP的文件：{路径: (大小, mtime_ns)}
+        self._not_zip = {}
+        self.hits = 0
+        self.loads = 0
+        self.parses = 0
+
+    def _cache_file(self, key):
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+        return self.cache_dir / f"{Path(key).stem[:40]}-{digest}.json"
+
+    def _load(self, key, signature):
+        if self.cache_dir is None:
+            return None
+        try:
+            with open(self._cache_file(key), 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get('version') != ZIP_INDEX_VERSION or (data.get('size'), data.get('mtime_ns')) != signature:
+            return None
+        return ZipDirectory.from_dict(key, data)
+
+    def _save(self, key, directory):
+        if self.cache_dir is None:
+            return
+        path = self._cache_file(key)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(directory.to_dict(), f, ensure_ascii=False, separators=(',', ':'))
+            os.replace(tmp_path, path)
+        except OSError:
+            # 缓存写不出来只影响下次运行的速度
+            pass
+
+    def _remember(self, key, directory):
+        self._memory[key] = directory
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_cached:
+            self._memory.popitem(last=False)
+
+    def get(self, zip_path):
+        """ZIP的中央目录（ZipDirectory）；不是ZIP或已损坏时抛出 zipfile.BadZipFile"""
+        key = os.path.abspath(zip_path)
+        st = os.stat(key)
+        signature = (st.st_size, st.st_mtime_ns)
+        directory = self._memory.get(key)
+        if directory is not None and (directory.size, directory.mtime_ns) == signature:
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return directory
+        if self._not_zip.get(key) == signature:
+            raise zipfile.BadZipFile(f"File is not a zip file: {zip_path}")
+        directory = self._load(key, signature)
+        if directory is not None:
+            self.loads += 1
+        else:
+            try:
+                directory = ZipDirectory.parse(key, st)
+            except zipfile.BadZipFile:
+                self._not_zip[key] = signature
+                raise
+            self.parses += 1
+            self._save(key, directory)
+        self._remember(key, directory)
+        return directory
+
+    def is_zip(self, path):
+        """与 zipfile.is_zipfile 相同的判断，但成功时顺带缓存中央目录供后续打开使用"""
+        try:
+            self.get(path)
+            return True
+        except (OSError, zipfile.BadZipFile):
+            return False
+
+
+_default_index = ZipIndex(os.environ.get(ZIP_INDEX_ENV) or None)
+
+
+def configure_zip_cache(cache_dir):
+    """设置持久化缓存目录（同时写入环境变量，之后启动的子进程/worker使用同一目录）"""
+    _default_index.cache_dir = Path(cache_dir) if cache_dir else None
+    if cache_dir:
+        os.environ[ZIP_INDEX_ENV] = str(cache_dir)
+    else:
+        os.environ.pop(ZIP_INDEX_ENV, None)
+    return _default_index
+
+
+def zip_directory(zip_path):
+    """默认缓存中 zip_path 的中央目录（ZipDirectory）"""
+    return _default_index.get(zip_path)
+
+
+def open_zip(zip_path):
+    """打开ZIP读取（中央目录来自缓存），用法与 zipfile.ZipFile(zip_path) 相同"""
+    return _default_index.get(zip_path).open()
+
+
+def is_zip(path):
+    """缓存版 zipfile.is_zipfile"""
+    return _default_index.is_zip(path)
+
+
+def zip_index():
+    """进程默认的 ZipIndex（查看命中统计等）"""
+    return _default_index
@@ -3,9 +3,9 @@
 DICOM脱敏工具 (通用版) - 支持所有输入模式
 
 功能:
-1. 支持单个ZIP文件
+1. 支持单个压缩包（ZIP / tar / tar.gz / tar.zst）
 2. 支持单个DICOM文件夹
-3. 支持父目录包含多个ZIP文件和DICOM文件夹（批量模式）
+3. 支持父目录包含多个压缩包和DICOM文件夹（批量模式）
 4. 自动识别输入类型并选择合适的处理模式
 5. 按case批量脱敏DICOM文件
 6. 每个case独立文件夹存储
@@ -15,17 +15,18 @@ DICOM脱敏工具 (通用版) - 支持所有输入模式
 
 使用方法:
 1. GUI模式: python dicom_deidentify_universal.py
-2. 命令行模式: python dicom_deidentify_universal.py <输入路径> [--id-prefix PREFIX] [--id-start N]
+2. 命令行模式: python dicom_deidentify_universal.py <输入路径> [--id-prefix PREFIX] [--id-start N] [--profile cpu|mem]
 
 参数:
   --id-prefix: 自定义PatientID前缀（默认: ANON）
   --id-start: 自定义起始编号（默认: 1）
+  --profile: 按case剖析，cpu 写出 .prof 文件，mem 写出内存分配报告（保存在 output_deid/profiles_<时间>/）
   例如: --id-prefix PATIENT --id-start 100 将生成 PATIENT_00100, PATIENT_00101...
 
 输入: 
-  - 单个ZIP文件
+  - 单个压缩包（ZIP / tar / tar.gz / tar.zst）
   - 单个DICOM文件夹
-  - 包含多个ZIP和/或DICOM文件夹的父目录
+  - 包含多个压缩包和/或DICOM文件夹的父目录
 输出: 
   - output_deid/<case_name>/ (脱敏后的DICOM文件)
   - dicom_deid_summary.csv (映射表和临床信息)
@@ -33,32 +34,38 @@ DICOM脱敏工具 (通用版) - 支持所有输入模式
 新功能:
   - 自动检测并复用已有临时解压目录（避免重复解压）
   - 支持自定义PatientID编号方案
+  - 批量模式按 SOPInstanceUID + 内容哈希 去除重复实例（--no-dedup 关闭）
+  - 多台机器挂载同一共享目录时用 --queue 共同处理一批数据（见 dcmnii.workqueue）
 """
 
 import os
 import sys
-import zipfile
+import json
 import shutil
 import re
 import stat
+import hashlib
 from datetime import datetime
 from pathlib import Path
 from collections import defaultdict
 
-try:
-    import pydicom
-    from pydicom.errors import InvalidDicomError
-except ImportError:
-    print("错误: 未安装pydicom库")
-    print("请运行: pip install pydicom")
-    sys.exit(1)
+# pydicom（以及它依赖的numpy）在用到的函数里才导入，--help 等不读DICOM的路径启动更快；
+# 是否已安装在 main() 开头检查
 
 try:
-    import pandas as pd
+    import xxhash  # 可选：更快的内容哈希
 except ImportError:
-    print("错误: 未安装pandas库")
-    print("请运行: pip install pandas")
-    sys.exit(1)
+    xxhash = None
+
+from dcmnii.profiling import CaseProfiler, add_profile_argument, profile_dir
+from dcmnii.progress import add_progress_arguments, progress_from_args
+from dcmnii.walk import walk_paths, sniff_dicom
+from dcmnii.zipindex import ZIP_INDEX_DIR_NAME, configure_zip_cache, zip_directory
+from dcmnii.archive import archive_kind, archive_stem, is_archive, iter_members, member_path
+from dcmnii.workqueue import add_queue_arguments, queue_from_args
+
+# tar 压缩包完整解压后在临时目录中写入的标记文件（用于判断能否复用）
+EXTRACT_MARKER = '.extract_complete.json'
 
 
 def sanitize_case_label(case_label):
@@ -92,9 +99,40 @@ def remove_tree(path):
         shutil.rmtree(path, onerror=onerror)
 
 
-def verify_zip_extraction_complete(zip_path, temp_dir):
+def _archive_signature(archive_path):
+    st = os.stat(archive_path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def _write_extract_marker(archive_path, temp_dir, members):
+    """tar 压缩包完整解压后写入标记文件：压缩包的 (大小, 修改时间) 和各成员的 {相对路径: 大小}"""
+    with open(os.path.join(temp_dir, EXTRACT_MARKER), 'w', encoding='utf-8') as f:
+        json.dump({'archive': _archive_signature(archive_path), 'members': members}, f, ensure_ascii=False)
+
+
+def _extract_tar_members(archive_path, temp_dir, existing_files=None):
+    """顺序读取 tar 流写出成员（已存在且大小一致的跳过），返回 {相对路径: 大小}"""
+    members = {}
+    for name, size, stream in iter_members(archive_path):
+        target = member_path(temp_dir, name)
+        if target is None:
+            continue
+        rel_path = os.path.relpath(target, temp_dir).replace('\\', '/')
+        members[rel_path] = size
+        if existing_files and existing_files.get(rel_path) == size:
+            continue
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, 'wb') as out:
+            shutil.copyfileobj(stream, out, 1024 * 1024)
+    return members
+
+
+def verify_extraction_complete(archive_path, temp_dir):
     """
-    验证ZIP文件是否已完整解压到临时目录
+    验证压缩包是否已完整解压到临时目录
+    
+    ZIP 按中央目录中的成员逐个检查；tar 流不读完整个包无法列出成员，按完整解压后写入的标记文件
+    （记录的成员列表和大小）逐个检查
     
     Returns:
         bool: True表示完整，False表示不完整或不存在
@@ -103,54 +141,75 @@ def verify_zip_extraction_complete(zip_path, temp_dir):
         return False
     
     try:
-        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            zip_files = set(zip_ref.namelist())
-            
-            # 检查所有文件是否存在
-            for zip_file in zip_files:
-                extract_path = os.path.join(temp_dir, zip_file)
-                if not os.path.exists(extract_path):
+        if archive_kind(archive_path) != 'zip':
+            with open(os.path.join(temp_dir, EXTRACT_MARKER), 'r', encoding='utf-8') as f:
+                marker = json.load(f)
+            if marker.get('archive') != _archive_signature(archive_path):
+                return False
+            for rel_path, size in marker['members'].items():
+                extract_path = os.path.join(temp_dir, rel_path)
+                if not os.path.exists(extract_path) or os.path.getsize(extract_path) != size:
                     return False
-            
             return True
+        
+        # 成员列表来自中央目录缓存，不再每次打开ZIP重建 namelist()
+        for zip_file in zip_directory(archive_path).names:
+            extract_path = os.path.join(temp_dir, zip_file)
+            if not os.path.exists(extract_path):
+                return False
+            
+        return True
+    except FileNotFoundError:
+        return False
     except Exception as e:
-        print(f"⚠ ZIP验证失败 {zip_path}: {str(e)}")
+        print(f"⚠ 压缩包验证失败 {archive_path}: {str(e)}")
         return False
 
 
-def smart_extract_zip(zip_path, temp_dir):
+def smart_extract_archive(archive_path, temp_dir):
     """
-    智能解压ZIP：如果临时目录已存在且完整，则跳过解压；否则补全或重新解压
+    智能解压压缩包（ZIP / tar / tar.gz / tar.zst）：如果临时目录已存在且完整，则跳过解压；否则补全或重新解压
     
     Returns:
         str: 'reused' 表示复用, 'extracted' 表示新解压, 'completed' 表示补全
     """
-    if verify_zip_extraction_complete(zip_path, temp_dir):
+    if verify_extraction_complete(archive_path, temp_dir):
         print(f"  ✓ 检测到完整的临时解压目录，直接复用")
         return 'reused'
     
+    is_zip_archive = archive_kind(archive_path) == 'zip'
     if os.path.exists(temp_dir):
         print(f"  ⚠ 临时目录不完整，补全缺失文件...")
-        # 获取已存在的文件列表
-        existing_files = set()
+        # 获取已存在的文件列表（相对路径 -> 大小）
+        existing_files = {}
         for root, dirs, files in os.walk(temp_dir):
             for f in files:
-                rel_path = os.path.relpath(os.path.join(root, f), temp_dir)
-                existing_files.add(rel_path.replace('\\', '/'))
+                file_path = os.path.join(root, f)
+                rel_path = os.path.relpath(file_path, temp_dir)
+                existing_files[rel_path.replace('\\', '/')] = os.path.getsize(file_path)
         
         # 只解压缺失的文件
-        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            for zip_file in zip_ref.namelist():
-                normalized = zip_file.replace('\\', '/')
-                if normalized not in existing_files:
-                    zip_ref.extract(zip_file, temp_dir)
+        if is_zip_archive:
+            with zip_directory(archive_path).open() as zip_ref:
+                for info in zip_ref.infolist():
+                    normalized = info.filename.replace('\\', '/')
+                    if normalized not in existing_files:
+                        zip_ref.extract(info, temp_dir)
+        else:
+            # tar 只能顺序读取：已存在且大小一致的成员跳过，其余（包括中断时写了一半的文件）重新写出
+            members = _extract_tar_members(archive_path, temp_dir, existing_files)
+            _write_extract_marker(archive_path, temp_dir, members)
         
         print(f"  ✓ 补全完成")
         return 'completed'
     else:
         print(f"  解压到临时目录: {temp_dir}")
-        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            zip_ref.extractall(temp_dir)
+        if is_zip_archive:
+            with zip_directory(archive_path).open() as zip_ref:
+                zip_ref.extractall(temp_dir)
+        else:
+            os.makedirs(temp_dir, exist_ok=True)
+            _write_extract_marker(archive_path, temp_dir, _extract_tar_members(archive_path, temp_dir))
         return 'extracted'
 
 
@@ -166,6 +225,9 @@ def deidentify_dicom(dicom_path, output_path, case_new_id):
     Returns:
         dict: 包含原始和脱敏后信息的字典，失败则返回None
     """
+    import pydicom
+    from pydicom.errors import InvalidDicomError
+    
     try:
         # 首先尝试常规读取
         try:
@@ -221,31 +283,112 @@ def deidentify_dicom(dicom_path, output_path, case_new_id):
         return None
 
 
-def find_dicom_files(root_dir):
+def compute_content_hash(file_path, chunk_size=1024 * 1024):
+    """
+    计算文件内容的快速哈希（优先使用xxhash，未安装时回退到blake2b）
+    
+    Returns:
+        str: 十六进制哈希值
+    """
+    if xxhash is not None:
+        hasher = xxhash.xxh3_128()
+    else:
+        hasher = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class InstanceDeduplicator:
+    """
+    实例级去重：以 SOPInstanceUID + 文件内容哈希 判定重复实例
+    
+    同一检查被重复导出（重新导出、ZIP与文件夹各一份）时，跳过已见过的实例。
+    只有当SOPInstanceUID发生碰撞（或缺失）时才计算内容哈希，
+    因此正常情况下不会对每个文件做额外的全量读取。
+    UID相同但内容不同的文件不视为重复（仅计数提醒）。
+    """
+    
+    def __init__(self):
+        self._first_file = {}            # SOPInstanceUID -> 首个文件路径（哈希延迟计算）
+        self._hashes = defaultdict(set)  # SOPInstanceUID -> 已见过的内容哈希
+        self.duplicate_files = 0
+        self.duplicate_bytes = 0
+        self.uid_conflicts = 0
+    
+    def is_duplicate(self, file_path, sop_uid):
+        """判断文件是否为已见过的实例，不是则登记"""
+        if sop_uid:
+            first_file = self._first_file.get(sop_uid)
+            if first_file is None:
+                self._first_file[sop_uid] = file_path
+                return False
+            seen_hashes = self._hashes[sop_uid]
+            if not seen_hashes:
+                seen_hashes.add(compute_content_hash(first_file))
+        else:
+            # 没有UID时只能依赖内容哈希
+            seen_hashes = self._hashes[None]
+        
+        digest = compute_content_hash(file_path)
+        if digest in seen_hashes:
+            self.duplicate_files += 1
+            self.duplicate_bytes += os.path.getsize(file_path)
+            return True
+        
+        if sop_uid:
+            self.uid_conflicts += 1
+        seen_hashes.add(digest)
+        return False
+    
+    def print_summary(self):
+        """打印去重节省的文件数和字节数"""
+        if self.duplicate_files:
+            print(f"\n去重: 跳过 {self.duplicate_files} 个重复实例，"
+                  f"节省 {self.duplicate_bytes / (1024 * 1024):.1f} MB")
+        else:
+            print("\n去重: 未发现重复实例")
+        if self.uid_conflicts:
+            print(f"  ⚠ {self.uid_conflicts} 个文件的SOPInstanceUID重复但内容不同，已保留")
+
+
+def find_dicom_files(root_dir, sop_uids=None, progress=None):
     """
     递归查找所有DICOM文件
     
+    Args:
+        root_dir: 要扫描的目录
+        sop_uids: 可选字典，传入时记录 {文件路径: SOPInstanceUID} 供去重使用
+        progress: 可选 Progress，传入时按文件计数并输出扫描速度（替代每100个文件的计数）
+    
     Returns:
         dict: {case_label: [dicom_file_paths]}
     """
+    import pydicom
+    
     case_files = defaultdict(list)
     file_count = 0
     
-    for root, dirs, files in os.walk(root_dir):
-        for file in files:
-            file_path = os.path.join(root, file)
-            file_count += 1
-            if file_count % 100 == 0:
-                print(f"  已扫描 {file_count} 个文件...", end='\r')
-            try:
-                ds = pydicom.dcmread(file_path, stop_before_pixels=True)
-                case_label = str(getattr(ds, 'PatientID', 'Unknown'))
-                case_files[case_label].append(file_path)
-            except Exception as e:
-                # 静默跳过非DICOM文件（在这里打印会产生大量输出）
-                continue
+    # 并行遍历并嗅探文件头（只接受带 DICM 标识的标准文件，与不加 force 的 dcmread 一致），
+    # 非DICOM文件不再交给pydicom解析
+    for file_path in walk_paths(root_dir, sniff=True, allow_raw=False):
+        file_count += 1
+        if progress is not None:
+            progress.tick(files=1)
+        elif file_count % 100 == 0:
+            print(f"  已扫描 {file_count} 个文件...", end='\r')
+        try:
+            ds = pydicom.dcmread(file_path, stop_before_pixels=True)
+            case_label = str(getattr(ds, 'PatientID', 'Unknown'))
+            case_files[case_label].append(file_path)
+            if sop_uids is not None:
+                sop_uids[file_path] = str(getattr(ds, 'SOPInstanceUID', '') or '')
+        except Exception as e:
+            # 静默跳过无法解析的文件（在这里打印会产生大量输出）
+            continue
     
-    print(f"  已扫描 {file_count} 个文件，找到 {len(case_files)} 个病例")
+    print(f"  已扫描 {file_count} 个DICOM文件，找到 {len(case_files)} 个病例")
     return case_files
 
 
@@ -260,10 +403,15 @@ def has_dicom_files(directory, max_depth=3):
     Returns:
         bool: 是否包含DICOM文件
     """
+    import pydicom
+    
     check_count = 0
     for root, dirs, files in os.walk(directory):
         for file in files[:5]:  # 只检查前5个文件
             file_path = os.path.join(root, file)
+            # 先嗅探文件头，明显不是DICOM的文件不调用pydicom
+            if not sniff_dicom(file_path, allow_raw=False):
+                continue
             try:
                 pydicom.dcmread(file_path, stop_before_pixels=True)
                 return True
@@ -278,45 +426,45 @@ def has_dicom_files(directory, max_depth=3):
 
 def collect_batch_inputs(parent_dir):
     """
-    收集父目录下所有需要处理的输入项（ZIP文件和DICOM文件夹）
-    智能识别：跳过ZIP解压生成的临时目录
-    - 跳过 temp_extract（单ZIP模式）
-    - 跳过 temp_extract_xxx（批量模式，xxx为ZIP文件名）
+    收集父目录下所有需要处理的输入项（压缩包和DICOM文件夹）
+    智能识别：跳过压缩包解压生成的临时目录
+    - 跳过 temp_extract（单压缩包模式）
+    - 跳过 temp_extract_xxx（批量模式，xxx为压缩包去掉扩展名的文件名）
     
     Returns:
         list: [(input_path, input_type, source_name), ...]
-              input_type: 'zip' 或 'folder'
+              input_type: 'archive' 或 'folder'
     """
     inputs = []
     zip_files = []
     folders = []
     
-    # 第一遍：收集所有ZIP文件和文件夹
+    # 第一遍：收集所有压缩包（ZIP / tar / tar.gz / tar.zst）和文件夹
     for item in os.listdir(parent_dir):
         item_path = os.path.join(parent_dir, item)
         
-        if os.path.isfile(item_path) and zipfile.is_zipfile(item_path):
+        if is_archive(item_path):
             zip_files.append((item_path, item))
         elif os.path.isdir(item_path):
             # 跳过明显的输出目录
             if item not in ['output_deid', '__pycache__', '.git']:
                 folders.append((item_path, item))
     
-    # 收集所有ZIP文件对应的临时解压目录名
-    # 格式: temp_extract_<zip文件名去掉扩展名>
+    # 收集所有压缩包对应的临时解压目录名
+    # 格式: temp_extract_<压缩包文件名去掉扩展名>
     temp_extract_folders = set()
     for zip_path, zip_name in zip_files:
-        # 去除.zip扩展名
-        base_name = os.path.splitext(zip_name)[0]
+        # 去除 .zip / .tar.gz 等扩展名
+        base_name = archive_stem(zip_name)
         # 生成对应的临时目录名（与 process_batch_inputs 中的逻辑一致）
         temp_folder_name = f"temp_extract_{base_name}"
         temp_extract_folders.add(temp_folder_name)
-        # 添加ZIP到输入列表
-        inputs.append((zip_path, 'zip', zip_name))
+        # 添加压缩包到输入列表
+        inputs.append((zip_path, 'archive', zip_name))
     
     # 第二遍：添加文件夹，但排除临时解压目录
     for folder_path, folder_name in folders:
-        # 跳过 temp_extract 开头的文件夹（ZIP解压目录）
+        # 跳过 temp_extract 开头的文件夹（压缩包解压目录）
         if folder_name == 'temp_extract' or folder_name in temp_extract_folders:
             print(f"  跳过临时解压目录 '{folder_name}'")
         else:
@@ -325,22 +473,22 @@ def collect_batch_inputs(parent_dir):
     return inputs
 
 
-def process_single_input(input_path, output_base):
+def process_single_input(input_path, output_base, progress=None):
     """
-    处理单个输入（ZIP文件或文件夹）
+    处理单个输入（压缩包或文件夹）
     
     Returns:
         tuple: (case_files, temp_dir)
     """
     temp_dir = None
     
-    # 处理ZIP文件
-    if zipfile.is_zipfile(input_path):
-        print(f"检测到ZIP文件: {input_path}")
+    # 处理压缩包
+    if is_archive(input_path):
+        print(f"检测到压缩包: {input_path}")
         temp_dir = os.path.join(os.path.dirname(input_path), "temp_extract")
         
         # 智能解压（复用已有临时目录）
-        extract_status = smart_extract_zip(input_path, temp_dir)
+        extract_status = smart_extract_archive(input_path, temp_dir)
         
         work_dir = temp_dir
     else:
@@ -350,15 +498,19 @@ def process_single_input(input_path, output_base):
     
     # 查找所有DICOM文件并按case分组
     print("扫描DICOM文件...")
-    case_files = find_dicom_files(work_dir)
+    case_files = find_dicom_files(work_dir, progress=progress)
     
     return case_files, temp_dir
 
 
-def process_batch_inputs(parent_dir, output_base):
+def process_batch_inputs(parent_dir, output_base, dedup=True, progress=None):
     """
     批量处理父目录下的所有输入项
     
+    Args:
+        dedup: 是否跨输入项去除重复实例（SOPInstanceUID + 内容哈希）
+        progress: 可选 Progress，扫描DICOM文件时计数
+    
     Returns:
         tuple: (all_case_files, temp_dirs)
     """
@@ -375,6 +527,7 @@ def process_batch_inputs(parent_dir, output_base):
     # 全局case汇总
     all_case_files = defaultdict(list)
     temp_dirs = []
+    deduplicator = InstanceDeduplicator() if dedup else None
     
     # 处理每个输入项
     for input_path, input_type, source_name in inputs:
@@ -383,12 +536,12 @@ def process_batch_inputs(parent_dir, output_base):
         print('='*60)
         
         # 确定工作目录
-        if input_type == 'zip':
-            temp_dir = os.path.join(parent_dir, f"temp_extract_{Path(source_name).stem}")
+        if input_type == 'archive':
+            temp_dir = os.path.join(parent_dir, f"temp_extract_{archive_stem(source_name)}")
             temp_dirs.append(temp_dir)
             
             # 智能解压（复用已有临时目录）
-            extract_status = smart_extract_zip(input_path, temp_dir)
+            extract_status = smart_extract_archive(input_path, temp_dir)
             
             work_dir = temp_dir
         else:
@@ -396,7 +549,8 @@ def process_batch_inputs(parent_dir, output_base):
         
         # 查找DICOM文件
         print("扫描DICOM文件...")
-        case_files = find_dicom_files(work_dir)
+        sop_uids = {} if deduplicator else None
+        case_files = find_dicom_files(work_dir, sop_uids, progress)
         
         if not case_files:
             print(f"⚠ 未找到有效的DICOM文件，跳过")
@@ -406,10 +560,19 @@ def process_batch_inputs(parent_dir, output_base):
         
         # 合并到全局case列表（添加来源标识避免冲突）
         for case_label, files in case_files.items():
+            if deduplicator:
+                # 在任何写入之前剔除已在其他输入项中出现过的实例
+                files = [f for f in files if not deduplicator.is_duplicate(f, sop_uids.get(f))]
+                if not files:
+                    print(f"  ⏩ case {case_label} 的所有实例均已在其他输入项中出现，跳过")
+                    continue
             # 使用来源名称作为前缀避免不同输入源的case冲突
             global_case_label = f"{source_name}_{case_label}"
             all_case_files[global_case_label].extend(files)
     
+    if deduplicator:
+        deduplicator.print_summary()
+    
     return all_case_files, temp_dirs
 
 
@@ -418,13 +581,13 @@ def determine_input_mode(input_path):
     判断输入模式（快速模式，不深度扫描）
     
     Returns:
-        str: 'single_zip', 'single_folder', 'batch', 或 'unknown'
+        str: 'single_archive', 'single_folder', 'batch', 或 'unknown'
     """
-    if os.path.isfile(input_path) and zipfile.is_zipfile(input_path):
-        return 'single_zip'
+    if is_archive(input_path):
+        return 'single_archive'
     
     if os.path.isdir(input_path):
-        # 先检查是否为批量模式（包含ZIP文件或子文件夹）
+        # 先检查是否为批量模式（包含压缩包或子文件夹）
         batch_inputs = collect_batch_inputs(input_path)
         if batch_inputs:
             return 'batch'
@@ -436,25 +599,189 @@ def determine_input_mode(input_path):
     return 'unknown'
 
 
+def deidentify_case(case_label, dicom_files, case_new_id, output_base):
+    """
+    脱敏一个case的全部DICOM文件到 output_base 下的case专属目录
+    
+    Returns:
+        tuple: (summary行字典或None, 该case的错误列表)
+    """
+    import pydicom
+    
+    # 从第一个DICOM文件中提取患者姓名用于文件夹命名
+    patient_name = "Unknown"
+    try:
+        ds = pydicom.dcmread(dicom_files[0], stop_before_pixels=True)
+        patient_name = str(getattr(ds, 'PatientName', 'Unknown'))
+    except Exception:
+        patient_name = "Unknown"
+    
+    print(f"\n处理 {case_label} -> {case_new_id} ({len(dicom_files)} 个文件)")
+    
+    # 创建case专属输出目录 - 使用PatientID、患者姓名和文件数量作为文件夹名
+    file_count = len(dicom_files)
+    safe_case_name = sanitize_case_label(f"{case_new_id}_{patient_name}_{file_count}")
+    case_output_dir = os.path.join(output_base, safe_case_name)
+    os.makedirs(case_output_dir, exist_ok=True)
+    
+    # 用于存储该case的临床信息
+    case_clinical_info = None
+    case_errors = []  # 收集该case的错误
+    
+    for dicom_file in dicom_files:
+        filename = os.path.basename(dicom_file)
+        output_path = os.path.join(case_output_dir, filename)
+        
+        info = deidentify_dicom(dicom_file, output_path, case_new_id)
+        
+        if info and not case_clinical_info:
+            case_clinical_info = info
+        if not info:
+            # 记录并提醒：该文件不是标准DICOM或读取失败，已跳过
+            error_msg = f"跳过文件(非DICOM或读取失败): {filename}"
+            print(f"  ⚠ {error_msg}")
+            case_errors.append(error_msg)
+    
+    # 生成summary行
+    summary_row = None
+    if case_clinical_info:
+        summary_row = {
+            'Case': case_label,
+            'NewPatientID': case_new_id,
+            'OriginalPatientName': case_clinical_info['OriginalPatientName'],
+            'OriginalPatientID': case_clinical_info['OriginalPatientID'],
+            'PatientBirthDate': case_clinical_info['PatientBirthDate'],
+            'PatientAge': case_clinical_info['PatientAge'],
+            'PatientSex': case_clinical_info['PatientSex'],
+            'StudyDate': case_clinical_info['StudyDate'],
+            'FileCount': len(dicom_files)
+        }
+    else:
+        # case完全失败
+        error_msg = f"Case完全失败，没有任何有效DICOM文件"
+        print(f"  ✗ {error_msg}")
+        case_errors.append(error_msg)
+    
+    return summary_row, case_errors
+
+
+def collect_cases(input_path, input_mode, output_base, args):
+    """
+    扫描输入（必要时解压压缩包），按case分组DICOM文件
+    
+    Returns:
+        tuple: (case_files, temp_dirs)，没有找到DICOM文件时 case_files 为空
+    """
+    temp_dirs = []
+    # 扫描阶段只知道文件数，单独计数
+    scan_progress = progress_from_args(args, label='文件')
+    
+    if input_mode in ['single_archive', 'single_folder']:
+        print(f"\n{'='*60}")
+        print("单输入模式")
+        print('='*60)
+        case_files, temp_dir = process_single_input(input_path, output_base, scan_progress)
+        scan_progress.close()
+        if temp_dir:
+            temp_dirs.append(temp_dir)
+        
+        if not case_files:
+            print("未找到有效的DICOM文件")
+            return {}, temp_dirs
+        
+        print(f"找到 {len(case_files)} 个case")
+    
+    else:  # batch
+        print(f"\n{'='*60}")
+        print("批量处理模式")
+        print('='*60)
+        case_files, temp_dirs = process_batch_inputs(input_path, output_base, dedup=not args.no_dedup,
+                                                     progress=scan_progress)
+        scan_progress.close()
+        
+        if not case_files:
+            print("未找到任何有效的DICOM文件")
+            return {}, temp_dirs
+        
+        print(f"\n{'='*60}")
+        print(f"汇总: 共 {len(case_files)} 个case待处理")
+        print('='*60)
+    return case_files, temp_dirs
+
+
+def queue_deidentify(queue, output_base, args):
+    """
+    分布式脱敏（--queue）：从共享队列领取case逐个脱敏，结果写入本worker的报告分片
+    
+    新ID在生成任务时按全部case统一分配，各worker领取的任务带着新ID和文件列表。
+    全部case完成后，最后完成的worker合并各分片，返回 (case_summary, processing_errors, temp_dirs, case数)；
+    其他worker返回None（汇总和临时目录清理由最后完成的worker负责）。
+    """
+    batch = queue.batch()
+    pending, running = queue.remaining()
+    print(f"\n批次: {batch['total']} 个case（任务由 {batch['seeded_by']} 生成），待领取 {pending}, 处理中 {running}")
+    profiler = CaseProfiler(args.profile, profile_dir(output_base, f"{datetime.now():%Y%m%d_%H%M%S}_{queue.worker_id}"))
+    # 每个worker只处理整批的一部分，只输出本机的吞吐
+    progress = progress_from_args(args)
+    try:
+        for task in queue.tasks():
+            case_label = task.name
+            dicom_files = task.data['files']
+            print(f"\n📥 领取: {case_label} (第 {task.attempt} 次)")
+            with profiler.case(case_label):
+                summary_row, case_errors = deidentify_case(case_label, dicom_files, task.data['new_id'], output_base)
+            queue.complete(task, {**task.data['label'], 'success': summary_row is not None, 'summary': summary_row,
+                                  'errors': case_errors, 'processing_time': datetime.now().isoformat()})
+            progress.case_done(case_label, summary_row is not None, files=len(dicom_files),
+                               nbytes=sum(os.path.getsize(f) for f in dicom_files if os.path.exists(f)))
+    finally:
+        queue.close()
+        progress.close()
+        profiler.close()
+    print(f"\n本worker完成 {queue.completed} 个case，回收过期租约 {queue.reclaimed} 个")
+    print(f"报告分片: {queue.shard_path}")
+    
+    records = queue.finalize()
+    if records is None:
+        print("其他worker仍在处理或已生成汇总，本worker退出")
+        return None
+    print(f"\n所有case已完成，合并 {len(queue.workers())} 个worker的报告分片...")
+    case_summary = [r['summary'] for r in records if r.get('summary')]
+    processing_errors = []
+    for r in records:
+        # 多次失去租约而放弃的case没有逐文件的错误，只有 error
+        errors = r.get('errors') or ([] if r['success'] else [f"Case完全失败: {r.get('error')}"])
+        if errors:
+            processing_errors.append({'case': r['case'], 'new_id': r['new_id'], 'total_files': r['total_files'],
+                                      'errors': errors})
+    return case_summary, processing_errors, batch.get('temp_dirs', []), len(records)
+
+
 def parse_args():
     """解析命令行参数"""
     import argparse
     
     parser = argparse.ArgumentParser(
-        description='DICOM脱敏工具 - 支持ZIP文件、文件夹和批量处理',
+        description='DICOM脱敏工具 - 支持压缩包（ZIP/tar）、文件夹和批量处理',
         formatter_class=argparse.RawDescriptionHelpFormatter,
         epilog='''
 示例:
   python dicom_deidentify_universal.py                    # GUI模式
   python dicom_deidentify_universal.py /path/to/data      # 命令行模式
   python dicom_deidentify_universal.py /path/to/data --id-prefix PATIENT --id-start 100
+  python dicom_deidentify_universal.py /path/to/data --profile cpu   # 按case剖析
         '''
     )
     
-    parser.add_argument('input_path', nargs='?', help='输入路径（ZIP文件、文件夹或父目录）')
+    parser.add_argument('input_path', nargs='?', help='输入路径（压缩包、文件夹或父目录）')
     parser.add_argument('--id-prefix', default='ANON', help='PatientID前缀（默认: ANON）')
     parser.add_argument('--id-start', type=int, default=1, help='起始编号（默认: 1）')
     parser.add_argument('--id-digits', type=int, default=5, help='编号位数（默认: 5位，如00001）')
+    parser.add_argument('--no-dedup', action='store_true',
+                        help='批量模式下不去除重复实例（默认按 SOPInstanceUID + 内容哈希 去重）')
+    add_profile_argument(parser)
+    add_progress_arguments(parser)
+    add_queue_arguments(parser)
     
     return parser.parse_args()
 
@@ -463,6 +790,13 @@ def main():
     # 解析命令行参数
     args = parse_args()
     
+    try:
+        import pydicom  # noqa: F401
+    except ImportError:
+        print("错误: 未安装pydicom库")
+        print("请运行: pip install pydicom")
+        sys.exit(1)
+    
     # 确定输入路径
     if args.input_path:
         input_path = args.input_path
@@ -473,12 +807,12 @@ def main():
             from tkinter import filedialog, simpledialog, messagebox
             root = tk.Tk()
             root.withdraw()
-            input_path = filedialog.askdirectory(title="选择DICOM文件夹或包含ZIP/文件夹的父目录")
+            input_path = filedialog.askdirectory(title="选择DICOM文件夹或包含压缩包/文件夹的父目录")
             if not input_path:
                 # 如果没有选择文件夹，尝试选择文件
                 input_path = filedialog.askopenfilename(
-                    title="或选择ZIP文件",
-                    filetypes=[("ZIP文件", "*.zip"), ("所有文件", "*.*")]
+                    title="或选择压缩包",
+                    filetypes=[("压缩包", "*.zip *.tar *.tar.gz *.tgz *.tar.zst *.tzst"), ("所有文件", "*.*")]
                 )
             
             # GUI模式下询问是否自定义编号
@@ -521,17 +855,23 @@ def main():
     print(f"  格式示例: {args.id_prefix}_{args.id_start:0{args.id_digits}d}")
     print('='*60)
     
+    # ZIP中央目录缓存放在输出目录下（与下面确定的 output_deid 位置一致），下次运行复用
+    input_root = os.path.abspath(input_path)
+    if os.path.isfile(input_root):
+        input_root = os.path.dirname(input_root)
+    configure_zip_cache(os.path.join(input_root, "output_deid", ZIP_INDEX_DIR_NAME))
+    
     # 判断输入模式
     input_mode = determine_input_mode(input_path)
     print(f"检测到输入模式: {input_mode}")
     
     if input_mode == 'unknown':
-        print("错误: 无法识别输入类型（未找到DICOM文件或ZIP文件）")
+        print("错误: 无法识别输入类型（未找到DICOM文件或压缩包）")
         sys.exit(1)
     
     # 确定输出目录
-    if input_mode == 'single_zip':
-        # ZIP所在目录下创建 output_deid
+    if input_mode == 'single_archive':
+        # 压缩包所在目录下创建 output_deid
         output_base = os.path.join(os.path.dirname(os.path.abspath(input_path)), "output_deid")
     elif input_mode == 'single_folder':
         # 在输入文件夹内创建 output_deid，便于查看输出
@@ -541,118 +881,81 @@ def main():
     
     os.makedirs(output_base, exist_ok=True)
     
-    # 根据模式处理
+    # 分布式队列（--queue）：第一个worker扫描输入、统一分配新ID并生成任务，各worker领取case脱敏
+    queue = queue_from_args(args, output_base)
+    if queue is not None:
+        queue.start()
+        print(f"\n🔗 分布式队列: {queue.root}")
+        print(f"   worker: {queue.worker_id}, 租约超时: {queue.lease_timeout:.0f}s, 心跳: {queue.heartbeat:.0f}s")
+    
     temp_dirs = []
+    if queue is None or queue.acquire_seed():
+        case_files, temp_dirs = collect_cases(input_path, input_mode, output_base, args)
     
-    if input_mode in ['single_zip', 'single_folder']:
-        print(f"\n{'='*60}")
-        print("单输入模式")
-        print('='*60)
-        case_files, temp_dir = process_single_input(input_path, output_base)
-        if temp_dir:
-            temp_dirs.append(temp_dir)
+        # 为每个case分配统一的新ID（使用自定义前缀和起始编号）
+        case_new_id_map = {}
+        for idx, case_label in enumerate(sorted(case_files.keys()), start=0):
+            case_number = args.id_start + idx
+            case_new_id_map[case_label] = f"{args.id_prefix}_{case_number:0{args.id_digits}d}"
+        
+        if queue is not None:
+            # 任务带上新ID和文件列表（临时解压目录在输入目录下，各worker都能访问）
+            tasks = [{'name': case_label, 'new_id': case_new_id_map[case_label], 'files': case_files[case_label],
+                      'label': {'case': case_label, 'new_id': case_new_id_map[case_label],
+                                'total_files': len(case_files[case_label])}}
+                     for case_label in sorted(case_files)]
+            if queue.seed(tasks, input_path=os.path.abspath(input_path), temp_dirs=temp_dirs):
+                print(f"✓ 已生成 {len(tasks)} 个任务")
         
         if not case_files:
-            print("未找到有效的DICOM文件")
+            if queue is not None:
+                queue.close()
             for td in temp_dirs:
                 remove_tree(td)
             sys.exit(1)
         
-        print(f"找到 {len(case_files)} 个case")
+    if queue is not None:
+        merged = queue_deidentify(queue, output_base, args)
+        if merged is None:
+            return
+        case_summary, processing_errors, temp_dirs, case_count = merged
+    else:
+        # 处理每个case
+        case_summary = []
+        processing_errors = []  # 收集处理错误
+        profiler = CaseProfiler(args.profile, profile_dir(output_base, datetime.now().strftime('%Y%m%d_%H%M%S')))
+        case_bytes = {case_label: sum(os.path.getsize(f) for f in dicom_files)
+                      for case_label, dicom_files in case_files.items()}
+        progress = progress_from_args(args, total=len(case_files), total_bytes=sum(case_bytes.values()))
         
-    else:  # batch
-        print(f"\n{'='*60}")
-        print("批量处理模式")
-        print('='*60)
-        case_files, temp_dirs = process_batch_inputs(input_path, output_base)
+        for case_label, dicom_files in case_files.items():
+            case_new_id = case_new_id_map[case_label]
         
-        if not case_files:
-            print("未找到任何有效的DICOM文件")
-            for td in temp_dirs:
-                remove_tree(td)
-            sys.exit(1)
+            with profiler.case(case_label):
+                summary_row, case_errors = deidentify_case(case_label, dicom_files, case_new_id, output_base)
         
-        print(f"\n{'='*60}")
-        print(f"汇总: 共 {len(case_files)} 个case待处理")
-        print('='*60)
+            if summary_row:
+                case_summary.append(summary_row)
     
-    # 为每个case分配统一的新ID（使用自定义前缀和起始编号）
-    case_new_id_map = {}
-    for idx, case_label in enumerate(sorted(case_files.keys()), start=0):
-        case_number = args.id_start + idx
-        case_new_id_map[case_label] = f"{args.id_prefix}_{case_number:0{args.id_digits}d}"
+            # 如果该case有错误，记录到全局错误列表
+            if case_errors:
+                processing_errors.append({
+                    'case': case_label,
+                    'new_id': case_new_id,
+                    'total_files': len(dicom_files),
+                    'errors': case_errors
+                })
     
-    # 处理每个case
-    case_summary = []
-    processing_errors = []  # 收集处理错误
+            progress.case_done(case_label, summary_row is not None, files=len(dicom_files),
+                               nbytes=case_bytes[case_label])
     
-    for case_label, dicom_files in case_files.items():
-        case_new_id = case_new_id_map[case_label]
-        
-        # 从第一个DICOM文件中提取患者姓名用于文件夹命名
-        patient_name = "Unknown"
-        try:
-            ds = pydicom.dcmread(dicom_files[0], stop_before_pixels=True)
-            patient_name = str(getattr(ds, 'PatientName', 'Unknown'))
-        except Exception:
-            patient_name = "Unknown"
-        
-        print(f"\n处理 {case_label} -> {case_new_id} ({len(dicom_files)} 个文件)")
-        
-        # 创建case专属输出目录 - 使用PatientID、患者姓名和文件数量作为文件夹名
-        file_count = len(dicom_files)
-        safe_case_name = sanitize_case_label(f"{case_new_id}_{patient_name}_{file_count}")
-        case_output_dir = os.path.join(output_base, safe_case_name)
-        os.makedirs(case_output_dir, exist_ok=True)
-        
-        # 用于存储该case的临床信息
-        case_clinical_info = None
-        case_errors = []  # 收集该case的错误
-        
-        for dicom_file in dicom_files:
-            filename = os.path.basename(dicom_file)
-            output_path = os.path.join(case_output_dir, filename)
-            
-            info = deidentify_dicom(dicom_file, output_path, case_new_id)
-            
-            if info and not case_clinical_info:
-                case_clinical_info = info
-            if not info:
-                # 记录并提醒：该文件不是标准DICOM或读取失败，已跳过
-                error_msg = f"跳过文件(非DICOM或读取失败): {filename}"
-                print(f"  ⚠ {error_msg}")
-                case_errors.append(error_msg)
-        
-        # 添加到summary
-        if case_clinical_info:
-            case_summary.append({
-                'Case': case_label,
-                'NewPatientID': case_new_id,
-                'OriginalPatientName': case_clinical_info['OriginalPatientName'],
-                'OriginalPatientID': case_clinical_info['OriginalPatientID'],
-                'PatientBirthDate': case_clinical_info['PatientBirthDate'],
-                'PatientAge': case_clinical_info['PatientAge'],
-                'PatientSex': case_clinical_info['PatientSex'],
-                'StudyDate': case_clinical_info['StudyDate'],
-                'FileCount': len(dicom_files)
-            })
-        else:
-            # case完全失败
-            error_msg = f"Case完全失败，没有任何有效DICOM文件"
-            print(f"  ✗ {error_msg}")
-            case_errors.append(error_msg)
-        
-        # 如果该case有错误，记录到全局错误列表
-        if case_errors:
-            processing_errors.append({
-                'case': case_label,
-                'new_id': case_new_id,
-                'total_files': len(dicom_files),
-                'errors': case_errors
-            })
+        progress.close()
+        profiler.close()
+        case_count = len(case_files)
     
     # 生成汇总CSV
     if case_summary:
+        import pandas as pd  # 只在生成汇总CSV时需要，避免拖慢启动
         summary_csv = os.path.join(output_base, "dicom_deid_summary.csv")
         df = pd.DataFrame(case_summary)
         df.to_csv(summary_csv, index=False, encoding='utf-8-sig')
@@ -660,7 +963,7 @@ def main():
     
     print(f"\n✓ 所有文件已脱敏完成")
     print(f"  输出目录: {output_base}")
-    print(f"  处理了 {len(case_files)} 个case")
+    print(f"  处理了 {case_count} 个case")
     
     # 错误汇总
     if processing_errors:
@@ -1,26 +1,24 @@
 #!/usr/bin/env python3
 """
 DICOM元数据快速提取脚本（优化版）
-直接从ZIP中读取DICOM文件，无需完全解压，大幅提升速度
-支持GUI选择目录或命令行参数
+直接从ZIP / tar / tar.gz / tar.zst 压缩包中读取DICOM文件，无需完全解压，大幅提升速度
+支持GUI选择目录或命令行参数（--profile cpu|mem 可按case剖析）
 """
 
 import os
 import sys
-import zipfile
 import io
-import pydicom
-import pandas as pd
 from pathlib import Path
 import json
 from datetime import datetime
+import argparse
 import traceback
 
-try:
-    import tkinter as tk
-    from tkinter import filedialog, messagebox
-except Exception:
-    tk = None
+from dcmnii.profiling import CaseProfiler, add_profile_argument, profile_dir
+from dcmnii.progress import add_progress_arguments, progress_from_args
+from dcmnii.walk import iter_files
+from dcmnii.zipindex import ZIP_INDEX_DIR_NAME, configure_zip_cache
+from dcmnii.archive import archive_stem, find_archives, iter_members
 
 def convert_dicom_value(value):
     """转换DICOM值为JSON可序列化的格式"""
@@ -83,57 +81,54 @@ def extract_dicom_metadata(dcm_dataset):
 
 def process_zip_file_fast(zip_path):
     """
-    快速处理ZIP文件：直接从ZIP中读取DICOM，不解压到磁盘
+    快速处理压缩包（ZIP / tar / tar.gz / tar.zst）：直接从包中读取DICOM，不解压到磁盘
+    
+    tar 系列按流顺序读取，找到足够的元数据后即停止，不必读完整个包
     """
-    zip_name = Path(zip_path).stem
+    import pydicom
+    zip_name = archive_stem(zip_path)
     print(f"[{datetime.now().strftime('%H:%M:%S')}] Processing {zip_name}...", end=' ')
     
     try:
         dicom_count = 0
         metadata = None
         
-        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            # 遍历ZIP中的所有文件
-            for file_info in zip_ref.infolist():
-                # 跳过目录
-                if file_info.is_dir():
-                    continue
+        # 遍历压缩包中的所有文件（目录已跳过）
+        for member_name, _, member_stream in iter_members(zip_path):
+            # 跳过明显不是DICOM的文件（根据扩展名）
+            filename = member_name.lower()
+            if filename.endswith(('.txt', '.xml', '.json', '.jpg', '.png', '.pdf')):
+                continue
                 
-                # 跳过明显不是DICOM的文件（根据扩展名）
-                filename = file_info.filename.lower()
-                if filename.endswith(('.txt', '.xml', '.json', '.jpg', '.png', '.pdf')):
-                    continue
+            try:
+                # 直接从压缩包中读取文件到内存
+                file_bytes = member_stream.read()
                 
-                try:
-                    # 直接从ZIP中读取文件到内存
-                    with zip_ref.open(file_info) as file:
-                        file_bytes = file.read()
-
-                    # 尝试作为DICOM文件读取
-                    dcm = pydicom.dcmread(io.BytesIO(file_bytes), force=True)
-                    dicom_count += 1
-
-                    # 尝试提取元数据并检查是否有意义
-                    candidate = extract_dicom_metadata(dcm)
-                    if candidate:
-                        candidate['ZipFileName'] = zip_name
-                        # 如果这个candidate包含有意义字段，则接受并停止
-                        if is_metadata_meaningful(candidate):
-                            metadata = candidate
-                            break
-                        # 否则，如果还没有metadata，则暂存（如果后面没有更好内容就用它）
-                        if metadata is None:
-                            metadata = candidate
+                # 尝试作为DICOM文件读取
+                dcm = pydicom.dcmread(io.BytesIO(file_bytes), force=True)
+                dicom_count += 1
 
-                    # 为了性能，我们最多检查前N个文件
-                    # 如果ZIP里非常大，避免遍历全部文件
-                    MAX_CHECK = 50
-                    if dicom_count >= MAX_CHECK and metadata:
+                # 尝试提取元数据并检查是否有意义
+                candidate = extract_dicom_metadata(dcm)
+                if candidate:
+                    candidate['ZipFileName'] = zip_name
+                    # 如果这个candidate包含有意义字段，则接受并停止
+                    if is_metadata_meaningful(candidate):
+                        metadata = candidate
                         break
+                    # 否则，如果还没有metadata，则暂存（如果后面没有更好内容就用它）
+                    if metadata is None:
+                        metadata = candidate
+
+                # 为了性能，我们最多检查前N个文件
+                # 如果压缩包非常大，避免遍历全部文件
+                MAX_CHECK = 50
+                if dicom_count >= MAX_CHECK and metadata:
+                    break
 
-                except Exception:
-                    # 不是有效的DICOM文件，跳过
-                    continue
+            except Exception:
+                # 不是有效的DICOM文件，跳过
+                continue
         
         if metadata:
             metadata['DicomFileCount'] = dicom_count
@@ -152,6 +147,7 @@ def process_directory(dir_path):
     """
     处理已解压的DICOM目录
     """
+    import pydicom
     dir_name = Path(dir_path).name
     print(f"[{datetime.now().strftime('%H:%M:%S')}] Processing {dir_name}...", end=' ')
     
@@ -159,19 +155,12 @@ def process_directory(dir_path):
         dicom_count = 0
         metadata = None
         
-        # 遍历目录中的所有文件
-        for file_path in Path(dir_path).rglob('*'):
-            if not file_path.is_file():
-                continue
-            
-            # 跳过明显不是DICOM的文件
-            filename = file_path.name.lower()
-            if filename.endswith(('.txt', '.xml', '.json', '.jpg', '.png', '.pdf')):
-                continue
-            
+        # 并行遍历目录，先嗅探文件头跳过非DICOM文件；找到有意义的元数据后提前结束遍历
+        for directory, name, _ in iter_files(dir_path, sniff=True):
+            file_path = os.path.join(directory, name)
             try:
                 # 读取DICOM文件
-                dcm = pydicom.dcmread(str(file_path), force=True)
+                dcm = pydicom.dcmread(file_path, force=True)
                 dicom_count += 1
 
                 candidate = extract_dicom_metadata(dcm)
@@ -206,21 +195,44 @@ def process_directory(dir_path):
         return None
 
 def choose_directory_via_gui():
-    """通过GUI选择目录"""
-    if tk is None:
-        print("tkinter is not available in this environment")
+    """通过GUI选择目录（tkinter只在这里导入）"""
+    try:
+        import tkinter as tk
+        from tkinter import filedialog
+        root = tk.Tk()
+    except Exception as e:
+        print(f"tkinter is not available in this environment: {e}")
         return None
-    root = tk.Tk()
     root.withdraw()
     selected = filedialog.askdirectory(title="请选择包含ZIP病例的主目录")
     root.destroy()
     return selected
 
+def show_message(kind, title, message):
+    """GUI模式下弹出提示框（kind: showinfo / showwarning / showerror），没有图形界面时忽略"""
+    try:
+        from tkinter import messagebox
+        getattr(messagebox, kind)(title, message)
+    except Exception:
+        pass
+
+def parse_args():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description='DICOM元数据快速提取')
+    parser.add_argument('data_dir', nargs='?', help='包含ZIP/tar病例或DICOM目录的主目录（不提供则弹窗选择）')
+    add_profile_argument(parser)
+    add_progress_arguments(parser)
+    return parser.parse_args()
+
+
 def main():
     """主函数"""
+    args = parse_args()
+    # 只有未提供命令行参数（弹窗模式）时才显示提示框，命令行/被其他脚本调用时保持无界面
+    gui_mode = not args.data_dir
     # 设置路径：命令行参数 > GUI选择 > 默认目录
-    if len(sys.argv) > 1:
-        data_dir = Path(sys.argv[1])
+    if args.data_dir:
+        data_dir = Path(args.data_dir)
         print(f"Using data directory from CLI: {data_dir}")
     else:
         # 尝试GUI选择
@@ -238,8 +250,8 @@ def main():
     if not data_dir.exists() or not data_dir.is_dir():
         error_msg = f"Directory does not exist or is not valid: {data_dir}"
         print(error_msg)
-        if tk is not None:
-            messagebox.showerror("错误", error_msg)
+        if gui_mode:
+            show_message('showerror', "错误", error_msg)
         return
     
     output_dir = data_dir / "output"
@@ -247,19 +259,21 @@ def main():
     
     # 创建输出目录
     output_dir.mkdir(exist_ok=True, parents=True)
+    # 与转换脚本共用ZIP中央目录缓存（转换脚本启动本脚本时已通过环境变量传入同一目录）
+    configure_zip_cache(output_dir / ZIP_INDEX_DIR_NAME)
     
-    # 获取所有ZIP文件和DICOM目录
-    zip_files = sorted(list(data_dir.glob("*.zip")))
+    # 获取所有压缩包和DICOM目录
+    zip_files = find_archives(data_dir)  # ZIP / tar / tar.gz / tar.zst
     dicom_dirs = sorted([d for d in data_dir.iterdir() if d.is_dir() and d.name != 'output'])
     
     total_items = len(zip_files) + len(dicom_dirs)
     
     if total_items == 0:
-        print(f"No ZIP files or DICOM directories found in: {data_dir}")
+        print(f"No archives or DICOM directories found in: {data_dir}")
         return
     
     print(f"\n{'='*60}")
-    print(f"Found {len(zip_files)} ZIP files and {len(dicom_dirs)} directories")
+    print(f"Found {len(zip_files)} archives and {len(dicom_dirs)} directories")
     print(f"Total items to process: {total_items}")
     print(f"{'='*60}\n")
     
@@ -267,22 +281,32 @@ def main():
     all_metadata = []
     success_count = 0
     start_time = datetime.now()
+    profiler = CaseProfiler(args.profile, profile_dir(output_dir, start_time.strftime('%Y%m%d_%H%M%S')))
+    # 目录的大小需要遍历才能得到，这里只按case数估算剩余时间
+    progress = progress_from_args(args, total=total_items)
     
-    # 先处理ZIP文件
+    # 先处理压缩包
     for i, zip_file in enumerate(zip_files, 1):
         print(f"[{i}/{total_items}] ", end='')
-        metadata = process_zip_file_fast(zip_file)
+        with profiler.case(archive_stem(zip_file)):
+            metadata = process_zip_file_fast(zip_file)
         if metadata:
             all_metadata.append(metadata)
             success_count += 1
+        progress.case_done(archive_stem(zip_file), bool(metadata), nbytes=zip_file.stat().st_size)
     
     # 再处理目录
     for j, dicom_dir in enumerate(dicom_dirs, len(zip_files) + 1):
         print(f"[{j}/{total_items}] ", end='')
-        metadata = process_directory(dicom_dir)
+        with profiler.case(dicom_dir.name):
+            metadata = process_directory(dicom_dir)
         if metadata:
             all_metadata.append(metadata)
             success_count += 1
+        progress.case_done(dicom_dir.name, bool(metadata))
+    
+    progress.close()
+    profiler.close()
     
     # 保存结果
     elapsed = (datetime.now() - start_time).total_seconds()
@@ -296,6 +320,7 @@ def main():
     
     if all_metadata:
         # 保存为CSV
+        import pandas as pd
         df = pd.DataFrame(all_metadata)
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         csv_path = output_dir / f"case_metadata_{timestamp}.csv"
@@ -312,9 +337,9 @@ def main():
         print(f"\nAverage processing time: {elapsed/total_items:.2f} seconds per item")
         
         # 显示完成提示
-        if tk is not None:
-            messagebox.showinfo(
-                "完成", 
+        if gui_mode:
+            show_message(
+                'showinfo', "完成",
                 f"已处理 {success_count}/{total_items} 个病例\n"
                 f"  ZIP文件: {len(zip_files)}\n"
                 f"  目录: {len(dicom_dirs)}\n"
@@ -324,8 +349,8 @@ def main():
     else:
         error_msg = "No valid DICOM data found in any ZIP file or directory"
         print(error_msg)
-        if tk is not None:
-            messagebox.showwarning("结果", error_msg)
+        if gui_mode:
+            show_message('showwarning', "结果", error_msg)
 
 if __name__ == "__main__":
     main()